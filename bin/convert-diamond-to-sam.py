@@ -10,11 +10,13 @@ import argparse
 from os.path import join
 from resource import getrlimit, RLIMIT_NOFILE
 from functools import partial
+from itertools import islice
 
 from dark.diamond.conversion import FIELDS
+from dark.civ.proteins import SqliteIndex
 from dark.diamond.sam import (
-    SimpleDiamondSAMWriter, PerReferenceDiamondSAMWriter)
-from dark.proteins import SqliteIndex
+    SimpleDiamondSAMWriter, PerReferenceDiamondSAMWriter,
+    StreamingDiamondSAMWriter)
 
 parser = argparse.ArgumentParser(
     formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -39,6 +41,14 @@ parser.add_argument(
           'output will be stored in RAM and only written out when the full '
           'header can be determined.'))
 
+parser.add_argument(
+    '--streaming', action='store_true', default=False,
+    help=('Write SAM output in a single pass, without holding the non-header '
+          'output in RAM or a temporary file. The SAM header will have an @SQ '
+          'line for every genome in the --genomesProteinsDatabaseFilename '
+          'database (not just those matched). Cannot be used with '
+          '--perReferenceOutput.'))
+
 parser.add_argument(
     '--keepDescriptions', action='store_true', default=False,
     help=('Do not discard text after the first space in query or subject '
@@ -75,6 +85,12 @@ parser.add_argument(
           'The default value is size half the maximum number of open files '
           'will be used.'))
 
+parser.add_argument(
+    '--chunkSize', type=int, default=1000,
+    help=('The number of lines of DIAMOND output to process at once. The '
+          'proteins and genomes matched in each chunk are looked up in the '
+          'database together.'))
+
 args = parser.parse_args()
 
 if args.printFields:
@@ -84,6 +100,11 @@ if args.printFields:
 if 0 > args.mappingQuality > 255:
     raise ValueError('Mapping quality must be between 0 and 255 (inclusive)')
 
+if args.streaming and args.perReferenceOutput:
+    print('--streaming cannot be used with --perReferenceOutput.',
+          file=sys.stderr)
+    sys.exit(1)
+
 genomesProteins = SqliteIndex(args.genomesProteinsDatabaseFilename)
 
 if args.perReferenceOutput:
@@ -108,6 +129,12 @@ if args.perReferenceOutput:
         baseFilenameFunc=referenceTitleToBasename,
         fpcMaxsize=args.filePointerCacheMaxSize)
 
+    save = writer.save
+elif args.streaming:
+    writer = StreamingDiamondSAMWriter(
+        genomesProteins, sys.stdout, mappingQuality=args.mappingQuality,
+        keepDescriptions=args.keepDescriptions)
+
     save = writer.save
 else:
     writer = SimpleDiamondSAMWriter(
@@ -116,9 +143,14 @@ else:
 
     save = partial(writer.save, filename=sys.stdout)
 
-addMatch = writer.addMatch
+addMatches = writer.addMatches
 
-for line in sys.stdin:
-    addMatch(line)
+# Read the DIAMOND output in chunks, so the proteins and genomes matched by
+# the lines in each chunk can be looked up together.
+while True:
+    lines = list(islice(sys.stdin, args.chunkSize))
+    if not lines:
+        break
+    addMatches(lines)
 
 save()
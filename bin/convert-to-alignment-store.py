@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import argparse
+import sys
+
+from dark.alignment_store import SUFFIX
+from dark.blast.conversion import JSONRecordsReader, XMLRecordsReader
+from dark.diamond.conversion import DiamondTabularFormatReader
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description=('Convert BLAST or DIAMOND output to a columnar '
+                     'alignment store.'),
+        epilog=('Give a JSON file (as made by convert-blast-xml-to-json.py '
+                'or convert-diamond-to-json.py), a BLAST XML file, or a '
+                'DIAMOND tabular file and convert it to an alignment store. '
+                'The store can be given to BlastReadsAlignments or '
+                'DiamondReadsAlignments in place of the JSON and is much '
+                'faster to read.'))
+
+    group = parser.add_mutually_exclusive_group(required=True)
+
+    group.add_argument(
+        '--json', metavar='JSON-file',
+        help='A BLAST or DIAMOND JSON file (possibly bzip2 compressed).')
+
+    group.add_argument(
+        '--xml', metavar='BLAST-XML-file',
+        help='A BLAST XML output file.')
+
+    group.add_argument(
+        '--diamond', metavar='DIAMOND-file',
+        help=('A DIAMOND tabular output file. See convert-diamond-to-json.py '
+              'for the required DIAMOND --outfmt 6 fields.'))
+
+    parser.add_argument(
+        '--out', metavar='FILE', required=True,
+        help='The alignment store file to write. Must end in %r.' % SUFFIX)
+
+    args = parser.parse_args()
+
+    if not args.out.endswith(SUFFIX):
+        print('The --out file name must end in %r.' % SUFFIX,
+              file=sys.stderr)
+        sys.exit(1)
+
+    if args.json:
+        # The BLAST JSON reader can also read DIAMOND JSON (whose parameters
+        # also have an 'application' key), and the records are stored as
+        # they are, without interpretation.
+        reader = JSONRecordsReader(args.json)
+    elif args.xml:
+        reader = XMLRecordsReader(args.xml)
+    else:
+        reader = DiamondTabularFormatReader(args.diamond)
+
+    count = reader.saveAsAlignmentStore(args.out)
+    print('Wrote %d record%s to %s.' %
+          (count, '' if count == 1 else 's', args.out), file=sys.stderr)
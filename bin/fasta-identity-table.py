@@ -4,10 +4,10 @@ from __future__ import print_function, division
 
 import sys
 import argparse
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict
 from operator import itemgetter
 
-from dark.dna import compareDNAReads
+from dark.dna import compareDNAReadSets, MATCH_COUNT_NAMES
 from dark.filter import (
     addFASTAFilteringCommandLineOptions, parseFASTAFilteringCommandLineOptions,
     addFASTAEditingCommandLineOptions, parseFASTAEditingCommandLineOptions)
@@ -179,7 +179,37 @@ Key to abbreviations:
     return '\n'.join(result)
 
 
-def collectData(reads1, reads2, square, matchAmbiguous):
+class TableData(object):
+    """
+    Provide access to the pairwise matching statistics of two sets of reads.
+
+    @param counts: A C{dict} of count arrays, as returned by
+        C{compareDNAReadSets}.
+    @param ids1: An iterable of the C{str} read ids of the rows of the
+        arrays in C{counts}.
+    @param ids2: An iterable of the C{str} read ids of the columns of the
+        arrays in C{counts}.
+    """
+    def __init__(self, counts, ids1, ids2):
+        self._counts = counts
+        self._index1 = dict((id_, index) for index, id_ in enumerate(ids1))
+        self._index2 = dict((id_, index) for index, id_ in enumerate(ids2))
+
+    def __getitem__(self, ids):
+        """
+        Get the statistics for a pair of reads.
+
+        @param ids: A 2-C{tuple} of C{str} read ids.
+        @return: A C{dict} with the same keys as the 'match' C{dict}
+            returned by C{compareDNAReads}.
+        """
+        index1 = self._index1[ids[0]]
+        index2 = self._index2[ids[1]]
+        return dict((name, int(self._counts[name][index1, index2]))
+                    for name in MATCH_COUNT_NAMES)
+
+
+def collectData(reads1, reads2, square, matchAmbiguous, workers=None):
     """
     Get pairwise matching statistics for two sets of reads.
 
@@ -194,26 +224,25 @@ def collectData(reads1, reads2, square, matchAmbiguous):
         possibly correct as actually being correct. Otherwise, we are strict
         and insist that only non-ambiguous nucleotides can contribute to the
         matching nucleotide count.
+    @param workers: If not C{None}, the C{int} number of worker processes to
+        use to do the comparisons.
+    @return: A C{TableData} instance.
     """
-    result = defaultdict(dict)
-    for id1, read1 in reads1.items():
-        for id2, read2 in reads2.items():
-            if id1 != id2 or not square:
-                match = compareDNAReads(
-                    read1, read2, matchAmbiguous=matchAmbiguous)['match']
-                if not matchAmbiguous:
-                    assert match['ambiguousMatchCount'] == 0
-                result[id1][id2] = result[id2][id1] = match
+    counts = compareDNAReadSets(
+        reads1.values(), None if square else reads2.values(),
+        matchAmbiguous=matchAmbiguous, workers=workers)
+    if not matchAmbiguous:
+        assert not counts['ambiguousMatchCount'].any()
 
-    return result
+    return TableData(counts, reads1, reads2)
 
 
 def simpleTable(tableData, reads1, reads2, square, matchAmbiguous, gapChars):
     """
     Make a text table showing inter-sequence distances.
 
-    @param tableData: A C{defaultdict(dict)} keyed by read ids, whose values
-        are the dictionaries returned by compareDNAReads.
+    @param tableData: A C{TableData} instance, as returned by
+        C{collectData}.
     @param reads1: An C{OrderedDict} of C{str} read ids whose values are
         C{Read} instances. These will be the rows of the table.
     @param reads2: An C{OrderedDict} of C{str} read ids whose values are
@@ -237,7 +266,7 @@ def simpleTable(tableData, reads1, reads2, square, matchAmbiguous, gapChars):
             if id1 == id2 and square:
                 print('\t', end='')
             else:
-                stats = tableData[id1][id2]
+                stats = tableData[id1, id2]
                 identity = (
                     stats['identicalMatchCount'] +
                     (stats['ambiguousMatchCount'] if matchAmbiguous else 0)
@@ -252,8 +281,8 @@ def htmlTable(tableData, reads1, reads2, square, matchAmbiguous, colors,
     """
     Make an HTML table showing inter-sequence distances.
 
-    @param tableData: A C{defaultdict(dict)} keyed by read ids, whose values
-        are the dictionaries returned by compareDNAReads.
+    @param tableData: A C{TableData} instance, as returned by
+        C{collectData}.
     @param reads1: An C{OrderedDict} of C{str} read ids whose values are
         C{Read} instances. These will be the rows of the table.
     @param reads2: An C{OrderedDict} of C{str} read ids whose values are
@@ -357,7 +386,7 @@ def htmlTable(tableData, reads1, reads2, square, matchAmbiguous, colors,
         bestIdentity = -1.0
         for id2, read2 in reads2.items():
             if id1 != id2 or not square:
-                stats = tableData[id1][id2]
+                stats = tableData[id1, id2]
                 identity = (
                     stats['identicalMatchCount'] +
                     (stats['ambiguousMatchCount'] if matchAmbiguous else 0)
@@ -385,7 +414,7 @@ def htmlTable(tableData, reads1, reads2, square, matchAmbiguous, colors,
                 append('<td>&nbsp;</td>')
                 continue
 
-            stats = tableData[id1][id2]
+            stats = tableData[id1, id2]
             identity = (
                 stats['identicalMatchCount'] +
                 (stats['ambiguousMatchCount'] if matchAmbiguous else 0)
@@ -503,6 +532,11 @@ if __name__ == '__main__':
               'default is to color all cells with the --defaultColor color. '
               'This option is ignored if --text is given.'))
 
+    parser.add_argument(
+        '--workers', type=int, metavar='N',
+        help=('The number of worker processes to use to compare the '
+              'sequences.'))
+
     addFASTACommandLineOptions(parser)
     addFASTAFilteringCommandLineOptions(parser)
     addFASTAEditingCommandLineOptions(parser)
@@ -535,7 +569,8 @@ if __name__ == '__main__':
         reads2 = reads1
 
     matchAmbiguous = not args.strict
-    tableData = collectData(reads1, reads2, square, matchAmbiguous)
+    tableData = collectData(reads1, reads2, square, matchAmbiguous,
+                            workers=args.workers)
 
     if args.text:
         simpleTable(tableData, reads1, reads2, square, matchAmbiguous,
@@ -34,6 +34,12 @@ if __name__ == '__main__':
               'not seen, the script exits with status 1 and an error '
               'message is printed unless --quiet was used.'))
 
+    parser.add_argument(
+        '--workers', type=int, metavar='N',
+        help=('The number of worker processes to use for filtering. Order is '
+              'preserved and the result is the same as when filtering '
+              'without workers. --randomSubset is never done in parallel.'))
+
     addFASTACommandLineOptions(parser)
     addFASTAFilteringCommandLineOptions(parser)
     addFASTAEditingCommandLineOptions(parser)
@@ -46,7 +52,8 @@ if __name__ == '__main__':
     # is given.
     reads = parseFASTAEditingCommandLineOptions(
         args, parseFASTAFilteringCommandLineOptions(
-            args, parseFASTACommandLineOptions(args)))
+            args, parseFASTACommandLineOptions(args), workers=args.workers),
+        workers=args.workers)
 
     saveAs = (
         args.saveAs or
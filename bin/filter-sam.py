@@ -3,12 +3,11 @@
 from __future__ import print_function, division
 
 import sys
-from pysam import AlignmentFile
 
 from dark.filter import (
     addFASTAFilteringCommandLineOptions, parseFASTAFilteringCommandLineOptions)
 from dark.reads import Reads
-from dark.sam import samfile, SAMFilter
+from dark.sam import samfile, SAMFilter, SAMWriter
 
 
 if __name__ == '__main__':
@@ -17,16 +16,41 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description=('Given a SAM/BAM file and a set of filtering criteria '
-                     'write filtered SAM/BAM to stdout.'))
+                     'write filtered SAM/BAM/CRAM to stdout (or a file).'))
 
     parser.add_argument(
         '--quiet', action='store_true', default=False,
         help='If True, do not print the final summary.')
 
-    parser.add_argument(
-        '--bam', action='store_const', const='b', default='',
+    group = parser.add_mutually_exclusive_group()
+
+    group.add_argument(
+        '--bam', action='store_true', default=False,
         help='If given, write (gzip compressed) BAM output.')
 
+    group.add_argument(
+        '--cram', action='store_true', default=False,
+        help='If given, write CRAM output (see --referenceFasta).')
+
+    parser.add_argument(
+        '--out', default='-', metavar='FILE',
+        help='The file to write output to. Use - for standard output.')
+
+    parser.add_argument(
+        '--threads', type=int, default=1, metavar='N',
+        help='The number of threads to use to compress BAM or CRAM output.')
+
+    parser.add_argument(
+        '--index', action='store_true', default=False,
+        help=('If given, index the output file once it has been written. '
+              'This requires --bam or --cram and --out, and that the input '
+              'file is sorted by coordinate.'))
+
+    parser.add_argument(
+        '--referenceFasta', metavar='FILE',
+        help=('The FASTA file of the reference sequences, for use with '
+              '--cram.'))
+
     parser.add_argument(
         '--checkResultCount', type=int,
         help=('The number of alignments expected in the output. If this '
@@ -37,9 +61,17 @@ if __name__ == '__main__':
     SAMFilter.addFilteringOptions(parser)
 
     args = parser.parse_args()
+
+    if args.index and not ((args.bam or args.cram) and args.out != '-'):
+        print('--index can only be used with --bam or --cram and --out.',
+              file=sys.stderr)
+        sys.exit(1)
+
+    format_ = 'bam' if args.bam else ('cram' if args.cram else 'sam')
+
     reads = parseFASTAFilteringCommandLineOptions(args, Reads())
-    samFilter = SAMFilter.parseFilteringOptions(args, reads.filterRead,
-                                                storeQueryIds=True)
+    samFilter = SAMFilter.parseFilteringOptions(
+        args, filterQuery=reads.filterAlignment, storeQueryIds=True)
 
     # The following 'if' has a False in it to make it always fail. That's
     # because pysam issue 716 (see below) did not fix the problem as I had
@@ -80,17 +112,13 @@ if __name__ == '__main__':
                     file=sys.stderr)
 
         header['SQ'] = sequences
-        out = AlignmentFile(sys.stdout, mode='w' + args.bam, header=header)
     else:
-        with samfile(args.samfile) as sam:
-            out = AlignmentFile(sys.stdout, mode='w' + args.bam, template=sam)
-
-    save = out.write
-    kept = 0
-    for kept, alignment in enumerate(samFilter.alignments(), start=1):
-        save(alignment)
+        header = None
 
-    out.close()
+    with SAMWriter(args.out, args.samfile, header=header, format_=format_,
+                   threads=args.threads, index=args.index,
+                   referenceFilename=args.referenceFasta) as writer:
+        kept = writer.writeAlignments(samFilter.alignments())
 
     if not args.quiet:
         total = samFilter.alignmentCount
@@ -6,12 +6,14 @@ import sys
 import argparse
 from itertools import chain
 
+import numpy as np
+
 from dark.civ.proteins import SqliteIndex
 from dark.errors import NoSuchGenomeError
 from dark.filter import (
     addFASTAFilteringCommandLineOptions, parseFASTAFilteringCommandLineOptions)
 from dark.genbank import GenomeRanges
-from dark.genomes import GenomeProteinInfo
+from dark.genomes import GenomeProteinInfo, addSAMToGenomes
 from dark.reads import Reads
 from dark.sam import SAMFilter, samReferences
 from dark.utils import pct
@@ -34,7 +36,7 @@ def summarize(gpi, sortOn, minReadOffsetCount):
     print('  Length: %d' % genome['length'])
     print('  Protein count: %d' % genome['proteinCount'])
     print('  Total protein offsets: %s' % (
-        pct(len(gpi.offsets), genome['length'])))
+        pct(len(gpi.proteinOffsets), genome['length'])))
 
     if gpi.samFiles:
         print('  SAM files analyzed: %d' % len(gpi.samFiles))
@@ -43,26 +45,26 @@ def summarize(gpi, sortOn, minReadOffsetCount):
     else:
         return
 
+    depth = gpi.depth()
     print('  Whole genome coverage (not just proteins):')
     print('    Reads matching genome: %d' % len(gpi.readIdsMatchingGenome))
     print('    Covered genome offsets: %s' % (
-        pct(len(gpi.coveredOffsetCount), genome['length'])))
+        pct(np.count_nonzero(depth), genome['length'])))
     print('    Average depth across genome: %.3f' % (
-        sum(gpi.coveredOffsetCount.values()) / genome['length']))
+        depth.sum() / genome['length']))
 
-    coveredProteinOffsetCount = coveredProteinBasesCount = 0
-    for offset in gpi.offsets:
-        coveredProteinOffsetCount += bool(gpi.coveredOffsetCount[offset])
-        coveredProteinBasesCount += gpi.coveredOffsetCount[offset]
+    proteinDepth = depth[gpi.proteinOffsets]
+    coveredProteinOffsetCount = np.count_nonzero(proteinDepth)
+    coveredProteinBasesCount = proteinDepth.sum()
 
     print('  Total protein coverage (irrespective of minReadOffsetCount):')
     print('    Reads matching proteins: %d' % len(gpi.readIdsForAllProteins()))
     print('    Proteins with any coverage: %s' %
           pct(len(gpi.coveredProteins), genome['proteinCount']))
     print('    Covered protein offsets: %s' % (
-        pct(coveredProteinOffsetCount, len(gpi.offsets))))
+        pct(coveredProteinOffsetCount, len(gpi.proteinOffsets))))
     print('    Average depth across proteins: %.3f' % (
-        coveredProteinBasesCount / len(gpi.offsets)))
+        coveredProteinBasesCount / len(gpi.proteinOffsets)))
 
     if sortOn == 'name':
         def key(proteinAccession):
@@ -193,28 +195,33 @@ if __name__ == '__main__':
     # We don't have a file of reads, we just want a read filter that we
     # can use to filter the SAM file query sequences.
     reads = parseFASTAFilteringCommandLineOptions(args, Reads())
-    samFilter = SAMFilter.parseFilteringOptions(args, reads.filterRead)
+    samFilter = SAMFilter.parseFilteringOptions(
+        args, filterQuery=reads.filterAlignment)
     filterAlignment = samFilter.filterAlignment
 
     proteinGenomeDB = SqliteIndex(args.proteinGenomeDatabase)
 
+    gpInfos = []
     for referenceId in referenceIds:
         try:
-            gpInfo = GenomeProteinInfo(
+            gpInfos.append(GenomeProteinInfo(
                 referenceId, proteinGenomeDB,
-                checkTranslations=args.checkTranslations)
+                checkTranslations=args.checkTranslations))
         except NoSuchGenomeError:
             print('Reference %r not found in genome database. Ignoring.' %
                   referenceId, file=sys.stderr)
-        else:
-            if samfiles:
-                if args.progress:
-                    print('Processing %d SAM file%s for matches with %r:' %
-                          (len(samfiles), '' if len(samfiles) == 1 else 's',
-                           referenceId), file=sys.stderr)
-                for i, filename in enumerate(samfiles, start=1):
-                    if args.progress:
-                        print('  %d: %s' % (i, filename), file=sys.stderr)
-                    gpInfo.addSAM(filename, filterAlignment)
-
-            summarize(gpInfo, args.sortOn, args.minReadOffsetCount)
+
+    if samfiles and gpInfos:
+        if args.progress:
+            print('Processing %d SAM file%s for matches with %s:' %
+                  (len(samfiles), '' if len(samfiles) == 1 else 's',
+                   ', '.join(repr(gpInfo.genomeAccession)
+                             for gpInfo in gpInfos)), file=sys.stderr)
+        # Read each SAM file just once, for all genomes.
+        for i, filename in enumerate(samfiles, start=1):
+            if args.progress:
+                print('  %d: %s' % (i, filename), file=sys.stderr)
+            addSAMToGenomes(gpInfos, filename, filterAlignment)
+
+    for gpInfo in gpInfos:
+        summarize(gpInfo, args.sortOn, args.minReadOffsetCount)
@@ -9,7 +9,7 @@ from __future__ import print_function
 import argparse
 
 from dark.fasta import FastaReads
-from dark.local_align import LocalAlignment
+from dark.local_align import alignToReference
 
 
 parser = argparse.ArgumentParser(
@@ -37,18 +37,32 @@ parser.add_argument(
     '--gapExtendScore', type=int, default=-1, help='The gap extend score.')
 
 parser.add_argument(
-    '--gapExtendDecay', type=float, default=0.0, help='The gap extend decay.')
+    '--gapExtendDecay', type=float, default=0.0,
+    help=('The gap extend decay. If this is non-zero, a much slower '
+          'alignment algorithm is used.'))
+
+parser.add_argument(
+    '--band', type=int,
+    help=('If given, only compute alignments in which the offsets of aligned '
+          'nucleotides in the two sequences differ by at most this much. '
+          'Use this to quickly align long similar sequences.'))
+
+parser.add_argument(
+    '--workers', type=int,
+    help=('The number of processes to use to align the sequences in the '
+          'second file against each sequence in the first.'))
 
 args = parser.parse_args()
 
 for seq1 in FastaReads(args.fastaFile1):
-    for seq2 in FastaReads(args.fastaFile2):
-        alignment = LocalAlignment(
-            seq1, seq2,
+    for result in alignToReference(
+            seq1, FastaReads(args.fastaFile2),
             match=args.matchScore,
             mismatch=args.mismatchScore,
             gap=args.gapOpenScore,
             gapExtend=args.gapExtendScore,
-            gapExtendDecay=args.gapExtendDecay)
-
-        print(alignment.createAlignment(resultFormat=str))
+            gapExtendDecay=args.gapExtendDecay,
+            band=args.band,
+            resultFormat=str,
+            workers=args.workers):
+        print(result)
@@ -320,6 +320,24 @@ if __name__ == '__main__':
               'the results in the files from HTCondor does not match the '
               'order of sequences in the FASTA/Q file.'))
 
+    parser.add_argument(
+        '--decompressionWorkers', type=int,
+        help=('The number of processes to use to decompress and parse each '
+              'compressed (.bz2 or .gz) JSON file. This only helps for files '
+              'made of many bzip2 streams or gzip members (e.g., as made by '
+              'pbzip2 or bgzip).'))
+
+    parser.add_argument(
+        '--fileWorkers', type=int,
+        help=('The number of processes to use to read the JSON files '
+              'concurrently. Requires --readsPerFile.'))
+
+    parser.add_argument(
+        '--readsPerFile', type=int,
+        help=('The number of reads whose records are in each JSON file '
+              '(e.g., as given to write-htcondor-job-spec.py with '
+              '--seqs-per-blast). The last file may have fewer.'))
+
     parser.add_argument(
         '--titlesJSONFile',
         help=('Give a file name for JSON holding information about titles to '
@@ -361,7 +379,9 @@ if __name__ == '__main__':
             reads, jsonFiles, databaseFilename=args.databaseFastaFilename,
             databaseDirectory=args.databaseFastaDirectory,
             sqliteDatabaseFilename=args.sqliteDatabaseFilename,
-            sortBlastFilenames=args.sortFilenames)
+            sortBlastFilenames=args.sortFilenames,
+            decompressionWorkers=args.decompressionWorkers,
+            fileWorkers=args.fileWorkers, readsPerFile=args.readsPerFile)
     else:
         # Must be 'diamond' (due to parser.add_argument 'choices' argument).
         if args.showOrfs:
@@ -391,7 +411,9 @@ if __name__ == '__main__':
             reads, jsonFiles, sortFilenames=args.sortFilenames,
             databaseFilename=args.databaseFastaFilename,
             databaseDirectory=args.databaseFastaDirectory,
-            sqliteDatabaseFilename=args.sqliteDatabaseFilename)
+            sqliteDatabaseFilename=args.sqliteDatabaseFilename,
+            decompressionWorkers=args.decompressionWorkers,
+            fileWorkers=args.fileWorkers, readsPerFile=args.readsPerFile)
 
     readsAlignments.filter(
         maxAlignmentsPerRead=args.maxAlignmentsPerRead,
@@ -4,13 +4,14 @@ from __future__ import print_function
 
 import sys
 import argparse
-from collections import Counter
 from numpy import std
 
 from dark.filter import (
-    addFASTAFilteringCommandLineOptions, parseFASTAFilteringCommandLineOptions)
+    addFASTAFilteringCommandLineOptions, parseFASTAFilteringCommandLineOptions,
+    filteringCommandLineOptionsKey)
 from dark.reads import Reads
-from dark.sam import samfile, SAMFilter, samReferences, UnknownReference
+from dark.sam import (
+    SAMFilter, SAMBaseCounts, SAMStats, samReferences, UnknownReference)
 from dark.utils import baseCountsToStr, pct
 
 
@@ -37,6 +38,22 @@ parser.add_argument(
           'that is provided by the SAMFilter.addFilteringOptions will be '
           'silently ignored!'))
 
+parser.add_argument(
+    '--minBaseQuality', type=int, default=13,
+    help='The minimum quality of a query nucleotide for it to be counted.')
+
+parser.add_argument(
+    '--includeOrphans', default=False, action='store_true',
+    help=('Count alignments of paired reads that are not mapped in a proper '
+          'pair. By default (as in pysam\'s pileup) these are ignored.'))
+
+parser.add_argument(
+    '--statsCache', default=False, action='store_true',
+    help=('Read the coverage statistics from a cache file next to the '
+          'SAM/BAM file, if it is up to date with the file and the filtering '
+          'options. Otherwise, compute them and write the cache file. Can '
+          'only be used with --noOffsets.'))
+
 args = parser.parse_args()
 
 if args.noOffsets and args.noStats:
@@ -44,11 +61,17 @@ if args.noOffsets and args.noStats:
           'output!', file=sys.stderr)
     sys.exit(1)
 
+if args.statsCache and not args.noOffsets:
+    print('The statistics cache (--statsCache) does not hold per-offset '
+          'base counts, so --noOffsets must also be used.', file=sys.stderr)
+    sys.exit(1)
+
 
 # We don't have a file of reads, we just want a read filter that we can use
 # to filter the SAM file query sequences and to get reference lengths from.
 reads = parseFASTAFilteringCommandLineOptions(args, Reads())
-samFilter = SAMFilter.parseFilteringOptions(args, reads.filterRead)
+samFilter = SAMFilter.parseFilteringOptions(
+    args, filterQuery=reads.filterAlignment)
 
 printOffsets = not args.noOffsets
 printStats = not args.noStats
@@ -71,51 +94,57 @@ except UnknownReference:
     sys.exit(1)
 
 
+if samFilter.referenceIds:
+    # No need to check if the given reference id is in referenceLengths
+    # because the samFilter.referenceLengths call above catches that.
+    referenceId = list(samFilter.referenceIds)[0]
+else:
+    if len(referenceLengths) == 1:
+        referenceId = list(referenceLengths)[0]
+    else:
+        print('SAM file %r contains %d references (%s). Only one '
+              'reference id can be analyzed at a time. Please use '
+              '--referenceId to specify the one you want examined.' % (
+                  args.samfile, len(referenceLengths),
+                  ', '.join(sorted(referenceLengths))), file=sys.stderr)
+        sys.exit(1)
+
 if args.noFilter:
     # Do not do our custom SAM filtering.
-    def filterRead(read):
-        return not (read.is_del or read.is_refskip)
+    samFilter = SAMFilter(args.samfile, referenceIds={referenceId},
+                          workers=args.workers, regionSize=args.regionSize)
 else:
-    def filterRead(read):
-        return (not (read.is_del or read.is_refskip) and
-                samFilter.filterAlignment(read.alignment))
-
-
-if printStats:
-    counts = []
+    samFilter.referenceIds = {referenceId}
+
+# Like samtools (and pysam's pileup), ignore secondary and duplicate
+# alignments. Orphan alignments are also ignored (unless --includeOrphans is
+# used) and only one mate is counted where the mates of a pair overlap.
+samFilter.dropSecondary = samFilter.dropDuplicates = True
+
+if args.statsCache:
+    stats = SAMStats(
+        samFilter,
+        filterKey=None if args.noFilter else filteringCommandLineOptionsKey(
+            args),
+        minBaseQuality=args.minBaseQuality,
+        ignoreOrphans=not args.includeOrphans, ignoreOverlaps=True)
+    # The depths of the sites covered by at least one alignment, in
+    # increasing order.
+    counts = stats.depths(referenceId)
+else:
+    baseCounts = SAMBaseCounts(samFilter, minBaseQuality=args.minBaseQuality,
+                               ignoreOrphans=not args.includeOrphans,
+                               ignoreOverlaps=True)
 
-with samfile(args.samfile) as sam:
+    # The sites covered by at least one alignment (even if the alignment
+    # has a deletion there or none of the nucleotides there are counted).
+    coveredSites = baseCounts.coveredSites(referenceId)
+    counts = baseCounts.depth(referenceId)[coveredSites]
 
-    if samFilter.referenceIds:
-        # No need to check if the given reference id is in referenceLengths
-        # because the samFilter.referenceLengths call above catches that.
-        referenceId = samFilter.referenceIds.pop()
-    else:
-        if len(referenceLengths) == 1:
-            referenceId = list(referenceLengths)[0]
-        else:
-            print('SAM file %r contains %d references (%s). Only one '
-                  'reference id can be analyzed at a time. Please use '
-                  '--referenceId to specify the one you want examined.' % (
-                      args.samfile, len(referenceLengths),
-                      ', '.join(sorted(referenceLengths))), file=sys.stderr)
-            sys.exit(1)
-
-    for column in sam.pileup(reference=referenceId):
-        bases = Counter()
-        for read in column.pileups:
-            if filterRead(read):
-                base = read.alignment.query_sequence[read.query_position]
-                bases[base] += 1
-
-        baseCount = sum(bases.values())
-
-        if printStats:
-            counts.append(baseCount)
-
-        if printOffsets:
-            print('%d: %d %s' % (column.reference_pos + 1, baseCount,
-                                 baseCountsToStr(bases)))
+if printOffsets:
+    for site, baseCount in zip(coveredSites, counts):
+        print('%d: %d %s' % (site + 1, baseCount, baseCountsToStr(
+            baseCounts.baseCounts(referenceId, site))))
 
 if printStats:
     referenceLength = referenceLengths[referenceId]
@@ -124,12 +153,12 @@ if printStats:
     print('Bases covered: %s' % pct(len(counts), referenceLength))
     print('Min coverage depth: %d' % (
         0 if len(counts) < referenceLength else min(counts)))
-    if counts:
+    if len(counts):
         # Don't use Python3 default= option on max. Trying to keep Python 2
         # compatibility.
         print('Max coverage depth: %d' % max(counts))
     else:
         print('Max coverage depth: 0')
     print('Mean coverage depth: %.3f' % (sum(counts) / referenceLength))
-    if counts:
+    if len(counts):
         print('Coverage depth s.d.: %.3f' % std(counts))
@@ -3,12 +3,12 @@
 from __future__ import print_function
 
 import argparse
-from collections import defaultdict, Counter
 
 from dark.filter import (
-    addFASTAFilteringCommandLineOptions, parseFASTAFilteringCommandLineOptions)
+    addFASTAFilteringCommandLineOptions, parseFASTAFilteringCommandLineOptions,
+    filteringCommandLineOptionsKey)
 from dark.reads import Reads
-from dark.sam import samfile, SAMFilter
+from dark.sam import SAMFilter, SAMBaseCounts, SAMStats
 
 parser = argparse.ArgumentParser(
     formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -21,6 +21,21 @@ parser.add_argument(
           'that is provided by the SAMFilter.addFilteringOptions will be '
           'silently ignored!'))
 
+parser.add_argument(
+    '--minBaseQuality', type=int, default=13,
+    help='The minimum quality of a query nucleotide for it to be counted.')
+
+parser.add_argument(
+    '--includeOrphans', default=False, action='store_true',
+    help=('Count alignments of paired reads that are not mapped in a proper '
+          'pair. By default (as in pysam\'s pileup) these are ignored.'))
+
+parser.add_argument(
+    '--statsCache', default=False, action='store_true',
+    help=('Read the coverage statistics from a cache file next to the '
+          'SAM/BAM file, if it is up to date with the file and the filtering '
+          'options. Otherwise, compute them and write the cache file.'))
+
 addFASTAFilteringCommandLineOptions(parser)
 SAMFilter.addFilteringOptions(parser, samfileIsPositional=True)
 
@@ -28,39 +43,53 @@ args = parser.parse_args()
 
 if args.noFilter:
     # Do not do our custom SAM filtering.
-    def filterRead(read):
-        return True
+    samFilter = SAMFilter(
+        args.samfile,
+        referenceIds=set(args.referenceId) if args.referenceId else None,
+        workers=args.workers, regionSize=args.regionSize)
 else:
-    def filterRead(read):
-        return (not (read.is_del or read.is_refskip) and
-                samFilter.filterAlignment(read.alignment))
-
-# We don't have a file of reads, we just want a read filter that we can use
-# to filter the SAM file query sequences and to get reference lengths from.
-reads = parseFASTAFilteringCommandLineOptions(args, Reads())
-samFilter = SAMFilter.parseFilteringOptions(args, reads.filterRead)
+    # We don't have a file of reads, we just want a read filter that we can
+    # use to filter the SAM file query sequences and to get reference
+    # lengths from.
+    reads = parseFASTAFilteringCommandLineOptions(args, Reads())
+    samFilter = SAMFilter.parseFilteringOptions(
+        args, filterQuery=reads.filterAlignment)
 
-coveredOffsets = defaultdict(Counter)
-coveringReads = defaultdict(set)
+# Like samtools (and pysam's pileup), ignore secondary and duplicate
+# alignments. Orphan alignments are also ignored (unless --includeOrphans is
+# used) and only one mate is counted where the mates of a pair overlap.
+samFilter.dropSecondary = samFilter.dropDuplicates = True
 
-with samfile(args.samfile) as sam:
-    for column in sam.pileup():
-        referenceOffset = column.reference_pos
-        for read in column.pileups:
-            if filterRead(read):
-                referenceId = read.alignment.reference_name
-                coveredOffsets[referenceId][referenceOffset] += 1
-                coveringReads[referenceId].add(read.alignment.query_name)
-
-referenceLengths = samFilter.referenceLengths()
+if args.statsCache:
+    stats = SAMStats(
+        samFilter,
+        filterKey=None if args.noFilter else filteringCommandLineOptionsKey(
+            args),
+        minBaseQuality=args.minBaseQuality,
+        ignoreOrphans=not args.includeOrphans, ignoreOverlaps=True)
+    referenceLengths = stats.referenceLengths
+    coveringReadCounts = stats.coveringReadCounts
+    depth = stats.depths
+else:
+    baseCounts = SAMBaseCounts(samFilter, storeQueryIds=True,
+                               minBaseQuality=args.minBaseQuality,
+                               ignoreOrphans=not args.includeOrphans,
+                               ignoreOverlaps=True)
+    referenceLengths = baseCounts.referenceLengths
+    coveringReadCounts = dict(
+        (referenceId, len(queryIds))
+        for referenceId, queryIds in baseCounts.queryIds.items())
+    depth = baseCounts.depth
 
 for referenceId in sorted(referenceLengths):
-    offsetsCovered = len(coveredOffsets[referenceId])
+    referenceDepth = depth(referenceId)
+    coveredDepth = referenceDepth[referenceDepth > 0]
+    offsetsCovered = len(coveredDepth)
     referenceLength = referenceLengths[referenceId]
     print('%s: length %d, covering reads %d, covered sites %d (%.4f%%), '
           'mean coverage depth %.4f (min: %d, max: %d)' %
-          (referenceId, referenceLength, len(coveringReads[referenceId]),
+          (referenceId, referenceLength, coveringReadCounts[referenceId],
            offsetsCovered, offsetsCovered / referenceLength * 100.0,
-           sum(coveredOffsets[referenceId].values()) / referenceLength,
-           min(coveredOffsets[referenceId].values(), default=0),
-           max(coveredOffsets[referenceId].values(), default=0)))
+           referenceDepth.sum() / referenceLength,
+           coveredDepth.min() if offsetsCovered else 0,
+           coveredDepth.max() if offsetsCovered else 0))
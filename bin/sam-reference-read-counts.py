@@ -6,7 +6,8 @@ import sys
 import argparse
 from collections import defaultdict
 
-from dark.sam import samfile, SAMFilter
+from dark.sam import (
+    SAMFilter, SAMStats, mapSAMRegions, regionAlignments)
 from dark.utils import pct
 
 
@@ -27,6 +28,50 @@ def referenceInfo():
     }
 
 
+def regionReadCounts(sam, region):
+    """
+    Collect the ids of the reads in a region of a SAM/BAM file.
+
+    @param sam: A C{pysam.AlignmentFile} instance.
+    @param region: A (referenceId, start, end) C{tuple}, or C{None} to
+        examine the whole file.
+    @return: A 4-C{tuple} with a C{dict} of C{referenceInfo} C{dict}s keyed
+        by reference id, and C{set}s of the mapped, unmapped, and all read
+        ids.
+    """
+    referenceReads = defaultdict(referenceInfo)
+    mapped = set()
+    unmapped = set()
+    readIds = set()
+
+    for read in regionAlignments(sam, region):
+        id_ = read.query_name
+        readIds.add(id_)
+        if read.is_unmapped:
+            unmapped.add(id_)
+        else:
+            mapped.add(id_)
+            stats = referenceReads[read.reference_name]
+            stats['readIds'].add(id_)
+
+            if read.is_secondary:
+                stats['secondary'].add(id_)
+            elif read.is_supplementary:
+                stats['supplementary'].add(id_)
+            else:
+                stats['primary'].add(id_)
+
+            if read.is_duplicate:
+                stats['duplicate'].add(id_)
+            else:
+                stats['nonDuplicate'].add(id_)
+
+            if read.is_qcfail:
+                stats['qcFail'].add(id_)
+
+    return referenceReads, mapped, unmapped, readIds
+
+
 def main(args):
     """
     Print SAM/BAM file reference read counts.
@@ -39,70 +84,82 @@ def main(args):
               'count', file=sys.stderr)
         sys.exit(1)
 
-    referenceReads = defaultdict(referenceInfo)
-    mapped = set()
-    unmapped = set()
-    readIds = set()
-
-    referenceLengths = SAMFilter(args.samFile).referenceLengths()
-
-    with samfile(args.samFile) as fp:
-        for read in fp.fetch():
-            id_ = read.query_name
-            readIds.add(id_)
-            if read.is_unmapped:
-                unmapped.add(id_)
-            else:
-                mapped.add(id_)
-                stats = referenceReads[read.reference_name]
-                stats['readIds'].add(id_)
-
-                if read.is_secondary:
-                    stats['secondary'].add(id_)
-                elif read.is_supplementary:
-                    stats['supplementary'].add(id_)
-                else:
-                    stats['primary'].add(id_)
-
-                if read.is_duplicate:
-                    stats['duplicate'].add(id_)
-                else:
-                    stats['nonDuplicate'].add(id_)
+    if args.statsCache:
+        stats = SAMStats(SAMFilter(args.samFile, keepQCFailures=True,
+                                   workers=args.workers,
+                                   regionSize=args.regionSize))
+        referenceLengths = stats.referenceLengths
+        totalReads = stats.readCount
+        mappedCount = stats.mappedCount
+        unmappedCount = stats.unmappedCount
+        readCounts = stats.referenceReadCounts
 
-                if read.is_qcfail:
-                    stats['qcFail'].add(id_)
+        def referenceReadIds(referenceId):
+            return set(stats.readIndices(referenceId))
 
-    totalReads = len(readIds)
+        readIdsToStr = stats.readIds
+    else:
+        referenceReads = defaultdict(referenceInfo)
+        mapped = set()
+        unmapped = set()
+        readIds = set()
+
+        referenceLengths = SAMFilter(args.samFile).referenceLengths()
+
+        for (regionReferenceReads, regionMapped, regionUnmapped,
+             regionReadIds) in mapSAMRegions(args.samFile, regionReadCounts,
+                                             args.workers, args.regionSize):
+            for referenceId, regionStats in regionReferenceReads.items():
+                stats = referenceReads[referenceId]
+                for key, ids in regionStats.items():
+                    stats[key].update(ids)
+            mapped.update(regionMapped)
+            unmapped.update(regionUnmapped)
+            readIds.update(regionReadIds)
+
+        totalReads = len(readIds)
+        mappedCount = len(mapped)
+        unmappedCount = len(unmapped)
+        readCounts = dict(
+            (referenceId, dict((key, len(ids)) for key, ids in stats.items()))
+            for referenceId, stats in referenceReads.items())
+
+        def referenceReadIds(referenceId):
+            return referenceReads[referenceId]['readIds']
+
+        def readIdsToStr(readIds):
+            return readIds
 
     print('Found a total of %d read%s (%d mapped, %d unmapped) mapping '
           'against %d of %d reference%s.' %
           (totalReads, '' if totalReads == 1 else 's',
-           len(mapped), len(unmapped),
-           len(referenceReads), len(referenceLengths),
+           mappedCount, unmappedCount,
+           len(readCounts), len(referenceLengths),
            '' if len(referenceLengths) == 1 else 's'))
 
     if args.sortBy == 'count':
 
         def key(referenceId):
-            return len(referenceReads[referenceId]['readIds'])
+            return readCounts[referenceId]['readIds']
 
-        sortedReferenceReads = sorted(referenceReads, key=key, reverse=True)
+        sortedReferenceReads = sorted(readCounts, key=key, reverse=True)
         topReference = sortedReferenceReads[0]
     else:
         # Sort the references by name
-        sortedReferenceReads = sorted(referenceReads)
+        sortedReferenceReads = sorted(readCounts)
 
     cumulativeReadIds = set()
 
     for count, referenceId in enumerate(sortedReferenceReads, start=1):
-        stats = referenceReads[referenceId]
-        readCount = len(stats['readIds'])
+        counts = readCounts[referenceId]
+        readCount = counts['readIds']
         if readCount == 0 and args.excludeZeroes:
             continue
-        newReadCount = len(stats['readIds'] - cumulativeReadIds)
+        readIds = referenceReadIds(referenceId)
+        newReadCount = len(readIds - cumulativeReadIds)
         if newReadCount == 0 and args.excludeIfNoAdditional:
             continue
-        cumulativeReadIds.update(stats['readIds'])
+        cumulativeReadIds.update(readIds)
         print('\nReference %d: %s (%d nt):\n'
               '  Overall reads mapped to the reference: %s\n'
               '  Non-duplicates: %s, Duplicates: %s, QC fails: %s\n'
@@ -111,20 +168,20 @@ def main(args):
               '  Previously unmatched reads for this reference: %s' %
               (count, referenceId, referenceLengths[referenceId],
                pct(readCount, totalReads),
-               pct(len(stats['nonDuplicate']), readCount),
-               pct(len(stats['duplicate']), readCount),
-               pct(len(stats['qcFail']), readCount),
-               pct(len(stats['primary']), readCount),
-               pct(len(stats['secondary']), readCount),
-               pct(len(stats['supplementary']), readCount),
+               pct(counts['nonDuplicate'], readCount),
+               pct(counts['duplicate'], readCount),
+               pct(counts['qcFail'], readCount),
+               pct(counts['primary'], readCount),
+               pct(counts['secondary'], readCount),
+               pct(counts['supplementary'], readCount),
                pct(newReadCount, totalReads),
                pct(newReadCount, readCount)))
 
     # Write out the (sorted) read ids of the reference with the most reads.
     if args.topReferenceIdsFile:
         with open(args.topReferenceIdsFile, 'w') as fp:
-            print('\n'.join(sorted(referenceReads[topReference]['readIds'])),
-                  file=fp)
+            print('\n'.join(sorted(readIdsToStr(
+                referenceReadIds(topReference)))), file=fp)
 
 
 if __name__ == '__main__':
@@ -161,4 +218,21 @@ if __name__ == '__main__':
               'reference with the highest number of matching reads. Only '
               'valid when --sortBy count is used.'))
 
+    parser.add_argument(
+        '--workers', type=int, metavar='N',
+        help=('The number of processes to use to read regions of the SAM/BAM '
+              'file. This is only possible if the file has an index.'))
+
+    parser.add_argument(
+        '--regionSize', type=int, metavar='N',
+        help=('The maximum length of the reference regions given to each '
+              'process when --workers is used. If not given, a size is '
+              'chosen automatically.'))
+
+    parser.add_argument(
+        '--statsCache', action='store_true',
+        help=('Read the read counts from a cache file next to the SAM/BAM '
+              'file, if it is up to date with the file. Otherwise, compute '
+              'them and write the cache file.'))
+
     main(parser.parse_args())
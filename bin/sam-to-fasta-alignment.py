@@ -60,17 +60,21 @@ addFASTAFilteringCommandLineOptions(parser)
 args = parser.parse_args()
 reads = parseFASTAFilteringCommandLineOptions(args, Reads())
 samFilter = SAMFilter.parseFilteringOptions(
-    args, filterRead=reads.filterRead)
-paddedSAM = PaddedSAM(samFilter)
+    args, filterQuery=reads.filterAlignment)
+# Use streaming mode, so memory use does not grow with the number of queries.
+paddedSAM = PaddedSAM(samFilter, streaming=True)
 
 for read in paddedSAM.queries(rcSuffix=args.rcSuffix, rcNeeded=args.rcNeeded):
     print(read.toString('fasta'), end='')
 
 if args.listReferenceInsertions:
-    if paddedSAM.referenceInsertions:
+    insertionCounts = paddedSAM.insertionCounts()
+    if insertionCounts:
         print('(0-based) insertions into the reference:\n%s' %
-              nucleotidesToStr(paddedSAM.referenceInsertions, '  '),
+              nucleotidesToStr(insertionCounts, '  '),
               file=sys.stderr)
     else:
         print('No matches required an insertion into the reference.',
               file=sys.stderr)
+
+paddedSAM.close()
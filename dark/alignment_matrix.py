@@ -0,0 +1,340 @@
+from __future__ import division
+
+from collections import Counter
+
+import numpy as np
+
+from dark.dna import AMBIGUOUS, BASES_TO_AMBIGUOUS, FloatBaseCounts
+from dark.errors import ReadLengthsNotIdenticalError
+
+# The bases (and gap) whose counts are returned by AlignmentMatrix.baseCounts,
+# in the order of the columns of the returned array.
+BASE_COUNT_ORDER = ('A', 'C', 'G', 'T', '-')
+
+# Bit masks for the bases in BASE_COUNT_ORDER.
+_BITS = dict((base, 1 << index) for index, base in
+             enumerate(BASE_COUNT_ORDER))
+
+_ACGT = _BITS['A'] | _BITS['C'] | _BITS['G'] | _BITS['T']
+
+# Counts are accumulated as integers, in units of 1/12th of a read, so
+# that a code that could be any of 1, 2, 3, or 4 bases contributes a whole
+# number of units to each of its possible bases.
+_UNITS = 12
+
+# For each byte value, the bit mask of the bases it is compatible with
+# (zero for unknown characters).
+_MASKS = np.zeros(256, dtype=np.uint8)
+for _code, _bases in AMBIGUOUS.items():
+    _MASKS[ord(_code)] = sum(_BITS[base] for base in _bases)
+
+# For each possible bit mask of ACGT bases, the ambiguous code for it.
+_MASK_TO_CODE = {}
+for _bases, _code in BASES_TO_AMBIGUOUS.items():
+    _MASK_TO_CODE[sum(_BITS[base] for base in _bases)] = _code
+
+# The number of sites to count at once when making the per-site code
+# histogram. Counting a block of sites at a time (rather than a block of
+# reads) keeps the bincount result array small enough to stay in cache.
+_HISTOGRAM_BLOCK = 256
+
+
+def _popcount(mask):
+    return bin(mask).count('1')
+
+
+class AlignmentMatrix(object):
+    """
+    Hold a set of sequences (normally aligned) as a matrix of bytes, with
+    one row per read, and compute per-site summaries of it with NumPy.
+
+    Reads of unequal length are padded on the right with zero bytes. The
+    methods that need all reads to be the same length raise
+    C{ReadLengthsNotIdenticalError} if they are not.
+
+    @param reads: An iterable of C{dark.reads.Read} instances.
+    """
+    def __init__(self, reads):
+        sequences = [read.sequence for read in reads]
+        self.n = n = len(sequences)
+        self.lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+        self.length = length = int(self.lengths.max()) if n else 0
+        self.equalLengths = bool(n == 0 or self.lengths.min() == length)
+
+        if self.equalLengths:
+            self.matrix = np.frombuffer(
+                ''.join(sequences).encode('latin-1'),
+                dtype=np.uint8).reshape(n, length)
+        else:
+            self.matrix = matrix = np.zeros((n, length), dtype=np.uint8)
+            for row, sequence in enumerate(sequences):
+                matrix[row, :len(sequence)] = np.frombuffer(
+                    sequence.encode('latin-1'), dtype=np.uint8)
+
+        self._histogram = None
+
+    def _checkEqualLengths(self):
+        """
+        Check that all reads are the same length.
+
+        @raise ReadLengthsNotIdenticalError: If they are not.
+        """
+        if not self.equalLengths:
+            raise ReadLengthsNotIdenticalError()
+
+    def histogram(self):
+        """
+        Count how many times each byte value occurs at each site.
+
+        @return: A C{(length, 256)} C{np.ndarray} of C{int} counts. Column
+            zero counts the padding of reads that are shorter than the
+            longest read.
+        """
+        if self._histogram is None:
+            length = self.length
+            histogram = np.empty((length, 256), dtype=np.int64)
+            siteOffsets = np.arange(_HISTOGRAM_BLOCK, dtype=np.intp) * 256
+            for start in range(0, length, _HISTOGRAM_BLOCK):
+                block = self.matrix[:, start:start + _HISTOGRAM_BLOCK]
+                width = block.shape[1]
+                index = block + siteOffsets[:width]
+                histogram[start:start + width] = np.bincount(
+                    index.ravel(), minlength=width * 256).reshape(width, 256)
+            self._histogram = histogram
+
+        return self._histogram
+
+    def _upperHistogram(self):
+        """
+        Get the per-site histogram with lower case letters counted as upper
+        case, and with the padding column zeroed.
+
+        @return: A C{(length, 256)} C{np.ndarray} of C{int} counts.
+        """
+        histogram = self.histogram().copy()
+        lower = np.arange(ord('a'), ord('z') + 1)
+        histogram[:, lower - 32] += histogram[:, lower]
+        histogram[:, lower] = 0
+        histogram[:, 0] = 0
+        return histogram
+
+    @staticmethod
+    def _masks(unknownAreAmbiguous):
+        """
+        Get the base bit mask for each byte value.
+
+        @param unknownAreAmbiguous: If C{True}, unknown characters are
+            compatible with all of ACGT. Otherwise they are all gaps.
+        @return: A C{np.ndarray} of 256 C{int} bit masks.
+        """
+        masks = _MASKS.copy()
+        masks[masks == 0] = _ACGT if unknownAreAmbiguous else _BITS['-']
+        return masks
+
+    def summarizePosition(self, index):
+        """
+        Compute residue counts at a specific sequence index.
+
+        @param index: an C{int} index into the sequences (negative values
+            index from the end of each sequence, as in Python).
+        @return: A C{dict} with the count of too-short (excluded) sequences,
+            and a Counter instance giving the residue counts, as returned by
+            C{dark.reads.Reads.summarizePosition}.
+        """
+        columns = (np.full(self.n, index, dtype=np.int64) if index >= 0
+                   else self.lengths + index)
+        present = (columns >= 0) & (columns < self.lengths)
+        rows = np.flatnonzero(present)
+        codes = self.matrix[rows, columns[rows]]
+        countAtPosition = Counter()
+        for code, count in zip(*np.unique(codes, return_counts=True)):
+            countAtPosition[chr(code)] = int(count)
+
+        return {
+            'excludedCount': int(self.n - len(rows)),
+            'countAtPosition': countAtPosition,
+        }
+
+    def baseCounts(self, unknownAreAmbiguous=False):
+        """
+        Compute ambiguity-aware base counts for all sites, as in
+        C{dark.dna.FloatBaseCounts}.
+
+        @param unknownAreAmbiguous: If C{True}, any unknown character (e.g., a
+            '-' gap or '?' unknown base) will be treated as being fully
+            ambiguous (i.e., could be any of ACGT). Otherwise, all unknown
+            characters are counted as '-'.
+        @return: A C{(length, 5)} C{np.ndarray} of C{float} counts, with
+            columns in the order given by C{BASE_COUNT_ORDER}.
+        """
+        masks = self._masks(unknownAreAmbiguous)
+        weights = np.zeros((256, len(BASE_COUNT_ORDER)), dtype=np.int64)
+        for code in range(1, 256):
+            mask = int(masks[code])
+            share = _UNITS // _popcount(mask)
+            for column in range(len(BASE_COUNT_ORDER)):
+                if mask & (1 << column):
+                    weights[code, column] = share
+
+        return self._upperHistogram().dot(weights) / _UNITS
+
+    def highestFrequencies(self, unknownAreAmbiguous=False):
+        """
+        Find the frequency of the most common base at each site, as in
+        C{dark.dna.FloatBaseCounts.highestFrequency}.
+
+        @param unknownAreAmbiguous: If C{True}, unknown characters are treated
+            as fully ambiguous. Otherwise they are counted as '-'.
+        @return: A C{np.ndarray} of C{float} frequencies, one per site.
+        """
+        counts = self.baseCounts(unknownAreAmbiguous)
+        if self.n == 0:
+            return np.ones(self.length)
+        return np.where((counts > 0).sum(axis=1) < 2, 1.0,
+                        counts.max(axis=1) / self.n)
+
+    def variable(self, confirm=True, unknownAreAmbiguous=False):
+        """
+        Find which sites are variable, as in
+        C{dark.dna.FloatBaseCounts.variable}.
+
+        @param confirm: If C{True}, only consider a site variable if the
+            ambiguous codes at the site cannot all be resolved in favor of a
+            single base. Else, all sites are considered variable if there
+            is more than one read.
+        @param unknownAreAmbiguous: If C{True}, unknown characters are treated
+            as fully ambiguous. Otherwise they are counted as '-'.
+        @return: A C{np.ndarray} of C{bool}, one per site.
+        """
+        if not confirm:
+            return np.full(self.length, self.n > 1)
+
+        masks = self._masks(unknownAreAmbiguous)
+        histogram = self._upperHistogram()
+        codes = [int(code) for code in np.flatnonzero(histogram.any(axis=0))]
+        present = dict((code, histogram[:, code] > 0) for code in codes)
+        allBits = _ACGT | _BITS['-']
+
+        unambiguousCount = np.zeros(self.length, dtype=np.int64)
+        # The single unambiguous code at each site (where there is one).
+        unambiguousCode = np.zeros(self.length, dtype=np.int64)
+        anyAmbiguous = np.zeros(self.length, dtype=bool)
+        intersection = np.full(self.length, allBits, dtype=np.int64)
+
+        for code in codes:
+            mask = int(masks[code])
+            if _popcount(mask) == 1:
+                unambiguousCount += present[code]
+                unambiguousCode[present[code]] = code
+            else:
+                anyAmbiguous |= present[code]
+                intersection[present[code]] &= mask
+
+        # Where there is exactly one unambiguous code, the site is variable
+        # if any code at the site excludes it. Note that (as in
+        # FloatBaseCounts) it is the unambiguous code itself that is looked
+        # for among the possible bases of each code, so an unknown character
+        # excludes itself.
+        codeBits = np.zeros(256, dtype=np.int64)
+        for base, bit in _BITS.items():
+            codeBits[ord(base)] = bit
+        wanted = codeBits[unambiguousCode]
+        excluded = np.zeros(self.length, dtype=bool)
+        for code in codes:
+            excluded |= present[code] & ((int(masks[code]) & wanted) == 0)
+
+        return np.where(
+            unambiguousCount == 0,
+            anyAmbiguous & (intersection == 0),
+            np.where(unambiguousCount == 1, anyAmbiguous & excluded,
+                     True))
+
+    def variableSites(self, confirm=False, homogeneityLevel=1.0,
+                      unknownAreAmbiguous=False):
+        """
+        Find the variable sites, as in C{dark.reads.Reads.variableSites}.
+
+        @param confirm: If C{True} only return sites where there is confirmed
+            variation (i.e., ambiguous sites that are compatible with there
+            being no variation are not returned).
+        @homogeneityLevel: If the frequency of the most-common nucleotide at
+            a site is at least this value, the site will be considered
+            homogeneous.
+        @param unknownAreAmbiguous: If C{True}, any unknown character (e.g., a
+            '-' gap or '?' unknown base) will be treated as being fully
+            ambiguous (i.e., could be any of ACGT). Otherwise, all unknown
+            characters are collected under the count for '-'.
+        @raise ReadLengthsNotIdenticalError: If the reads are not all the
+            same length.
+        @return: A C{dict} keyed by C{int} site number (0-based) with values
+            that are C{FloatBaseCounts} instances giving the base counts at
+            the site.
+        """
+        self._checkEqualLengths()
+        if self.n == 0:
+            return {}
+
+        sites = np.flatnonzero(
+            self.variable(confirm, unknownAreAmbiguous) &
+            (self.highestFrequencies(unknownAreAmbiguous) < homogeneityLevel))
+
+        matrix = self.matrix
+        return dict(
+            (int(site),
+             FloatBaseCounts(matrix[:, site].tobytes().decode('latin-1'),
+                             unknownAreAmbiguous=unknownAreAmbiguous))
+            for site in sites)
+
+    def combine(self):
+        """
+        Combine all reads into a single sequence, as in
+        C{dark.reads.Reads.combineReads}.
+
+        @raise ReadLengthsNotIdenticalError: If the reads are not all the
+            same length.
+        @raise ValueError: If a site has more than one code and none of them
+            is a known nucleotide code.
+        @return: a C{str} sequence made from combining all reads.
+        """
+        self._checkEqualLengths()
+        histogram = self.histogram()
+        codes = [int(code) for code in np.flatnonzero(histogram.any(axis=0))]
+        present = dict((code, histogram[:, code] > 0) for code in codes)
+        length = self.length
+
+        distinct = np.zeros(length, dtype=np.int64)
+        # The highest code at each site, which is the only code at sites
+        # with just one code.
+        lastCode = np.zeros(length, dtype=np.uint8)
+        union = np.zeros(length, dtype=np.int64)
+        # The unambiguous ACGT code at sites where that's the only code
+        # apart from N.
+        acgtCode = np.zeros(length, dtype=np.uint8)
+        for code in codes:
+            distinct += present[code]
+            lastCode[present[code]] = code
+            union[present[code]] |= int(_MASKS[code])
+            if chr(code) in 'ACGT':
+                acgtCode[present[code]] = code
+
+        nPresent = present.get(ord('N'), np.zeros(length, dtype=bool))
+        result = np.where(
+            distinct == 1, lastCode,
+            np.where((distinct == 2) & nPresent & (acgtCode != 0), acgtCode,
+                     0)).astype(np.uint8)
+
+        ambiguous = np.flatnonzero(result == 0)
+        if len(ambiguous):
+            unknown = np.flatnonzero(union[ambiguous] == 0)
+            if len(unknown):
+                site = int(ambiguous[unknown[0]])
+                raise ValueError(
+                    'Unknown DNA base(s) at site %d: %s' %
+                    (site, ', '.join(sorted(
+                        chr(code) for code in codes if present[code][site]))))
+            toCode = np.zeros(_ACGT + 1, dtype=np.uint8)
+            for mask, code in _MASK_TO_CODE.items():
+                toCode[mask] = ord(code)
+            result[ambiguous] = toCode[union[ambiguous]]
+
+        return result.tobytes().decode('latin-1')
@@ -0,0 +1,490 @@
+from __future__ import division
+
+import numpy as np
+import struct
+import zipfile
+from array import array
+from json import dumps, loads
+
+# A columnar on-disk format for BLAST and DIAMOND records (as produced by
+# dark.blast.conversion.XMLRecordsReader._convertBlastRecordToDict and
+# dark.diamond.conversion.DiamondTabularFormatReader.records, or read back
+# from our line-JSON files). Instead of one JSON object per read, the store
+# holds one numpy array per HSP field, so reloading a large run does not
+# need to parse (and allocate) a JSON object for every HSP.
+#
+# The store is an (uncompressed) numpy .npz file, with a name ending in
+# '.alignments.npz' (SUFFIX), holding:
+#
+#   params, meta: JSON (encoded as uint8 arrays) holding the BLAST/DIAMOND
+#       parameters and a description of the columns in the store.
+#   query.data, query.offsets: the query titles, one per record.
+#   alignmentOffsets: for each record, the index of its first alignment.
+#   title.data, title.offsets: the distinct subject titles.
+#   alignmentTitle, alignmentLength: for each alignment, the index of its
+#       subject title and the subject length.
+#   hspOffsets: for each alignment, the index of its first HSP.
+#   <key>: an array for each HSP key (e.g., 'bits', 'query_start'), or
+#       <key>.data and <key>.offsets for the string-valued keys.
+#   <key>.none: a boolean array for HSP keys that have None values.
+#
+# The raw (un-normalized) HSP values are stored, exactly as they appear in
+# the JSON, so the store can be made without the reads and HSP
+# normalization happens when the store is read.
+
+VERSION = 1
+
+# The suffix of alignment store file names.
+SUFFIX = '.alignments.npz'
+
+INT_KEYS = ('identicalCount', 'positiveCount', 'query_end', 'query_start',
+            'sbjct_end', 'sbjct_start')
+
+FLOAT_KEYS = ('bits', 'expect', 'percentIdentical', 'percentPositive')
+
+STRING_KEYS = ('btop', 'query', 'sbjct')
+
+
+def _jsonToArray(value):
+    """
+    Convert a value to JSON held in a numpy uint8 array.
+
+    @param value: A JSON-serializable value.
+    @return: A numpy C{uint8} array.
+    """
+    return np.frombuffer(dumps(value, sort_keys=True).encode('UTF-8'),
+                         dtype=np.uint8)
+
+
+def _arrayToJSON(value):
+    """
+    Convert a numpy uint8 array holding JSON back to a value.
+
+    @param value: A numpy C{uint8} array, made by C{_jsonToArray}.
+    @return: The value held in the array.
+    """
+    return loads(value.tobytes().decode('UTF-8'))
+
+
+class _StringColumn(object):
+    """
+    Accumulate strings in a single byte buffer, with an array of offsets.
+    """
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('q', [0])
+
+    def append(self, s):
+        """
+        Add a string.
+
+        @param s: The C{str} to add.
+        """
+        self.data.extend(s.encode('UTF-8'))
+        self.offsets.append(len(self.data))
+
+    def arrays(self, name):
+        """
+        Get numpy arrays for the column.
+
+        @param name: The C{str} name of the column.
+        @return: A C{dict} mapping C{str} array names to numpy arrays.
+        """
+        return {
+            name + '.data': np.frombuffer(bytes(self.data), dtype=np.uint8),
+            name + '.offsets': np.array(self.offsets, dtype=np.int64),
+        }
+
+
+def _strings(data, offsets, start, end):
+    """
+    Decode a range of strings from a string column.
+
+    @param data: A numpy C{uint8} array with the encoded strings.
+    @param offsets: A numpy C{int64} array of string offsets in C{data}.
+    @param start: The C{int} index of the first string to decode.
+    @param end: The C{int} index of the string after the last one to decode.
+    @return: A C{list} of C{str}s.
+    """
+    offsets = offsets[start:end + 1].tolist()
+    base = offsets[0]
+    chunk = data[base:offsets[-1]].tobytes()
+    text = chunk.decode('UTF-8')
+    if len(text) == len(chunk):
+        # All ASCII, so byte offsets are also character offsets. This is
+        # the usual case, and slicing one decoded string is much faster
+        # than decoding each string separately.
+        return [text[a - base:b - base] for a, b in zip(offsets, offsets[1:])]
+    else:
+        return [chunk[a - base:b - base].decode('UTF-8')
+                for a, b in zip(offsets, offsets[1:])]
+
+
+def _memmapMember(filename, name):
+    """
+    Memory-map an array held in an npz file, so its data is read from the
+    file when it is used instead of being held in memory.
+
+    @param filename: The C{str} name of an npz file.
+    @param name: The C{str} name of the array in the file.
+    @return: A numpy C{memmap} (or an ordinary array, if the array is empty
+        or is compressed in the file and so cannot be memory-mapped).
+    """
+    with zipfile.ZipFile(filename) as zf:
+        info = zf.getinfo(name + '.npy')
+
+    with open(filename, 'rb') as fp:
+        # Skip the zip local file header (whose extra field may not be the
+        # same length as the one in the zip central directory).
+        fp.seek(info.header_offset + 26)
+        nameLength, extraLength = struct.unpack('<HH', fp.read(4))
+        fp.seek(nameLength + extraLength, 1)
+        version = np.lib.format.read_magic(fp)
+        if version == (1, 0):
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(
+                fp)
+        else:
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(
+                fp)
+        offset = fp.tell()
+
+    if info.compress_type != zipfile.ZIP_STORED or not shape[0]:
+        with np.load(filename, allow_pickle=False) as npz:
+            return npz[name]
+
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                     shape=shape)
+
+
+class AlignmentStoreWriter(object):
+    """
+    Accumulate BLAST or DIAMOND records and save them as an alignment store.
+    """
+    def __init__(self):
+        self._queries = _StringColumn()
+        self._titles = _StringColumn()
+        self._titleIndex = {}
+        self._alignmentOffsets = array('q', [0])
+        self._alignmentTitle = array('q')
+        self._alignmentLength = array('q')
+        self._hspOffsets = array('q', [0])
+        self._framePair = None
+        self._frames = array('q')
+        self._columns = {}
+        self._nones = {}
+        self._hspCount = 0
+        self.recordCount = 0
+
+    def _column(self, key):
+        """
+        Get the column for an HSP key, creating it if need be.
+
+        @param key: A C{str} HSP key.
+        @raise ValueError: If C{key} is not a known HSP key.
+        @return: An C{array} or C{_StringColumn} instance.
+        """
+        try:
+            return self._columns[key]
+        except KeyError:
+            if key in INT_KEYS:
+                column = array('q', [0] * self._hspCount)
+            elif key in FLOAT_KEYS:
+                column = array('d', [0.0] * self._hspCount)
+            elif key in STRING_KEYS:
+                column = _StringColumn()
+                for _ in range(self._hspCount):
+                    column.append('')
+            else:
+                raise ValueError('Unknown HSP key %r.' % key)
+
+            # All earlier HSPs did not have this key.
+            self._nones[key] = array('b', [1] * self._hspCount)
+            self._columns[key] = column
+            return column
+
+    def _addHsp(self, hsp):
+        """
+        Add an HSP.
+
+        @param hsp: A C{dict} holding an HSP.
+        @raise ValueError: If the HSP has an unknown key, or if its frame is
+            not of the same kind (a single frame or a pair of frames) as
+            that of the earlier HSPs.
+        """
+        frame = hsp['frame']
+        framePair = isinstance(frame, (list, tuple))
+        if self._framePair is None:
+            self._framePair = framePair
+        elif framePair != self._framePair:
+            raise ValueError('Inconsistent HSP frame %r.' % (frame,))
+
+        if framePair:
+            self._frames.extend(frame)
+        else:
+            self._frames.append(frame)
+
+        for key in hsp:
+            if key != 'frame':
+                self._column(key)
+
+        for key, column in self._columns.items():
+            value = hsp.get(key)
+            isNone = value is None
+            self._nones[key].append(isNone)
+            if key in STRING_KEYS:
+                column.append('' if isNone else value)
+            elif key in INT_KEYS:
+                column.append(0 if isNone else value)
+            else:
+                column.append(0.0 if isNone else value)
+
+        self._hspCount += 1
+
+    def addRecord(self, record):
+        """
+        Add a record.
+
+        @param record: A C{dict} with 'query' and 'alignments' keys, as
+            produced by the BLAST and DIAMOND conversion code.
+        """
+        self._queries.append(record['query'])
+        for alignment in record['alignments']:
+            title = alignment['title']
+            try:
+                titleIndex = self._titleIndex[title]
+            except KeyError:
+                titleIndex = self._titleIndex[title] = len(self._titleIndex)
+                self._titles.append(title)
+            self._alignmentTitle.append(titleIndex)
+            self._alignmentLength.append(alignment['length'])
+            for hsp in alignment['hsps']:
+                self._addHsp(hsp)
+            self._hspOffsets.append(self._hspCount)
+        self._alignmentOffsets.append(len(self._alignmentTitle))
+        self.recordCount += 1
+
+    def save(self, filename, params):
+        """
+        Save the accumulated records.
+
+        @param filename: The C{str} name of the file to write. This should
+            end in C{SUFFIX}, so the readers in C{dark.blast.alignments} and
+            C{dark.diamond.alignments} recognize it as a store.
+        @param params: A C{dict} of BLAST or DIAMOND parameters.
+        """
+        meta = {
+            'columns': sorted(self._columns),
+            'framePair': bool(self._framePair),
+            'version': VERSION,
+        }
+        arrays = {
+            'alignmentLength': np.array(self._alignmentLength,
+                                        dtype=np.int64),
+            'alignmentOffsets': np.array(self._alignmentOffsets,
+                                         dtype=np.int64),
+            'alignmentTitle': np.array(self._alignmentTitle, dtype=np.int64),
+            'frame': np.array(self._frames, dtype=np.int64),
+            'hspOffsets': np.array(self._hspOffsets, dtype=np.int64),
+            'meta': _jsonToArray(meta),
+            'params': _jsonToArray(params),
+        }
+        arrays.update(self._queries.arrays('query'))
+        arrays.update(self._titles.arrays('title'))
+
+        for key, column in self._columns.items():
+            if key in STRING_KEYS:
+                arrays.update(column.arrays('hsp.' + key))
+            else:
+                arrays['hsp.' + key] = np.array(
+                    column, dtype=np.int64 if key in INT_KEYS else np.float64)
+            nones = self._nones[key]
+            if any(nones):
+                arrays['hsp.%s.none' % key] = np.array(nones, dtype=bool)
+
+        np.savez(filename, **arrays)
+
+
+def saveAlignmentStore(filename, params, records):
+    """
+    Save BLAST or DIAMOND records as an alignment store.
+
+    @param filename: The C{str} name of the file to write.
+    @param params: A C{dict} of BLAST or DIAMOND parameters.
+    @param records: An iterable of C{dict}s with 'query' and 'alignments'
+        keys, as produced by the BLAST and DIAMOND conversion code.
+    @return: The C{int} number of records saved.
+    """
+    writer = AlignmentStoreWriter()
+    for record in records:
+        writer.addRecord(record)
+    writer.save(filename, params)
+    return writer.recordCount
+
+
+class AlignmentStore(object):
+    """
+    Read BLAST or DIAMOND records from an alignment store.
+
+    @param filename: The C{str} name of a file made by
+        C{AlignmentStoreWriter.save}.
+    @raise ValueError: If the file is not a (current version) alignment
+        store.
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        self._arrays = self._sequenceArrays = None
+        self._npz = np.load(filename, allow_pickle=False)
+        try:
+            self.params = _arrayToJSON(self._npz['params'])
+            meta = _arrayToJSON(self._npz['meta'])
+        except KeyError:
+            self.close()
+            raise ValueError('%r is not an alignment store.' % filename)
+
+        if meta['version'] != VERSION:
+            self.close()
+            raise ValueError(
+                'Alignment store %r has version %r (expected %d).' %
+                (filename, meta['version'], VERSION))
+
+        self._columns = meta['columns']
+        self._framePair = meta['framePair']
+
+    def __len__(self):
+        return len(self._load()['query.offsets']) - 1
+
+    def close(self):
+        """
+        Close the underlying numpy file. Only the arrays needed by
+        C{matchedSequences} are kept, with the (large) matched sequence
+        data memory-mapped from the file instead of held in memory.
+        """
+        self._npz.close()
+        if self._arrays is not None:
+            self._sequenceArrays = {}
+            for name, values in self._arrays.items():
+                if name.startswith(('hsp.query.', 'hsp.sbjct.')):
+                    if name.endswith('.data'):
+                        values = _memmapMember(self._filename, name)
+                    self._sequenceArrays[name] = values
+            self._arrays = None
+
+    def _load(self):
+        """
+        Read all the arrays in the store (once).
+
+        @return: A C{dict} mapping C{str} array names to numpy arrays.
+        """
+        if self._arrays is None:
+            self._arrays = dict((name, self._npz[name])
+                                for name in self._npz.files)
+        return self._arrays
+
+    def matchedSequences(self, index):
+        """
+        Get the matched read and subject sequences of an HSP. The arrays
+        holding the sequences are kept in memory once read, so this can be
+        called after C{close} as long as C{records} has been called.
+
+        @param index: The C{int} index of the HSP in the store (i.e., its
+            position in the order the HSPs of all records are yielded by
+            C{records}).
+        @return: A 2-tuple with the C{str} read ('query') and subject
+            ('sbjct') matched sequences, either of which may be C{None}.
+        """
+        if self._sequenceArrays is None:
+            arrays = self._load()
+        else:
+            arrays = self._sequenceArrays
+        result = []
+        for key in 'query', 'sbjct':
+            name = 'hsp.' + key
+            if key not in self._columns:
+                result.append(None)
+                continue
+            nones = arrays.get(name + '.none')
+            if nones is not None and nones[index]:
+                result.append(None)
+            else:
+                offsets = arrays[name + '.offsets']
+                result.append(arrays[name + '.data'][
+                    offsets[index]:offsets[index + 1]].tobytes().decode(
+                        'UTF-8'))
+        return tuple(result)
+
+    def records(self, chunkSize=10000):
+        """
+        Yield the records in the store.
+
+        @param chunkSize: The C{int} number of records to decode at once.
+        @return: A generator that yields C{dict}s with 'query' and
+            'alignments' keys, as found in our JSON files.
+        """
+        arrays = self._load()
+        titles = _strings(arrays['title.data'], arrays['title.offsets'], 0,
+                          len(arrays['title.offsets']) - 1)
+        alignmentOffsets = arrays['alignmentOffsets']
+        hspOffsets = arrays['hspOffsets']
+        nRecords = len(alignmentOffsets) - 1
+        framePair = self._framePair
+
+        for recordStart in range(0, nRecords, chunkSize):
+            recordEnd = min(recordStart + chunkSize, nRecords)
+            queries = _strings(arrays['query.data'], arrays['query.offsets'],
+                               recordStart, recordEnd)
+            recordAlignmentOffsets = alignmentOffsets[
+                recordStart:recordEnd + 1].tolist()
+            alignmentStart = recordAlignmentOffsets[0]
+            alignmentEnd = recordAlignmentOffsets[-1]
+            alignmentTitles = arrays['alignmentTitle'][
+                alignmentStart:alignmentEnd].tolist()
+            alignmentLengths = arrays['alignmentLength'][
+                alignmentStart:alignmentEnd].tolist()
+            alignmentHspOffsets = hspOffsets[
+                alignmentStart:alignmentEnd + 1].tolist()
+            hspStart = alignmentHspOffsets[0]
+            hspEnd = alignmentHspOffsets[-1]
+
+            if framePair:
+                frames = arrays['frame'][2 * hspStart:2 * hspEnd].reshape(
+                    (-1, 2)).tolist()
+            else:
+                frames = arrays['frame'][hspStart:hspEnd].tolist()
+
+            columns = [('frame', frames)]
+            for key in self._columns:
+                name = 'hsp.' + key
+                if key in STRING_KEYS:
+                    values = _strings(arrays[name + '.data'],
+                                      arrays[name + '.offsets'],
+                                      hspStart, hspEnd)
+                else:
+                    values = arrays[name][hspStart:hspEnd].tolist()
+                nones = arrays.get(name + '.none')
+                if nones is not None:
+                    values = [None if isNone else value for isNone, value in
+                              zip(nones[hspStart:hspEnd].tolist(), values)]
+                columns.append((key, values))
+
+            keys = [key for key, _ in columns]
+            hsps = [dict(zip(keys, values))
+                    for values in zip(*[values for _, values in columns])]
+
+            for recordIndex, query in enumerate(queries):
+                alignments = []
+                for alignmentIndex in range(
+                        recordAlignmentOffsets[recordIndex] - alignmentStart,
+                        recordAlignmentOffsets[recordIndex + 1] -
+                        alignmentStart):
+                    alignments.append({
+                        'hsps': hsps[
+                            alignmentHspOffsets[alignmentIndex] - hspStart:
+                            alignmentHspOffsets[alignmentIndex + 1] -
+                            hspStart],
+                        'length': alignmentLengths[alignmentIndex],
+                        'title': titles[alignmentTitles[alignmentIndex]],
+                    })
+                yield {
+                    'alignments': alignments,
+                    'query': query,
+                }
@@ -1,8 +1,44 @@
 import re
+from itertools import islice
 
 from dark.taxonomy import LineageFetcher
 from dark.filter import TitleFilter
 from dark.score import HigherIsBetterScore
+from dark.utils import orderedPoolMap
+
+
+# The ReadsAlignments instance whose files are being read by a worker
+# process (see ReadsAlignments._iterFilesConcurrently).
+_workerReadsAlignments = None
+
+
+def _initFileWorker(readsAlignments):
+    """
+    Initialize a worker process that reads alignment files.
+
+    @param readsAlignments: The C{ReadsAlignments} instance whose files the
+        worker will read.
+    """
+    global _workerReadsAlignments
+    _workerReadsAlignments = readsAlignments
+
+
+def _readFileAlignments(args):
+    """
+    Read the alignments for a set of reads from one file.
+
+    @param args: A 2-tuple with the C{str} file name and a C{list} of the
+        C{Read} instances whose records are in the file.
+    @return: A 2-tuple with the C{dict} of parameters found in the file and
+        a C{list} with the C{list} of alignments for each read that was
+        consumed while reading the file, in order.
+    """
+    filename, reads = args
+    reader = _workerReadsAlignments._getReader(
+        filename, _workerReadsAlignments.scoreClass)
+    alignments = [list(readAlignments)
+                  for readAlignments in reader.readAlignments(reads)]
+    return reader.params, alignments
 
 
 def bestAlignment(readAlignments):
@@ -180,20 +216,22 @@ class ReadsAlignmentsFilter(object):
             self.readIdRegex = re.compile(readIdRegex)
 
         self.count = 0
+        self._compile()
 
-    def filter(self, readAlignments):
+    def _compile(self):
         """
-        Filter a read's alignments.
+        Make a list of the filtering steps that are needed for the options
+        given to C{__init__}, in the order they must be applied. This avoids
+        testing every option for every read in C{filter}.
 
-        @param readAlignments: A C{ReadAlignments} instance.
-        @return: A C{ReadAlignments} instance if the passed
-            C{readAlignments} is not filtered out, else C{False}.
+        Each step is passed a C{ReadAlignments} instance and returns either
+        that instance (possibly with some of its alignments, or their HSPs,
+        removed) or C{False} if the read is to be filtered out.
         """
-
         # Implementation notes:
         #
         # 1. The order in which we carry out the filtering actions can make
-        #    a big difference in the result of this function. The current
+        #    a big difference in the result of filtering. The current
         #    ordering is based on what seems reasonable - it may not be the
         #    best way to do things. E.g., if maxHspsPerHit is 1 and there
         #    is a title regex, which should we perform first?
@@ -202,83 +240,134 @@ class ReadsAlignmentsFilter(object):
         #    HSPs. That's because there's no point filtering all HSPs for
         #    an alignment that we end up throwing away anyhow.
         #
-        # 2. This function could be made faster if it first looked at its
-        #    arguments and dynamically created an acceptance function
-        #    (taking a readAlignments as an argument). The acceptance
-        #    function would run without examining the desired filtering
-        #    settings on each call the way the current code does.
-        #
-        # 3. A better approach with readIdRegex would be to allow the
+        # 2. A better approach with readIdRegex would be to allow the
         #    passing of a regex object. Then the caller would make the
         #    regex with whatever flags they liked (e.g., case insensitive).
 
+        steps = []
+
+        def keepAlignments(readAlignments, wanted):
+            """
+            Keep only the wanted alignments of a read.
+
+            @param readAlignments: A C{ReadAlignments} instance.
+            @param wanted: A function that takes an alignment and returns
+                C{True} if it is to be kept.
+            @return: C{readAlignments} if any alignments are kept, else
+                C{False}.
+            """
+            wantedAlignments = [alignment for alignment in readAlignments
+                                if wanted(alignment)]
+            if wantedAlignments:
+                readAlignments[:] = wantedAlignments
+                return readAlignments
+            else:
+                return False
+
+        def keepHsps(readAlignments, wanted):
+            """
+            Keep only the wanted HSPs of the alignments of a read.
+
+            @param readAlignments: A C{ReadAlignments} instance.
+            @param wanted: A function that takes an HSP and returns C{True}
+                if it is to be kept.
+            @return: C{readAlignments} if any alignments still have HSPs,
+                else C{False}.
+            """
+            wantedAlignments = []
+            for alignment in readAlignments:
+                wantedHsps = [hsp for hsp in alignment.hsps if wanted(hsp)]
+                if wantedHsps:
+                    alignment.hsps = wantedHsps
+                    wantedAlignments.append(alignment)
+            if wantedAlignments:
+                readAlignments[:] = wantedAlignments
+                return readAlignments
+            else:
+                return False
+
         #
         # Alignment-only (i.e., non-HSP based) filtering.
         #
-        if self.limit is not None and self.count == self.limit:
-            return False
+        if self.limit is not None:
+            limit = self.limit
+            steps.append(
+                lambda readAlignments: self.count != limit and readAlignments)
 
         # Does the read have too many alignments?
-        if (self.maxAlignmentsPerRead is not None and
-                len(readAlignments) > self.maxAlignmentsPerRead):
-            return False
+        if self.maxAlignmentsPerRead is not None:
+            maxAlignmentsPerRead = self.maxAlignmentsPerRead
+            steps.append(
+                lambda readAlignments: (
+                    len(readAlignments) <= maxAlignmentsPerRead and
+                    readAlignments))
 
         # Filter on the read id.
-        if (self.readIdRegex and
-                self.readIdRegex.search(readAlignments.read.id) is None):
-            return False
+        if self.readIdRegex:
+            search = self.readIdRegex.search
+            steps.append(
+                lambda readAlignments: (
+                    search(readAlignments.read.id) is not None and
+                    readAlignments))
 
         if self.titleFilter:
             # Remove alignments against sequences whose titles are
             # unacceptable.
-            wantedAlignments = []
-            for alignment in readAlignments:
-                if (self.titleFilter.accept(alignment.subjectTitle) !=
-                        TitleFilter.REJECT):
-                    wantedAlignments.append(alignment)
-            if wantedAlignments:
-                readAlignments[:] = wantedAlignments
-            else:
-                return False
+            accept = self.titleFilter.accept
+            reject = TitleFilter.REJECT
+            steps.append(
+                lambda readAlignments: keepAlignments(
+                    readAlignments,
+                    lambda alignment: accept(alignment.subjectTitle) !=
+                    reject))
 
         # Only return alignments that are against sequences of the
         # desired length.
         minSequenceLen = self.minSequenceLen
         maxSequenceLen = self.maxSequenceLen
         if minSequenceLen is not None or maxSequenceLen is not None:
-            wantedAlignments = []
-            for alignment in readAlignments:
-                length = alignment.subjectLength
-                if not ((minSequenceLen is not None and
-                         length < minSequenceLen) or
-                        (maxSequenceLen is not None and
-                         length > self.maxSequenceLen)):
-                    wantedAlignments.append(alignment)
-            if wantedAlignments:
-                readAlignments[:] = wantedAlignments
+            if maxSequenceLen is None:
+                def wanted(alignment):
+                    return alignment.subjectLength >= minSequenceLen
+            elif minSequenceLen is None:
+                def wanted(alignment):
+                    return alignment.subjectLength <= maxSequenceLen
             else:
-                return False
+                def wanted(alignment):
+                    return (minSequenceLen <= alignment.subjectLength <=
+                            maxSequenceLen)
+
+            steps.append(
+                lambda readAlignments: keepAlignments(readAlignments, wanted))
 
         if self.taxonomy is not None:
-            wantedAlignments = []
-            for alignment in readAlignments:
-                lineage = self.lineageFetcher.lineage(alignment.subjectTitle)
-                if lineage:
-                    for taxonomyIdAndScientificName in lineage:
-                        if self.taxonomy in taxonomyIdAndScientificName:
-                            wantedAlignments.append(alignment)
+            def filterTaxonomy(readAlignments):
+                wantedAlignments = []
+                for alignment in readAlignments:
+                    lineage = self.lineageFetcher.lineage(
+                        alignment.subjectTitle)
+                    if lineage:
+                        for taxonomyIdAndScientificName in lineage:
+                            if self.taxonomy in taxonomyIdAndScientificName:
+                                wantedAlignments.append(alignment)
+                    else:
+                        # No lineage info was found. Keep the alignment
+                        # since we can't rule it out.  We could add another
+                        # option to control this.
+                        wantedAlignments.append(alignment)
+                if wantedAlignments:
+                    readAlignments[:] = wantedAlignments
+                    return readAlignments
                 else:
-                    # No lineage info was found. Keep the alignment
-                    # since we can't rule it out.  We could add another
-                    # option to control this.
-                    wantedAlignments.append(alignment)
-            if wantedAlignments:
-                readAlignments[:] = wantedAlignments
-            else:
-                return False
+                    return False
+            steps.append(filterTaxonomy)
 
-        if self.oneAlignmentPerRead and readAlignments:
-            readAlignments[:] = [bestAlignment(readAlignments)]
+        if self.oneAlignmentPerRead:
+            def keepBestAlignment(readAlignments):
+                if readAlignments:
+                    readAlignments[:] = [bestAlignment(readAlignments)]
+                return readAlignments
+            steps.append(keepBestAlignment)
 
         #
         # From here on we do only HSP-based filtering.
@@ -286,27 +375,22 @@ class ReadsAlignmentsFilter(object):
 
         # Throw out any unwanted HSPs due to maxHspsPerHit.
         if self.maxHspsPerHit is not None:
-            for alignment in readAlignments:
-                hsps = alignment.hsps
-                if len(hsps) > self.maxHspsPerHit:
-                    alignment.hsps = hsps[:self.maxHspsPerHit]
+            maxHspsPerHit = self.maxHspsPerHit
+
+            def truncateHsps(readAlignments):
+                for alignment in readAlignments:
+                    hsps = alignment.hsps
+                    if len(hsps) > maxHspsPerHit:
+                        alignment.hsps = hsps[:maxHspsPerHit]
+                return readAlignments
+            steps.append(truncateHsps)
 
         # Throw out HSPs whose scores are not good enough.
         if self.scoreCutoff is not None:
-            wantedAlignments = []
-            for alignment in readAlignments:
-                hsps = alignment.hsps
-                wantedHsps = []
-                for hsp in hsps:
-                    if hsp.betterThan(self.scoreCutoff):
-                        wantedHsps.append(hsp)
-                if wantedHsps:
-                    alignment.hsps = wantedHsps
-                    wantedAlignments.append(alignment)
-            if wantedAlignments:
-                readAlignments[:] = wantedAlignments
-            else:
-                return False
+            scoreCutoff = self.scoreCutoff
+            steps.append(
+                lambda readAlignments: keepHsps(
+                    readAlignments, lambda hsp: hsp.betterThan(scoreCutoff)))
 
         # Throw out HSPs whose percentage identical is not good enough.
         #
@@ -315,21 +399,14 @@ class ReadsAlignmentsFilter(object):
         # output, so we cannot eliminate such an HSP.
         if self.percentageIdenticalCutoff is not None:
             piCutoff = self.percentageIdenticalCutoff
-            wantedAlignments = []
-            for alignment in readAlignments:
-                hsps = alignment.hsps
-                wantedHsps = []
-                for hsp in hsps:
-                    pi = hsp.percentIdentical
-                    if pi is None or pi >= piCutoff:
-                        wantedHsps.append(hsp)
-                if wantedHsps:
-                    alignment.hsps = wantedHsps
-                    wantedAlignments.append(alignment)
-            if wantedAlignments:
-                readAlignments[:] = wantedAlignments
-            else:
-                return False
+
+            def wantedPercentIdentical(hsp):
+                pi = hsp.percentIdentical
+                return pi is None or pi >= piCutoff
+
+            steps.append(
+                lambda readAlignments: keepHsps(readAlignments,
+                                                wantedPercentIdentical))
 
         # Throw out HSPs whose percentage positive is not good enough.
         #
@@ -338,43 +415,43 @@ class ReadsAlignmentsFilter(object):
         # output, so we cannot eliminate such an HSP.
         if self.percentagePositiveCutoff is not None:
             ppCutoff = self.percentagePositiveCutoff
-            wantedAlignments = []
-            for alignment in readAlignments:
-                hsps = alignment.hsps
-                wantedHsps = []
-                for hsp in hsps:
-                    pp = hsp.percentPositive
-                    if pp is None or pp >= ppCutoff:
-                        wantedHsps.append(hsp)
-                if wantedHsps:
-                    alignment.hsps = wantedHsps
-                    wantedAlignments.append(alignment)
-            if wantedAlignments:
-                readAlignments[:] = wantedAlignments
-            else:
-                return False
+
+            def wantedPercentPositive(hsp):
+                pp = hsp.percentPositive
+                return pp is None or pp >= ppCutoff
+
+            steps.append(
+                lambda readAlignments: keepHsps(readAlignments,
+                                                wantedPercentPositive))
 
         # Throw out HSPs that don't match in the desired place on the
         # matched sequence.
         minStart = self.minStart
         maxStop = self.maxStop
         if minStart is not None or maxStop is not None:
-            wantedAlignments = []
-            for alignment in readAlignments:
-                hsps = alignment.hsps
-                wantedHsps = []
-                for hsp in hsps:
-                    if not ((minStart is not None and
+            def wantedOffsets(hsp):
+                return not ((minStart is not None and
                              hsp.readStartInSubject < minStart) or
                             (maxStop is not None and
-                             hsp.readEndInSubject > maxStop)):
-                        wantedHsps.append(hsp)
-                if wantedHsps:
-                    alignment.hsps = wantedHsps
-                    wantedAlignments.append(alignment)
-            if wantedAlignments:
-                readAlignments[:] = wantedAlignments
-            else:
+                             hsp.readEndInSubject > maxStop))
+
+            steps.append(
+                lambda readAlignments: keepHsps(readAlignments,
+                                                wantedOffsets))
+
+        self._steps = steps
+
+    def filter(self, readAlignments):
+        """
+        Filter a read's alignments.
+
+        @param readAlignments: A C{ReadAlignments} instance.
+        @return: A C{ReadAlignments} instance if the passed
+            C{readAlignments} is not filtered out, else C{False}.
+        """
+        for step in self._steps:
+            readAlignments = step(readAlignments)
+            if readAlignments is False:
                 return False
 
         self.count += 1
@@ -470,6 +547,77 @@ class ReadsAlignments(object):
         """
         return []
 
+    def _iterFilesConcurrently(self, reads, filenames, readsPerFile, workers,
+                               checkParams, unmatchedReads):
+        """
+        Read alignment files in worker processes and yield their
+        C{ReadAlignments} instances in order.
+
+        The subclass must implement C{_getReader(filename, scoreClass)},
+        returning a reader with a C{params} attribute and a
+        C{readAlignments(reads)} method.
+
+        @param reads: An iterator of the L{Read} instances whose records are
+            in the files, in order.
+        @param filenames: A C{list} of C{str} file names.
+        @param readsPerFile: Either an C{int} number of reads whose records
+            are in each file (the last file may have fewer, and is given all
+            the remaining reads), or a C{list} with the C{int} number of reads
+            for each file.
+        @param workers: The C{int} number of worker processes to use.
+        @param checkParams: A function that will be called with the C{str}
+            file name and the C{dict} of parameters found in each file after
+            the first, before any of the file's C{ReadAlignments} are yielded.
+            It should raise if the parameters are not compatible. If
+            C{None}, parameters are not checked.
+        @param unmatchedReads: If C{True}, reads given to a file that were
+            not consumed when reading it are yielded with no alignments.
+            Otherwise, such reads cause a C{ValueError}.
+        @raise ValueError: If C{readsPerFile} is a C{list} whose length is not
+            the number of files, or if reads are left over after reading a
+            file and C{unmatchedReads} is C{False}.
+        @return: A generator that yields C{ReadAlignments} instances.
+        """
+        if isinstance(readsPerFile, int):
+            counts = [readsPerFile] * (len(filenames) - 1) + [None]
+        else:
+            counts = list(readsPerFile)
+            if len(counts) != len(filenames):
+                raise ValueError(
+                    'The number of reads per file was given for %d file%s, '
+                    'but there are %d files.' %
+                    (len(counts), '' if len(counts) == 1 else 's',
+                     len(filenames)))
+
+        def chunks():
+            for filename, count in zip(filenames, counts):
+                chunkReads = list(reads if count is None else
+                                  islice(reads, count))
+                yield filename, chunkReads
+
+        first = True
+        for (filename, chunkReads), (params, alignmentsList) in orderedPoolMap(
+                _readFileAlignments, chunks(), workers,
+                initializer=_initFileWorker, initargs=(self,)):
+            if first:
+                first = False
+            elif checkParams:
+                checkParams(filename, params)
+
+            for read, alignments in zip(chunkReads, alignmentsList):
+                yield ReadAlignments(read, alignments)
+
+            if len(alignmentsList) < len(chunkReads):
+                if unmatchedReads:
+                    for read in chunkReads[len(alignmentsList):]:
+                        yield ReadAlignments(read, [])
+                else:
+                    raise ValueError(
+                        'Only %d of the %d reads given for file %r have '
+                        'a record in it. First unused read id is %r.' %
+                        (len(alignmentsList), len(chunkReads), filename,
+                         chunkReads[len(alignmentsList)].id))
+
     def filter(self, **kwargs):
         """
         Add a filter to this C{readsAlignments}.
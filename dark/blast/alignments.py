@@ -4,7 +4,9 @@ import copy
 
 from dark.score import HigherIsBetterScore
 from dark.alignments import ReadsAlignments, ReadsAlignmentsParams
-from dark.blast.conversion import JSONRecordsReader
+from dark.alignment_store import SUFFIX as ALIGNMENT_STORE_SUFFIX
+from dark.blast.conversion import (
+    AlignmentStoreRecordsReader, JSONRecordsReader)
 from dark.blast.params import checkCompatibleParams
 from dark.fasta import FastaReads, SqliteIndex
 from dark.reads import AARead, DNARead
@@ -44,15 +46,31 @@ class BlastReadsAlignments(ReadsAlignments):
         by our HTCondor jobs.
     @param randomizeZeroEValues: If C{True}, e-values that are zero will be set
         to a random (very good) value.
+    @param decompressionWorkers: The C{int} number of processes to use to
+        decompress and parse each compressed JSON file that holds many bzip2
+        streams or gzip members (see L{dark.parallel_json}), or C{None} to
+        read the files in this process.
+    @param fileWorkers: The C{int} number of processes to use to read
+        BLAST files concurrently. If C{None} or less than two, the files
+        are read one after another. Requires C{readsPerFile}.
+    @param readsPerFile: The number of reads whose records are in each
+        file (as needed when reading files concurrently). Either an C{int}
+        (the number of reads given to each HTCondor job by
+        C{bin/write-htcondor-job-spec.py}; the last file may have fewer) or a
+        C{list} with the C{int} number of reads for each file, in the order
+        the files are read (i.e., after any sorting).
     @raises ValueError: if a file type is not recognized, if the number of
         reads does not match the number of records found in the BLAST result
-        files, or if BLAST parameters in all files do not match.
+        files, if BLAST parameters in all files do not match, or if
+        C{fileWorkers} is more than one and C{readsPerFile} is not given.
     """
 
     def __init__(self, reads, blastFilenames, databaseFilename=None,
                  databaseDirectory=None, sqliteDatabaseFilename=None,
                  scoreClass=HigherIsBetterScore,
-                 sortBlastFilenames=True, randomizeZeroEValues=True):
+                 sortBlastFilenames=True, randomizeZeroEValues=True,
+                 decompressionWorkers=None, fileWorkers=None,
+                 readsPerFile=None):
         if type(blastFilenames) == str:
             blastFilenames = [blastFilenames]
         if sortBlastFilenames:
@@ -64,6 +82,12 @@ class BlastReadsAlignments(ReadsAlignments):
         self._databaseDirectory = databaseDirectory
         self._subjectTitleToSubject = None
         self.randomizeZeroEValues = randomizeZeroEValues
+        self.decompressionWorkers = decompressionWorkers
+        self.fileWorkers = fileWorkers
+        self.readsPerFile = readsPerFile
+        if self._concurrent() and readsPerFile is None:
+            raise ValueError(
+                'readsPerFile must be given if fileWorkers is more than one.')
 
         # Prepare application parameters in order to initialize self.
         self._reader = self._getReader(self.blastFilenames[0], scoreClass)
@@ -82,24 +106,56 @@ class BlastReadsAlignments(ReadsAlignments):
 
     def _getReader(self, filename, scoreClass):
         """
-        Obtain a JSON record reader for BLAST records.
+        Obtain a record reader for BLAST records.
 
-        @param filename: The C{str} file name holding the JSON.
+        @param filename: The C{str} file name holding the JSON or alignment
+            store (see L{dark.alignment_store}).
         @param scoreClass: A class to hold and compare scores (see scores.py).
         """
-        if filename.endswith('.json') or filename.endswith('.json.bz2'):
-            return JSONRecordsReader(filename, scoreClass)
+        if (filename.endswith('.json') or filename.endswith('.json.bz2') or
+                filename.endswith('.json.gz')):
+            return JSONRecordsReader(filename, scoreClass,
+                                     workers=self.decompressionWorkers)
+        elif filename.endswith(ALIGNMENT_STORE_SUFFIX):
+            return AlignmentStoreRecordsReader(filename, scoreClass)
         else:
             raise ValueError(
                 'Unknown BLAST record file suffix for file %r.' % filename)
 
-    def iter(self):
+    def _concurrent(self):
         """
-        Extract BLAST records and yield C{ReadAlignments} instances.
+        Should the BLAST files be read concurrently?
+
+        @return: C{True} if there are many files and many file workers.
+        """
+        return (self.fileWorkers is not None and self.fileWorkers > 1 and
+                len(self.blastFilenames) > 1)
+
+    def _checkParams(self, blastFilename, params):
+        """
+        Check the BLAST parameters of a file are compatible with those found
+        (in __init__) in the first file.
+
+        @param blastFilename: The C{str} name of the file.
+        @param params: A C{dict} of the BLAST parameters in the file.
+        @raise ValueError: If the parameters are not compatible.
+        """
+        differences = checkCompatibleParams(
+            self.params.applicationParams, params)
+        if differences:
+            raise ValueError(
+                'Incompatible BLAST parameters found. The parameters '
+                'in %s differ from those originally found in %s. %s' %
+                (blastFilename, self.blastFilenames[0], differences))
+
+    def _iterFiles(self, reads):
+        """
+        Read the BLAST files one after another.
 
         For each file except the first, check that the BLAST parameters are
         compatible with those found (above, in __init__) in the first file.
 
+        @param reads: An iterator of the reads given to BLAST.
         @return: A generator that yields C{ReadAlignments} instances.
         """
         # Note that self._reader is already initialized (in __init__) for
@@ -107,9 +163,7 @@ class BlastReadsAlignments(ReadsAlignments):
         # makes testing easier, since open() is then only called once for
         # each input file.
 
-        count = 0
         reader = self._reader
-        reads = iter(self.reads)
         first = True
 
         for blastFilename in self.blastFilenames:
@@ -119,18 +173,36 @@ class BlastReadsAlignments(ReadsAlignments):
                 first = False
             else:
                 reader = self._getReader(blastFilename, self.scoreClass)
-                differences = checkCompatibleParams(
-                    self.params.applicationParams, reader.params)
-                if differences:
-                    raise ValueError(
-                        'Incompatible BLAST parameters found. The parameters '
-                        'in %s differ from those originally found in %s. %s' %
-                        (blastFilename, self.blastFilenames[0], differences))
+                self._checkParams(blastFilename, reader.params)
 
             for readAlignments in reader.readAlignments(reads):
-                count += 1
                 yield readAlignments
 
+    def iter(self):
+        """
+        Extract BLAST records and yield C{ReadAlignments} instances.
+
+        The BLAST files are read one after another or, if C{fileWorkers} was
+        given to __init__, concurrently. Either way, the BLAST parameters in
+        each file are checked for compatibility with those in the first file
+        before any of the file's C{ReadAlignments} are yielded.
+
+        @return: A generator that yields C{ReadAlignments} instances.
+        """
+        count = 0
+        reads = iter(self.reads)
+
+        if self._concurrent():
+            readsAlignments = self._iterFilesConcurrently(
+                reads, self.blastFilenames, self.readsPerFile,
+                self.fileWorkers, self._checkParams, False)
+        else:
+            readsAlignments = self._iterFiles(reads)
+
+        for readAlignments in readsAlignments:
+            count += 1
+            yield readAlignments
+
         # Make sure all reads were used.
         try:
             read = next(reads)
@@ -2,16 +2,21 @@ from __future__ import print_function
 
 import six
 import bz2
+import gzip
 from json import dumps, loads
 from operator import itemgetter
+from itertools import count
 
 from Bio.Blast import NCBIXML
 from Bio.File import as_handle
 
-from dark.hsp import HSP, LSP
+from dark.hsp import HSP, LSP, SlottedHSP, SlottedLSP
 from dark.score import HigherIsBetterScore
 from dark.alignments import Alignment, ReadAlignments
-from dark.blast.hsp import normalizeHSP
+from dark.blast.hsp import normalizeHSP, normalizeHSPs
+from dark.parallel_json import compression, parallelJSONLines
+from dark.alignment_store import (
+    AlignmentStore, AlignmentStoreWriter, saveAlignmentStore)
 
 
 class XMLRecordsReader(object):
@@ -167,6 +172,20 @@ class XMLRecordsReader(object):
             print(dumps(self._convertBlastRecordToDict(record),
                         separators=(',', ':')), file=fp)
 
+    def saveAsAlignmentStore(self, filename):
+        """
+        Write the records out as an alignment store (see
+        L{dark.alignment_store}).
+
+        @param filename: The C{str} name of the file to write.
+        @return: The C{int} number of records saved.
+        """
+        writer = AlignmentStoreWriter()
+        for record in self.records():
+            writer.addRecord(self._convertBlastRecordToDict(record))
+        writer.save(filename, self.params)
+        return writer.recordCount
+
 
 class JSONRecordsReader(object):
     """
@@ -177,14 +196,22 @@ class JSONRecordsReader(object):
     @param scoreClass: A class to hold and compare scores (see scores.py).
         Default is C{HigherIsBetterScore}, for comparing bit scores. If you
         are using e-values, pass LowerIsBetterScore instead.
+    @param workers: The C{int} number of processes to use to decompress and
+        parse a compressed ('.bz2' or '.gz') file that holds many bzip2
+        streams or gzip members (such as those made by pbzip2 or bgzip).
+        If C{None}, the file is read in this process.
     """
+    # The number of records whose HSPs are normalized together.
+    BATCH_SIZE = 5000
 
     # Note that self._fp is opened in self.__init__, accessed in
     # self._params and in self.records, and closed in self.close.
 
-    def __init__(self, filename, scoreClass=HigherIsBetterScore):
+    def __init__(self, filename, scoreClass=HigherIsBetterScore,
+                 workers=None):
         self._filename = filename
         self._scoreClass = scoreClass
+        self._workers = workers
         if scoreClass is HigherIsBetterScore:
             self._hspClass = HSP
         else:
@@ -203,42 +230,55 @@ class JSONRecordsReader(object):
             if the input file is empty, or if the JSON does not contain an
             'application' key.
         """
-        if filename.endswith('.bz2'):
-            if six.PY3:
-                self._fp = bz2.open(filename, mode='rt', encoding='UTF-8')
-            else:
-                self._fp = bz2.BZ2File(filename)
+        self._parallel = (self._workers is not None and
+                          self._workers > 1 and
+                          compression(filename) is not None)
+
+        if self._parallel:
+            self._fp = parallelJSONLines(filename, self._workers)
+            try:
+                self.params = next(self._fp)
+            except StopIteration:
+                raise ValueError('JSON file %r was empty.' % self._filename)
         else:
-            self._fp = open(filename)
+            if filename.endswith('.bz2'):
+                if six.PY3:
+                    self._fp = bz2.open(filename, mode='rt', encoding='UTF-8')
+                else:
+                    self._fp = bz2.BZ2File(filename)
+            elif filename.endswith('.gz'):
+                if six.PY3:
+                    self._fp = gzip.open(filename, mode='rt', encoding='UTF-8')
+                else:
+                    self._fp = gzip.GzipFile(filename)
+            else:
+                self._fp = open(filename)
 
-        line = self._fp.readline()
-        if not line:
-            raise ValueError('JSON file %r was empty.' % self._filename)
+            line = self._fp.readline()
+            if not line:
+                raise ValueError('JSON file %r was empty.' % self._filename)
 
-        try:
-            self.params = loads(line[:-1])
-        except ValueError as e:
-            raise ValueError(
-                'Could not convert first line of %r to JSON (%s). '
-                'Line is %r.' % (self._filename, e, line[:-1]))
-        else:
-            if 'application' not in self.params:
+            try:
+                self.params = loads(line[:-1])
+            except ValueError as e:
                 raise ValueError(
-                    '%r appears to be an old JSON file with no BLAST global '
-                    'parameters. Please re-run convert-blast-xml-to-json.py '
-                    'to convert it to the newest format.' % self._filename)
+                    'Could not convert first line of %r to JSON (%s). '
+                    'Line is %r.' % (self._filename, e, line[:-1]))
 
-    def _dictToAlignments(self, blastDict, read):
+        if 'application' not in self.params:
+            raise ValueError(
+                '%r appears to be an old JSON file with no BLAST global '
+                'parameters. Please re-run convert-blast-xml-to-json.py '
+                'to convert it to the newest format.' % self._filename)
+
+    def _checkReadId(self, blastDict, read):
         """
-        Take a dict (made by XMLRecordsReader._convertBlastRecordToDict)
-        and convert it to a list of alignments.
+        Check that a BLAST record is for a read.
 
         @param blastDict: A C{dict}, from convertBlastRecordToDict.
-        @param read: A C{Read} instance, containing the read that BLAST used
-            to create this record.
+        @param read: A C{Read} instance.
         @raise ValueError: If the query id in the BLAST dictionary does not
             match the id of the read.
-        @return: A C{list} of L{dark.alignment.Alignment} instances.
         """
         if (blastDict['query'] != read.id and
                 blastDict['query'].split()[0] != read.id):
@@ -248,8 +288,35 @@ class JSONRecordsReader(object):
                 'supposedly corresponding read (%s).' %
                 (blastDict['query'], read.id))
 
+    def _matchedSequences(self, blastHsp):
+        """
+        Get the keyword arguments that give an HSP its matched sequences.
+
+        @param blastHsp: A C{dict} holding an HSP, from a BLAST record.
+        @return: A C{dict} of keyword arguments for C{self._hspClass}.
+        """
+        return {
+            'readMatchedSequence': blastHsp['query'],
+            'subjectMatchedSequence': blastHsp['sbjct'],
+        }
+
+    def _dictToAlignments(self, blastDict, read):
+        """
+        Take a dict (made by XMLRecordsReader._convertBlastRecordToDict)
+        and convert it to a list of alignments.
+
+        @param blastDict: A C{dict}, from convertBlastRecordToDict.
+        @param read: A C{Read} instance, containing the read that BLAST used
+            to create this record.
+        @raise ValueError: If the query id in the BLAST dictionary does not
+            match the id of the read.
+        @return: A C{list} of L{dark.alignment.Alignment} instances.
+        """
+        self._checkReadId(blastDict, read)
+
         alignments = []
-        getScore = itemgetter('bits' if self._hspClass is HSP else 'expect')
+        getScore = itemgetter(
+            'bits' if self._scoreClass is HigherIsBetterScore else 'expect')
 
         for blastAlignment in blastDict['alignments']:
             alignment = Alignment(blastAlignment['length'],
@@ -269,8 +336,6 @@ class JSONRecordsReader(object):
                     subjectStart=normalized['subjectStart'],
                     subjectEnd=normalized['subjectEnd'],
                     subjectFrame=blastHsp['frame'][1],
-                    readMatchedSequence=blastHsp['query'],
-                    subjectMatchedSequence=blastHsp['sbjct'],
                     # Use blastHsp.get on identicalCount and positiveCount
                     # because they were added in version 2.0.3 and will not
                     # be present in any of our JSON output generated before
@@ -278,16 +343,151 @@ class JSONRecordsReader(object):
                     # but that's much better than no longer being able to
                     # read all that data.
                     identicalCount=blastHsp.get('identicalCount'),
-                    positiveCount=blastHsp.get('positiveCount'))
+                    positiveCount=blastHsp.get('positiveCount'),
+                    **self._matchedSequences(blastHsp))
 
                 alignment.addHsp(hsp)
 
         return alignments
 
+    def records(self):
+        """
+        Read lines of JSON from self._filename and yield the records they
+        hold.
+
+        @raise ValueError: If any of the lines in the file cannot be converted
+            to JSON.
+        @return: A generator that yields C{dict}s with 'alignments' and
+            'query' keys.
+        """
+        if self._fp is None:
+            self._open(self._filename)
+
+        try:
+            if self._parallel:
+                # The records are already parsed (and the first line, the
+                # parameters, has been read in self._open).
+                for record in self._fp:
+                    yield record
+            else:
+                for lineNumber, line in enumerate(self._fp, start=2):
+                    try:
+                        record = loads(line[:-1])
+                    except ValueError as e:
+                        raise ValueError(
+                            'Could not convert line %d of %r to JSON (%s). '
+                            'Line is %r.' %
+                            (lineNumber, self._filename, e, line[:-1]))
+                    else:
+                        yield record
+        finally:
+            self._fp.close()
+            self._fp = None
+
+    def saveAsAlignmentStore(self, filename):
+        """
+        Write the records out as an alignment store (see
+        L{dark.alignment_store}).
+
+        @param filename: The C{str} name of the file to write.
+        @return: The C{int} number of records saved.
+        """
+        return saveAlignmentStore(filename, self.params, self.records())
+
+    def _dictsToAlignments(self, blastDicts, reads):
+        """
+        Take many dicts (made by XMLRecordsReader._convertBlastRecordToDict)
+        and convert them to lists of alignments, normalizing all their HSPs
+        at once (see L{dark.blast.hsp.normalizeHSPs}).
+
+        @param blastDicts: A C{list} of C{dict}s, from
+            convertBlastRecordToDict.
+        @param reads: A C{list} of the C{Read} instances that BLAST used to
+            create the records. Their ids must already have been checked
+            against the records.
+        @return: A C{list} containing a C{list} of
+            L{dark.alignment.Alignment} instances for each record.
+        """
+        blastHsps = []
+        readLens = []
+        for blastDict, read in zip(blastDicts, reads):
+            readLen = len(read)
+            for blastAlignment in blastDict['alignments']:
+                for blastHsp in blastAlignment['hsps']:
+                    blastHsps.append(blastHsp)
+                    readLens.append(readLen)
+
+        try:
+            normalized = normalizeHSPs(
+                [blastHsp['query_start'] for blastHsp in blastHsps],
+                [blastHsp['query_end'] for blastHsp in blastHsps],
+                [blastHsp['sbjct_start'] for blastHsp in blastHsps],
+                [blastHsp['sbjct_end'] for blastHsp in blastHsps],
+                [blastHsp['frame'][0] for blastHsp in blastHsps],
+                [blastHsp['frame'][1] for blastHsp in blastHsps],
+                readLens,
+                [blastHsp['query'].count('-') for blastHsp in blastHsps],
+                [blastHsp['sbjct'].count('-') for blastHsp in blastHsps],
+                self.application)
+        except AssertionError:
+            # Convert the records one by one, so normalizeHSP can report
+            # the details of the HSP that caused the problem.
+            return [self._dictToAlignments(blastDict, read)
+                    for blastDict, read in zip(blastDicts, reads)]
+
+        offsets = zip(*[normalized[key].tolist() for key in (
+            'readStart', 'readEnd', 'readStartInSubject', 'readEndInSubject',
+            'subjectStart', 'subjectEnd')])
+
+        result = []
+        getScore = itemgetter(
+            'bits' if self._scoreClass is HigherIsBetterScore else 'expect')
+
+        for blastDict in blastDicts:
+            alignments = []
+            for blastAlignment in blastDict['alignments']:
+                alignment = Alignment(blastAlignment['length'],
+                                      blastAlignment['title'])
+                alignments.append(alignment)
+                for blastHsp in blastAlignment['hsps']:
+                    (readStart, readEnd, readStartInSubject, readEndInSubject,
+                     subjectStart, subjectEnd) = next(offsets)
+                    # See _dictToAlignments for why blastHsp.get is used for
+                    # identicalCount and positiveCount.
+                    alignment.addHsp(self._hspClass(
+                        getScore(blastHsp),
+                        readStart=readStart,
+                        readEnd=readEnd,
+                        readStartInSubject=readStartInSubject,
+                        readEndInSubject=readEndInSubject,
+                        readFrame=blastHsp['frame'][0],
+                        subjectStart=subjectStart,
+                        subjectEnd=subjectEnd,
+                        subjectFrame=blastHsp['frame'][1],
+                        identicalCount=blastHsp.get('identicalCount'),
+                        positiveCount=blastHsp.get('positiveCount'),
+                        **self._matchedSequences(blastHsp)))
+            result.append(alignments)
+
+        return result
+
+    def _convertBatch(self, reads, blastDicts):
+        """
+        Convert a batch of reads and their records to read alignments.
+
+        @param reads: A C{list} of C{Read} instances.
+        @param blastDicts: A C{list} of the corresponding record C{dict}s.
+        @return: A generator that yields C{dark.alignments.ReadAlignments}
+            instances.
+        """
+        for read, alignments in zip(
+                reads, self._dictsToAlignments(blastDicts, reads)):
+            yield ReadAlignments(read, alignments)
+
     def readAlignments(self, reads):
         """
-        Read lines of JSON from self._filename, convert them to read alignments
-        and yield them.
+        Read BLAST records from self._filename, convert them to read
+        alignments and yield them.
 
         @param reads: An iterable of L{Read} instances, corresponding to the
             reads that were given to BLAST.
@@ -296,31 +496,115 @@ class JSONRecordsReader(object):
         @return: A generator that yields C{dark.alignments.ReadAlignments}
             instances.
         """
+        reads = iter(reads)
+        # Records are converted in batches, so their HSPs can be normalized
+        # together.
+        batchReads = []
+        batchRecords = []
+
+        for recordNumber, record in enumerate(self.records(), start=1):
+            try:
+                read = next(reads)
+            except StopIteration:
+                for readAlignments in self._convertBatch(batchReads,
+                                                         batchRecords):
+                    yield readAlignments
+                raise ValueError(
+                    'Read generator failed to yield read number %d '
+                    'during parsing of BLAST file %r.' %
+                    (recordNumber, self._filename))
+            else:
+                try:
+                    self._checkReadId(record, read)
+                except ValueError:
+                    for readAlignments in self._convertBatch(batchReads,
+                                                             batchRecords):
+                        yield readAlignments
+                    raise
+                batchReads.append(read)
+                batchRecords.append(record)
+
+            if len(batchRecords) == self.BATCH_SIZE:
+                for readAlignments in self._convertBatch(batchReads,
+                                                         batchRecords):
+                    yield readAlignments
+                batchReads = []
+                batchRecords = []
+
+        for readAlignments in self._convertBatch(batchReads, batchRecords):
+            yield readAlignments
+
+
+class AlignmentStoreRecordsReader(JSONRecordsReader):
+    """
+    Provide a method that yields BLAST records from an alignment store (see
+    L{dark.alignment_store}). Store, check, and make accessible the global
+    BLAST parameters.
+
+    The HSPs are L{dark.hsp.SlottedHSP} (or L{dark.hsp.SlottedLSP})
+    instances whose matched sequences are only read from the store when
+    they are accessed. This keeps the alignments of large runs (e.g., in a
+    C{TitlesAlignments} instance) small in memory.
+
+    @param filename: A C{str} alignment store filename.
+    @param scoreClass: A class to hold and compare scores (see scores.py).
+        Default is C{HigherIsBetterScore}, for comparing bit scores. If you
+        are using e-values, pass LowerIsBetterScore instead.
+    """
+    def __init__(self, filename, scoreClass=HigherIsBetterScore,
+                 workers=None):
+        JSONRecordsReader.__init__(self, filename, scoreClass, workers)
+        if scoreClass is HigherIsBetterScore:
+            self._hspClass = SlottedHSP
+        else:
+            self._hspClass = SlottedLSP
+
+    def _open(self, filename):
+        """
+        Open the alignment store. Set self._fp to point to it and set
+        self.params.
+
+        @param filename: A C{str} alignment store filename.
+        @raise ValueError: if the store parameters do not contain an
+            'application' key.
+        """
+        self._fp = self._store = AlignmentStore(filename)
+        self.params = self._fp.params
+        if 'application' not in self.params:
+            raise ValueError(
+                'Alignment store %r has no BLAST global parameters.' %
+                self._filename)
+
+    def records(self):
+        """
+        Yield the records in the alignment store.
+
+        @return: A generator that yields C{dict}s with 'alignments' and
+            'query' keys.
+        """
         if self._fp is None:
             self._open(self._filename)
 
-        reads = iter(reads)
+        # The index in the store of the next HSP to be converted. Records
+        # are converted in the order they are read.
+        self._hspIndex = count()
 
         try:
-            for lineNumber, line in enumerate(self._fp, start=2):
-                try:
-                    record = loads(line[:-1])
-                except ValueError as e:
-                    raise ValueError(
-                        'Could not convert line %d of %r to JSON (%s). '
-                        'Line is %r.' %
-                        (lineNumber, self._filename, e, line[:-1]))
-                else:
-                    try:
-                        read = next(reads)
-                    except StopIteration:
-                        raise ValueError(
-                            'Read generator failed to yield read number %d '
-                            'during parsing of BLAST file %r.' %
-                            (lineNumber - 1, self._filename))
-                    else:
-                        alignments = self._dictToAlignments(record, read)
-                        yield ReadAlignments(read, alignments)
+            for record in self._fp.records():
+                yield record
         finally:
             self._fp.close()
             self._fp = None
+
+    def _matchedSequences(self, hsp):
+        """
+        Get the keyword arguments that make an HSP load its matched
+        sequences from the store.
+
+        @param hsp: A C{dict} holding an HSP, from a record in the store.
+        @return: A C{dict} of keyword arguments for C{self._hspClass}.
+        """
+        return {
+            'sequenceSource': self._store,
+            'sequenceIndex': next(self._hspIndex),
+        }
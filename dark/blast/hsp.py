@@ -1,3 +1,6 @@
+import numpy as np
+
+
 def printHSP(hsp, indent=''):
     for attr in ['bits', 'expect', 'frame', 'query_end', 'query_start',
                  'sbjct', 'query', 'sbjct_end', 'sbjct_start']:
@@ -178,3 +181,100 @@ def normalizeHSP(hsp, readLen, blastApplication):
         'subjectStart': subjectStart,
         'subjectEnd': subjectEnd,
     }
+
+
+def normalizeHSPs(readStarts, readEnds, subjectStarts, subjectEnds,
+                  readFrames, subjectFrames, readLens, readGaps, subjectGaps,
+                  blastApplication):
+    """
+    Normalize many HSPs at once. This does exactly what C{normalizeHSP}
+    does, but on numpy arrays, so a whole file (or chunk of a file) of HSPs
+    can be normalized without a Python function call (and result C{dict})
+    per HSP.
+
+    @param readStarts: An iterable of the C{int} 1-based 'query_start'
+        values of the HSPs.
+    @param readEnds: An iterable of the C{int} 1-based 'query_end' values.
+    @param subjectStarts: An iterable of the C{int} 1-based 'sbjct_start'
+        values.
+    @param subjectEnds: An iterable of the C{int} 1-based 'sbjct_end' values.
+    @param readFrames: An iterable of the C{int} read (first) 'frame'
+        values.
+    @param subjectFrames: An iterable of the C{int} subject (second) 'frame'
+        values.
+    @param readLens: An iterable of the C{int} lengths of the reads.
+    @param readGaps: An iterable of the C{int} number of '-' characters in
+        the 'query' of each HSP.
+    @param subjectGaps: An iterable of the C{int} number of '-' characters
+        in the 'sbjct' of each HSP.
+    @param blastApplication: The C{str} command line program that was
+        run (e.g., 'blastn', 'blastx').
+    @raise AssertionError: If any HSP fails a sanity check that would make
+        C{normalizeHSP} raise. The message gives the index of the first
+        such HSP. Call C{normalizeHSP} on that HSP for full details.
+    @return: A C{dict} with the same keys as returned by C{normalizeHSP},
+        whose values are numpy C{int64} arrays of the zero-based offsets.
+    """
+    def array(values):
+        return np.asarray(values, dtype=np.int64)
+
+    def checkNone(failed, msg):
+        if failed.any():
+            raise AssertionError('%s (HSP %d)' % (msg, np.argmax(failed)))
+
+    read_start = array(readStarts)
+    read_end = array(readEnds)
+    sbjct_start = array(subjectStarts)
+    sbjct_end = array(subjectEnds)
+    readPositive = array(readFrames) > 0
+    hitPositive = array(subjectFrames) > 0
+    readLen = array(readLens)
+    readGaps = array(readGaps)
+    hitGaps = array(subjectGaps)
+
+    # See normalizeHSP for an explanation of all the following.
+
+    checkNone(read_start > read_end, 'read_start > read_end')
+    checkNone(hitPositive & (sbjct_start > sbjct_end),
+              'sbjct_start > sbjct_end')
+
+    swap = sbjct_start > sbjct_end
+    sbjct_start, sbjct_end = (np.where(swap, sbjct_end, sbjct_start),
+                              np.where(swap, sbjct_start, sbjct_end))
+
+    readStartInSubject = read_start - 1
+    readEndInSubject = read_end
+    subjectStart = sbjct_start - 1
+    subjectEnd = sbjct_end
+
+    if blastApplication == 'blastx':
+        # Truncate towards zero, as int(x / 3) does.
+        readStartInSubject = (np.sign(readStartInSubject) *
+                              (np.abs(readStartInSubject) // 3))
+        readEndInSubject = (np.sign(readEndInSubject) *
+                            (np.abs(readEndInSubject) // 3))
+
+    checkNone(subjectEnd - subjectStart + hitGaps !=
+              readEndInSubject - readStartInSubject + readGaps,
+              'Including gaps, hit match length != Read match length')
+
+    unmatchedReadLeft = np.where(readPositive, readStartInSubject,
+                                 readLen - readEndInSubject)
+
+    readStartInSubject = np.where(
+        hitPositive, subjectStart - unmatchedReadLeft,
+        subjectEnd + unmatchedReadLeft - readLen - readGaps)
+    readEndInSubject = readStartInSubject + readLen + readGaps
+
+    checkNone(readStartInSubject > subjectStart,
+              'readStartInSubject > subjectStart')
+    checkNone(readEndInSubject < subjectEnd, 'readEndInSubject < subjectEnd')
+
+    return {
+        'readStart': read_start - 1,
+        'readEnd': read_end,
+        'readStartInSubject': readStartInSubject,
+        'readEndInSubject': readEndInSubject,
+        'subjectStart': subjectStart,
+        'subjectEnd': subjectEnd,
+    }
@@ -0,0 +1,139 @@
+from __future__ import division
+
+from math import ceil, exp, log
+
+from dark.utils import xxh3_128_intdigest
+
+_LN2_SQUARED = log(2) ** 2
+_MASK64 = (1 << 64) - 1
+
+
+class BloomFilter(object):
+    """
+    Remember (approximately) which strings have been seen, in a fixed amount
+    of memory.
+
+    A Bloom filter never forgets a string it has been given, but will
+    sometimes claim to have seen a string that it has not (a false
+    positive). The false positive rate rises as more strings are added.
+
+    At least one of C{capacity} and C{maxBytes} must be given. If only
+    C{capacity} is given, the filter is made big enough to give the wanted
+    false positive rate once C{capacity} distinct strings have been added.
+    If only C{maxBytes} is given, the filter uses that much memory and its
+    capacity is however many strings it can hold at the wanted false
+    positive rate. If both are given, the filter is sized for C{capacity}
+    but will not use more than C{maxBytes} (in which case the false positive
+    rate will be higher than C{errorRate} once C{capacity} strings have been
+    added).
+
+    @param capacity: The C{int} number of distinct strings that are
+        expected to be added.
+    @param errorRate: The C{float} wanted false positive rate, once
+        C{capacity} distinct strings have been added.
+    @param maxBytes: The C{int} maximum number of bytes of memory to use for
+        the filter bits.
+    @raise ValueError: If neither C{capacity} nor C{maxBytes} is given, or
+        if any of the arguments is out of range.
+    """
+    def __init__(self, capacity=None, errorRate=0.001, maxBytes=None):
+        if capacity is None and maxBytes is None:
+            raise ValueError('At least one of capacity or maxBytes must be '
+                             'given.')
+        if not 0.0 < errorRate < 1.0:
+            raise ValueError('The error rate (%r) must be greater than zero '
+                             'and less than one.' % errorRate)
+        if capacity is not None and capacity < 1:
+            raise ValueError('The capacity (%r) must be at least one.' %
+                             capacity)
+        if maxBytes is not None and maxBytes < 1:
+            raise ValueError('The maximum number of bytes (%r) must be at '
+                             'least one.' % maxBytes)
+
+        if capacity is None:
+            bitCount = maxBytes * 8
+            capacity = max(1, int(bitCount * _LN2_SQUARED / -log(errorRate)))
+        else:
+            bitCount = int(ceil(capacity * -log(errorRate) / _LN2_SQUARED))
+            if maxBytes is not None:
+                bitCount = min(bitCount, maxBytes * 8)
+
+        # Round the number of bits up to a whole number of bytes.
+        byteCount = (bitCount + 7) // 8
+        self.bitCount = byteCount * 8
+        self.capacity = capacity
+        self.errorRate = errorRate
+        self.hashCount = max(1, int(round(self.bitCount / capacity * log(2))))
+        self.count = 0
+        self._bits = bytearray(byteCount)
+
+    def _offsets(self, s):
+        """
+        Find the bit offsets for a string, using double hashing (see
+        Kirsch & Mitzenmacher, "Less Hashing, Same Performance: Building a
+        Better Bloom Filter").
+
+        @param s: A C{str}.
+        @return: A C{list} of C{self.hashCount} C{int} bit offsets.
+        """
+        digest = xxh3_128_intdigest(s.encode('UTF-8'))
+        bitCount = self.bitCount
+        offset = (digest & _MASK64) % bitCount
+        # Make the second hash odd so it is never zero.
+        step = ((digest >> 64) | 1) % bitCount
+        offsets = []
+        append = offsets.append
+        for _ in range(self.hashCount):
+            append(offset)
+            offset += step
+            if offset >= bitCount:
+                offset -= bitCount
+        return offsets
+
+    def __contains__(self, s):
+        bits = self._bits
+        for offset in self._offsets(s):
+            if not bits[offset >> 3] & (1 << (offset & 7)):
+                return False
+        return True
+
+    def add(self, s):
+        """
+        Add a string to the filter.
+
+        @param s: A C{str}.
+        @return: C{True} if C{s} was (probably) already in the filter, else
+            C{False}.
+        """
+        bits = self._bits
+        present = True
+        for offset in self._offsets(s):
+            index = offset >> 3
+            mask = 1 << (offset & 7)
+            if not bits[index] & mask:
+                bits[index] |= mask
+                present = False
+
+        if not present:
+            self.count += 1
+
+        return present
+
+    def __len__(self):
+        """
+        How many distinct strings have been added?
+
+        @return: The C{int} number of strings that have been added and which
+            were not (apparently) already present.
+        """
+        return self.count
+
+    def falsePositiveRate(self):
+        """
+        Estimate the current false positive rate.
+
+        @return: The C{float} probability that a string that has not been
+            added will be reported as present.
+        """
+        return (1.0 - exp(-self.hashCount * self.count / self.bitCount)) ** (
+            self.hashCount)
@@ -2155,6 +2155,19 @@ class SqliteIndex(object):
     PROTEIN_ACCESSION_FIELD = 2
     GENOME_ACCESSION_FIELD = 4
 
+    # The columns of the genomes and proteins tables, other than the
+    # (potentially long) sequence.
+    GENOME_COLUMNS = ('accession', 'organism', 'name', 'length',
+                      'proteinCount', 'host', 'note', 'taxonomyId',
+                      'databaseName')
+    PROTEIN_COLUMNS = ('accession', 'genomeAccession', 'length', 'offsets',
+                       'forward', 'circular', 'rangeCount', 'gene', 'note',
+                       'product')
+
+    # The maximum number of accession numbers to look up in one query.
+    # Older versions of sqlite3 allow at most 999 parameters per query.
+    LOOKUP_BATCH_SIZE = 500
+
     def __init__(self, dbFilenameOrConnection, lookupCacheSize=1024):
         if isinstance(dbFilenameOrConnection, string_types):
             self._connection = sqlite3.connect(dbFilenameOrConnection)
@@ -2272,6 +2285,100 @@ class SqliteIndex(object):
 
         return self._findProtein(accession)
 
+    def _findMany(self, table, ids, accessionFunc, columns, allColumns):
+        """
+        Helper function for self.findGenomes and self.findProteins.
+
+        @param table: The C{str} name of the database table to look in.
+        @param ids: An iterable of C{str} sequence ids or accession numbers.
+        @param accessionFunc: A function to extract an accession number
+            from a sequence id.
+        @param columns: An iterable of C{str} column names, or C{None}.
+        @param allColumns: The C{tuple} of C{str} column names to use if
+            C{columns} is C{None}.
+        @raise ValueError: If an unknown column name is given.
+        @return: A C{dict} keyed by C{str} accession number, with C{dict}
+            values keyed by column name.
+        """
+        if columns is None:
+            columns = allColumns
+        else:
+            columns = list(columns)
+            unknown = set(columns) - set(allColumns + ('sequence',))
+            if unknown:
+                raise ValueError('Unknown %s column name%s: %s.' % (
+                    table, '' if len(unknown) == 1 else 's',
+                    ', '.join(sorted(unknown))))
+            if 'accession' not in columns:
+                columns.append('accession')
+
+        accessions = set()
+        for id_ in ids:
+            try:
+                accessions.add(accessionFunc(id_))
+            except IndexError:
+                accessions.add(id_)
+        accessions = sorted(accessions)
+
+        result = {}
+        batchSize = self.LOOKUP_BATCH_SIZE
+        for start in range(0, len(accessions), batchSize):
+            batch = accessions[start:start + batchSize]
+            cur = self.execute(
+                'SELECT %s FROM %s WHERE accession IN (%s)' % (
+                    ', '.join(columns), table, ', '.join('?' * len(batch))),
+                batch)
+            for row in cur:
+                result[row['accession']] = dict(row)
+
+        return result
+
+    def findGenomes(self, ids, columns=None):
+        """
+        Find info about many genomes, with a database query per (up to)
+        C{self.LOOKUP_BATCH_SIZE} genomes.
+
+        @param ids: An iterable of C{str} sequence ids, as for
+            C{findGenome}.
+        @param columns: An iterable of C{str} genomes table column names to
+            return (the accession is always returned). If C{None}, all
+            columns except the genome sequence are returned.
+        @raise ValueError: If an unknown column name is given.
+        @return: A C{dict} keyed by C{str} accession number, with values
+            that are C{dict}s with keys corresponding to the names of the
+            wanted columns in the genomes database table. Accessions that
+            cannot be found are not in the result.
+        """
+        return self._findMany('genomes', ids, self.genomeAccession, columns,
+                              self.GENOME_COLUMNS)
+
+    def findProteins(self, ids, columns=None):
+        """
+        Find info about many proteins, with a database query per (up to)
+        C{self.LOOKUP_BATCH_SIZE} proteins.
+
+        @param ids: An iterable of C{str} sequence ids, as for
+            C{findProtein}.
+        @param columns: An iterable of C{str} proteins table column names
+            to return (the accession is always returned). If C{None}, all
+            columns except the protein sequence are returned.
+        @raise ValueError: If an unknown column name is given.
+        @return: A C{dict} keyed by C{str} accession number, with values
+            that are C{dict}s with keys corresponding to the names of the
+            wanted columns in the proteins database table. Accessions that
+            cannot be found are not in the result.
+        """
+        result = self._findMany('proteins', ids, self.proteinAccession,
+                                columns, self.PROTEIN_COLUMNS)
+        for protein in result.values():
+            if 'forward' in protein:
+                protein['forward'] = bool(protein['forward'])
+            if 'circular' in protein:
+                protein['circular'] = bool(protein['circular'])
+            if 'length' in protein:
+                protein['length'] = int(protein['length'])
+        return result
+
     def _yieldProteins(self, rows, cur):
         """
         Helper function for self.findProteinsForGenome.
@@ -2347,6 +2454,19 @@ class SqliteIndex(object):
         cur = self.execute('SELECT COUNT(1) FROM genomes')
         return int(cur.fetchone()[0])
 
+    def genomeLengths(self):
+        """
+        Get the lengths of all genomes in the database.
+
+        @return: A generator that yields (accession, length) 2-tuples, with a
+            C{str} accession number and an C{int} length, sorted by
+            accession number.
+        """
+        cur = self.execute(
+            'SELECT accession, length FROM genomes ORDER BY accession')
+        for row in cur:
+            yield row['accession'], int(row['length'])
+
     def close(self):
         """
         Close the database connection (if we opened it).
@@ -4,7 +4,9 @@ import copy
 
 from dark.alignments import (
     ReadsAlignments, ReadAlignments, ReadsAlignmentsParams)
-from dark.diamond.conversion import JSONRecordsReader
+from dark.alignment_store import SUFFIX as ALIGNMENT_STORE_SUFFIX
+from dark.diamond.conversion import (
+    AlignmentStoreRecordsReader, JSONRecordsReader)
 from dark.fasta import FastaReads, SqliteIndex
 from dark.reads import AAReadWithX
 from dark.score import HigherIsBetterScore
@@ -43,16 +45,31 @@ class DiamondReadsAlignments(ReadsAlignments):
         by our HTCondor jobs.
     @param randomizeZeroEValues: If C{True}, e-values that are zero will be set
         to a random (very good) value.
+    @param decompressionWorkers: The C{int} number of processes to use to
+        decompress and parse each compressed JSON file that holds many bzip2
+        streams or gzip members (see L{dark.parallel_json}), or C{None} to
+        read the files in this process.
+    @param fileWorkers: The C{int} number of processes to use to read
+        DIAMOND files concurrently. If C{None} or less than two, the files
+        are read one after another. Requires C{readsPerFile}.
+    @param readsPerFile: The number of reads whose records are in each
+        file (as needed when reading files concurrently). Either an C{int}
+        (the number of reads given to each HTCondor job by
+        C{bin/write-htcondor-job-spec.py}; the last file may have fewer) or a
+        C{list} with the C{int} number of reads for each file, in the order
+        the files are read (i.e., after any sorting).
     @raises ValueError: if a file type is not recognized, or if the number of
         reads does not match the number of records found in the DIAMOND result
-        files, or if neither (or both) of databaseFilename and
-        sqliteDatabaseFilename are given.
+        files, if neither (or both) of databaseFilename and
+        sqliteDatabaseFilename are given, or if C{fileWorkers} is more than
+        one and C{readsPerFile} is not given.
     """
 
     def __init__(self, reads, filenames, databaseFilename=None,
                  databaseDirectory=None, sqliteDatabaseFilename=None,
                  scoreClass=HigherIsBetterScore, sortFilenames=False,
-                 randomizeZeroEValues=True):
+                 randomizeZeroEValues=True, decompressionWorkers=None,
+                 fileWorkers=None, readsPerFile=None):
         if type(filenames) == str:
             filenames = [filenames]
         if sortFilenames:
@@ -65,6 +82,12 @@ class DiamondReadsAlignments(ReadsAlignments):
         self._databaseDirectory = databaseDirectory
         self._subjectTitleToSubject = None
         self.randomizeZeroEValues = randomizeZeroEValues
+        self.decompressionWorkers = decompressionWorkers
+        self.fileWorkers = fileWorkers
+        self.readsPerFile = readsPerFile
+        if self._concurrent() and readsPerFile is None:
+            raise ValueError(
+                'readsPerFile must be given if fileWorkers is more than one.')
 
         # Prepare diamondTask parameters in order to initialize self.
         self._reader = self._getReader(self.filenames[0], scoreClass)
@@ -83,21 +106,36 @@ class DiamondReadsAlignments(ReadsAlignments):
 
     def _getReader(self, filename, scoreClass):
         """
-        Obtain a JSON record reader for DIAMOND records.
+        Obtain a record reader for DIAMOND records.
 
-        @param filename: The C{str} file name holding the JSON.
+        @param filename: The C{str} file name holding the JSON or alignment
+            store (see L{dark.alignment_store}).
         @param scoreClass: A class to hold and compare scores (see scores.py).
         """
-        if filename.endswith('.json') or filename.endswith('.json.bz2'):
-            return JSONRecordsReader(filename, scoreClass)
+        if (filename.endswith('.json') or filename.endswith('.json.bz2') or
+                filename.endswith('.json.gz')):
+            return JSONRecordsReader(filename, scoreClass,
+                                     workers=self.decompressionWorkers)
+        elif filename.endswith(ALIGNMENT_STORE_SUFFIX):
+            return AlignmentStoreRecordsReader(filename, scoreClass)
         else:
             raise ValueError(
                 'Unknown DIAMOND record file suffix for file %r.' % filename)
 
-    def iter(self):
+    def _concurrent(self):
         """
-        Extract DIAMOND records and yield C{ReadAlignments} instances.
+        Should the DIAMOND files be read concurrently?
+
+        @return: C{True} if there are many files and many file workers.
+        """
+        return (self.fileWorkers is not None and self.fileWorkers > 1 and
+                len(self.filenames) > 1)
 
+    def _iterFiles(self, reads):
+        """
+        Read the DIAMOND files one after another.
+
+        @param reads: An iterator of the reads given to DIAMOND.
         @return: A generator that yields C{ReadAlignments} instances.
         """
         # Note that self._reader is already initialized (in __init__) for
@@ -105,7 +143,6 @@ class DiamondReadsAlignments(ReadsAlignments):
         # makes testing easier, since open() is then only called once for
         # each input file.
 
-        reads = iter(self.reads)
         first = True
 
         for filename in self.filenames:
@@ -119,6 +156,27 @@ class DiamondReadsAlignments(ReadsAlignments):
             for readAlignments in reader.readAlignments(reads):
                 yield readAlignments
 
+    def iter(self):
+        """
+        Extract DIAMOND records and yield C{ReadAlignments} instances.
+
+        The DIAMOND files are read one after another or, if C{fileWorkers}
+        was given to __init__, concurrently.
+
+        @return: A generator that yields C{ReadAlignments} instances.
+        """
+        reads = iter(self.reads)
+
+        if self._concurrent():
+            readsAlignments = self._iterFilesConcurrently(
+                reads, self.filenames, self.readsPerFile, self.fileWorkers,
+                None, True)
+        else:
+            readsAlignments = self._iterFiles(reads)
+
+        for readAlignments in readsAlignments:
+            yield readAlignments
+
         # Any remaining query reads must have had no subject matches.
         for read in reads:
             yield ReadAlignments(read, [])
@@ -2,16 +2,21 @@ from __future__ import print_function
 
 import six
 import bz2
+import gzip
 from json import dumps, loads
 from operator import itemgetter
+from itertools import count
 from collections import Counter
 
 from Bio.File import as_handle
 
-from dark.hsp import HSP, LSP
+from dark.hsp import HSP, LSP, SlottedHSP, SlottedLSP
 from dark.score import HigherIsBetterScore
 from dark.alignments import Alignment, ReadAlignments
-from dark.diamond.hsp import normalizeHSP
+from dark.btop import countGaps
+from dark.diamond.hsp import normalizeHSP, normalizeHSPs
+from dark.parallel_json import compression, parallelJSONLines
+from dark.alignment_store import AlignmentStore, saveAlignmentStore
 
 # The following are the fields (in the order they are expected on the
 # command line via --outfmt 6) that must be given to DIAMOND blastx to
@@ -279,6 +284,16 @@ class DiamondTabularFormatReader(object):
                 fp.write(six.u(dumps(record, sort_keys=True)))
                 fp.write(six.u('\n'))
 
+    def saveAsAlignmentStore(self, filename):
+        """
+        Write the records out as an alignment store (see
+        L{dark.alignment_store}).
+
+        @param filename: The C{str} name of the file to write.
+        @return: The C{int} number of records saved.
+        """
+        return saveAlignmentStore(filename, self.params, self.records())
+
 
 class JSONRecordsReader(object):
     """
@@ -289,10 +304,19 @@ class JSONRecordsReader(object):
     @param scoreClass: A class to hold and compare scores (see scores.py).
         Default is C{HigherIsBetterScore}, for comparing bit scores. If you
         are using e-values, pass LowerIsBetterScore instead.
+    @param workers: The C{int} number of processes to use to decompress and
+        parse a compressed ('.bz2' or '.gz') file that holds many bzip2
+        streams or gzip members (such as those made by pbzip2 or bgzip).
+        If C{None}, the file is read in this process.
     """
-    def __init__(self, filename, scoreClass=HigherIsBetterScore):
+    # The number of records whose HSPs are normalized together.
+    BATCH_SIZE = 5000
+
+    def __init__(self, filename, scoreClass=HigherIsBetterScore,
+                 workers=None):
         self._filename = filename
         self._scoreClass = scoreClass
+        self._workers = workers
         if scoreClass is HigherIsBetterScore:
             self._hspClass = HSP
         else:
@@ -311,24 +335,52 @@ class JSONRecordsReader(object):
             if the input file is empty, or if the JSON does not contain an
             'application' key.
         """
-        if filename.endswith('.bz2'):
-            if six.PY3:
-                self._fp = bz2.open(filename, mode='rt', encoding='UTF-8')
-            else:
-                self._fp = bz2.BZ2File(filename)
+        self._parallel = (self._workers is not None and
+                          self._workers > 1 and
+                          compression(filename) is not None)
+
+        if self._parallel:
+            self._fp = parallelJSONLines(filename, self._workers)
+            try:
+                self.params = next(self._fp)
+            except StopIteration:
+                raise ValueError('JSON file %r was empty.' % self._filename)
         else:
-            self._fp = open(filename)
+            if filename.endswith('.bz2'):
+                if six.PY3:
+                    self._fp = bz2.open(filename, mode='rt', encoding='UTF-8')
+                else:
+                    self._fp = bz2.BZ2File(filename)
+            elif filename.endswith('.gz'):
+                if six.PY3:
+                    self._fp = gzip.open(filename, mode='rt', encoding='UTF-8')
+                else:
+                    self._fp = gzip.GzipFile(filename)
+            else:
+                self._fp = open(filename)
 
-        line = self._fp.readline()
-        if not line:
-            raise ValueError('JSON file %r was empty.' % self._filename)
+            line = self._fp.readline()
+            if not line:
+                raise ValueError('JSON file %r was empty.' % self._filename)
 
-        try:
-            self.params = loads(line[:-1])
-        except ValueError as e:
-            raise ValueError(
-                'Could not convert first line of %r to JSON (%s). '
-                'Line is %r.' % (self._filename, e, line[:-1]))
+            try:
+                self.params = loads(line[:-1])
+            except ValueError as e:
+                raise ValueError(
+                    'Could not convert first line of %r to JSON (%s). '
+                    'Line is %r.' % (self._filename, e, line[:-1]))
+
+    def _matchedSequences(self, diamondHsp):
+        """
+        Get the keyword arguments that give an HSP its matched sequences.
+
+        @param diamondHsp: A C{dict} holding an HSP, from a DIAMOND record.
+        @return: A C{dict} of keyword arguments for C{self._hspClass}.
+        """
+        return {
+            'readMatchedSequence': diamondHsp['query'],
+            'subjectMatchedSequence': diamondHsp['sbjct'],
+        }
 
     def _dictToAlignments(self, diamondDict, read):
         """
@@ -341,7 +393,8 @@ class JSONRecordsReader(object):
         @return: A C{list} of L{dark.alignment.Alignment} instances.
         """
         alignments = []
-        getScore = itemgetter('bits' if self._hspClass is HSP else 'expect')
+        getScore = itemgetter(
+            'bits' if self._scoreClass is HigherIsBetterScore else 'expect')
 
         for diamondAlignment in diamondDict['alignments']:
             alignment = Alignment(diamondAlignment['length'],
@@ -360,8 +413,6 @@ class JSONRecordsReader(object):
                     readFrame=diamondHsp['frame'],
                     subjectStart=normalized['subjectStart'],
                     subjectEnd=normalized['subjectEnd'],
-                    readMatchedSequence=diamondHsp['query'],
-                    subjectMatchedSequence=diamondHsp['sbjct'],
                     # Use diamondHsp.get on identicalCount, positiveCount,
                     # percentPositive, and percentIdentical because they
                     # were either added in version 2.0.3 or we didn't start
@@ -373,16 +424,158 @@ class JSONRecordsReader(object):
                     identicalCount=diamondHsp.get('identicalCount'),
                     positiveCount=diamondHsp.get('positiveCount'),
                     percentIdentical=diamondHsp.get('percentIdentical'),
-                    percentPositive=diamondHsp.get('percentPositive'))
+                    percentPositive=diamondHsp.get('percentPositive'),
+                    **self._matchedSequences(diamondHsp))
 
                 alignment.addHsp(hsp)
 
         return alignments
 
+    def records(self):
+        """
+        Read lines of JSON from self._filename and yield the records they
+        hold.
+
+        @raise ValueError: If any of the lines in the file cannot be converted
+            to JSON.
+        @return: A generator that yields C{dict}s with 'alignments' and
+            'query' keys.
+        """
+        if self._fp is None:
+            self._open(self._filename)
+
+        try:
+            if self._parallel:
+                # The records are already parsed (and the first line, the
+                # parameters, has been read in self._open).
+                for record in self._fp:
+                    yield record
+            else:
+                for lineNumber, line in enumerate(self._fp, start=2):
+                    try:
+                        record = loads(line[:-1])
+                    except ValueError as e:
+                        raise ValueError(
+                            'Could not convert line %d of %r to JSON (%s). '
+                            'Line is %r.' %
+                            (lineNumber, self._filename, e, line[:-1]))
+                    else:
+                        yield record
+        finally:
+            self._fp.close()
+            self._fp = None
+
+    def saveAsAlignmentStore(self, filename):
+        """
+        Write the records out as an alignment store (see
+        L{dark.alignment_store}).
+
+        @param filename: The C{str} name of the file to write.
+        @return: The C{int} number of records saved.
+        """
+        return saveAlignmentStore(filename, self.params, self.records())
+
+    def _dictsToAlignments(self, diamondDicts, reads):
+        """
+        Take many dicts (made by DiamondTabularFormatReader.records) and
+        convert them to lists of alignments, normalizing all their HSPs at
+        once (see L{dark.diamond.hsp.normalizeHSPs}).
+
+        @param diamondDicts: A C{list} of C{dict}s, from records().
+        @param reads: A C{list} of the C{Read} instances that DIAMOND used to
+            create the records.
+        @return: A C{list} containing a C{list} of
+            L{dark.alignment.Alignment} instances for each record.
+        """
+        diamondHsps = []
+        readLens = []
+        for diamondDict, read in zip(diamondDicts, reads):
+            readLen = len(read)
+            for diamondAlignment in diamondDict['alignments']:
+                for diamondHsp in diamondAlignment['hsps']:
+                    diamondHsps.append(diamondHsp)
+                    readLens.append(readLen)
+
+        queryGaps, subjectGaps = (
+            zip(*[countGaps(diamondHsp['btop'])
+                  for diamondHsp in diamondHsps]) if diamondHsps else ([], []))
+
+        try:
+            normalized = normalizeHSPs(
+                [diamondHsp['query_start'] for diamondHsp in diamondHsps],
+                [diamondHsp['query_end'] for diamondHsp in diamondHsps],
+                [diamondHsp['sbjct_start'] for diamondHsp in diamondHsps],
+                [diamondHsp['sbjct_end'] for diamondHsp in diamondHsps],
+                [diamondHsp['frame'] for diamondHsp in diamondHsps],
+                readLens, queryGaps, subjectGaps, self.diamondTask)
+        except AssertionError:
+            # Convert the records one by one, so normalizeHSP can report
+            # the details of the HSP that caused the problem.
+            return [self._dictToAlignments(diamondDict, read)
+                    for diamondDict, read in zip(diamondDicts, reads)]
+
+        offsets = zip(*[normalized[key].tolist() for key in (
+            'readStart', 'readEnd', 'readStartInSubject', 'readEndInSubject',
+            'subjectStart', 'subjectEnd')])
+
+        result = []
+        getScore = itemgetter(
+            'bits' if self._scoreClass is HigherIsBetterScore else 'expect')
+
+        for diamondDict in diamondDicts:
+            alignments = []
+            for diamondAlignment in diamondDict['alignments']:
+                alignment = Alignment(diamondAlignment['length'],
+                                      diamondAlignment['title'])
+                alignments.append(alignment)
+                for diamondHsp in diamondAlignment['hsps']:
+                    (readStart, readEnd, readStartInSubject, readEndInSubject,
+                     subjectStart, subjectEnd) = next(offsets)
+                    # See _dictToAlignments for why diamondHsp.get is used
+                    # for the last four arguments.
+                    alignment.addHsp(self._hspClass(
+                        getScore(diamondHsp),
+                        readStart=readStart,
+                        readEnd=readEnd,
+                        readStartInSubject=readStartInSubject,
+                        readEndInSubject=readEndInSubject,
+                        readFrame=diamondHsp['frame'],
+                        subjectStart=subjectStart,
+                        subjectEnd=subjectEnd,
+                        identicalCount=diamondHsp.get('identicalCount'),
+                        positiveCount=diamondHsp.get('positiveCount'),
+                        percentIdentical=diamondHsp.get('percentIdentical'),
+                        percentPositive=diamondHsp.get('percentPositive'),
+                        **self._matchedSequences(diamondHsp)))
+            result.append(alignments)
+
+        return result
+
+    def _convertBatch(self, batch):
+        """
+        Convert a batch of reads and their records to read alignments.
+
+        @param batch: A C{list} of (read, record) 2-tuples, where the record
+            is C{None} for reads that have no DIAMOND matches.
+        @return: A generator that yields C{dark.alignments.ReadAlignments}
+            instances, in the order of C{batch}.
+        """
+        matched = [(read, record) for read, record in batch
+                   if record is not None]
+        alignmentsList = iter(self._dictsToAlignments(
+            [record for _, record in matched],
+            [read for read, _ in matched]))
+
+        for read, record in batch:
+            if record is None:
+                yield ReadAlignments(read, [])
+            else:
+                yield ReadAlignments(read, next(alignmentsList))
+
     def readAlignments(self, reads):
         """
-        Read lines of JSON from self._filename, convert them to read alignments
-        and yield them.
+        Read DIAMOND records from self._filename, convert them to read
+        alignments and yield them.
 
         @param reads: An iterable of L{Read} instances, corresponding to the
             reads that were given to DIAMOND.
@@ -391,53 +584,120 @@ class JSONRecordsReader(object):
         @return: A generator that yields C{dark.alignments.ReadAlignments}
             instances.
         """
-        if self._fp is None:
-            self._open(self._filename)
-
         reads = iter(reads)
-
-        try:
-            for lineNumber, line in enumerate(self._fp, start=2):
+        # Records are converted in batches, so their HSPs can be normalized
+        # together.
+        batch = []
+        batchRecordCount = 0
+
+        for recordNumber, record in enumerate(self.records(), start=1):
+            recordTitle = record['query']
+            while True:
+                # Iterate through the input reads until we find the
+                # one that matches this DIAMOND record.
                 try:
-                    record = loads(line[:-1])
-                except ValueError as e:
+                    read = next(reads)
+                except StopIteration:
+                    for readAlignments in self._convertBatch(batch):
+                        yield readAlignments
                     raise ValueError(
-                        'Could not convert line %d of %r to JSON (%s). '
-                        'Line is %r.' %
-                        (lineNumber, self._filename, e, line[:-1]))
+                        'Read generator failed to yield a read '
+                        'with id \'%s\' as found in record number %d '
+                        'during parsing of DIAMOND output file %r.' %
+                        (recordTitle, recordNumber, self._filename))
                 else:
-                    recordTitle = record['query']
-                    while True:
-                        # Iterate through the input reads until we find the
-                        # one that matches this DIAMOND record.
-                        try:
-                            read = next(reads)
-                        except StopIteration:
-                            raise ValueError(
-                                'Read generator failed to yield a read '
-                                'with id \'%s\' as found in record number %d '
-                                'during parsing of DIAMOND output file %r.' %
-                                (recordTitle, lineNumber - 1, self._filename))
-                        else:
-                            # Look for an exact read id / subject title match.
-                            # If that doesn't work, allow for the case where
-                            # the JSON record has a truncated query (i.e.,
-                            # read) id. This covers the situation where a tool
-                            # we use (e.g., bwa mem) unconditionally does this
-                            # truncation in the output it writes.
-                            if (read.id == recordTitle or
-                                    read.id.split()[0] == recordTitle):
-                                alignments = self._dictToAlignments(record,
-                                                                    read)
-                                yield ReadAlignments(read, alignments)
-                                break
-                            else:
-                                # This is an input read that had no DIAMOND
-                                # matches. So it does not appear in the
-                                # DIAMOND's output. Yield an empty
-                                # ReadAlignments for it.
-                                yield ReadAlignments(read, [])
+                    # Look for an exact read id / subject title match.
+                    # If that doesn't work, allow for the case where
+                    # the JSON record has a truncated query (i.e.,
+                    # read) id. This covers the situation where a tool
+                    # we use (e.g., bwa mem) unconditionally does this
+                    # truncation in the output it writes.
+                    if (read.id == recordTitle or
+                            read.id.split()[0] == recordTitle):
+                        batch.append((read, record))
+                        batchRecordCount += 1
+                        break
+                    else:
+                        # This is an input read that had no DIAMOND
+                        # matches. So it does not appear in the
+                        # DIAMOND's output. Give it an empty
+                        # ReadAlignments.
+                        batch.append((read, None))
+
+            if batchRecordCount == self.BATCH_SIZE:
+                for readAlignments in self._convertBatch(batch):
+                    yield readAlignments
+                batch = []
+                batchRecordCount = 0
 
+        for readAlignments in self._convertBatch(batch):
+            yield readAlignments
+
+
+class AlignmentStoreRecordsReader(JSONRecordsReader):
+    """
+    Provide a method that yields DIAMOND records from an alignment store
+    (see L{dark.alignment_store}). Store, check, and make accessible the
+    DIAMOND parameters.
+
+    The HSPs are L{dark.hsp.SlottedHSP} (or L{dark.hsp.SlottedLSP})
+    instances whose matched sequences are only read from the store when
+    they are accessed. This keeps the alignments of large runs (e.g., in a
+    C{TitlesAlignments} instance) small in memory.
+
+    @param filename: A C{str} alignment store filename.
+    @param scoreClass: A class to hold and compare scores (see scores.py).
+        Default is C{HigherIsBetterScore}, for comparing bit scores. If you
+        are using e-values, pass LowerIsBetterScore instead.
+    """
+    def __init__(self, filename, scoreClass=HigherIsBetterScore,
+                 workers=None):
+        JSONRecordsReader.__init__(self, filename, scoreClass, workers)
+        if scoreClass is HigherIsBetterScore:
+            self._hspClass = SlottedHSP
+        else:
+            self._hspClass = SlottedLSP
+
+    def _open(self, filename):
+        """
+        Open the alignment store. Set self._fp to point to it and set
+        self.params.
+
+        @param filename: A C{str} alignment store filename.
+        """
+        self._fp = self._store = AlignmentStore(filename)
+        self.params = self._fp.params
+
+    def records(self):
+        """
+        Yield the records in the alignment store.
+
+        @return: A generator that yields C{dict}s with 'alignments' and
+            'query' keys.
+        """
+        if self._fp is None:
+            self._open(self._filename)
+
+        # The index in the store of the next HSP to be converted. Records
+        # are converted in the order they are read.
+        self._hspIndex = count()
+
+        try:
+            for record in self._fp.records():
+                yield record
         finally:
             self._fp.close()
             self._fp = None
+
+    def _matchedSequences(self, hsp):
+        """
+        Get the keyword arguments that make an HSP load its matched
+        sequences from the store.
+
+        @param hsp: A C{dict} holding an HSP, from a record in the store.
+        @return: A C{dict} of keyword arguments for C{self._hspClass}.
+        """
+        return {
+            'sequenceSource': self._store,
+            'sequenceIndex': next(self._hspIndex),
+        }
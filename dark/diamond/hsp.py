@@ -1,5 +1,6 @@
 from __future__ import division, print_function
 import sys
+import numpy as np
 
 from dark.btop import countGaps
 
@@ -195,3 +196,99 @@ def normalizeHSP(hsp, queryLen, diamondTask):
         'subjectStart': subjectStart,
         'subjectEnd': subjectEnd,
     }
+
+
+def normalizeHSPs(queryStarts, queryEnds, subjectStarts, subjectEnds, frames,
+                  queryLens, queryGaps, subjectGaps, diamondTask):
+    """
+    Normalize many HSPs at once. This does exactly what C{normalizeHSP}
+    does, but on numpy arrays, so a whole file (or chunk of a file) of HSPs
+    can be normalized without a Python function call (and result C{dict})
+    per HSP.
+
+    @param queryStarts: An iterable of the C{int} 1-based 'query_start'
+        values of the HSPs.
+    @param queryEnds: An iterable of the C{int} 1-based 'query_end' values.
+    @param subjectStarts: An iterable of the C{int} 1-based 'sbjct_start'
+        values.
+    @param subjectEnds: An iterable of the C{int} 1-based 'sbjct_end' values.
+    @param frames: An iterable of the C{int} 'frame' values.
+    @param queryLens: An iterable of the C{int} lengths of the query
+        sequences.
+    @param queryGaps: An iterable of the C{int} number of gaps in the query
+        of each HSP (see L{dark.btop.countGaps}).
+    @param subjectGaps: An iterable of the C{int} number of gaps in the
+        subject of each HSP.
+    @param diamondTask: The C{str} command-line matching algorithm that was
+        run (either 'blastx' or 'blastp').
+    @raise AssertionError: If any HSP fails a sanity check that would make
+        C{normalizeHSP} raise. The message gives the index of the first
+        such HSP. Call C{normalizeHSP} on that HSP for full details.
+    @return: A C{dict} with the same keys as returned by C{normalizeHSP},
+        whose values are numpy C{int64} arrays of the zero-based offsets.
+    """
+    def array(values):
+        return np.asarray(values, dtype=np.int64)
+
+    queryLen = array(queryLens)
+    queryGaps = array(queryGaps)
+    subjectGaps = array(subjectGaps)
+    frames = array(frames)
+    queryStart = array(queryStarts) - 1
+    queryEnd = array(queryEnds)
+    subjectStart = array(subjectStarts) - 1
+    subjectEnd = array(subjectEnds)
+
+    # See normalizeHSP for an explanation of all the following.
+
+    failed = queryStart >= queryEnd
+    if failed.any():
+        if diamondTask == 'blastx':
+            reversedFailed = failed & (frames < 0)
+            queryStart, queryEnd = (
+                np.where(reversedFailed, queryLen - (queryStart + 1),
+                         queryStart),
+                np.where(reversedFailed, queryLen - (queryEnd - 1),
+                         queryEnd))
+            failed &= ~reversedFailed
+        _checkNone(failed, 'queryStart >= queryEnd')
+
+    if diamondTask == 'blastx':
+        initiallyIgnored = np.abs(frames) - 1
+        queryLen = (queryLen - initiallyIgnored) // 3
+        queryStart = (queryStart - initiallyIgnored) // 3
+        queryEnd = (queryEnd - initiallyIgnored) // 3
+
+    queryStartInSubject = subjectStart - queryStart
+    queryEndInSubject = queryStartInSubject + queryLen + queryGaps
+
+    _checkNone(subjectStart >= subjectEnd, 'subjectStart >= subjectEnd')
+    _checkNone(subjectEnd - subjectStart + subjectGaps !=
+               queryEnd - queryStart + queryGaps,
+               'Including gaps, subject match length != Query match length')
+    _checkNone(queryStartInSubject > subjectStart,
+               'queryStartInSubject > subjectStart')
+    _checkNone(queryEndInSubject < subjectEnd,
+               'queryEndInSubject < subjectEnd')
+
+    return {
+        'readStart': queryStart,
+        'readEnd': queryEnd,
+        'readStartInSubject': queryStartInSubject,
+        'readEndInSubject': queryEndInSubject,
+        'subjectStart': subjectStart,
+        'subjectEnd': subjectEnd,
+    }
+
+
+def _checkNone(failed, msg):
+    """
+    Raise if a sanity check failed for any HSP in a batch.
+
+    @param failed: A numpy C{bool} array, with C{True} for HSPs that
+        failed the check.
+    @param msg: A C{str} description of the check.
+    @raise AssertionError: If any value in C{failed} is C{True}.
+    """
+    if failed.any():
+        raise AssertionError('%s (HSP %d)' % (msg, np.argmax(failed)))
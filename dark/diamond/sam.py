@@ -3,6 +3,7 @@ from __future__ import print_function
 from os import unlink
 from tempfile import TemporaryFile
 from resource import getrlimit, RLIMIT_NOFILE
+from cachetools import LRUCache
 
 from dark.btop import btop2cigar
 from dark.diamond.conversion import DiamondTabularFormat
@@ -100,6 +101,10 @@ class _DiamondSAMWriter(object):
         SAM specification, but since SAM files are TAB-separated there may be
         only a small chance this will cause problems downstream.
     """
+    # The maximum number of genomes and of proteins to keep after they have
+    # been looked up.
+    LOOKUP_CACHE_SIZE = 1024
+
     def __init__(self, genomesProteins, mappingQuality=255, ram=False,
                  keepDescriptions=False):
         self._genomesProteins = genomesProteins
@@ -108,38 +113,89 @@ class _DiamondSAMWriter(object):
         self._keepDescriptions = keepDescriptions
         self._strToDiamondDict = DiamondTabularFormat().diamondFieldsToDict
         self._referenceLengths = {}
+        # Recently looked up genomes and proteins (without sequences),
+        # keyed by accession number.
+        self._genomes = LRUCache(maxsize=self.LOOKUP_CACHE_SIZE)
+        self._proteins = LRUCache(maxsize=self.LOOKUP_CACHE_SIZE)
 
-    def _preprocessMatch(self, diamondStr):
+    def _preprocessMatches(self, diamondStrs):
         """
-        Add information from a row of DIAMOND tabular output.
-
-        @param diamondStr: A C{str} with TAB-separated fields from DIAMOND
-            output format 6.
-        @return: A C{tuple} containing the match C{dict} (from
-            C{self._strToDiamondDict}), the protein C{dict} as looked up
-            by C{self._genomesProteins.findProtein}, and the genome C{dict}
-            as looked up by C{self._genomesProteins.findGenome}.
+        Parse rows of DIAMOND tabular output and look up the proteins and
+        genomes they match.
+
+        The genomes and proteins (without their sequences) are looked up in
+        batches, using C{findGenomes} and C{findProteins}. The most recently
+        used C{self.LOOKUP_CACHE_SIZE} of each are kept, so accessions seen
+        in recent calls are not looked up again.
+
+        @param diamondStrs: An iterable of C{str}s with TAB-separated fields
+            from DIAMOND output format 6.
+        @raise ValueError: If a genome or protein accession cannot be found
+            in the genomes/proteins database.
+        @return: A C{list} of C{tuple}s, each containing the match C{dict}
+            (from C{self._strToDiamondDict}), the protein C{dict} as looked
+            up by C{self._genomesProteins.findProteins}, and the genome
+            C{dict} as looked up by C{self._genomesProteins.findGenomes}.
         """
-        match = self._strToDiamondDict(diamondStr)
-        stitle = match['stitle']
-
-        genomeAccession = self._genomesProteins.genomeAccession(stitle)
-        genome = self._genomesProteins.findGenome(genomeAccession)
-        if genome is None:
-            raise ValueError(
-                'Could not find accession %r in genomes database table.' %
-                genomeAccession)
+        db = self._genomesProteins
+        genomeCache = self._genomes
+        proteinCache = self._proteins
+        # The genomes and proteins needed for these matches. These are kept
+        # separately from the (bounded) caches so none can be evicted
+        # before they are used.
+        genomes = {}
+        proteins = {}
+        matches = []
+        wantedGenomes = set()
+        wantedProteins = set()
+
+        for diamondStr in diamondStrs:
+            match = self._strToDiamondDict(diamondStr)
+            stitle = match['stitle']
+            genomeAccession = db.genomeAccession(stitle)
+            proteinAccession = db.proteinAccession(stitle)
+            matches.append((match, genomeAccession, proteinAccession))
+            if genomeAccession not in genomes:
+                if genomeAccession in genomeCache:
+                    genomes[genomeAccession] = genomeCache[genomeAccession]
+                else:
+                    wantedGenomes.add(genomeAccession)
+            if proteinAccession not in proteins:
+                if proteinAccession in proteinCache:
+                    proteins[proteinAccession] = proteinCache[
+                        proteinAccession]
+                else:
+                    wantedProteins.add(proteinAccession)
+
+        if wantedGenomes:
+            found = db.findGenomes(wantedGenomes)
+            genomes.update(found)
+            genomeCache.update(found)
+        if wantedProteins:
+            found = db.findProteins(wantedProteins)
+            proteins.update(found)
+            proteinCache.update(found)
+
+        result = []
+        for match, genomeAccession, proteinAccession in matches:
+            try:
+                genome = genomes[genomeAccession]
+            except KeyError:
+                raise ValueError(
+                    'Could not find accession %r in genomes database table.' %
+                    genomeAccession)
 
-        proteinAccession = self._genomesProteins.proteinAccession(stitle)
-        protein = self._genomesProteins.findProtein(proteinAccession)
-        if protein is None:
-            raise ValueError(
-                'Could not find accession %r in proteins database table.' %
-                proteinAccession)
+            try:
+                protein = proteins[proteinAccession]
+            except KeyError:
+                raise ValueError(
+                    'Could not find accession %r in proteins database table.' %
+                    proteinAccession)
 
-        self._referenceLengths[genomeAccession] = genome['length']
+            self._referenceLengths[genomeAccession] = genome['length']
+            result.append((match, protein, genome))
 
-        return match, protein, genome
+        return result
 
     def _SAMLine(self, match, protein, genome):
         """
@@ -147,13 +203,13 @@ class _DiamondSAMWriter(object):
 
         @param match: A C{dict} with information about the DIAMOND match, as
             returned by C{DiamondTabularFormat().diamondFieldsToDict} which
-            has been called for us by C{self._preprocessMatch}.
+            has been called for us by C{self._preprocessMatches}.
         @param protein: A C{dict} with information about the protein the
             DIAMOND was for. The C{dict} is as returned by
-            C{dark.proteins.SqliteIndex.findProtein}.
+            C{dark.civ.proteins.SqliteIndex.findProteins}.
         @param genome: A C{dict} with information about the (nucleotide) genome
             that the protein in the DIAMOND match comes from. The C{dict} is
-            as returned by C{dark.proteins.SqliteIndex.findGenome}.
+            as returned by C{dark.civ.proteins.SqliteIndex.findGenomes}.
         @return: A TAB-separated C{str} line of SAM.
         """
         qseqid = (match['qseqid'] if self._keepDescriptions else
@@ -238,7 +294,32 @@ class _DiamondSAMWriter(object):
         @param diamondStr: A C{str} with TAB-separated fields from DIAMOND
             output format 6.
         """
-        raise NotImplementedError('addMatch must be implemented by a subclass')
+        self.addMatches((diamondStr,))
+
+    def addMatches(self, diamondStrs):
+        """
+        Add information from rows of DIAMOND tabular output. This is faster
+        than calling C{addMatch} for each row, because the genomes and
+        proteins the rows match are looked up together.
+
+        @param diamondStrs: An iterable of C{str}s with TAB-separated fields
+            from DIAMOND output format 6.
+        """
+        addPreprocessedMatch = self._addPreprocessedMatch
+        for match, protein, genome in self._preprocessMatches(diamondStrs):
+            addPreprocessedMatch(match, protein, genome)
+
+    def _addPreprocessedMatch(self, match, protein, genome):
+        """
+        Add a DIAMOND match.
+
+        @param match: A C{dict} with information about the DIAMOND match.
+        @param protein: A C{dict} with information about the matched protein.
+        @param genome: A C{dict} with information about the genome of the
+            matched protein.
+        """
+        raise NotImplementedError(
+            '_addPreprocessedMatch must be implemented by a subclass')
 
     def save(self, fp):
         """
@@ -274,14 +355,15 @@ class SimpleDiamondSAMWriter(_DiamondSAMWriter):
         self._tf = TemporaryFile(mode='w+t', encoding='utf-8')
         self._writer = SAMWriter(ram=ram)
 
-    def addMatch(self, diamondStr):
+    def _addPreprocessedMatch(self, match, protein, genome):
         """
-        Add information from a row of DIAMOND tabular output.
+        Add a DIAMOND match.
 
-        @param diamondStr: A C{str} with TAB-separated fields from DIAMOND
-            output format 6.
+        @param match: A C{dict} with information about the DIAMOND match.
+        @param protein: A C{dict} with information about the matched protein.
+        @param genome: A C{dict} with information about the genome of the
+            matched protein.
         """
-        match, protein, genome = self._preprocessMatch(diamondStr)
         self._writer.addMatchLine(
             self._SAMLine(match, protein, genome), genome, self._tf)
 
@@ -297,6 +379,71 @@ class SimpleDiamondSAMWriter(_DiamondSAMWriter):
         self._tf = self._writer = None
 
 
+class StreamingDiamondSAMWriter(_DiamondSAMWriter):
+    """
+    Convert DIAMOND tabular output to SAM in a single pass.
+
+    The SAM header is written immediately, with an @SQ line for every genome
+    in the C{genomesProteins} database, so there is no need to hold the
+    non-header SAM output (in RAM or in a temporary file) until all
+    reference lengths are known. SAM lines are written to C{fp} in batches.
+
+    @param genomesProteins: An open sqlite3 database with information on
+        genomes and proteins, as made by the dark-matter
+        make-protein-database.py script.
+    @param fp: An open file pointer to write SAM to.
+    @param mappingQuality: The mapping quality to use for the SAM MAPQ field
+        (#5). The default (255) indicates that mapping quality information is
+        not available.
+    @param keepDescriptions: If C{True}, do not discard text after the first
+        space in query or subject sequence ids. Note that this violates the
+        SAM specification, but since SAM files are TAB-separated there may be
+        only a small chance this will cause problems downstream.
+    @param headerLines: An optional iterable of C{str}s SAM header lines
+        (with no trailing newlines) to write before the @SQ lines.
+    @param batchSize: The C{int} number of SAM lines to collect before
+        writing them to C{fp}.
+    """
+    def __init__(self, genomesProteins, fp, mappingQuality=255,
+                 keepDescriptions=False, headerLines=None, batchSize=1000):
+        _DiamondSAMWriter.__init__(
+            self, genomesProteins, mappingQuality=mappingQuality,
+            keepDescriptions=keepDescriptions)
+        self._fp = fp
+        self._batchSize = batchSize
+        self._lines = list(headerLines or [])
+        for accession, length in genomesProteins.genomeLengths():
+            self._lines.append('@SQ\tSN:%s\tLN:%d' % (accession, length))
+        self._write()
+
+    def _write(self):
+        """
+        Write the collected SAM lines.
+        """
+        if self._lines:
+            self._fp.write('\n'.join(self._lines) + '\n')
+            self._lines = []
+
+    def _addPreprocessedMatch(self, match, protein, genome):
+        """
+        Add a DIAMOND match.
+
+        @param match: A C{dict} with information about the DIAMOND match.
+        @param protein: A C{dict} with information about the matched protein.
+        @param genome: A C{dict} with information about the genome of the
+            matched protein.
+        """
+        self._lines.append(self._SAMLine(match, protein, genome))
+        if len(self._lines) >= self._batchSize:
+            self._write()
+
+    def save(self):
+        """
+        Write any remaining SAM output.
+        """
+        self._write()
+
+
 class PerReferenceDiamondSAMWriter(_DiamondSAMWriter):
     """
     Convert DIAMOND tabular output to SAM and write it to per-reference
@@ -342,14 +489,15 @@ class PerReferenceDiamondSAMWriter(_DiamondSAMWriter):
             maxsize=(fpcMaxsize or getrlimit(RLIMIT_NOFILE)[0] >> 1),
             openArgs={'mode': 'wt'}, reopenArgs={'mode': 'at'})
 
-    def addMatch(self, diamondStr):
+    def _addPreprocessedMatch(self, match, protein, genome):
         """
-        Add information from a row of DIAMOND tabular output.
+        Add a DIAMOND match.
 
-        @param diamondStr: A C{str} with TAB-separated fields from DIAMOND
-            output format 6.
+        @param match: A C{dict} with information about the DIAMOND match.
+        @param protein: A C{dict} with information about the matched protein.
+        @param genome: A C{dict} with information about the genome of the
+            matched protein.
         """
-        match, protein, genome = self._preprocessMatch(diamondStr)
         genomeAccession = genome['accession']
         basename = self._baseFilenameFunc(match['stitle'])
 
@@ -2,16 +2,9 @@ from __future__ import division
 
 from collections import defaultdict
 
-from dark.utils import countPrint
+import numpy as np
 
-try:
-    from itertools import zip_longest
-except ImportError:
-    # zip_longest does not exist in Python 2.7 itertools. We should be able
-    # to get it via from six.moves import zip_longest according to
-    # https://pythonhosted.org/six/index.html?highlight=zip_longest but
-    # that doesn't work for me.
-    from itertools import izip_longest as zip_longest
+from dark.utils import countPrint, orderedPoolMap
 
 # A list of the ambiguous values is given at
 # https://en.wikipedia.org/wiki/Nucleic_acid_notation
@@ -37,6 +30,29 @@ AMBIGUOUS = {
 BASES_TO_AMBIGUOUS = dict(
     (''.join(sorted(bases)), symbol) for symbol, bases in AMBIGUOUS.items())
 
+# Bit masks for the nucleotides, used when comparing sequences with NumPy.
+_NT_BITS = {'A': 1, 'C': 2, 'G': 4, 'T': 8}
+
+# For each byte value, the bit mask of the nucleotides it could be (zero if
+# it is not a known nucleotide code).
+_NT_MASKS = np.zeros(256, dtype=np.uint8)
+for _code, _nts in AMBIGUOUS.items():
+    _NT_MASKS[ord(_code)] = sum(_NT_BITS[nt] for nt in _nts)
+
+# For each bit mask, the number of nucleotides it could be.
+_MASK_SIZES = np.array([bin(mask).count('1') for mask in range(256)],
+                       dtype=np.uint8)
+
+# The names of the counts made when comparing two DNA sequences.
+MATCH_COUNT_NAMES = ('identicalMatchCount', 'ambiguousMatchCount',
+                     'gapMismatchCount', 'gapGapMismatchCount',
+                     'nonGapMismatchCount')
+
+# Codes used by compareDNAReadSets for sequence characters that are not
+# known nucleotide codes. Known codes are represented by their (non-zero)
+# bit masks, which are all less than _GAP.
+_PAD, _GAP, _UNKNOWN = 0, 16, 32
+
 
 def matchToString(dnaMatch, read1, read2, matchAmbiguous=True, indent='',
                   offsets=None, includeGapLocations=True):
@@ -114,6 +130,23 @@ def matchToString(dnaMatch, read1, read2, matchAmbiguous=True, indent='',
     return '\n'.join(result)
 
 
+def _encodeDNA(sequence, gapChars):
+    """
+    Encode a DNA sequence for comparison with NumPy.
+
+    @param sequence: A C{str} DNA sequence.
+    @param gapChars: An object supporting __contains__ with characters that
+        should be considered to be gaps.
+    @return: A 2-tuple of C{np.ndarray}s, with the nucleotide bit mask (zero
+        for characters that are not nucleotide codes) of each upper-cased
+        sequence character, and a C{bool} indicating whether it is a gap.
+    """
+    codes = np.frombuffer(sequence.upper().encode('latin-1', 'replace'),
+                          dtype=np.uint8)
+    isGap = np.array([chr(code) in gapChars for code in range(256)])
+    return _NT_MASKS[codes], isGap[codes]
+
+
 def compareDNAReads(read1, read2, matchAmbiguous=True, gapChars='-',
                     offsets=None):
     """
@@ -133,75 +166,45 @@ def compareDNAReads(read1, read2, matchAmbiguous=True, gapChars='-',
     @return: A C{dict} with information about the match and the individual
         sequences (see below).
     """
-    identicalMatchCount = ambiguousMatchCount = 0
-    gapMismatchCount = nonGapMismatchCount = gapGapMismatchCount = 0
-    read1ExtraCount = read2ExtraCount = 0
-    read1GapOffsets = []
-    read2GapOffsets = []
-    read1AmbiguousOffsets = []
-    read2AmbiguousOffsets = []
-    empty = set()
-
-    def _identicalMatch(a, b):
-        return a == b and len(AMBIGUOUS[a]) == 1
-
-    def _ambiguousMatch(a, b, matchAmbiguous):
-        """
-        Checks if two characters match ambiguously if matchAmbiguous is True.
-        A match is an ambiguous match if it is not an identical match, but the
-        sets of ambiguous characters overlap.
-        """
-        return (matchAmbiguous and
-                not _identicalMatch(a, b) and
-                AMBIGUOUS.get(a, empty) & AMBIGUOUS.get(b, empty))
-
-    for offset, (a, b) in enumerate(zip_longest(read1.sequence.upper(),
-                                                read2.sequence.upper())):
-        # Use 'is not None' in the following to allow an empty offsets set
-        # to be passed.
-        if offsets is not None and offset not in offsets:
-            continue
-        if len(AMBIGUOUS.get(a, '')) > 1:
-            read1AmbiguousOffsets.append(offset)
-        if len(AMBIGUOUS.get(b, '')) > 1:
-            read2AmbiguousOffsets.append(offset)
-        if a is None:
-            # b has an extra character at its end (it cannot be None).
-            assert b is not None
-            read2ExtraCount += 1
-            if b in gapChars:
-                read2GapOffsets.append(offset)
-        elif b is None:
-            # a has an extra character at its end.
-            read1ExtraCount += 1
-            if a in gapChars:
-                read1GapOffsets.append(offset)
-        else:
-            # We have a character from both sequences (they could still be
-            # gap characters).
-            if a in gapChars:
-                read1GapOffsets.append(offset)
-                if b in gapChars:
-                    # Both are gaps. This can happen (though hopefully not
-                    # if the sequences were pairwise aligned).
-                    gapGapMismatchCount += 1
-                    read2GapOffsets.append(offset)
-                else:
-                    # a is a gap, b is not.
-                    gapMismatchCount += 1
-            else:
-                if b in gapChars:
-                    # b is a gap, a is not.
-                    gapMismatchCount += 1
-                    read2GapOffsets.append(offset)
-                else:
-                    # Neither is a gap character.
-                    if _identicalMatch(a, b):
-                        identicalMatchCount += 1
-                    elif _ambiguousMatch(a, b, matchAmbiguous):
-                        ambiguousMatchCount += 1
-                    else:
-                        nonGapMismatchCount += 1
+    masks1, gaps1 = _encodeDNA(read1.sequence, gapChars)
+    masks2, gaps2 = _encodeDNA(read2.sequence, gapChars)
+    length1, length2 = len(masks1), len(masks2)
+    common = min(length1, length2)
+
+    # Which offsets are wanted.
+    wanted = np.ones(max(length1, length2), dtype=bool)
+    # Use 'is not None' in the following to allow an empty offsets set to
+    # be passed.
+    if offsets is not None:
+        wanted[:] = False
+        wanted[[offset for offset in offsets
+                if 0 <= offset < len(wanted)]] = True
+    wanted1, wanted2 = wanted[:length1], wanted[:length2]
+
+    read1AmbiguousOffsets = np.flatnonzero(
+        (_MASK_SIZES[masks1] > 1) & wanted1).tolist()
+    read2AmbiguousOffsets = np.flatnonzero(
+        (_MASK_SIZES[masks2] > 1) & wanted2).tolist()
+    read1GapOffsets = np.flatnonzero(gaps1 & wanted1).tolist()
+    read2GapOffsets = np.flatnonzero(gaps2 & wanted2).tolist()
+    read1ExtraCount = int(wanted1[common:].sum())
+    read2ExtraCount = int(wanted2[common:].sum())
+
+    # Compare the offsets that are in both sequences.
+    gaps1, gaps2, wanted = gaps1[:common], gaps2[:common], wanted[:common]
+    masks1, masks2 = masks1[:common], masks2[:common]
+    gapGapMismatchCount = int((gaps1 & gaps2 & wanted).sum())
+    gapMismatchCount = int(((gaps1 ^ gaps2) & wanted).sum())
+    noGaps = ~gaps1 & ~gaps2 & wanted
+    identical = noGaps & (masks1 == masks2) & (_MASK_SIZES[masks1] == 1)
+    identicalMatchCount = int(identical.sum())
+    if matchAmbiguous:
+        ambiguousMatchCount = int(
+            (noGaps & ~identical & ((masks1 & masks2) != 0)).sum())
+    else:
+        ambiguousMatchCount = 0
+    nonGapMismatchCount = (int(noGaps.sum()) - identicalMatchCount -
+                           ambiguousMatchCount)
 
     return {
         'match': {
@@ -224,6 +227,217 @@ def compareDNAReads(read1, read2, matchAmbiguous=True, gapChars='-',
     }
 
 
+def _encodeDNAReads(reads, length, gapChars):
+    """
+    Encode DNA sequences into a matrix for C{compareDNAReadSets}.
+
+    @param reads: A C{list} of C{Read} instances.
+    @param length: The C{int} number of columns to make.
+    @param gapChars: An object supporting __contains__ with characters that
+        should be considered to be gaps.
+    @return: A C{np.ndarray} with one row per read, holding the nucleotide
+        bit mask of each character of the read, or C{_GAP} or C{_UNKNOWN}.
+        Rows of reads shorter than C{length} are padded with C{_PAD}.
+    """
+    matrix = np.zeros((len(reads), length), dtype=np.uint8)
+    for row, read in enumerate(reads):
+        masks, gaps = _encodeDNA(read.sequence, gapChars)
+        matrix[row, :len(masks)] = np.where(
+            gaps, _GAP, np.where(masks == 0, _UNKNOWN, masks))
+    return matrix
+
+
+def _pairCounts(indicators1, indicators2):
+    """
+    For every pair of rows from two boolean matrices, count the columns where
+    both rows are C{True}.
+
+    @param indicators1: A 2-D C{bool} C{np.ndarray}.
+    @param indicators2: A 2-D C{bool} C{np.ndarray} with the same number of
+        columns as C{indicators1}.
+    @return: A C{np.ndarray} of C{int} counts, with a row for each row of
+        C{indicators1} and a column for each row of C{indicators2}.
+    """
+    # Only columns that are set somewhere in both matrices can contribute,
+    # and there are often very few of these.
+    columns = indicators1.any(axis=0) & indicators2.any(axis=0)
+    count = int(columns.sum())
+    if count == 0:
+        return np.zeros((len(indicators1), len(indicators2)), dtype=np.int64)
+
+    # Single precision floats hold integer counts exactly up to 2^24 and
+    # make for a much faster matrix multiplication.
+    dtype = np.float32 if count < (1 << 24) else np.float64
+    product = np.dot(indicators1[:, columns].astype(dtype),
+                     indicators2[:, columns].astype(dtype).T)
+    return np.rint(product).astype(np.int64)
+
+
+def _compareDNAMatrices(matrix1, matrix2, matchAmbiguous):
+    """
+    Compare all pairs of rows from two encoded DNA sequence matrices.
+
+    @param matrix1: A C{np.ndarray} as returned by C{_encodeDNAReads}.
+    @param matrix2: A C{np.ndarray} as returned by C{_encodeDNAReads}, with
+        the same number of columns as C{matrix1}.
+    @param matchAmbiguous: If C{True}, count ambiguous nucleotides that are
+        possibly correct as actually being correct.
+    @return: A C{dict} keyed by the names in C{MATCH_COUNT_NAMES}, with
+        C{np.ndarray} values giving the count for each pair of rows.
+    """
+    present1 = matrix1 != _PAD
+    present2 = matrix2 != _PAD
+    gaps1 = matrix1 == _GAP
+    gaps2 = matrix2 == _GAP
+
+    # Padding only occurs at the end of a row, so the number of columns two
+    # rows have in common is the smaller of their unpadded lengths.
+    common = np.minimum.outer(present1.sum(axis=1), present2.sum(axis=1))
+    gapGap = _pairCounts(gaps1, gaps2)
+    gap1 = _pairCounts(gaps1, present2)
+    gap2 = _pairCounts(present1, gaps2)
+    noGaps = common - gap1 - gap2 + gapGap
+
+    identical = 0
+    for mask in _NT_BITS.values():
+        identical = identical + _pairCounts(matrix1 == mask, matrix2 == mask)
+
+    ambiguous = 0
+    if matchAmbiguous:
+        masks1 = set(np.unique(matrix1).tolist())
+        masks2 = [mask for mask in np.unique(matrix2).tolist()
+                  if 0 < mask < _GAP]
+        for mask1 in masks1:
+            if 0 < mask1 < _GAP:
+                # The masks that share a nucleotide with mask1, not including
+                # mask1 itself if it's a single nucleotide (that would be an
+                # identical match).
+                others = [mask2 for mask2 in masks2 if mask1 & mask2 and not
+                          (mask1 == mask2 and _MASK_SIZES[mask1] == 1)]
+                if others:
+                    ambiguous = ambiguous + _pairCounts(
+                        matrix1 == mask1, np.isin(matrix2, others))
+
+    shape = common.shape
+    return {
+        'identicalMatchCount': identical + np.zeros(shape, dtype=np.int64),
+        'ambiguousMatchCount': ambiguous + np.zeros(shape, dtype=np.int64),
+        'gapMismatchCount': gap1 + gap2 - 2 * gapGap,
+        'gapGapMismatchCount': gapGap,
+        'nonGapMismatchCount': noGaps - identical - ambiguous,
+    }
+
+
+# The matrix of sequences that worker processes compare their blocks of rows
+# against, and whether ambiguous matches count (see _initCompareWorker).
+_workerMatrix = _workerMatchAmbiguous = None
+
+
+def _initCompareWorker(matrix, matchAmbiguous):
+    """
+    Initialize a worker process for C{compareDNAReadSets}.
+
+    @param matrix: The C{np.ndarray} second set of encoded sequences.
+    @param matchAmbiguous: If C{True}, count ambiguous nucleotides that are
+        possibly correct as actually being correct.
+    """
+    global _workerMatrix, _workerMatchAmbiguous
+    _workerMatrix = matrix
+    _workerMatchAmbiguous = matchAmbiguous
+
+
+def _compareDNABlock(matrix):
+    """
+    Compare a block of rows with the worker's matrix.
+
+    @param matrix: A C{np.ndarray} of encoded sequences.
+    @return: A C{dict}, as returned by C{_compareDNAMatrices}.
+    """
+    return _compareDNAMatrices(matrix, _workerMatrix, _workerMatchAmbiguous)
+
+
+def compareDNAReadSets(reads1, reads2=None, matchAmbiguous=True,
+                       gapChars='-', workers=None):
+    """
+    Compare all pairs of DNA sequences from two sets, using array
+    operations.
+
+    The counts are the same as those in the 'match' C{dict} returned by
+    C{compareDNAReads} (except that two identical characters that are not
+    nucleotide codes or gaps, e.g., '?', are counted as a non-gap mismatch
+    rather than causing a C{KeyError}).
+
+    @param reads1: An iterable of C{Read} instances.
+    @param reads2: An iterable of C{Read} instances, or C{None} to compare
+        the reads in C{reads1} with each other.
+    @param matchAmbiguous: If C{True}, count ambiguous nucleotides that are
+        possibly correct as actually being correct, and score these in the
+        ambiguousMatchCount. Otherwise, we are strict and insist that only
+        non-ambiguous nucleotides can contribute to the matching nucleotide
+        count.
+    @param gapChars: An object supporting __contains__ with characters that
+        should be considered to be gaps.
+    @param workers: If not C{None} and greater than one, the C{int} number of
+        worker processes to divide the comparisons between.
+    @return: A C{dict} keyed by the names in C{MATCH_COUNT_NAMES}, whose
+        values are C{np.ndarray}s of C{int} counts with a row for each read
+        in C{reads1} and a column for each read in C{reads2}.
+    """
+    reads1 = list(reads1)
+    reads2 = reads1 if reads2 is None else list(reads2)
+    length = max([len(read.sequence) for read in reads1 + reads2] or [0])
+    matrix1 = _encodeDNAReads(reads1, length, gapChars)
+    matrix2 = (matrix1 if reads2 is reads1 else
+               _encodeDNAReads(reads2, length, gapChars))
+
+    if not (reads1 and reads2):
+        return dict(
+            (name, np.zeros((len(reads1), len(reads2)), dtype=np.int64))
+            for name in MATCH_COUNT_NAMES)
+
+    # Columns in which all sequences have the same character contribute the
+    # same amount to every pair, so only the other columns are compared in
+    # detail. In aligned genomes, this is nearly all columns.
+    first = matrix1[0]
+    constant = ((first != _PAD) & (matrix1 == first).all(axis=0) &
+                (matrix2 == first).all(axis=0))
+    constantCounts = dict((name, 0) for name in MATCH_COUNT_NAMES)
+    for code, count in zip(*np.unique(first[constant], return_counts=True)):
+        if code == _GAP:
+            name = 'gapGapMismatchCount'
+        elif code == _UNKNOWN:
+            name = 'nonGapMismatchCount'
+        elif _MASK_SIZES[code] == 1:
+            name = 'identicalMatchCount'
+        elif matchAmbiguous:
+            name = 'ambiguousMatchCount'
+        else:
+            name = 'nonGapMismatchCount'
+        constantCounts[name] += int(count)
+
+    variable = ~constant
+    matrix1 = matrix1[:, variable]
+    matrix2 = matrix2[:, variable]
+
+    if workers is None or workers < 2 or len(reads1) < 2:
+        result = _compareDNAMatrices(matrix1, matrix2, matchAmbiguous)
+    else:
+        blockSize = max(1, -(-len(reads1) // (4 * workers)))
+        blocks = [matrix1[start:start + blockSize]
+                  for start in range(0, len(reads1), blockSize)]
+        results = [block for _, block in orderedPoolMap(
+            _compareDNABlock, blocks, workers,
+            initializer=_initCompareWorker,
+            initargs=(matrix2, matchAmbiguous))]
+        result = dict((name, np.vstack([block[name] for block in results]))
+                      for name in MATCH_COUNT_NAMES)
+
+    for name, count in constantCounts.items():
+        result[name] += count
+
+    return result
+
+
 def findKozakConsensus(read):
     """
     In a given DNA sequence, search for a Kozak consensus: (gcc)gccRccATGG.
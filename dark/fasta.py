@@ -5,25 +5,32 @@ import os
 
 from Bio import SeqIO, bgzf
 
-from dark.reads import Reads, DNARead
-from dark.utils import asHandle
+from dark.reads import Reads, DNARead, FASTA_PARSERS
+from dark.utils import (
+    asHandle, textChunks, stringHashFunction, DEFAULT_BUFFER_SIZE)
 
 
 def fastaToList(fastaFilename):
     return list(SeqIO.parse(fastaFilename, 'fasta'))
 
 
-def dedupFasta(reads):
+def dedupFasta(reads, hashFunction='md5'):
     """
     Remove sequence duplicates (based on sequence) from FASTA.
 
     @param reads: a C{dark.reads.Reads} instance.
+    @param hashFunction: The hash function to use to store sequences, as
+        accepted by C{dark.utils.stringHashFunction}, or C{None} to store
+        (and compare) the full sequences.
     @return: a generator of C{dark.reads.Read} instances with no duplicates.
     """
     seen = set()
     add = seen.add
+    hashFunction = (
+        (lambda s: s) if hashFunction is None else
+        stringHashFunction(hashFunction))
     for read in reads:
-        hash_ = md5(read.sequence.encode('UTF-8')).digest()
+        hash_ = hashFunction(read.sequence)
         if hash_ not in seen:
             add(hash_)
             yield read
@@ -80,6 +87,102 @@ def fastaSubtract(fastaFiles):
     return iter(reads.values())
 
 
+def _fastaRecordsFromText(text):
+    """
+    Split a block of complete FASTA records into (title, sequence) pairs.
+
+    @param text: A C{str} containing zero or more complete FASTA records.
+        The first character must be the '>' of the first record's title line.
+    @return: A generator of 2-tuples, each containing a C{str} title and a
+        C{str} sequence.
+    """
+    for record in text[1:].split('\n>'):
+        newline = record.find('\n')
+        if newline == -1:
+            yield record.rstrip(), ''
+        else:
+            yield (record[:newline].rstrip(),
+                   ''.join(record[newline + 1:].split()))
+
+
+def fastaRecords(fp, bufferSize=DEFAULT_BUFFER_SIZE):
+    """
+    Quickly parse FASTA from an open file.
+
+    The file is read in large chunks, which are split on record boundaries
+    (a '>' at the start of a line). No per-line processing or intermediate
+    objects (as made by C{Bio.SeqIO}) are needed. All whitespace is removed
+    from sequences and trailing whitespace is removed from titles, matching
+    the behaviour of C{Bio.SeqIO.parse}.
+
+    @param fp: An open file handle, in either text or binary mode.
+    @param bufferSize: The C{int} number of bytes (or characters) to read
+        at a time.
+    @raise ValueError: If there is non-whitespace text before the first
+        FASTA record.
+    @return: A generator of 2-tuples, each containing a C{str} title (i.e.,
+        the read id and any description) and a C{str} sequence.
+    """
+    pending = []
+    lastChar = '\n'
+    preamble = True
+
+    def complete(text):
+        """
+        Check a block of text that precedes the first FASTA record.
+
+        @param text: A C{str} of FASTA.
+        @raise ValueError: If there is non-whitespace text before the first
+            record.
+        @return: C{text}, minus any leading whitespace.
+        """
+        if text.startswith('>'):
+            return text
+        else:
+            start = text.find('\n>') + 1
+            prefix = text if start == 0 else text[:start]
+            if prefix.strip():
+                raise ValueError(
+                    'FASTA input contains text before the first record.')
+            return text[start:] if start else ''
+
+    for chunk in textChunks(fp, bufferSize):
+        # Find the offset of the '>' of the last record start in this chunk,
+        # taking into account that the preceding newline may have been at
+        # the end of the previous chunk.
+        boundary = chunk.rfind('\n>')
+        if boundary == -1:
+            if chunk[0] == '>' and lastChar == '\n':
+                boundary = 0
+            else:
+                pending.append(chunk)
+                lastChar = chunk[-1]
+                continue
+        else:
+            boundary += 1
+
+        pending.append(chunk[:boundary])
+        text = ''.join(pending)
+        pending = [chunk[boundary:]]
+        lastChar = chunk[-1]
+
+        if preamble:
+            text = complete(text)
+            preamble = False
+
+        if text:
+            for record in _fastaRecordsFromText(text):
+                yield record
+
+    text = ''.join(pending)
+    if preamble:
+        text = complete(text)
+
+    if text:
+        for record in _fastaRecordsFromText(text):
+            yield record
+
+
 class FastaReads(Reads):
     """
     Subclass of L{dark.reads.Reads} providing access to FASTA reads.
@@ -90,10 +193,19 @@ class FastaReads(Reads):
     @param readClass: The class of read that should be yielded by iter.
     @param upperCase: If C{True}, read sequences will be converted to upper
         case.
+    @param parser: The C{str} name of the FASTA parser to use. Either
+        'biopython' (the default) to use C{Bio.SeqIO}, or 'native' to use
+        the much faster C{fastaRecords} function (above).
+    @raise ValueError: If C{parser} is unknown.
     """
-    def __init__(self, _files, readClass=DNARead, upperCase=False):
+    def __init__(self, _files, readClass=DNARead, upperCase=False,
+                 parser='biopython'):
+        if parser not in FASTA_PARSERS:
+            raise ValueError('Unknown FASTA parser %r. Known parsers: %s.' %
+                             (parser, ', '.join(FASTA_PARSERS)))
         self._files = _files if isinstance(_files, (list, tuple)) else [_files]
         self._readClass = readClass
+        self._parser = parser
         # TODO: It would be better if upperCase were an argument that could
         # be passed to Reads.__init__ and that could do the uppercasing in
         # its add method (as opposed to using it below in our iter method).
@@ -112,6 +224,18 @@ class FastaReads(Reads):
         Iterate over the sequences in the files in self.files_, yielding each
         as an instance of the desired read class.
         """
+        if self._parser == 'native':
+            readClass = self._readClass
+            for _file in self._files:
+                with asHandle(_file, 'rb') as fp:
+                    if self._upperCase:
+                        for title, sequence in fastaRecords(fp):
+                            yield readClass(title, sequence.upper())
+                    else:
+                        for title, sequence in fastaRecords(fp):
+                            yield readClass(title, sequence)
+            return
+
         count = 0
         for _file in self._files:
             with asHandle(_file) as fp:
@@ -2,8 +2,125 @@ from six import PY3
 
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
-from dark.reads import Reads, DNARead
-from dark.utils import asHandle
+from dark.reads import Reads, DNARead, FASTA_PARSERS
+from dark.utils import asHandle, textChunks, DEFAULT_BUFFER_SIZE
+
+
+def _fastqRecord(lines, index, final):
+    """
+    Parse a (possibly multi-line) FASTQ record from a list of lines.
+
+    @param lines: A C{list} of C{str} lines, without line endings.
+    @param index: The C{int} index in C{lines} of the record's title line.
+    @param final: If C{True}, C{lines} contains all remaining input, so a
+        record that runs off the end of C{lines} is truncated.
+    @raise ValueError: If the record is malformed, or if it is truncated and
+        C{final} is C{True}.
+    @return: C{None} if C{lines} ends before the record does (and C{final}
+        is C{False}), else a 4-tuple with the C{str} title, sequence, and
+        quality, and the C{int} index of the line following the record.
+    """
+    title = lines[index]
+    if title[0] != '@':
+        raise ValueError(
+            'FASTQ record title line does not start with @: %r' % title)
+
+    title = title[1:]
+    count = len(lines)
+    index += 1
+    sequenceParts = []
+    while index < count and lines[index][:1] != '+':
+        sequenceParts.append(lines[index])
+        index += 1
+
+    if index == count:
+        if final:
+            raise ValueError('Truncated FASTQ record for %r.' % title)
+        return None
+
+    index += 1
+    sequence = ''.join(sequenceParts)
+    length = len(sequence)
+    qualityParts = []
+    qualityLength = 0
+    while qualityLength < length and index < count:
+        qualityParts.append(lines[index])
+        qualityLength += len(lines[index])
+        index += 1
+
+    if qualityLength < length and not final:
+        return None
+
+    if qualityLength != length:
+        raise ValueError(
+            'Lengths of sequence and quality values differs for %s '
+            '(%d and %d).' % (title, length, qualityLength))
+
+    return title, sequence, ''.join(qualityParts), index
+
+
+def fastqRecords(fp, bufferSize=DEFAULT_BUFFER_SIZE):
+    """
+    Quickly parse FASTQ from an open file.
+
+    The file is read in large chunks and no per-record quality conversion is
+    done. Records that occupy exactly four lines are recognized directly
+    from the lines of each chunk. Multi-line (wrapped) sequences and quality
+    strings are also handled, as in
+    C{Bio.SeqIO.QualityIO.FastqGeneralIterator}.
+
+    @param fp: An open file handle, in either text or binary mode.
+    @param bufferSize: The C{int} number of bytes (or characters) to read
+        at a time.
+    @raise ValueError: If the FASTQ is malformed or truncated, or if a
+        sequence and its quality string differ in length.
+    @return: A generator of 3-tuples, each containing C{str} title, sequence,
+        and quality strings.
+    """
+    pending = []
+    partial = ''
+
+    for chunk in textChunks(fp, bufferSize):
+        lines = (partial + chunk).splitlines()
+        # If the chunk did not end with a newline, its last line is
+        # incomplete and must be prepended to the next chunk.
+        partial = '' if chunk[-1] in '\r\n' else lines.pop()
+        if pending:
+            lines = pending + lines
+
+        index = 0
+        count = len(lines)
+        while index < count:
+            title = lines[index]
+            if not title:
+                # Allow blank lines between records.
+                index += 1
+            elif (index + 3 < count and title[0] == '@' and
+                  lines[index + 2][:1] == '+' and
+                  len(lines[index + 1]) == len(lines[index + 3])):
+                yield title[1:], lines[index + 1], lines[index + 3]
+                index += 4
+            else:
+                result = _fastqRecord(lines, index, False)
+                if result is None:
+                    break
+                title, sequence, quality, index = result
+                yield title, sequence, quality
+
+        pending = lines[index:]
+
+    if partial:
+        pending.append(partial)
+
+    index = 0
+    count = len(pending)
+    while index < count:
+        if pending[index]:
+            title, sequence, quality, index = _fastqRecord(
+                pending, index, True)
+            yield title, sequence, quality
+        else:
+            index += 1
 
 
 class FastqReads(Reads):
@@ -14,10 +131,18 @@ class FastqReads(Reads):
         C{list} of C{str} file names and/or file handles. Each file or file
         handle must contain sequences in FASTQ format.
     @param readClass: The class of read that should be yielded by iter.
+    @param parser: The C{str} name of the FASTQ parser to use. Either
+        'biopython' (the default) to use C{FastqGeneralIterator}, or 'native'
+        to use the faster C{fastqRecords} function (above).
+    @raise ValueError: If C{parser} is unknown.
     """
-    def __init__(self, _files, readClass=DNARead):
+    def __init__(self, _files, readClass=DNARead, parser='biopython'):
+        if parser not in FASTA_PARSERS:
+            raise ValueError('Unknown FASTQ parser %r. Known parsers: %s.' %
+                             (parser, ', '.join(FASTA_PARSERS)))
         self._files = _files if isinstance(_files, (list, tuple)) else [_files]
         self.readClass = readClass
+        self._parser = parser
         if PY3:
             super().__init__()
         else:
@@ -28,11 +153,18 @@ class FastqReads(Reads):
         Iterate over the sequences in the files in self.files_, yielding each
         as an instance of the desired read class.
         """
+        native = self._parser == 'native'
         for _file in self._files:
-            with asHandle(_file) as fp:
-                # Use FastqGeneralIterator because it provides access to
-                # the unconverted quality string (i.e., it doesn't try to
-                # figure out the numeric quality values, which we don't
-                # care about at this point).
-                for sequenceId, sequence, quality in FastqGeneralIterator(fp):
-                    yield self.readClass(sequenceId, sequence, quality)
+            if native:
+                with asHandle(_file, 'rb') as fp:
+                    for sequenceId, sequence, quality in fastqRecords(fp):
+                        yield self.readClass(sequenceId, sequence, quality)
+            else:
+                with asHandle(_file) as fp:
+                    # Use FastqGeneralIterator because it provides access to
+                    # the unconverted quality string (i.e., it doesn't try to
+                    # figure out the numeric quality values, which we don't
+                    # care about at this point).
+                    for sequenceId, sequence, quality in FastqGeneralIterator(
+                            fp):
+                        yield self.readClass(sequenceId, sequence, quality)
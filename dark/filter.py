@@ -1,11 +1,13 @@
 from __future__ import division
 
+import os
 import re
+import argparse
 from math import ceil
 from collections import OrderedDict
 
 from dark.simplify import simplifyTitle
-from dark.utils import parseRangeExpression
+from dark.utils import parseRangeExpression, HASH_FUNCTIONS
 
 
 class TitleFilter(object):
@@ -255,11 +257,49 @@ def addFASTAFilteringCommandLineOptions(parser):
     parser.add_argument(
         '--removeDuplicatesUseMD5', action='store_true', default=False,
         help=('MD5 sums will be stored instead of the full sequence or read '
-              'id when either --removeDuplicates or removeDuplicatesById are '
-              'given. One of --removeDuplicates and --removeDuplicatesById '
-              'must also be given. Note that this makes duplicate removal '
-              'probabilistic. This option can be used to reduce the amount '
-              'of RAM consumed during duplicate removal.'))
+              'id when either --removeDuplicates or --removeDuplicatesById '
+              'are given. One of --removeDuplicates and '
+              '--removeDuplicatesById must also be given. Note that this '
+              'makes duplicate removal probabilistic. This option can be '
+              'used to reduce the amount of RAM consumed during duplicate '
+              'removal.'))
+
+    parser.add_argument(
+        '--removeDuplicatesHash', choices=HASH_FUNCTIONS,
+        help=('The hash function whose values will be stored instead of the '
+              'full sequence or read id when either --removeDuplicates or '
+              '--removeDuplicatesById are given. As with '
+              '--removeDuplicatesUseMD5, this makes duplicate removal '
+              'probabilistic: reads whose hashes collide are removed '
+              'without their sequences or ids being compared. Without a '
+              'hash function (or a Bloom filter), the full sequences or read '
+              'ids are stored and duplicate removal is exact. The fast64 and '
+              'fast128 functions are much faster than MD5, and fast64 also '
+              'uses less RAM. fast128 is fastest with the xxhash module (pip '
+              'install dark-matter[xxhash]).'))
+
+    parser.add_argument(
+        '--removeDuplicatesBloomCapacity', type=int, metavar='N',
+        help=('The expected number of distinct sequences (or read ids) when '
+              'either --removeDuplicates or --removeDuplicatesById is given. '
+              'Duplicates will be found using a Bloom filter, which needs a '
+              'fixed amount of RAM no matter how many reads there are. Some '
+              'reads that are not duplicates will also be removed (see '
+              '--removeDuplicatesBloomErrorRate).'))
+
+    parser.add_argument(
+        '--removeDuplicatesBloomErrorRate', type=float, metavar='RATE',
+        help=('The false positive rate (i.e., the fraction of non-duplicate '
+              'reads that will be removed) of the Bloom filter when the '
+              'expected number of distinct reads have been seen. The default '
+              'is 0.001.'))
+
+    parser.add_argument(
+        '--removeDuplicatesBloomMaxMB', type=float, metavar='MB',
+        help=('The maximum number of megabytes of RAM the Bloom filter may '
+              'use. If --removeDuplicatesBloomCapacity is not given, the '
+              'filter will use this much RAM and its capacity will be as '
+              'large as possible for the false positive rate.'))
 
     # See the docstring for dark.reads.Reads.filter for more detail on
     # randomSubset.
@@ -288,7 +328,7 @@ def addFASTAFilteringCommandLineOptions(parser):
               'be one per line.'))
 
 
-def parseFASTAFilteringCommandLineOptions(args, reads):
+def parseFASTAFilteringCommandLineOptions(args, reads, workers=None):
     """
     Examine parsed FASTA filtering command-line options and return filtered
     reads.
@@ -296,6 +336,8 @@ def parseFASTAFilteringCommandLineOptions(args, reads):
     @param args: An argparse namespace, as returned by the argparse
         C{parse_args} function.
     @param reads: A C{Reads} instance to filter.
+    @param workers: If not C{None}, the C{int} number of worker processes to
+        use when filtering (see C{dark.reads.ReadFilter}).
     @return: The filtered C{Reads} instance.
     """
     keepSequences = (
@@ -318,9 +360,44 @@ def parseFASTAFilteringCommandLineOptions(args, reads):
         head=args.head, removeDuplicates=args.removeDuplicates,
         removeDuplicatesById=args.removeDuplicatesById,
         removeDuplicatesUseMD5=args.removeDuplicatesUseMD5,
+        removeDuplicatesHash=args.removeDuplicatesHash,
+        removeDuplicatesBloomCapacity=args.removeDuplicatesBloomCapacity,
+        removeDuplicatesBloomErrorRate=args.removeDuplicatesBloomErrorRate,
+        removeDuplicatesBloomMaxBytes=(
+            None if args.removeDuplicatesBloomMaxMB is None else
+            int(args.removeDuplicatesBloomMaxMB * (1 << 20))),
         randomSubset=args.randomSubset, trueLength=args.trueLength,
         sampleFraction=args.sampleFraction,
-        sequenceNumbersFile=args.sequenceNumbersFile)
+        sequenceNumbersFile=args.sequenceNumbersFile, workers=workers)
+
+
+def filteringCommandLineOptionsKey(args):
+    """
+    Make a key describing the FASTA filtering command-line options in
+    C{args}, for use when caching results computed from filtered reads (see
+    C{dark.sam.SAMStats}). The key includes the size and modification time
+    of any files named by the options.
+
+    @param args: An argparse namespace, as returned by the argparse
+        C{parse_args} function.
+    @return: A C{str} key, or C{None} if the options select reads at random
+        (in which case results cannot be cached).
+    """
+    if args.randomSubset is not None or args.sampleFraction is not None:
+        return None
+
+    parser = argparse.ArgumentParser(add_help=False)
+    addFASTAFilteringCommandLineOptions(parser)
+    fileOptions = {'whitelistFile', 'blacklistFile', 'sequenceNumbersFile'}
+    key = []
+    for name in sorted(vars(parser.parse_args([]))):
+        value = getattr(args, name)
+        if name in fileOptions and value is not None:
+            stat = os.stat(value)
+            value = (value, stat.st_size, stat.st_mtime)
+        key.append((name, value))
+
+    return repr(key)
 
 
 def addFASTAEditingCommandLineOptions(parser):
@@ -411,7 +488,7 @@ def addFASTAEditingCommandLineOptions(parser):
         help='Reverse complement the sequences.')
 
 
-def parseFASTAEditingCommandLineOptions(args, reads):
+def parseFASTAEditingCommandLineOptions(args, reads, workers=None):
     """
     Examine parsed FASTA editing command-line options and return information
     about kept sites and sequences.
@@ -419,6 +496,8 @@ def parseFASTAEditingCommandLineOptions(args, reads):
     @param args: An argparse namespace, as returned by the argparse
         C{parse_args} function.
     @param reads: A C{Reads} instance to filter.
+    @param workers: If not C{None}, the C{int} number of worker processes to
+        use when editing (see C{dark.reads.ReadFilter}).
     @return: The filtered C{Reads} instance.
     """
     removeGaps = args.removeGaps
@@ -462,4 +541,5 @@ def parseFASTAEditingCommandLineOptions(args, reads):
         removeDescriptions=removeDescriptions,
         idLambda=args.idLambda, readLambda=args.readLambda,
         keepSites=keepSites, removeSites=removeSites,
-        reverse=args.reverse, reverseComplement=args.reverseComplement)
+        reverse=args.reverse, reverseComplement=args.reverseComplement,
+        workers=workers)
@@ -1,9 +1,18 @@
 from collections import Counter
 
+import numpy as np
+from pysam import CMATCH, CINS, CDEL, CREF_SKIP, CSOFT_CLIP, CEQUAL, CDIFF
+
 from dark.errors import NoSuchGenomeError
 from dark.genbank import GenomeRanges
 from dark.reads import DNARead
-from dark.sam import samfile
+from dark.sam import (
+    MIN_BASE_QUALITY, samfile, samIsIndexed, mateMayOverlap,
+    overlappingMateQualities)
+
+_MATCH_OPERATIONS = {CMATCH, CEQUAL, CDIFF}
+_QUERY_OPERATIONS = {CMATCH, CINS, CSOFT_CLIP, CEQUAL, CDIFF}
+_REFERENCE_OPERATIONS = {CMATCH, CDEL, CREF_SKIP, CEQUAL, CDIFF}
 
 
 class GenomeProteinInfo(object):
@@ -11,6 +20,10 @@ class GenomeProteinInfo(object):
     Hold information about the proteins in a genome and how they are matched
     by reads in SAM files.
 
+    The offsets of the genome that are covered by the reads are stored as
+    arrays of (read, start, end) blocks, from which coverage information is
+    computed when it is needed.
+
     @param accession: The C{str} accession number of a genome.
     @param proteinGenomeDB: A L{dark.civ.proteins.SqliteIndex} instance.
     @param checkTranslations: If C{True}, check that the protein sequences
@@ -23,46 +36,46 @@ class GenomeProteinInfo(object):
         self.proteinGenomeDB = proteinGenomeDB
         # self.proteins is keyed by protein accession number.
         self.proteins = {}
-        self.coveredProteins = set()
-        # self.offsets is keyed by genome offset, values are dicts that
-        # contain a list of protein accession numbers that overlap that
-        # offset and a set of read ids (if any) that match at that offset.
-        # The offsets keys are only those that correspond to one or more
-        # proteins in the genome.
-        self.offsets = {}
-        # self.coveredOffsetCount holds the read counts for all offsets covered
-        # by reads, regardless of whether the offsets correspond to proteins or
-        # not.
-        self.coveredOffsetCount = Counter()
+        # self.proteinRanges is keyed by protein accession number, values
+        # are lists of (start, stop, forward) genome ranges.
+        self.proteinRanges = {}
         self.samFiles = []
         self.readIdsMatchingGenome = set()
 
+        # The blocks of genome offsets covered by each alignment, as parallel
+        # lists of read index (into self._readIds), start, and end. See
+        # _blocks for the merged version, with one block per read for each
+        # region of the genome covered by any of its alignments.
+        self._readIds = []
+        self._readIndex = {}
+        self._blockReads = []
+        self._blockStarts = []
+        self._blockEnds = []
+        self._cache = {}
+
         self.genome = proteinGenomeDB.findGenome(genomeAccession)
         if self.genome is None:
             raise NoSuchGenomeError('Reference %r not found in protein/genome '
                                     'database.' % genomeAccession)
 
+        proteinOffsets = np.zeros(self.genome['length'], dtype=bool)
+
         for protein in proteinGenomeDB.findProteinsForGenome(genomeAccession):
             proteinAccession = protein['accession']
             self.proteins[proteinAccession] = protein
 
             ranges = GenomeRanges(protein['offsets']).ranges
-            # print('Protein accession', proteinAccession)
-            # print(ranges)
+            self.proteinRanges[proteinAccession] = ranges
 
             for (start, stop, forward) in ranges:
-                for offset in range(start, stop):
-                    if offset not in self.offsets:
-                        self.offsets[offset] = {
-                            'proteinAccessions': set(),
-                            'readIds': set(),
-                        }
-                    self.offsets[offset]['proteinAccessions'].add(
-                        proteinAccession)
+                proteinOffsets[start:stop] = True
 
             if checkTranslations:
                 self._checkTranslation(self.genome, ranges, protein)
 
+        # The (sorted) genome offsets that are in at least one protein.
+        self.proteinOffsets = proteinOffsets.nonzero()[0]
+
     def _checkTranslation(self, genome, ranges, protein):
         """
         Make sure all protein sequences supposed to be in the genome can in
@@ -91,7 +104,8 @@ class GenomeProteinInfo(object):
             raise ValueError(
                 'Could not translate genome range to get protein sequence')
 
-    def addSAM(self, filename, filterAlignment=None):
+    def addSAM(self, filename, filterAlignment=None, ignoreOrphans=True,
+               ignoreOverlaps=True, minBaseQuality=MIN_BASE_QUALITY):
         """
         Read a SAM file and add information about the reads that match our
         reference id.
@@ -99,30 +113,252 @@ class GenomeProteinInfo(object):
         @param filename: A C{str} SAM filename.
         @param filterAlignment: A 1-argument function to be used for filtering
             reads in the SAM file. If C{None}, all alignments will be examined.
+        @param ignoreOrphans: If C{True}, ignore alignments of reads that are
+            paired but not mapped in a proper pair.
+        @param ignoreOverlaps: If C{True}, only count one of the bases of the
+            mates of a proper pair where the mates overlap.
+        @param minBaseQuality: The C{int} minimum quality a matched read base
+            must have to count towards coverage.
+        """
+        addSAMToGenomes([self], filename, filterAlignment,
+                        ignoreOrphans=ignoreOrphans,
+                        ignoreOverlaps=ignoreOverlaps,
+                        minBaseQuality=minBaseQuality)
+
+    def _addAlignment(self, alignment, minBaseQuality=MIN_BASE_QUALITY,
+                      qualities=None, adjustedFrom=None):
+        """
+        Add the genome offsets covered by an alignment.
+
+        As in a pileup, offsets that are deleted or skipped in the query are
+        considered covered, but offsets matched by a read base whose quality
+        is below C{minBaseQuality} are not (for deleted or skipped offsets,
+        the quality of the following read base is used).
+
+        @param alignment: A pysam alignment instance.
+        @param minBaseQuality: The C{int} minimum quality a matched read base
+            must have to count towards coverage.
+        @param qualities: The read base qualities to use instead of those of
+            C{alignment}, or C{None}.
+        @param adjustedFrom: The C{int} genome offset from which
+            C{qualities} are used for deleted or skipped offsets, or C{None}
+            to use them for all offsets. Before it, the qualities of
+            C{alignment} are used (a pileup adjusts the qualities of
+            overlapping mates only when it reads the second mate, after it
+            has reported the offsets before the alignment it read before).
+        """
+        start = alignment.reference_start
+        end = min(alignment.reference_end, self.genome['length'])
+
+        if end <= start:
+            return
+
+        originalQualities = alignment.query_qualities
+        if qualities is None:
+            qualities = originalQualities
+            adjustedFrom = None
+
+        if (minBaseQuality > 0 and qualities is not None and
+                (adjustedFrom is not None or
+                 min(qualities) < minBaseQuality)):
+            covered = np.ones(alignment.reference_end - start, dtype=bool)
+            qualities = np.asarray(qualities)
+            queryOffset = referenceOffset = 0
+            for operation, length in alignment.cigartuples:
+                if operation in _MATCH_OPERATIONS:
+                    covered[referenceOffset:referenceOffset + length] = (
+                        qualities[queryOffset:queryOffset + length] >=
+                        minBaseQuality)
+                elif (operation in _REFERENCE_OPERATIONS and
+                      queryOffset < len(qualities)):
+                    # Like a pileup, use the quality of the next read base
+                    # for deleted or skipped offsets.
+                    covered[referenceOffset:referenceOffset + length] = (
+                        qualities[queryOffset] >= minBaseQuality)
+                    if adjustedFrom is not None:
+                        before = min(adjustedFrom - start,
+                                     referenceOffset + length)
+                        if before > referenceOffset:
+                            covered[referenceOffset:before] = (
+                                originalQualities[queryOffset] >=
+                                minBaseQuality)
+                if operation in _QUERY_OPERATIONS:
+                    queryOffset += length
+                if operation in _REFERENCE_OPERATIONS:
+                    referenceOffset += length
+
+            # Find the runs of covered offsets.
+            change = np.diff(np.concatenate(
+                ([False], covered[:end - start], [False])).astype(np.int8))
+            blockStarts = (change == 1).nonzero()[0] + start
+            blockEnds = (change == -1).nonzero()[0] + start
+            if not len(blockStarts):
+                return
+        else:
+            blockStarts = (start,)
+            blockEnds = (end,)
+
+        readId = alignment.query_name
+        self.readIdsMatchingGenome.add(readId)
+
+        try:
+            readIndex = self._readIndex[readId]
+        except KeyError:
+            readIndex = self._readIndex[readId] = len(self._readIds)
+            self._readIds.append(readId)
+
+        for blockStart, blockEnd in zip(blockStarts, blockEnds):
+            self._blockReads.append(readIndex)
+            self._blockStarts.append(int(blockStart))
+            self._blockEnds.append(int(blockEnd))
+
+    def depth(self):
+        """
+        Get the number of alignments covering each genome offset.
+
+        @return: A C{np.ndarray} of C{int} depths, one for each genome offset.
+        """
+        try:
+            return self._cache['depth']
+        except KeyError:
+            length = self.genome['length']
+            change = np.zeros(length + 1, dtype=np.int64)
+            np.add.at(change, np.array(self._blockStarts, dtype=np.intp), 1)
+            np.add.at(change, np.array(self._blockEnds, dtype=np.intp), -1)
+            depth = self._cache['depth'] = np.cumsum(change[:-1])
+            return depth
+
+    @property
+    def coveredOffsetCount(self):
+        """
+        Get the read counts for all offsets covered by reads, regardless of
+        whether the offsets correspond to proteins or not.
+
+        @return: A C{Counter} keyed by C{int} genome offset (in increasing
+            order), with C{int} alignment count values. Offsets not covered
+            by any alignment are not present.
+        """
+        depth = self.depth()
+        covered = depth.nonzero()[0]
+        return Counter(dict(zip(covered.tolist(), depth[covered].tolist())))
+
+    def _blocks(self):
+        """
+        Get the blocks of genome offsets covered by each read, merging the
+        blocks of any read with more than one alignment so that no offset is
+        covered twice by the same read.
+
+        @return: A 3-C{tuple} of C{np.ndarray}s, with the C{int} read index,
+            start, and end of each block.
+        """
+        try:
+            return self._cache['blocks']
+        except KeyError:
+            pass
+
+        reads = np.array(self._blockReads, dtype=np.intp)
+        starts = np.array(self._blockStarts, dtype=np.intp)
+        ends = np.array(self._blockEnds, dtype=np.intp)
+
+        if len(reads):
+            # Sort the blocks by read and start, and give the offsets of
+            # each read a separate range (of size genome length + 1) so the
+            # blocks of all reads can be merged at once.
+            order = np.lexsort((starts, reads))
+            base = reads[order] * (self.genome['length'] + 1)
+            starts = base + starts[order]
+            ends = np.maximum.accumulate(base + ends[order])
+            # A new merged block begins wherever a block starts after the
+            # end of all earlier blocks (of the same read).
+            newBlock = np.ones(len(starts), dtype=bool)
+            newBlock[1:] = starts[1:] > ends[:-1]
+            firsts = newBlock.nonzero()[0]
+            lasts = np.append(firsts[1:], len(starts)) - 1
+            base = base[firsts]
+            reads = reads[order][firsts]
+            starts = starts[firsts] - base
+            ends = ends[lasts] - base
+
+        blocks = self._cache['blocks'] = (reads, starts, ends)
+        return blocks
+
+    def _proteinOverlaps(self, proteinAccession):
+        """
+        Find how many offsets of each block overlap a protein.
+
+        @param proteinAccession: A C{str} protein accession number.
+        @return: A 2-C{tuple} with a C{np.ndarray} of the C{int} number of
+            offsets of each block (as returned by C{_blocks}) that overlap
+            the protein, and a C{np.ndarray} of (start, stop) protein ranges.
         """
-        self.samFiles.append(filename)
-        referenceId = self.genomeAccession
-        with samfile(filename) as sam:
-            for column in sam.pileup():
-                for read in column.pileups:
-                    alignment = read.alignment
-                    if (alignment.reference_name == referenceId and
-                            (filterAlignment is None or
-                             filterAlignment(alignment))):
-                        readId = alignment.query_name
-                        self.readIdsMatchingGenome.add(readId)
-                        offset = column.reference_pos
-                        self.coveredOffsetCount[offset] += 1
-
-                        try:
-                            offsetInfo = self.offsets[offset]
-                        except KeyError:
-                            pass
-                        else:
-                            # This offset corresponds to one or more proteins.
-                            self.coveredProteins.update(
-                                offsetInfo['proteinAccessions'])
-                            offsetInfo['readIds'].add(readId)
+        reads, starts, ends = self._blocks()
+        ranges = np.array(
+            [(start, stop) for (start, stop, _)
+             in self.proteinRanges[proteinAccession]],
+            dtype=np.intp).reshape(-1, 2)
+        overlaps = np.clip(
+            np.minimum(ends[:, np.newaxis], ranges[:, 1]) -
+            np.maximum(starts[:, np.newaxis], ranges[:, 0]),
+            0, None).sum(axis=1)
+        return overlaps, ranges
+
+    @property
+    def coveredProteins(self):
+        """
+        Get the proteins that are covered by any read.
+
+        @return: A C{set} of C{str} protein accession numbers.
+        """
+        try:
+            return self._cache['coveredProteins']
+        except KeyError:
+            result = self._cache['coveredProteins'] = set(
+                proteinAccession for proteinAccession in self.proteins
+                if self._proteinOverlaps(proteinAccession)[0].any())
+            return result
+
+    @property
+    def offsets(self):
+        """
+        Get information about each genome offset that is in a protein.
+
+        This makes a C{dict} for every protein offset, so is slow and uses a
+        lot of memory for large genomes.
+
+        @return: A C{dict} keyed by C{int} genome offset (for only those
+            offsets that correspond to one or more proteins), with C{dict}
+            values containing a C{set} of accession numbers of the proteins
+            that overlap that offset (under the 'proteinAccessions' key) and
+            a set of read ids (if any) that match at that offset (under the
+            'readIds' key).
+        """
+        try:
+            return self._cache['offsets']
+        except KeyError:
+            pass
+
+        offsets = dict(
+            (offset, {'proteinAccessions': set(), 'readIds': set()})
+            for offset in self.proteinOffsets.tolist())
+
+        for proteinAccession, ranges in self.proteinRanges.items():
+            for (start, stop, forward) in ranges:
+                for offset in range(start, stop):
+                    offsets[offset]['proteinAccessions'].add(
+                        proteinAccession)
+
+        readIds = self._readIds
+        for readIndex, start, end in zip(*(a.tolist()
+                                           for a in self._blocks())):
+            readId = readIds[readIndex]
+            for offset in range(start, end):
+                try:
+                    offsets[offset]['readIds'].add(readId)
+                except KeyError:
+                    pass
+
+        self._cache['offsets'] = offsets
+        return offsets
 
     def proteinCoverageInfo(self, proteinAccession, minReadOffsetCount=None):
         """
@@ -144,32 +380,13 @@ class GenomeProteinInfo(object):
             See below for the dictionary keys.
         """
         protein = self.proteins[proteinAccession]
-        coveredOffsets = 0
-        totalBases = 0
-        allReadIds = set()
-        offsetsSeen = set()
-        proteinLength = 0
 
         if minReadOffsetCount is not None and minReadOffsetCount < 2:
             # A minimum of zero or one is equivalent to not giving a value.
             minReadOffsetCount = None
 
-        if minReadOffsetCount:
-            readOffsetCounts = Counter()
-
-        proteinRanges = GenomeRanges(protein['offsets']).ranges
-
-        # Do an initial pass across all the offsets of the protein to see
-        # which reads intersect and where. We will then do a second pass in
-        # which we ignore reads that do not sufficiently overlap.
-        for (start, stop, forward) in proteinRanges:
-            proteinLength += stop - start
-            for offset in range(start, stop):
-                assert offset not in offsetsSeen
-                offsetsSeen.add(offset)
-                readIds = self.offsets[offset]['readIds']
-                if readIds and minReadOffsetCount:
-                    readOffsetCounts.update(readIds)
+        overlaps, ranges = self._proteinOverlaps(proteinAccession)
+        proteinLength = int((ranges[:, 1] - ranges[:, 0]).sum())
 
         # Sanity check that the sum of the range lengths is the same as the
         # overall length given in the database.
@@ -177,36 +394,44 @@ class GenomeProteinInfo(object):
         # The +3 in the following is because the database holds the AA
         # length, not including the stop codon. But the database range
         # covers the stop codon.
-        dbProteinLength = self.proteins[proteinAccession]['length'] * 3 + 3
+        dbProteinLength = protein['length'] * 3 + 3
         if proteinLength != dbProteinLength:
             raise ValueError(
                 'Sum of protein database ranges (%d) does not agree with '
                 'database protein length (%d) for protein %s!' %
                 (proteinLength, dbProteinLength, proteinAccession))
 
-        # If we are not reporting reads whose overlapping offset count is
-        # too low, make a set of such reads.
-        if minReadOffsetCount:
-            unwanted = set(readId for readId in readOffsetCounts
-                           if readOffsetCounts[readId] < minReadOffsetCount)
-        else:
-            unwanted = set()
-
-        # Second pass, in which we ignore unwanted (i.e., insufficiently
-        # overlapping) reads.
-        for (start, stop, forward) in proteinRanges:
-            for offset in range(start, stop):
-                readIds = set(self.offsets[offset]['readIds']) - unwanted
-                if readIds:
-                    allReadIds.update(readIds)
-                    coveredOffsets += 1
-                    totalBases += len(readIds)
+        reads, starts, ends = self._blocks()
+
+        # The number of protein offsets overlapped by each read.
+        readOverlaps = np.bincount(reads, weights=overlaps,
+                                   minlength=len(self._readIds))
 
+        # Ignore reads that do not overlap the protein, or that do not
+        # overlap it sufficiently.
+        wantedReads = readOverlaps >= (minReadOffsetCount or 1)
+        wanted = wantedReads[reads] & (overlaps > 0)
+
+        # Find the depth of the wanted blocks at the protein offsets, working
+        # only in the part of the genome spanned by the protein.
+        low = ranges[:, 0].min()
+        high = ranges[:, 1].max()
+        depth = np.zeros(high - low + 1, dtype=np.int64)
+        np.add.at(depth, np.clip(starts[wanted], low, high) - low, 1)
+        np.add.at(depth, np.clip(ends[wanted], low, high) - low, -1)
+        depth = np.cumsum(depth[:-1])
+        inProtein = np.zeros(len(depth), dtype=bool)
+        for start, stop in ranges:
+            inProtein[start - low:stop - low] = True
+        depth = depth[inProtein]
+
+        readIds = self._readIds
         return {
-            'coveredOffsets': coveredOffsets,
-            'totalBases': totalBases,
+            'coveredOffsets': int(np.count_nonzero(depth)),
+            'totalBases': int(depth.sum()),
             'ntLength': proteinLength,
-            'readIds': allReadIds,
+            'readIds': set(readIds[readIndex]
+                           for readIndex in wantedReads.nonzero()[0]),
         }
 
     def readIdsForAllProteins(self):
@@ -215,7 +440,109 @@ class GenomeProteinInfo(object):
 
         @return: A C{set} of C{str} read ids.
         """
-        result = set()
-        for offsetInfo in self.offsets.values():
-            result.update(offsetInfo['readIds'])
-        return result
+        reads, starts, ends = self._blocks()
+        proteinOffsets = np.zeros(self.genome['length'] + 1, dtype=np.int64)
+        proteinOffsets[self.proteinOffsets + 1] = 1
+        # The number of protein offsets before each genome offset.
+        proteinOffsets = np.cumsum(proteinOffsets)
+        inProtein = proteinOffsets[ends] > proteinOffsets[starts]
+        readIds = self._readIds
+        return set(readIds[readIndex]
+                   for readIndex in np.unique(reads[inProtein]))
+
+
+def addSAMToGenomes(genomeProteinInfos, filename, filterAlignment=None,
+                    ignoreOrphans=True, ignoreOverlaps=True,
+                    minBaseQuality=MIN_BASE_QUALITY):
+    """
+    Read a SAM file (once) and add information about the reads that match
+    each of a number of genomes.
+
+    Secondary, duplicate, and quality control failure alignments are
+    ignored. By default, the coverage is the same as in a pysam pileup:
+    alignments of orphan reads (paired reads that are not mapped in a
+    proper pair) are ignored, the offsets where the mates of a proper pair
+    overlap are only counted for one of the mates, and read bases with a
+    quality below 13 do not count. If the SAM/BAM file has an index, only
+    the alignments to the genomes are read.
+
+    @param genomeProteinInfos: An iterable of C{GenomeProteinInfo}
+        instances.
+    @param filename: A C{str} SAM filename.
+    @param filterAlignment: A 1-argument function to be used for filtering
+        reads in the SAM file. If C{None}, all alignments will be examined.
+    @param ignoreOrphans: If C{True}, ignore alignments of reads that are
+        paired but not mapped in a proper pair.
+    @param ignoreOverlaps: If C{True}, only count one of the bases of the
+        mates of a proper pair where the mates overlap.
+    @param minBaseQuality: The C{int} minimum quality a matched read base
+        must have to count towards coverage.
+    """
+    genomes = dict((gpi.genomeAccession, gpi) for gpi in genomeProteinInfos)
+
+    for gpi in genomes.values():
+        gpi.samFiles.append(filename)
+        gpi._cache.clear()
+
+    with samfile(filename) as sam:
+        referenceIds = [referenceId for referenceId in sam.references
+                        if referenceId in genomes]
+
+        if samIsIndexed(filename):
+            alignments = (alignment
+                          for referenceId in referenceIds
+                          for alignment in sam.fetch(referenceId))
+        else:
+            alignments = sam.fetch()
+
+        referenceGenomes = dict(
+            (sam.get_tid(referenceId), genomes[referenceId])
+            for referenceId in referenceIds)
+
+        # Alignments whose mate may still be read and overlap them, keyed
+        # by read id. These can only be added once their mate is seen.
+        waiting = {}
+        start = None
+
+        for alignment in alignments:
+            try:
+                gpi = referenceGenomes[alignment.reference_id]
+            except KeyError:
+                continue
+            if (alignment.is_unmapped or alignment.is_secondary or
+                    alignment.is_duplicate or alignment.is_qcfail or
+                    not alignment.cigartuples or
+                    (ignoreOrphans and alignment.is_paired and
+                     not alignment.is_proper_pair)):
+                continue
+
+            # The start of the alignment a pileup would have read before
+            # this one (see _addAlignment).
+            previousStart, start = start, alignment.reference_start
+
+            if (filterAlignment is not None and
+                    not filterAlignment(alignment)):
+                continue
+
+            if ignoreOverlaps and mateMayOverlap(alignment):
+                readId = alignment.query_name
+                mate = waiting.pop(readId, None)
+                if mate is not None:
+                    mateQualities, qualities = overlappingMateQualities(
+                        mate, alignment)
+                    referenceGenomes[mate.reference_id]._addAlignment(
+                        mate, minBaseQuality, mateQualities, previousStart)
+                    gpi._addAlignment(alignment, minBaseQuality, qualities)
+                    continue
+                elif (alignment.next_reference_start >=
+                      alignment.reference_start or
+                      alignment.next_reference_start == -1):
+                    waiting[readId] = alignment
+                    continue
+
+            gpi._addAlignment(alignment, minBaseQuality)
+
+        # Add the alignments whose mate was never seen.
+        for alignment in waiting.values():
+            referenceGenomes[alignment.reference_id]._addAlignment(
+                alignment, minBaseQuality)
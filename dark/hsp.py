@@ -4,7 +4,54 @@ from dark.score import HigherIsBetterScore, LowerIsBetterScore
 
 
 @total_ordering
-class _Base(object):
+class _Comparable(object):
+    """
+    Comparison and conversion methods shared by the HSP and LSP classes.
+    Subclasses must have a C{score} attribute and the attributes listed in
+    C{_Base}.
+    """
+    __slots__ = ()
+
+    def __lt__(self, other):
+        return self.score < other.score
+
+    def __eq__(self, other):
+        return self.score == other.score
+
+    def betterThan(self, score):
+        """
+        Compare this instance's score with another score.
+
+        @param score: A C{float} score.
+        @return: A C{bool}, C{True} if this score is the better.
+        """
+        return self.score.betterThan(score)
+
+    def toDict(self):
+        """
+        Get information about the HSP/LSP as a dictionary.
+
+        @return: A C{dict} representation of the HSP/LSP.
+        """
+        return {
+            'readStart': self.readStart,
+            'readEnd': self.readEnd,
+            'readStartInSubject': self.readStartInSubject,
+            'readEndInSubject': self.readEndInSubject,
+            'readFrame': self.readFrame,
+            'subjectStart': self.subjectStart,
+            'subjectEnd': self.subjectEnd,
+            'subjectFrame': self.subjectFrame,
+            'readMatchedSequence': self.readMatchedSequence,
+            'subjectMatchedSequence': self.subjectMatchedSequence,
+            'identicalCount': self.identicalCount,
+            'percentIdentical': self.percentIdentical,
+            'positiveCount': self.positiveCount,
+            'percentPositive': self.percentPositive,
+        }
+
+
+class _Base(_Comparable):
     """
     Holds information about a matching region from a read alignment.
 
@@ -86,55 +133,172 @@ class _Base(object):
         self.positiveCount = positiveCount
         self.percentPositive = percentPositive
 
-    def __lt__(self, other):
-        return self.score < other.score
 
-    def __eq__(self, other):
-        return self.score == other.score
+class HSP(_Base):
+    """
+    Holds information about a high-scoring pair from a read alignment.
+    Comparisons are done as for BLAST or DIAMOND bit scores (higher is better).
 
-    def betterThan(self, score):
+    @param score: The numeric score of this HSP.
+    """
+
+    def __init__(self, score, **kwargs):
+        _Base.__init__(self, **kwargs)
+        self.score = HigherIsBetterScore(score)
+
+    def toDict(self):
         """
-        Compare this instance's score with another score.
+        Get information about the HSP as a dictionary.
 
-        @param score: A C{float} score.
-        @return: A C{bool}, C{True} if this score is the better.
+        @return: A C{dict} representation of the HSP.
         """
-        return self.score.betterThan(score)
+        result = _Base.toDict(self)
+        result['score'] = self.score.score
+        return result
+
+
+class LSP(_Base):
+    """
+    Holds information about a low-scoring pair from a read alignment.
+    Comparisons are done as for BLAST or DIAMOND e-values (smaller is better).
+
+    @param score: The numeric score of this LSP.
+    """
+
+    def __init__(self, score, **kwargs):
+        _Base.__init__(self, **kwargs)
+        self.score = LowerIsBetterScore(score)
 
     def toDict(self):
         """
-        Get information about the HSP/LSP as a dictionary.
+        Get information about the LSP as a dictionary.
 
-        @return: A C{dict} representation of the HSP/LSP.
+        @return: A C{dict} representation of the LSP.
         """
-        return {
-            'readStart': self.readStart,
-            'readEnd': self.readEnd,
-            'readStartInSubject': self.readStartInSubject,
-            'readEndInSubject': self.readEndInSubject,
-            'readFrame': self.readFrame,
-            'subjectStart': self.subjectStart,
-            'subjectEnd': self.subjectEnd,
-            'subjectFrame': self.subjectFrame,
-            'readMatchedSequence': self.readMatchedSequence,
-            'subjectMatchedSequence': self.subjectMatchedSequence,
-            'identicalCount': self.identicalCount,
-            'percentIdentical': self.percentIdentical,
-            'positiveCount': self.positiveCount,
-            'percentPositive': self.percentPositive,
-        }
+        result = _Base.toDict(self)
+        result['score'] = self.score.score
+        return result
 
 
-class HSP(_Base):
+class _SlottedBase(_Comparable):
     """
-    Holds information about a high-scoring pair from a read alignment.
+    Holds the same information as C{_Base}, but in slots instead of an
+    instance C{__dict__}, which makes instances much smaller. This matters
+    when holding the alignments of a large BLAST or DIAMOND run in memory,
+    e.g., in C{TitlesAlignments}.
+
+    The matched sequences can also be loaded lazily: if C{sequenceSource} is
+    given, the C{readMatchedSequence} and C{subjectMatchedSequence}
+    attributes are fetched from it each time they are accessed, so the
+    (often long) matched sequences are not held in memory by the instance.
+
+    You should not use this class directly. Use one of its subclasses,
+    either SlottedHSP or SlottedLSP.
+
+    All parameters apart from the following are as for C{_Base}.
+
+    @param sequenceSource: If not C{None}, an object with a
+        C{matchedSequences} method that takes C{sequenceIndex} and returns
+        a 2-tuple with the C{str} read and subject matched sequences (e.g.,
+        a L{dark.alignment_store.AlignmentStore}). In this case
+        C{readMatchedSequence} and C{subjectMatchedSequence} are ignored.
+    @param sequenceIndex: The C{int} index of this HSP in C{sequenceSource}.
+    """
+    __slots__ = ('readStart', 'readEnd', 'readStartInSubject',
+                 'readEndInSubject', 'readFrame', 'subjectStart', 'subjectEnd',
+                 'subjectFrame', 'identicalCount', 'percentIdentical',
+                 'positiveCount', 'percentPositive', 'score',
+                 '_readMatchedSequence', '_subjectMatchedSequence',
+                 '_sequenceSource', '_sequenceIndex')
+
+    def __init__(self, readStart=None, readEnd=None, readStartInSubject=None,
+                 readEndInSubject=None, readFrame=None, subjectStart=None,
+                 subjectEnd=None, subjectFrame=None, readMatchedSequence=None,
+                 subjectMatchedSequence=None, identicalCount=None,
+                 percentIdentical=None, positiveCount=None,
+                 percentPositive=None, sequenceSource=None,
+                 sequenceIndex=None):
+        self.readStart = readStart
+        self.readEnd = readEnd
+        self.readStartInSubject = readStartInSubject
+        self.readEndInSubject = readEndInSubject
+        self.readFrame = readFrame
+        self.subjectStart = subjectStart
+        self.subjectEnd = subjectEnd
+        self.subjectFrame = subjectFrame
+        self.identicalCount = identicalCount
+        self.percentIdentical = percentIdentical
+        self.positiveCount = positiveCount
+        self.percentPositive = percentPositive
+        if sequenceSource is None:
+            self._readMatchedSequence = readMatchedSequence
+            self._subjectMatchedSequence = subjectMatchedSequence
+        else:
+            self._readMatchedSequence = self._subjectMatchedSequence = None
+        self._sequenceSource = sequenceSource
+        self._sequenceIndex = sequenceIndex
+
+    @property
+    def readMatchedSequence(self):
+        """
+        Get the matched part of the read.
+
+        @return: A C{str} (possibly containing gaps) or C{None}.
+        """
+        if self._sequenceSource is None:
+            return self._readMatchedSequence
+        else:
+            return self._sequenceSource.matchedSequences(
+                self._sequenceIndex)[0]
+
+    @property
+    def subjectMatchedSequence(self):
+        """
+        Get the matched part of the subject.
+
+        @return: A C{str} (possibly containing gaps) or C{None}.
+        """
+        if self._sequenceSource is None:
+            return self._subjectMatchedSequence
+        else:
+            return self._sequenceSource.matchedSequences(
+                self._sequenceIndex)[1]
+
+    def __getstate__(self):
+        """
+        Get the state of the instance, for pickling. The matched sequences
+        are loaded, so the sequence source is not pickled.
+
+        @return: A C{dict} of attribute values.
+        """
+        state = dict((name, getattr(self, name))
+                     for name in _SlottedBase.__slots__ if name[0] != '_')
+        state['_readMatchedSequence'] = self.readMatchedSequence
+        state['_subjectMatchedSequence'] = self.subjectMatchedSequence
+        state['_sequenceSource'] = state['_sequenceIndex'] = None
+        return state
+
+    def __setstate__(self, state):
+        """
+        Set the state of the instance, when unpickling.
+
+        @param state: A C{dict} of attribute values, from C{__getstate__}.
+        """
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+class SlottedHSP(_SlottedBase):
+    """
+    A slotted version of C{HSP}, with optionally lazy matched sequences.
     Comparisons are done as for BLAST or DIAMOND bit scores (higher is better).
 
     @param score: The numeric score of this HSP.
     """
+    __slots__ = ()
 
     def __init__(self, score, **kwargs):
-        _Base.__init__(self, **kwargs)
+        _SlottedBase.__init__(self, **kwargs)
         self.score = HigherIsBetterScore(score)
 
     def toDict(self):
@@ -143,21 +307,22 @@ class HSP(_Base):
 
         @return: A C{dict} representation of the HSP.
         """
-        result = _Base.toDict(self)
+        result = _SlottedBase.toDict(self)
         result['score'] = self.score.score
         return result
 
 
-class LSP(_Base):
+class SlottedLSP(_SlottedBase):
     """
-    Holds information about a low-scoring pair from a read alignment.
+    A slotted version of C{LSP}, with optionally lazy matched sequences.
     Comparisons are done as for BLAST or DIAMOND e-values (smaller is better).
 
     @param score: The numeric score of this LSP.
     """
+    __slots__ = ()
 
     def __init__(self, score, **kwargs):
-        _Base.__init__(self, **kwargs)
+        _SlottedBase.__init__(self, **kwargs)
         self.score = LowerIsBetterScore(score)
 
     def toDict(self):
@@ -166,6 +331,6 @@ class LSP(_Base):
 
         @return: A C{dict} representation of the LSP.
         """
-        result = _Base.toDict(self)
+        result = _SlottedBase.toDict(self)
         result['score'] = self.score.score
         return result
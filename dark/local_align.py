@@ -1,3 +1,39 @@
+import numpy as np
+
+from dark.utils import orderedPoolMap, take
+
+# The traceback pointers stored for each cell by the NumPy alignment engine
+# (see LocalAlignment._fillArrays). These say whether a cell's score came
+# from the diagonal, from an insertion (a gap in the first sequence) or from
+# a deletion (a gap in the second sequence), or is zero (_STOP).
+_STOP = 0
+_DIAGONAL = 1
+_INSERTION = 2
+_DELETION = 3
+
+
+class _ScoreProfiles(dict):
+    """
+    Hold the match and mismatch scores of letters against all of a
+    sequence. The scores for a letter are computed the first time they are
+    needed.
+
+    @param sequence: The C{str} sequence.
+    @param match: The C{int} match score.
+    @param mismatch: The C{int} mismatch score.
+    """
+    def __init__(self, sequence, match, mismatch):
+        self._letters = np.frombuffer(sequence.encode('latin-1'),
+                                      dtype=np.uint8)
+        self._match = float(match)
+        self._mismatch = float(mismatch)
+
+    def __missing__(self, letter):
+        profile = self[letter] = np.where(self._letters == ord(letter),
+                                          self._match, self._mismatch)
+        return profile
+
+
 class LocalAlignment(object):
     """
     Perform a Smith-Waterman local alignment between two FASTA files.
@@ -9,12 +45,20 @@ class LocalAlignment(object):
     @param gap: The C{int} penalty for opening a gap.
     @param gapExtend: The C{int} penalty for extending a gap.
     @param gapExtendDecay: A C{float} which decreases the penalty for extending
-        a gap.
-    @raise ValueError: If either sequence is of zero length.
+        a gap. If this is non-zero, the alignment is done with a (much
+        slower) table of Python C{dict}s. Otherwise, scores are computed a
+        row at a time with NumPy arrays.
+    @param band: If not C{None}, an C{int} band width. Only cells whose
+        offsets in the two sequences differ by at most this much are
+        computed, which saves a great deal of time and memory when aligning
+        long similar sequences.
+    @raise ValueError: If either sequence is of zero length, if a score is
+        out of range, or if C{band} is given with a non-zero
+        C{gapExtendDecay}.
     """
 
     def __init__(self, seq1, seq2, match=1, mismatch=-1, gap=-1,
-                 gapExtend=-1, gapExtendDecay=0.0):
+                 gapExtend=-1, gapExtendDecay=0.0, band=None):
         self.seq1Seq = seq1.sequence.upper()
         self.seq1ID = seq1.id
         self.seq2Seq = seq2.sequence.upper()
@@ -24,6 +68,9 @@ class LocalAlignment(object):
         self.gapOpen = gap
         self.gapExtend = gapExtend
         self.gapExtendDecay = gapExtendDecay
+        self.band = band
+        # The scores of each letter of seq2 against all of seq1.
+        self._profiles = _ScoreProfiles(self.seq1Seq, match, mismatch)
 
         if self.mismatch >= 0:
             raise ValueError('Mismatch must be negative')
@@ -31,6 +78,12 @@ class LocalAlignment(object):
             raise ValueError('Gap must be negative')
         if self.gapExtend > 0:
             raise ValueError('Gap extension penalty cannot be positive')
+        if band is not None:
+            if band < 0:
+                raise ValueError('Band must not be negative')
+            if gapExtendDecay:
+                raise ValueError('A band cannot be used with a gap extend '
+                                 'decay')
 
         if len(self.seq1Seq) == 0:
             raise ValueError('Empty sequence: %s' % self.seq1ID)
@@ -198,6 +251,176 @@ class LocalAlignment(object):
 
         return ([align1, align, align2], indexes)
 
+    def _fillArrays(self, traceback=True):
+        """
+        Compute Smith-Waterman scores a row at a time, using NumPy arrays.
+
+        The scores are exactly those of C{self._fillAndTraceback} (without a
+        gap extend decay): a gap is extended, rather than opened, if the
+        cell above was reached by a gap of the same kind. Scores within a
+        row depend on the scores to their left (via deletions), but whether
+        these deletions are opened or extended only depends on the row
+        above. So the scores of a row are found with a cumulative maximum
+        of the scores without a deletion, less the summed deletion penalties
+        to their left.
+
+        @param traceback: If C{True}, store a traceback pointer for every
+            cell that is computed. Otherwise, only keep two rows of scores.
+        @return: A 4-C{tuple} with the best score, its (1-based) row and
+            column, and either C{None} (if C{traceback} is C{False}) or a
+            2-C{tuple} with a 2-D C{np.uint8} array of traceback pointers
+            (with a row for each row of the table) and a C{np.ndarray}
+            giving the (1-based) column of the first pointer in each row.
+        """
+        seq1, seq2 = self.seq1Seq, self.seq2Seq
+        cols, rows = len(seq1), len(seq2)
+        band = max(cols, rows) if self.band is None else self.band
+        gapOpen = float(self.gapOpen)
+        gapExtend = float(self.gapExtend)
+        profiles = self._profiles
+
+        # The scores and traceback pointers of the previous row. Cells that
+        # have not yet entered the band have a score of zero (and so can
+        # never be reached by a gap). Cells that have left it are never
+        # looked at again.
+        scores = np.zeros(cols + 1)
+        pointers = np.zeros(cols + 1, dtype=np.uint8)
+
+        if traceback:
+            width = min(cols, 2 * band + 1)
+            flags = np.zeros((rows, width), dtype=np.uint8)
+            rowStarts = np.maximum(1, np.arange(1, rows + 1) - band)
+        else:
+            flags = rowStarts = None
+
+        maxScore = 0.0
+        maxRow = maxCol = 0
+
+        for row in range(1, rows + 1):
+            start = max(1, row - band)
+            end = min(cols, row + band)
+            if start > end:
+                if start > cols:
+                    # The band has moved past the end of seq1.
+                    break
+                continue
+            abovePointers = pointers[start:end + 1]
+            diagonal = scores[start - 1:end] + profiles[seq2[row - 1]][
+                start - 1:end]
+            insertion = scores[start:end + 1] + np.where(
+                abovePointers == _INSERTION, gapExtend, gapOpen)
+            deletionPenalties = np.where(abovePointers == _DELETION,
+                                         gapExtend, gapOpen)
+
+            # The best scores without a deletion, and then the best scores.
+            # Each best score is the larger of the score without a deletion
+            # and the best score to its left plus the deletion penalty.
+            noDeletion = np.maximum(diagonal, insertion)
+            np.maximum(noDeletion, 0.0, out=noDeletion)
+            penalties = np.cumsum(deletionPenalties)
+            best = np.maximum.accumulate(noDeletion - penalties)
+            best += penalties
+            deletion = np.empty(end - start + 1)
+            deletion[0] = 0.0
+            deletion[1:] = best[:-1]
+            deletion += deletionPenalties
+
+            rowPointers = np.where(
+                best <= 0.0, _STOP,
+                np.where(deletion > noDeletion, _DELETION,
+                         np.where(insertion > diagonal, _INSERTION,
+                                  _DIAGONAL))).astype(np.uint8)
+
+            if traceback:
+                flags[row - 1, :end - start + 1] = rowPointers
+
+            scores[start:end + 1] = best
+            pointers[start:end + 1] = rowPointers
+
+            # Ties are resolved in favour of the last cell (in row order).
+            rowMax = best.max()
+            if rowMax >= maxScore:
+                maxScore = rowMax
+                maxRow = row
+                maxCol = end - int(np.argmax(best[::-1]))
+
+        return (maxScore, maxRow, maxCol,
+                None if flags is None else (flags, rowStarts))
+
+    def _tracebackArrays(self, maxRow, maxCol, flags, rowStarts):
+        """
+        Trace back through the pointers made by C{self._fillArrays}.
+
+        @param maxRow: The C{int} (1-based) row of the best score.
+        @param maxCol: The C{int} (1-based) column of the best score.
+        @param flags: A 2-D C{np.uint8} array of traceback pointers.
+        @param rowStarts: A C{np.ndarray} giving the (1-based) column of the
+            first pointer in each row of C{flags}.
+        @return: A 2-C{tuple}, in the same format as is returned by
+            C{self._fillAndTraceback}.
+        """
+        seq1, seq2 = self.seq1Seq, self.seq2Seq
+        align1 = []
+        align2 = []
+        align = []
+        row, col = maxRow, maxCol
+
+        while row > 0 and col > 0:
+            pointer = flags[row - 1, col - rowStarts[row - 1]]
+            if pointer == _DIAGONAL:
+                nt1 = seq1[col - 1]
+                nt2 = seq2[row - 1]
+                align1.append(nt1)
+                align2.append(nt2)
+                align.append('|' if nt1 == nt2 else ' ')
+                row -= 1
+                col -= 1
+            elif pointer == _INSERTION:
+                align1.append('-')
+                align2.append(seq2[row - 1])
+                align.append(' ')
+                row -= 1
+            elif pointer == _DELETION:
+                align1.append(seq1[col - 1])
+                align2.append('-')
+                align.append(' ')
+                col -= 1
+            else:
+                break
+
+        indexes = {
+            'max_row': maxRow,
+            'max_col': maxCol,
+            'min_row': row + 1,
+            'min_col': col + 1,
+        }
+
+        return ([''.join(reversed(align1)), ''.join(reversed(align)),
+                 ''.join(reversed(align2))], indexes)
+
+    def score(self):
+        """
+        Find the best local alignment score, without storing the information
+        needed to recover the alignment (so using memory proportional to the
+        length of the first sequence).
+
+        @raise ValueError: If C{self.gapExtendDecay} is non-zero.
+        @return: A C{dict} with the 'score' and the (1-based) 'sequence1End'
+            and 'sequence2End' offsets of the end of the best alignment, or
+            C{None} if the sequences have no positive-scoring alignment.
+        """
+        if self.gapExtendDecay:
+            raise ValueError('Scores cannot be computed separately when '
+                             'using a gap extend decay')
+        score, row, col, _ = self._fillArrays(traceback=False)
+        if score <= 0.0:
+            return None
+        return {
+            'score': int(score) if score == int(score) else score,
+            'sequence1End': col,
+            'sequence2End': row,
+        }
+
     def _cigarString(self, output):
         """
         Return a cigar string of aligned sequences.
@@ -337,8 +560,13 @@ class LocalAlignment(object):
             version of the match info (see _alignmentToStr above for the exact
             format).
         """
-        table = self._initialise()
-        alignment = self._fillAndTraceback(table)
+        if self.gapExtendDecay:
+            table = self._initialise()
+            alignment = self._fillAndTraceback(table)
+        else:
+            _, maxRow, maxCol, (flags, rowStarts) = self._fillArrays()
+            alignment = self._tracebackArrays(maxRow, maxCol, flags,
+                                              rowStarts)
         output = alignment[0]
         if output[0] == '' or output[2] == '':
             result = None
@@ -354,3 +582,113 @@ class LocalAlignment(object):
             }
 
         return self._alignmentToStr(result) if resultFormat is str else result
+
+
+# The reference, the alignment arguments, and the score profiles used by
+# worker processes (see _initAlignWorker).
+_workerReference = _workerKwargs = _workerProfiles = None
+
+
+def _alignQuery(query, reference, kwargs, profiles, resultFormat):
+    """
+    Align a query against a reference.
+
+    @param query: A C{dark.reads.Read} instance.
+    @param reference: A C{dark.reads.Read} instance.
+    @param kwargs: A C{dict} of keyword arguments for C{LocalAlignment}.
+    @param profiles: A C{_ScoreProfiles} instance for the reference.
+    @param resultFormat: Either C{dict} or C{str}, giving the desired
+        result format.
+    @return: The result of C{LocalAlignment.createAlignment}.
+    """
+    alignment = LocalAlignment(reference, query, **kwargs)
+    alignment._profiles = profiles
+    return alignment.createAlignment(resultFormat=resultFormat)
+
+
+def _initAlignWorker(reference, kwargs):
+    """
+    Initialize a worker process for C{alignToReference}.
+
+    @param reference: A C{dark.reads.Read} instance.
+    @param kwargs: A C{dict} of keyword arguments for C{LocalAlignment}.
+    """
+    global _workerReference, _workerKwargs, _workerProfiles
+    _workerReference = reference
+    _workerKwargs = kwargs
+    _workerProfiles = _ScoreProfiles(reference.sequence.upper(),
+                                     kwargs['match'], kwargs['mismatch'])
+
+
+def _alignQueriesInWorker(args):
+    """
+    Align a chunk of queries against the worker's reference.
+
+    @param args: A 2-C{tuple} with a C{list} of C{dark.reads.Read} queries
+        and the desired result format.
+    @return: A C{list} of the results of C{LocalAlignment.createAlignment}.
+    """
+    queries, resultFormat = args
+    return [_alignQuery(query, _workerReference, _workerKwargs,
+                        _workerProfiles, resultFormat)
+            for query in queries]
+
+
+def alignToReference(reference, queries, match=1, mismatch=-1, gap=-1,
+                     gapExtend=-1, gapExtendDecay=0.0, band=None,
+                     resultFormat=dict, workers=None, chunkSize=16):
+    """
+    Make local alignments of many query sequences against one reference.
+
+    The scores of each query letter against the reference are computed
+    just once. The reference is the first sequence (C{seq1}) of each
+    C{LocalAlignment}.
+
+    @param reference: A C{dark.reads.Read} instance.
+    @param queries: An iterable of C{dark.reads.Read} instances (e.g., a
+        C{dark.fasta.FastaReads} instance). These are read as they are
+        needed.
+    @param match: The C{int} match score.
+    @param mismatch: The C{int} mismatch score.
+    @param gap: The C{int} penalty for opening a gap.
+    @param gapExtend: The C{int} penalty for extending a gap.
+    @param gapExtendDecay: A C{float} which decreases the penalty for extending
+        a gap.
+    @param band: If not C{None}, an C{int} band width (see
+        C{LocalAlignment}).
+    @param resultFormat: Either C{dict} or C{str}, giving the desired
+        result format.
+    @param workers: If not C{None} and greater than one, the C{int} number of
+        worker processes to spread the alignments over.
+    @param chunkSize: The C{int} number of queries to send to a worker
+        process at a time. At most twice the number of workers chunks are
+        read ahead of the results that have been yielded.
+    @raise ValueError: If any sequence is of zero length or if a score is out
+        of range (see C{LocalAlignment}).
+    @return: A generator that yields the result of
+        C{LocalAlignment.createAlignment} for each query, in the order of
+        C{queries}.
+    """
+    kwargs = {
+        'match': match,
+        'mismatch': mismatch,
+        'gap': gap,
+        'gapExtend': gapExtend,
+        'gapExtendDecay': gapExtendDecay,
+        'band': band,
+    }
+
+    if workers is None or workers < 2:
+        profiles = _ScoreProfiles(reference.sequence.upper(), match,
+                                  mismatch)
+        for query in queries:
+            yield _alignQuery(query, reference, kwargs, profiles,
+                              resultFormat)
+    else:
+        for _, results in orderedPoolMap(
+                _alignQueriesInWorker,
+                ((chunk, resultFormat) for chunk in take(queries, chunkSize)),
+                workers, initializer=_initAlignWorker,
+                initargs=(reference, kwargs)):
+            for result in results:
+                yield result
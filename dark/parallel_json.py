@@ -0,0 +1,348 @@
+import re
+import bz2
+import mmap
+import zlib
+from json import loads
+
+from dark.utils import orderedPoolMap
+
+# Read compressed files of JSON lines (such as those written by
+# convert-blast-xml-to-json.py and convert-diamond-to-json.py) using many
+# processes.
+#
+# A bzip2 file made by pbzip2 (or by concatenating bzip2 files) holds many
+# independent streams, and a gzip file made by bgzip (or by concatenating
+# gzip files) holds many independent members. The compressed file is cut
+# into segments at stream / member boundaries and each segment is
+# decompressed, and its JSON lines parsed, in a worker process. The
+# segments are handed back in order and the lines that cross segment
+# boundaries are re-joined and parsed in the calling process.
+#
+# A file made by a single-stream compressor (e.g., bzip2 or gzip) cannot be
+# cut up in this way, and is read in the calling process.
+
+# The approximate size (in compressed bytes) of the segments given to each
+# worker.
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+# The start of a bzip2 stream: the stream header and the magic number of
+# its first block.
+_BZ2_STREAM_START = re.compile(b'BZh[1-9]1AY&SY')
+
+# The start of a gzip member: the magic number and the deflate method.
+_GZIP_MEMBER_START = re.compile(b'\x1f\x8b\x08')
+
+# How many bytes of a possible gzip member to decompress to check it is
+# real.
+_GZIP_CHECK_SIZE = 64 * 1024
+
+# How many compressed bytes to read at a time when decompressing in the
+# calling process.
+_READ_SIZE = 1024 * 1024
+
+
+def compression(filename):
+    """
+    Get the compression used in a file, according to its suffix.
+
+    @param filename: A C{str} file name.
+    @return: 'bz2', 'gzip', or C{None} if the file name does not end with
+        '.bz2' or '.gz'.
+    """
+    if filename.endswith('.bz2'):
+        return 'bz2'
+    elif filename.endswith('.gz'):
+        return 'gzip'
+
+
+def _decompressor(compression):
+    """
+    Make a decompressor for one bzip2 stream or gzip member.
+
+    @param compression: Either 'bz2' or 'gzip'.
+    @return: A decompressor object with C{decompress}, C{eof}, and
+        C{unused_data} attributes.
+    """
+    if compression == 'bz2':
+        return bz2.BZ2Decompressor()
+    else:
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+
+def _isMemberStart(data, offset, compression):
+    """
+    Check whether a possible gzip member start (or bzip2 stream start) is
+    real.
+
+    @param data: The compressed C{bytes} (or C{mmap}).
+    @param offset: The C{int} offset of the possible start.
+    @param compression: Either 'bz2' or 'gzip'.
+    @return: C{True} if C{offset} is very likely the start of a member.
+    """
+    if compression == 'bz2':
+        # The stream start pattern is long enough not to need checking.
+        return True
+
+    # The reserved gzip header flag bits must be zero, and the start of the
+    # member must decompress.
+    if len(data) < offset + 10 or ord(data[offset + 3:offset + 4]) & 0xe0:
+        return False
+
+    try:
+        _decompressor(compression).decompress(
+            data[offset:offset + _GZIP_CHECK_SIZE])
+    except zlib.error:
+        return False
+    else:
+        return True
+
+
+def segmentBoundaries(filename, compression, segmentSize=SEGMENT_SIZE):
+    """
+    Find offsets at which a compressed file can be cut into segments that
+    can be decompressed independently.
+
+    @param filename: A C{str} file name.
+    @param compression: Either 'bz2' or 'gzip'.
+    @param segmentSize: The C{int} approximate size of each segment.
+    @return: A C{list} of C{int} offsets, starting with zero and ending with
+        the file size. Any segment may, very rarely, end at an offset that
+        is not actually the start of a stream or member. That is detected
+        when the segment is decompressed.
+    """
+    pattern = (_BZ2_STREAM_START if compression == 'bz2' else
+               _GZIP_MEMBER_START)
+
+    boundaries = [0]
+
+    with open(filename, 'rb') as fp:
+        fp.seek(0, 2)
+        size = fp.tell()
+        if size:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                target = segmentSize
+                while target < size:
+                    match = pattern.search(data, target)
+                    while match and not _isMemberStart(data, match.start(),
+                                                       compression):
+                        match = pattern.search(data, match.start() + 1)
+                    if match is None:
+                        break
+                    boundaries.append(match.start())
+                    target = match.start() + segmentSize
+            finally:
+                data.close()
+
+    boundaries.append(size)
+
+    return boundaries
+
+
+def _parseLines(data):
+    """
+    Parse the complete JSON lines in a block of data.
+
+    @param data: The C{bytes} to parse.
+    @return: A 4-tuple containing the C{bytes} before the first newline,
+        a C{list} of the values parsed from the lines between the first and
+        last newlines, the C{bytes} after the last newline (or C{None} if
+        there is no newline in C{data}), and either C{None} or (if a line
+        could not be parsed) a 2-tuple with the C{str} error and the
+        C{bytes} line. The values parsed before any error are returned.
+    """
+    lines = data.split(b'\n')
+    if len(lines) == 1:
+        return data, [], None, None
+
+    values = []
+    for line in lines[1:-1]:
+        try:
+            values.append(loads(line.decode('UTF-8')))
+        except ValueError as e:
+            return lines[0], values, lines[-1], (str(e), line)
+
+    return lines[0], values, lines[-1], None
+
+
+def _decompressRange(fp, start, end, compression):
+    """
+    Decompress a range of a file that holds complete streams or members.
+
+    @param fp: A file pointer, opened in binary mode.
+    @param start: The C{int} offset of the start of the range.
+    @param end: The C{int} offset of the end of the range.
+    @param compression: Either 'bz2' or 'gzip'.
+    @return: The decompressed C{bytes}, or C{None} if the range does not
+        hold exactly a number of complete streams or members.
+    """
+    fp.seek(start)
+    data = fp.read(end - start)
+    result = []
+    try:
+        while data:
+            decompressor = _decompressor(compression)
+            result.append(decompressor.decompress(data))
+            if not decompressor.eof:
+                return None
+            data = decompressor.unused_data
+    except (IOError, OSError, EOFError, zlib.error):
+        return None
+
+    return b''.join(result)
+
+
+def _decompressAndParse(args):
+    """
+    Decompress a segment of a file and parse its JSON lines.
+
+    @param args: A 4-tuple with the C{str} file name, the C{int} start
+        and end offsets of the segment, and the compression ('bz2' or
+        'gzip').
+    @return: The result of C{_parseLines} on the decompressed data, or
+        C{None} if the segment could not be decompressed.
+    """
+    filename, start, end, compression = args
+    with open(filename, 'rb') as fp:
+        data = _decompressRange(fp, start, end, compression)
+    return None if data is None else _parseLines(data)
+
+
+def _serialPieces(filename, start, compression):
+    """
+    Decompress a file (from a stream or member start) and parse its JSON
+    lines in this process.
+
+    @param filename: A C{str} file name.
+    @param start: The C{int} offset to start reading at.
+    @param compression: Either 'bz2', 'gzip' or C{None}.
+    @return: A generator that yields the results of C{_parseLines} on
+        successive blocks of decompressed data.
+    """
+    with open(filename, 'rb') as fp:
+        fp.seek(start)
+        decompressor = None
+        while True:
+            data = fp.read(_READ_SIZE)
+            if not data:
+                break
+            if compression is None:
+                yield _parseLines(data)
+                continue
+            while data:
+                if decompressor is None:
+                    decompressor = _decompressor(compression)
+                yield _parseLines(decompressor.decompress(data))
+                if decompressor.eof:
+                    data = decompressor.unused_data
+                    decompressor = None
+                else:
+                    data = None
+
+        if decompressor is not None:
+            raise ValueError(
+                'Compressed file %r ended before the end of its last %s.' %
+                (filename, 'stream' if compression == 'bz2' else 'member'))
+
+
+def _parallelPieces(filename, boundaries, compression, workers):
+    """
+    Decompress the segments of a file and parse their JSON lines in worker
+    processes.
+
+    @param filename: A C{str} file name.
+    @param boundaries: A C{list} of C{int} segment boundaries, as returned
+        by C{segmentBoundaries}.
+    @param compression: Either 'bz2' or 'gzip'.
+    @param workers: The C{int} number of worker processes to use.
+    @return: A generator that yields the results of C{_parseLines} on each
+        segment, in order.
+    """
+    results = orderedPoolMap(
+        _decompressAndParse,
+        ((filename, start, end, compression)
+         for start, end in zip(boundaries, boundaries[1:])),
+        workers)
+
+    for (_, start, _, _), piece in results:
+        if piece is None:
+            # This segment did not end at a real stream or member boundary
+            # (but did start at one, or the previous segment would have
+            # failed). Stop the workers and read the rest of the file here.
+            results.close()
+            for piece in _serialPieces(filename, start, compression):
+                yield piece
+            return
+        yield piece
+
+
+def parallelJSONLines(filename, workers=None, segmentSize=SEGMENT_SIZE):
+    """
+    Read the JSON lines in a (possibly compressed) file, decompressing and
+    parsing them in worker processes.
+
+    @param filename: A C{str} file name. If this ends with '.bz2' or '.gz'
+        the file is decompressed. Files with many streams (bzip2) or members
+        (gzip) are decompressed in parallel.
+    @param workers: The C{int} number of worker processes to use. If
+        C{None} or less than two, or if the file is not compressed or has a
+        single stream or member, the file is read in this process.
+    @param segmentSize: The C{int} approximate size of the segments of the
+        compressed file given to each worker.
+    @raise ValueError: If a line cannot be parsed as JSON, or if a
+        compressed file is truncated.
+    @return: A generator that yields the value parsed from each line of
+        the file, in order.
+    """
+    fileCompression = compression(filename)
+
+    if workers is None or workers < 2 or fileCompression is None:
+        boundaries = None
+    else:
+        boundaries = segmentBoundaries(filename, fileCompression,
+                                       segmentSize)
+
+    if boundaries is None or len(boundaries) < 3:
+        pieces = _serialPieces(filename, 0, fileCompression)
+    else:
+        pieces = _parallelPieces(filename, boundaries, fileCompression,
+                                 workers)
+
+    def load(line):
+        try:
+            return loads(line.decode('UTF-8'))
+        except ValueError as e:
+            fail(str(e), line)
+
+    def fail(error, line):
+        raise ValueError(
+            'Could not convert line %d of %r to JSON (%s). Line is %r.' %
+            (lineNumber, filename, error, line.decode('UTF-8', 'replace')))
+
+    partial = b''
+    lineNumber = 0
+
+    try:
+        for head, values, tail, error in pieces:
+            if tail is None:
+                partial += head
+                continue
+
+            lineNumber += 1
+            yield load(partial + head)
+
+            for value in values:
+                lineNumber += 1
+                yield value
+
+            if error:
+                lineNumber += 1
+                fail(*error)
+
+            partial = tail
+
+        if partial:
+            lineNumber += 1
+            yield load(partial)
+    finally:
+        pieces.close()
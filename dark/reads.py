@@ -1,9 +1,10 @@
 import sys
 import six
 import os
+from array import array
+from copy import copy
 from functools import total_ordering
 from collections import Counter
-from hashlib import md5
 from random import uniform
 
 from Bio.Seq import translate
@@ -12,9 +13,10 @@ from Bio.Data.IUPACData import (
 
 from dark.aa import (
     AA_LETTERS, NAMES as AA_NAMES, PROPERTIES, PROPERTY_DETAILS, NONE)
+from dark.alignment_matrix import AlignmentMatrix
+from dark.bloom import BloomFilter
 from dark.filter import TitleFilter
-from dark.dna import FloatBaseCounts, AMBIGUOUS, BASES_TO_AMBIGUOUS
-from dark.errors import ReadLengthsNotIdenticalError
+from dark.utils import orderedPoolMap, stringHashFunction
 
 
 if six.PY3:
@@ -71,6 +73,9 @@ class Read(object):
     @raise ValueError: if the length of the quality string (if any) does not
         match the length of the sequence.
     """
+    # Reads are slotted, to save memory when there are many of them.
+    __slots__ = ('id', 'sequence', 'quality')
+
     ALPHABET = None
 
     def __init__(self, id, sequence, quality=None):
@@ -104,13 +109,9 @@ class Read(object):
 
         @return: The C{int} hash key for the read.
         """
-        if self.quality is None:
-            return hash(md5(self.id.encode('UTF-8') + b'\0' +
-                            self.sequence.encode('UTF-8')).digest())
-        else:
-            return hash(md5(self.id.encode('UTF-8') + b'\0' +
-                            self.sequence.encode('UTF-8') + b'\0' +
-                            self.quality.encode('UTF-8')).digest())
+        # Python's string hashes are fast and are cached on the strings, so
+        # there's no need to compute a digest of our own.
+        return hash((self.id, self.sequence, self.quality))
 
     def __getitem__(self, item):
         sequence = self.sequence[item]
@@ -298,6 +299,8 @@ class _NucleotideRead(Read):
     """
     Holds methods to work with nucleotide (DNA and RNA) sequences.
     """
+    __slots__ = ()
+
     def translations(self):
         """
         Yield all six translations of a nucleotide sequence.
@@ -336,6 +339,8 @@ class DNARead(_NucleotideRead):
     """
     Hold information and methods to work with DNA reads.
     """
+    __slots__ = ()
+
     ALPHABET = set('ATCG')
 
     COMPLEMENT_TABLE = _makeComplementTable(ambiguous_dna_complement)
@@ -345,6 +350,8 @@ class RNARead(_NucleotideRead):
     """
     Hold information and methods to work with RNA reads.
     """
+    __slots__ = ()
+
     ALPHABET = set('ATCGU')
 
     COMPLEMENT_TABLE = _makeComplementTable(ambiguous_rna_complement)
@@ -364,6 +371,8 @@ class DNAKozakRead(DNARead):
         locations in the Kozak sequence that match the most frequent Kozak
         nucleotides.
     """
+    __slots__ = ('originalRead', 'start', 'stop', 'kozakQuality')
+
     def __init__(self, originalRead, start, stop, kozakQuality):
         if start < 0:
             raise ValueError('start offset (%d) less than zero' % start)
@@ -406,6 +415,8 @@ class AARead(Read):
     """
     Hold information and methods to work with AA reads.
     """
+    __slots__ = ()
+
     ALPHABET = set(AA_LETTERS)
 
     def checkAlphabet(self, count=10):
@@ -513,6 +524,8 @@ class AAReadWithX(AARead):
     Hold information and methods to work with AA reads with additional
     characters.
     """
+    __slots__ = ()
+
     ALPHABET = set(AA_LETTERS + ['X'])
 
 
@@ -535,6 +548,8 @@ class AAReadORF(AARead):
         was found). If C{False}, a stop codon was found in the read after this
         ORF.
     """
+    __slots__ = ('start', 'stop', 'openLeft', 'openRight')
+
     def __init__(self, originalRead, start, stop, openLeft, openRight):
         if start < 0:
             raise ValueError('start offset (%d) less than zero' % start)
@@ -615,6 +630,8 @@ class SSAARead(AARead):
     @param structure: A C{str} of structure information.
     @raise ValueError: If the sequence and structure lengths are not the same.
     """
+    __slots__ = ('structure',)
+
     def __init__(self, id, sequence, structure):
         if six.PY3:
             super().__init__(id, sequence)
@@ -638,9 +655,7 @@ class SSAARead(AARead):
 
         @return: The C{int} hash key for the read.
         """
-        return hash(md5(self.id.encode('UTF-8') + b'\0' +
-                        self.sequence.encode('UTF-8') + b'\0' +
-                        self.structure.encode('UTF-8')).digest())
+        return hash((self.id, self.sequence, self.structure))
 
     def __getitem__(self, item):
         sequence = self.sequence[item]
@@ -727,6 +742,8 @@ class SSAAReadWithX(SSAARead):
     Hold information and methods to work with C{SSAARead}s allowing 'X'
     characters to appear in sequences.
     """
+    __slots__ = ()
+
     ALPHABET = set(AA_LETTERS + ['X'])
 
 
@@ -741,6 +758,8 @@ class TranslatedRead(AARead):
     @param reverseComplemented: A C{bool}, C{True} if the original sequence
         must be reverse complemented to obtain this AA sequence.
     """
+    __slots__ = ('frame', 'reverseComplemented')
+
     def __init__(self, originalRead, sequence, frame,
                  reverseComplemented=False):
         if frame not in (0, 1, 2):
@@ -849,7 +868,28 @@ class ReadFilter(object):
         only on read id.
     @param removeDuplicatesUseMD5: If C{True}, use MD5 sums instead of the
         full sequence or read when either C{removeDuplicates} or
-        C{removeDuplicatesById} are C{True}.
+        C{removeDuplicatesById} are C{True}. This is the same as passing
+        'md5' as C{removeDuplicatesHash}.
+    @param removeDuplicatesHash: If not C{None}, store hashes made by this
+        hash function instead of the full sequence or read id when either
+        C{removeDuplicates} or C{removeDuplicatesById} are C{True}. This can
+        be one of the names in C{dark.utils.HASH_FUNCTIONS} or a function
+        (see C{dark.utils.stringHashFunction}). Hashes save memory but two
+        different sequences (or ids) with the same hash will be considered
+        duplicates. Leave this as C{None} to have all apparent duplicates
+        verified (Python's sets use a fast non-cryptographic hash and then
+        compare the full values).
+    @param removeDuplicatesBloomCapacity: If not C{None}, the C{int}
+        expected number of distinct sequences (or read ids) when removing
+        duplicates. This (or C{removeDuplicatesBloomMaxBytes}) causes
+        duplicates to be found using a C{dark.bloom.BloomFilter}, which uses
+        a fixed amount of memory. Some reads that are not duplicates will
+        then be removed (at about the rate given by
+        C{removeDuplicatesBloomErrorRate}).
+    @param removeDuplicatesBloomErrorRate: If not C{None}, the C{float}
+        false positive rate for the Bloom filter (the default is 0.001).
+    @param removeDuplicatesBloomMaxBytes: If not C{None}, the C{int} maximum
+        number of bytes the Bloom filter may use.
     @param removeDescriptions: If C{True} remove the description (the part
         following the first whitespace) from read ids. The description is
         removed after applying the function specified by --idLambda (if any).
@@ -922,6 +962,17 @@ class ReadFilter(object):
     @param reverseComplement: If C{True}, replace seqeunces with their reverse
         complements. Reversing happens at a very late stage (i.e., after sites
         are altered via keepSites and removeSites).
+    @param workers: If not C{None}, the C{int} number of worker processes to
+        use in C{filterReads}. The stateless parts of the filter (length,
+        N fraction, gap removal, title matching, site editing, id and read
+        lambdas, and reversing) are run in the workers, on chunks of reads.
+        The stateful parts (sequence numbers, sampling, head, duplicate
+        removal, title truncation, and C{modifier}) are applied in this
+        process, in the original read order, so the result is identical to
+        filtering serially. If C{randomSubset} is given, filtering is always
+        done serially. The C{filter} method never uses workers.
+    @param chunkSize: The C{int} number of reads to send to a worker at a
+        time when C{workers} is used.
     @raises ValueError: If C{randomSubset} and C{sampleFraction} are both
         specified, or if C{randomSubset} is specified but C{trueLength} is not,
         or if the sequence numbers in C{sequenceNumbersFile} are
@@ -944,11 +995,15 @@ class ReadFilter(object):
                  truncateTitlesAfter=None, keepSequences=None,
                  removeSequences=None, head=None,
                  removeDuplicates=False, removeDuplicatesById=False,
-                 removeDuplicatesUseMD5=False, removeDescriptions=False,
+                 removeDuplicatesUseMD5=False, removeDuplicatesHash=None,
+                 removeDuplicatesBloomCapacity=None,
+                 removeDuplicatesBloomErrorRate=None,
+                 removeDuplicatesBloomMaxBytes=None, removeDescriptions=False,
                  modifier=None, randomSubset=None, trueLength=None,
                  sampleFraction=None, sequenceNumbersFile=None, idLambda=None,
                  readLambda=None, keepSites=None, removeSites=None,
-                 reverse=False, reverseComplement=False):
+                 reverse=False, reverseComplement=False, workers=None,
+                 chunkSize=1000):
 
         if randomSubset is not None:
             if sampleFraction is not None:
@@ -975,9 +1030,48 @@ class ReadFilter(object):
             raise ValueError(
                 'If you specify removeDuplicatesUseMD5, you need to also use '
                 'one of removeDuplicates or removeDuplicatesById.')
+        if removeDuplicatesHash is not None and not (
+                removeDuplicates or removeDuplicatesById):
+            raise ValueError(
+                'If you specify removeDuplicatesHash, you need to also use '
+                'one of removeDuplicates or removeDuplicatesById.')
+        if removeDuplicatesUseMD5:
+            if removeDuplicatesHash not in (None, 'md5'):
+                raise ValueError(
+                    'removeDuplicatesUseMD5 and removeDuplicatesHash cannot '
+                    'be used simultaneously.')
+            removeDuplicatesHash = 'md5'
         self.removeDuplicates = removeDuplicates
         self.removeDuplicatesById = removeDuplicatesById
         self.removeDuplicatesUseMD5 = removeDuplicatesUseMD5
+        self.removeDuplicatesHash = (
+            None if removeDuplicatesHash is None else
+            stringHashFunction(removeDuplicatesHash))
+
+        if (removeDuplicatesBloomCapacity is None and
+                removeDuplicatesBloomMaxBytes is None):
+            if removeDuplicatesBloomErrorRate is not None:
+                raise ValueError(
+                    'If you specify removeDuplicatesBloomErrorRate, you need '
+                    'to also use removeDuplicatesBloomCapacity or '
+                    'removeDuplicatesBloomMaxBytes.')
+            self._bloomKwargs = None
+        else:
+            if not (removeDuplicates or removeDuplicatesById):
+                raise ValueError(
+                    'If you specify a Bloom filter capacity or maximum size, '
+                    'you need to also use one of removeDuplicates or '
+                    'removeDuplicatesById.')
+            if removeDuplicatesHash is not None:
+                raise ValueError(
+                    'A Bloom filter cannot be used with removeDuplicatesHash '
+                    'or removeDuplicatesUseMD5.')
+            self._bloomKwargs = {
+                'capacity': removeDuplicatesBloomCapacity,
+                'errorRate': (0.001 if removeDuplicatesBloomErrorRate is None
+                              else removeDuplicatesBloomErrorRate),
+                'maxBytes': removeDuplicatesBloomMaxBytes,
+            }
 
         if keepSequences and removeSequences:
             raise ValueError(
@@ -1057,10 +1151,14 @@ class ReadFilter(object):
             self.titleFilter = None
 
         if removeDuplicates:
-            self.sequencesSeen = set()
+            self.sequencesSeen = (
+                set() if self._bloomKwargs is None else
+                BloomFilter(**self._bloomKwargs))
 
         if removeDuplicatesById:
-            self.idsSeen = set()
+            self.idsSeen = (
+                set() if self._bloomKwargs is None else
+                BloomFilter(**self._bloomKwargs))
 
         if sampleFraction is not None:
             if sampleFraction == 0.0:
@@ -1075,6 +1173,48 @@ class ReadFilter(object):
         self.idLambda = eval(idLambda) if idLambda else None
         self.readLambda = eval(readLambda) if readLambda else None
 
+        # Title truncation keeps a record of the titles seen so far, so
+        # title filtering must be done in order (in _finish) if it's used.
+        self._statelessTitleFilter = truncateTitlesAfter is None
+
+        self.workers = workers
+        self.chunkSize = chunkSize
+
+        # The arguments needed to make an equivalent stateless filter in a
+        # worker process. See filterReads.
+        self._workerKwargs = {
+            'minLength': minLength,
+            'maxLength': maxLength,
+            'maxNFraction': maxNFraction,
+            'removeGaps': removeGaps,
+            'whitelist': whitelist,
+            'blacklist': blacklist,
+            'whitelistFile': whitelistFile,
+            'blacklistFile': blacklistFile,
+            'titleRegex': titleRegex,
+            'negativeTitleRegex': negativeTitleRegex,
+            'removeDescriptions': removeDescriptions,
+            'idLambda': idLambda,
+            'readLambda': readLambda,
+            'keepSites': keepSites,
+            'removeSites': removeSites,
+            'reverse': reverse,
+            'reverseComplement': reverseComplement,
+        }
+
+        self._compile()
+
+    @property
+    def stateful(self):
+        """
+        Can the result of filtering a read depend on the reads that were
+        filtered before it (e.g., because of sequence numbers, sampling,
+        head, or duplicate removal)?
+
+        @return: A C{bool}.
+        """
+        return bool(self._indexChecks or self._finishSteps)
+
     def filter(self, read):
         """
         Check if a read passes the filter.
@@ -1087,141 +1227,486 @@ class ReadFilter(object):
         if self.alwaysFalse:
             return False
 
-        if self.wantedSequenceNumberGeneratorExhausted:
-            return False
+        for check in self._indexChecks:
+            if not check():
+                return False
 
-        if self.nextWantedSequenceNumber is not None:
-            if self.readIndex + 1 == self.nextWantedSequenceNumber:
-                # We want this sequence.
-                try:
-                    self.nextWantedSequenceNumber = next(
-                        self.wantedSequenceNumberGenerator)
-                except StopIteration:
-                    # The sequence number iterator ran out of sequence
-                    # numbers.  We must let the rest of the filtering
-                    # continue for the current sequence in case we
-                    # throw it out for other reasons (as we might have
-                    # done for any of the earlier wanted sequence
-                    # numbers).
-                    self.wantedSequenceNumberGeneratorExhausted = True
-            else:
-                # This sequence isn't one of the ones that's wanted.
+        for step in self._steps:
+            read = step(read)
+            if read is False:
                 return False
 
-        if (self.sampleFraction is not None and
-                uniform(0.0, 1.0) > self.sampleFraction):
-            # Note that we don't have to worry about the 0.0 or 1.0
-            # cases in the above 'if', as they have been dealt with
-            # in self.__init__.
+        self.yieldCount += 1
+        return read
+
+    def filterAlignment(self, alignment):
+        """
+        Check if the query of a pysam alignment passes the filter.
+
+        If the filter never changes reads, its checks are made directly on
+        the fields of the alignment. Otherwise, a C{Read} is made from the
+        alignment and passed to C{filter}.
+
+        @param alignment: A pysam alignment instance.
+        @return: C{True} if the query passes the filter and no C{Read} was
+            made, the C{Read} returned by C{filter} if one was needed, or
+            C{False} if the query does not pass the filter.
+        """
+        alignmentChecks = self._alignmentChecks
+
+        if alignmentChecks is None:
+            return self.filter(Read(alignment.query_name,
+                                    alignment.query_sequence, alignment.qual))
+
+        self.readIndex += 1
+
+        if self.alwaysFalse:
             return False
 
-        if self.randomSubset is not None:
-            if self.yieldCount == self.randomSubset:
-                # The random subset has already been fully returned.
-                # There's no point in going any further through the input.
-                self.alwaysFalse = True
+        for check in self._indexChecks:
+            if not check():
                 return False
-            elif uniform(0.0, 1.0) > ((self.randomSubset - self.yieldCount) /
-                                      (self.trueLength - self.readIndex)):
+
+        for check in alignmentChecks:
+            if not check(alignment):
                 return False
 
-        if self.head is not None and self.readIndex == self.head:
-            # We're completely done.
-            self.alwaysFalse = True
-            return False
+        self.yieldCount += 1
+        return True
 
-        readLen = len(read)
-        if ((self.minLength is not None and readLen < self.minLength) or
-                (self.maxLength is not None and readLen > self.maxLength)):
-            return False
+    def filterReads(self, reads):
+        """
+        Filter an iterable of reads, possibly using worker processes.
 
-        if self.maxNFraction is not None:
-            nFraction = read.sequence.count('N') / readLen
-            if self.maxNFraction < nFraction:
-                return False
+        @param reads: An iterable of C{Read} instances.
+        @return: A generator that yields the C{Read} instances that pass the
+            filter, in the order they were given.
+        """
+        if (self.workers is None or self.workers < 2 or
+                self.randomSubset is not None):
+            for read in reads:
+                read = self.filter(read)
+                if read is not False:
+                    yield read
+            return
 
-        if self.removeGaps:
-            if read.quality is None:
-                read = read.__class__(read.id, read.sequence.replace('-', ''))
-            else:
-                newSequence = []
-                newQuality = []
-                for base, quality in zip(read.sequence, read.quality):
-                    if base != '-':
-                        newSequence.append(base)
-                        newQuality.append(quality)
-                read = read.__class__(
-                    read.id, ''.join(newSequence), ''.join(newQuality))
-
-        if (self.titleFilter and
-                self.titleFilter.accept(read.id) == TitleFilter.REJECT):
-            return False
+        # The worker only transforms the reads if nothing that must be done
+        # in order (here) needs to happen before the transformation.
+        transform = self.modifier is None
 
-        if (self.keepSequences is not None and
-                self.readIndex not in self.keepSequences):
-            return False
+        def indexAccepted():
+            """
+            Yield lists of reads that pass the sequence index checks.
 
-        if (self.removeSequences is not None and
-                self.readIndex in self.removeSequences):
-            return False
+            @return: A generator that yields C{list}s of C{Read} instances.
+            """
+            chunk = []
+            for read in reads:
+                if self._acceptIndex():
+                    chunk.append(read)
+                    if len(chunk) == self.chunkSize:
+                        yield chunk
+                        chunk = []
+            if chunk:
+                yield chunk
+
+        for _, results in orderedPoolMap(
+                _workerFilterChunk, indexAccepted(), self.workers,
+                initializer=_initWorkerFilter,
+                initargs=(self._workerKwargs, transform)):
+            for read in self._finishChunk(results):
+                yield read
+
+    def _finishChunk(self, results):
+        """
+        Apply the stateful parts of the filter to a chunk of results from a
+        worker process.
+
+        @param results: A C{list} of (prepared, transformed) 2-tuples, as
+            returned by C{_workerFilterChunk}.
+        @return: A generator that yields the C{Read} instances that pass the
+            filter.
+        """
+        for prepared, transformed in results:
+            if prepared is not False:
+                read = self._finish(prepared, transformed)
+                if read is not False:
+                    yield read
+
+    def _compile(self):
+        """
+        Make lists of the checks and changes that are needed for the options
+        given to C{__init__}, in the order they must be applied. This avoids
+        testing every option for every read in C{filter}.
+
+        The index checks take no arguments and return a C{bool}. Each of the
+        other steps is passed a read and returns a (possibly new) read, or
+        C{False} if the read does not pass the filter.
+        """
+        indexChecks = []
+        prepare = []
+        finish = []
+        transform = []
+
+        # Checks based only on the index of a read in the input.
+        if self.nextWantedSequenceNumber is not None:
+            def checkSequenceNumber():
+                if self.wantedSequenceNumberGeneratorExhausted:
+                    return False
+                if self.readIndex + 1 == self.nextWantedSequenceNumber:
+                    # We want this sequence.
+                    try:
+                        self.nextWantedSequenceNumber = next(
+                            self.wantedSequenceNumberGenerator)
+                    except StopIteration:
+                        # The sequence number iterator ran out of sequence
+                        # numbers.  We must let the rest of the filtering
+                        # continue for the current sequence in case we
+                        # throw it out for other reasons (as we might have
+                        # done for any of the earlier wanted sequence
+                        # numbers).
+                        self.wantedSequenceNumberGeneratorExhausted = True
+                    return True
+                else:
+                    # This sequence isn't one of the ones that's wanted.
+                    return False
+            indexChecks.append(checkSequenceNumber)
 
+        if self.sampleFraction is not None:
+            sampleFraction = self.sampleFraction
+
+            def checkSample():
+                # Note that we don't have to worry about the 0.0 or 1.0
+                # cases here, as they have been dealt with in __init__.
+                return uniform(0.0, 1.0) <= sampleFraction
+            indexChecks.append(checkSample)
+
+        if self.randomSubset is not None:
+            randomSubset = self.randomSubset
+            trueLength = self.trueLength
+
+            def checkRandomSubset():
+                if self.yieldCount == randomSubset:
+                    # The random subset has already been fully returned.
+                    # There's no point in going any further through the
+                    # input.
+                    self.alwaysFalse = True
+                    return False
+                return uniform(0.0, 1.0) <= (
+                    (randomSubset - self.yieldCount) /
+                    (trueLength - self.readIndex))
+            indexChecks.append(checkRandomSubset)
+
+        if self.head is not None:
+            head = self.head
+
+            def checkHead():
+                if self.readIndex == head:
+                    # We're completely done.
+                    self.alwaysFalse = True
+                    return False
+                return True
+            indexChecks.append(checkHead)
+
+        # We have to use 'is not None' in the following tests so the empty set
+        # is processed properly.
+        if self.keepSequences is not None:
+            keepSequences = self.keepSequences
+            indexChecks.append(lambda: self.readIndex in keepSequences)
+
+        if self.removeSequences is not None:
+            removeSequences = self.removeSequences
+            indexChecks.append(lambda: self.readIndex not in removeSequences)
+
+        # Stateless checks and changes that precede duplicate removal.
+        minLength = self.minLength
+        maxLength = self.maxLength
+        if minLength is not None and maxLength is not None:
+            prepare.append(
+                lambda read: minLength <= len(read) <= maxLength and read)
+        elif minLength is not None:
+            prepare.append(lambda read: len(read) >= minLength and read)
+        elif maxLength is not None:
+            prepare.append(lambda read: len(read) <= maxLength and read)
+
+        if self.maxNFraction is not None:
+            maxNFraction = self.maxNFraction
+            prepare.append(
+                lambda read: (read.sequence.count('N') / len(read) <=
+                              maxNFraction) and read)
+
+        if self.removeGaps:
+            def removeGaps(read):
+                if read.quality is None:
+                    return read.__class__(read.id,
+                                          read.sequence.replace('-', ''))
+                else:
+                    newSequence = []
+                    newQuality = []
+                    for base, quality in zip(read.sequence, read.quality):
+                        if base != '-':
+                            newSequence.append(base)
+                            newQuality.append(quality)
+                    return read.__class__(
+                        read.id, ''.join(newSequence), ''.join(newQuality))
+            prepare.append(removeGaps)
+
+        if self.titleFilter:
+            accept = self.titleFilter.accept
+            reject = TitleFilter.REJECT
+            (prepare if self._statelessTitleFilter else finish).append(
+                lambda read: accept(read.id) != reject and read)
+
+        # Stateful checks.
         if self.removeDuplicates:
-            if self.removeDuplicatesUseMD5:
-                sequence = md5(read.sequence.encode('UTF-8')).digest()
-            else:
-                sequence = read.sequence
-            if sequence in self.sequencesSeen:
-                return False
-            self.sequencesSeen.add(sequence)
+            isNewSequence = self._newValueChecker(self.sequencesSeen)
+            finish.append(lambda read: isNewSequence(read.sequence) and read)
 
         if self.removeDuplicatesById:
-            if self.removeDuplicatesUseMD5:
-                id_ = md5(read.id.encode('UTF-8')).digest()
-            else:
-                id_ = read.id
-            if id_ in self.idsSeen:
-                return False
-            self.idsSeen.add(id_)
+            isNewId = self._newValueChecker(self.idsSeen)
+            finish.append(lambda read: isNewId(read.id) and read)
 
         if self.modifier:
-            modified = self.modifier(read)
-            if modified is None:
-                return False
-            else:
-                read = modified
+            modifier = self.modifier
 
-        # We have to use 'is not None' in the following tests so the empty set
-        # is processed properly.
+            def modify(read):
+                modified = modifier(read)
+                return False if modified is None else modified
+            finish.append(modify)
+
+        # Stateless changes that follow duplicate removal.
         if self.keepSites is not None:
-            read = read.newFromSites(self.keepSites)
+            keepSites = self.keepSites
+            transform.append(lambda read: read.newFromSites(keepSites))
         elif self.removeSites is not None:
-            read = read.newFromSites(self.removeSites, exclude=True)
+            removeSites = self.removeSites
+            transform.append(
+                lambda read: read.newFromSites(removeSites, exclude=True))
 
         if self.idLambda:
-            newId = self.idLambda(read.id)
-            if newId is None:
-                return False
-            else:
-                read.id = newId
+            idLambda = self.idLambda
+
+            def changeId(read):
+                newId = idLambda(read.id)
+                if newId is None:
+                    return False
+                else:
+                    read.id = newId
+                    return read
+            transform.append(changeId)
 
         if self.readLambda:
-            newRead = self.readLambda(read)
-            if newRead is None:
-                return False
-            else:
-                read = newRead
+            readLambda = self.readLambda
+
+            def changeRead(read):
+                newRead = readLambda(read)
+                return False if newRead is None else newRead
+            transform.append(changeRead)
 
         if self.removeDescriptions:
-            read.id = read.id.split()[0]
+            def removeDescription(read):
+                read.id = read.id.split()[0]
+                return read
+            transform.append(removeDescription)
 
         if self.reverse:
-            read = read.reverse()
+            transform.append(lambda read: read.reverse())
         elif self.reverseComplement:
-            read = read.reverseComplement()
+            transform.append(lambda read: read.reverseComplement())
+
+        self._indexChecks = indexChecks
+        self._prepareSteps = prepare
+        self._finishSteps = finish
+        self._transformSteps = transform
+        self._steps = prepare + finish + transform
+
+        # If the filter never changes a read, its checks can be made on the
+        # fields of a pysam alignment without making a Read (see
+        # filterAlignment). The checks must be made in the same order as the
+        # steps above.
+        if (self.removeGaps or self.modifier or transform):
+            self._alignmentChecks = None
+        else:
+            alignmentChecks = []
+
+            if minLength is not None and maxLength is not None:
+                alignmentChecks.append(
+                    lambda alignment: (
+                        minLength <= alignment.query_length <= maxLength))
+            elif minLength is not None:
+                alignmentChecks.append(
+                    lambda alignment: alignment.query_length >= minLength)
+            elif maxLength is not None:
+                alignmentChecks.append(
+                    lambda alignment: alignment.query_length <= maxLength)
+
+            if self.maxNFraction is not None:
+                alignmentChecks.append(
+                    lambda alignment: (
+                        alignment.query_sequence.count('N') /
+                        alignment.query_length <= maxNFraction))
+
+            if self.titleFilter:
+                alignmentChecks.append(
+                    lambda alignment: (
+                        accept(alignment.query_name) != reject))
+
+            if self.removeDuplicates:
+                alignmentChecks.append(
+                    lambda alignment: isNewSequence(alignment.query_sequence))
+
+            if self.removeDuplicatesById:
+                alignmentChecks.append(
+                    lambda alignment: isNewId(alignment.query_name))
+
+            self._alignmentChecks = alignmentChecks
+
+    def _newValueChecker(self, seen):
+        """
+        Make a function to check whether values have been seen before, for
+        use in duplicate removal.
+
+        @param seen: A C{set} or C{dark.bloom.BloomFilter} instance that
+            holds the values (or their hashes) seen so far.
+        @return: A function that takes a C{str} value, adds it (or its hash)
+            to C{seen}, and returns C{True} if it had not been seen before.
+        """
+        hash_ = self.removeDuplicatesHash
+
+        if self._bloomKwargs:
+            add = seen.add
+            return lambda value: not add(value)
+        elif hash_:
+            def isNew(value):
+                value = hash_(value)
+                if value in seen:
+                    return False
+                seen.add(value)
+                return True
+        else:
+            def isNew(value):
+                if value in seen:
+                    return False
+                seen.add(value)
+                return True
+
+        return isNew
+
+    def _acceptIndex(self):
+        """
+        Advance to the next read and check whether it is acceptable based only
+        on its position in the input.
+
+        @return: C{True} if the read at the new index might be acceptable,
+            C{False} if not.
+        """
+        self.readIndex += 1
+
+        if self.alwaysFalse:
+            return False
+
+        for check in self._indexChecks:
+            if not check():
+                return False
+
+        return True
+
+    def _prepare(self, read):
+        """
+        Apply the stateless checks and changes that precede duplicate
+        removal.
+
+        @param read: A C{Read} instance.
+        @return: A (possibly new) C{Read} instance, or C{False} if the read
+            does not pass the filter.
+        """
+        for step in self._prepareSteps:
+            read = step(read)
+            if read is False:
+                return False
+
+        return read
+
+    def _finish(self, read, transformed=None):
+        """
+        Apply the stateful checks to a prepared read and then transform it.
+
+        @param read: A C{Read} instance, as returned by C{_prepare}.
+        @param transformed: If not C{None}, the already-computed result of
+            calling C{_transform} on (a copy of) C{read}.
+        @return: The final C{Read} instance, or C{False} if the read does not
+            pass the filter.
+        """
+        for step in self._finishSteps:
+            read = step(read)
+            if read is False:
+                return False
+
+        read = self._transform(read) if transformed is None else transformed
+
+        if read is not False:
+            self.yieldCount += 1
 
-        self.yieldCount += 1
         return read
 
+    def _transform(self, read):
+        """
+        Apply the stateless changes that follow duplicate removal.
+
+        @param read: A C{Read} instance.
+        @return: A (possibly new) C{Read} instance, or C{False} if the read
+            does not pass the filter.
+        """
+        for step in self._transformSteps:
+            read = step(read)
+            if read is False:
+                return False
+
+        return read
+
+
+# The stateless ReadFilter used in a worker process (see
+# ReadFilter.filterReads), and whether it should transform reads.
+_workerFilter = None
+_workerTransform = False
+
+
+def _initWorkerFilter(kwargs, transform):
+    """
+    Initialize a worker process for C{ReadFilter.filterReads}.
+
+    @param kwargs: A C{dict} of keyword arguments for C{ReadFilter}.
+    @param transform: If C{True}, the worker should also transform reads.
+    """
+    global _workerFilter, _workerTransform
+    _workerFilter = ReadFilter(**kwargs)
+    _workerTransform = transform
+
+
+def _workerFilterChunk(reads):
+    """
+    Apply the stateless parts of a C{ReadFilter} to a chunk of reads.
+
+    @param reads: A C{list} of C{Read} instances.
+    @return: A C{list} of (prepared, transformed) 2-tuples, one for each
+        read. The first element is the result of C{ReadFilter._prepare}. The
+        second is the result of C{ReadFilter._transform} on a copy of the
+        first, or C{None} if the read was rejected or the worker does not
+        transform reads.
+    """
+    prepare = _workerFilter._prepare
+    transform = _workerFilter._transform if _workerTransform else None
+    result = []
+    for read in reads:
+        prepared = prepare(read)
+        if prepared is False or transform is None:
+            result.append((prepared, None))
+        else:
+            # Transform a copy, seeing as an id lambda changes the read
+            # in place and the original is needed for duplicate removal.
+            result.append((prepared, transform(copy(prepared))))
+    return result
+
 
 # Provide a mapping from all read class names to read classes. This can be
 # useful in deserialization.
@@ -1237,6 +1722,10 @@ readClassNameToClass = {
     'TranslatedRead': TranslatedRead,
 }
 
+# The names of the available FASTA/FASTQ parsers. See
+# dark.fasta.FastaReads and dark.fastq.FastqReads.
+FASTA_PARSERS = ('biopython', 'native')
+
 _DNA = set('ACGT')
 _RNA = set('ACGU')
 _AA = set(AA_NAMES)
@@ -1278,14 +1767,48 @@ class Reads(object):
         @return: C{False} if the read fails any of our filters, else the
             C{Read} instance returned by our list of filters.
         """
-        for filterFunc in self._filters:
-            filteredRead = filterFunc(read)
+        for readFilter in self._filters:
+            filteredRead = readFilter.filter(read)
             if filteredRead is False:
                 return False
             else:
                 read = filteredRead
         return read
 
+    @property
+    def stateful(self):
+        """
+        Can the result of filtering a read depend on the reads that were
+        filtered before it? See C{ReadFilter.stateful}.
+
+        @return: A C{bool}.
+        """
+        return any(readFilter.stateful for readFilter in self._filters)
+
+    def filterAlignment(self, alignment):
+        """
+        Filter the query of a pysam alignment, according to our set of
+        filters.
+
+        A C{Read} is only made from the alignment if one of our filters
+        changes reads, in which case it (and all later filters) are given a
+        C{Read} (see C{ReadFilter.filterAlignment}).
+
+        @param alignment: A pysam alignment instance.
+        @return: C{False} if the query fails any of our filters, else C{True}.
+        """
+        read = None
+        for readFilter in self._filters:
+            if read is None:
+                result = readFilter.filterAlignment(alignment)
+            else:
+                result = readFilter.filter(read)
+            if result is False:
+                return False
+            elif result is not True:
+                read = result
+        return True
+
     def add(self, read):
         """
         Add a read to this collection of reads.
@@ -1301,11 +1824,31 @@ class Reads(object):
         @return: A generator that yields reads. The returned read types depend
             on the kind of reads that were added to this instance.
         """
+        if any(readFilter.workers for readFilter in self._filters):
+            # At least one filter can use worker processes, so pass all
+            # reads through the filters as a stream.
+            reads = self._unfilteredReads()
+            for readFilter in self._filters:
+                reads = readFilter.filterReads(reads)
+            for read in reads:
+                yield read
+        else:
+            for read in self._unfilteredReads():
+                filteredRead = self.filterRead(read)
+                if filteredRead is not False:
+                    yield filteredRead
+
+    def _unfilteredReads(self):
+        """
+        Iterate through all the reads, without filtering.
+
+        Once all reads have been yielded, the unfiltered length is set.
+
+        @return: A generator that yields reads.
+        """
         # self._additionalReads is a regular list.
         for read in self._additionalReads:
-            filteredRead = self.filterRead(read)
-            if filteredRead is not False:
-                yield filteredRead
+            yield read
 
         _unfilteredLength = len(self._additionalReads)
 
@@ -1315,9 +1858,7 @@ class Reads(object):
         initialReadsLength = 0
         for read in initialReads:
             initialReadsLength += 1
-            filteredRead = self.filterRead(read)
-            if filteredRead is not False:
-                yield filteredRead
+            yield read
 
         if isinstance(initialReads, Reads):
             _unfilteredLength += initialReads.unfilteredLength()
@@ -1330,9 +1871,7 @@ class Reads(object):
         subclassReadsLength = 0
         for read in subclassReads:
             subclassReadsLength += 1
-            filteredRead = self.filterRead(read)
-            if filteredRead is not False:
-                yield filteredRead
+            yield read
 
         if isinstance(subclassReads, Reads):
             _unfilteredLength += subclassReads.unfilteredLength()
@@ -1410,8 +1949,7 @@ class Reads(object):
         @param kwargs: Keyword arguments, as accepted by C{ReadFilter}.
         @return: C{self}.
         """
-        readFilter = ReadFilter(**kwargs)
-        self._filters.append(readFilter.filter)
+        self._filters.append(ReadFilter(**kwargs))
         return self
 
     def clearFilters(self):
@@ -1501,22 +2039,9 @@ class Reads(object):
             that are C{FloatBaseCounts} instances giving the base counts at
             the site.
         """
-        reads = list(self)
-        varSites = {}
-
-        if reads:
-            length = len(reads[0].sequence)
-            if not all(len(read.sequence) == length for read in reads):
-                raise ReadLengthsNotIdenticalError()
-            for site in range(length):
-                counts = FloatBaseCounts(
-                    [r.sequence[site] for r in reads],
-                    unknownAreAmbiguous=unknownAreAmbiguous)
-                if (counts.variable(confirm) and
-                        not counts.homogeneous(homogeneityLevel)):
-                    varSites[site] = counts
-
-        return varSites
+        return AlignmentMatrix(self).variableSites(
+            confirm=confirm, homogeneityLevel=homogeneityLevel,
+            unknownAreAmbiguous=unknownAreAmbiguous)
 
     def combineReads(self):
         """
@@ -1527,26 +2052,122 @@ class Reads(object):
         reads = list(self)
         assert len({len(read) for read in reads}) == 1
 
-        sequence = ''
-        for site in range(len(reads[0])):
-            bases = set([r.sequence[site] for r in reads])
-            if len(bases) == 1:
-                sequence += bases.pop()
-            elif (len(bases) == 2 and 'N' in bases and
-                  bases.intersection({'A', 'T', 'G', 'C'})):
-                sequence += list(bases.intersection({'A', 'T', 'G', 'C'}))[0]
-            else:
-                nucleotides = set()
-                for base in bases:
-                    nucleotides.update(AMBIGUOUS.get(base, set()))
-                try:
-                    sequence += BASES_TO_AMBIGUOUS[''.join(
-                        sorted(nucleotides))]
-                except KeyError:
-                    raise ValueError('Unknown DNA base(s): %r' %
-                                     nucleotides - set('ACGTN-'))
+        return AlignmentMatrix(reads).combine()
+
+
+class _CompactReadList(object):
+    """
+    Store reads compactly, in a list-like object.
+
+    The ids, sequences, and quality strings of all reads are each held
+    (UTF-8 encoded) in a single contiguous C{bytearray}, with an array of
+    offsets marking where each read's data starts. A C{Read} instance is
+    only made when a read is accessed. Reads that are replaced (via
+    C{__setitem__}) are kept as regular C{Read} instances.
+
+    Only reads whose class is in C{COMPACT_READ_CLASSES} can be stored, as
+    those are the classes that hold nothing beyond an id, a sequence, and an
+    optional quality string.
+    """
+    COMPACT_READ_CLASSES = {AARead, AAReadWithX, DNARead, RNARead, Read}
+
+    def __init__(self):
+        self._ids = bytearray()
+        self._sequences = bytearray()
+        self._qualities = bytearray()
+        self._idOffsets = array('Q', [0])
+        self._sequenceOffsets = array('Q', [0])
+        self._qualityOffsets = array('Q', [0])
+        # A per-read byte giving the index of the read class in
+        # self._classes, with the high bit set if the read has a quality
+        # string.
+        self._flags = bytearray()
+        self._classes = []
+        self._replaced = {}
+
+    def append(self, read):
+        """
+        Add a read.
+
+        @param read: A C{Read} instance, whose class must be in
+            C{COMPACT_READ_CLASSES}.
+        @raise ValueError: If the class of C{read} is not one that can be
+            stored compactly.
+        """
+        cls = read.__class__
+        if cls not in self.COMPACT_READ_CLASSES:
+            raise ValueError('Reads of class %s cannot be stored compactly.' %
+                             cls.__name__)
+
+        try:
+            flag = self._classes.index(cls)
+        except ValueError:
+            flag = len(self._classes)
+            self._classes.append(cls)
+
+        self._ids += read.id.encode('UTF-8')
+        self._idOffsets.append(len(self._ids))
+        self._sequences += read.sequence.encode('UTF-8')
+        self._sequenceOffsets.append(len(self._sequences))
+        if read.quality is not None:
+            flag |= 0x80
+            self._qualities += read.quality.encode('UTF-8')
+        self._qualityOffsets.append(len(self._qualities))
+        self._flags.append(flag)
+
+    def _read(self, index):
+        """
+        Make a read.
+
+        @param index: The non-negative C{int} index of the read.
+        @return: A C{Read} instance (of the class originally added).
+        """
+        try:
+            return self._replaced[index]
+        except KeyError:
+            pass
+
+        flag = self._flags[index]
+        if flag & 0x80:
+            quality = self._qualities[
+                self._qualityOffsets[index]:
+                self._qualityOffsets[index + 1]].decode('UTF-8')
+        else:
+            quality = None
+
+        return self._classes[flag & 0x7F](
+            self._ids[self._idOffsets[index]:
+                      self._idOffsets[index + 1]].decode('UTF-8'),
+            self._sequences[self._sequenceOffsets[index]:
+                            self._sequenceOffsets[index + 1]].decode('UTF-8'),
+            quality)
+
+    def __len__(self):
+        return len(self._flags)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self._read(index)
+                    for index in range(*item.indices(len(self)))]
 
-        return sequence
+        length = len(self)
+        if item < 0:
+            item += length
+        if not 0 <= item < length:
+            raise IndexError('list index out of range')
+        return self._read(item)
+
+    def __setitem__(self, item, value):
+        length = len(self)
+        if item < 0:
+            item += length
+        if not 0 <= item < length:
+            raise IndexError('list assignment index out of range')
+        self._replaced[item] = value
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._read(index)
 
 
 class ReadsInRAM(Reads):
@@ -1555,6 +2176,14 @@ class ReadsInRAM(Reads):
 
     @param initialReads: If not C{None}, an iterable of C{Read} (or a C{Read}
         subclass) instances.
+    @param compact: If C{True}, store the reads in contiguous byte buffers
+        instead of as a C{list} of C{Read} instances. This uses far less
+        memory, at the cost of making a new C{Read} each time a read is
+        accessed (so changes to an accessed read will not be stored). Only
+        C{Read}, C{DNARead}, C{RNARead}, C{AARead}, and C{AAReadWithX}
+        instances can be stored compactly.
+    @raise ValueError: If C{compact} is C{True} and a read of another class
+        is added.
     """
 
     # This class provides some C{list} like methods (len and indexing) but
@@ -1563,11 +2192,16 @@ class ReadsInRAM(Reads):
     # inheritance. If you want a real list, you can just call C{list} on a
     # C{Reads} or C{ReadsInRAM} instance.
 
-    def __init__(self, initialReads=None):
+    def __init__(self, initialReads=None, compact=False):
+        # Don't keep a reference to the initial reads if we're being
+        # compact, seeing as they may be a list of reads.
         if six.PY3:
-            super().__init__(initialReads)
+            super().__init__(None if compact else initialReads)
         else:
-            Reads.__init__(self, initialReads)
+            Reads.__init__(self, None if compact else initialReads)
+
+        if compact:
+            self._additionalReads = _CompactReadList()
 
         # Read all initial reads into memory.
         if initialReads:
@@ -1590,6 +2224,14 @@ class ReadsInRAM(Reads):
     def __iter__(self):
         return self._additionalReads.__iter__()
 
+    def unfilteredLength(self):
+        """
+        How many reads are held, ignoring filtering.
+
+        @return: The C{int} number of reads in C{self}.
+        """
+        return self._additionalReads.__len__()
+
 
 def addFASTACommandLineOptions(parser):
     """
@@ -1609,6 +2251,12 @@ def addFASTACommandLineOptions(parser):
         help=('If specified, give the type of the reads in the input. '
               'Possible choices: %s.' % ', '.join(readClassNameToClass)))
 
+    parser.add_argument(
+        '--parser', default='biopython', choices=FASTA_PARSERS,
+        help=('The FASTA/FASTQ parser to use. The native parser is much '
+              'faster than the Biopython one. This option has no effect '
+              'when --fasta-ss is used.'))
+
     # A mutually exclusive group for either --fasta, --fastq, or --fasta-ss
     group = parser.add_mutually_exclusive_group()
 
@@ -1645,10 +2293,12 @@ def parseFASTACommandLineOptions(args):
 
     if args.fasta:
         from dark.fasta import FastaReads
-        return FastaReads(args.fastaFile, readClass=readClass)
+        return FastaReads(args.fastaFile, readClass=readClass,
+                          parser=args.parser)
     elif args.fastq:
         from dark.fastq import FastqReads
-        return FastqReads(args.fastaFile, readClass=readClass)
+        return FastqReads(args.fastaFile, readClass=readClass,
+                          parser=args.parser)
     else:
         from dark.fasta_ss import SSFastaReads
         return SSFastaReads(args.fastaFile, readClass=readClass)
@@ -1,13 +1,20 @@
+import os
 import six
+import json
+import sqlite3
+import numpy as np
+from hashlib import md5
 
 from contextlib import contextmanager
 from collections import Counter, defaultdict
 
 from pysam import (
-    AlignmentFile, CMATCH, CINS, CDEL, CREF_SKIP, CSOFT_CLIP, CHARD_CLIP, CPAD,
-    CEQUAL, CDIFF)
+    AlignmentFile, AlignedSegment, CMATCH, CINS, CDEL, CREF_SKIP, CSOFT_CLIP,
+    CHARD_CLIP, CPAD, CEQUAL, CDIFF)
+from pysam import index as samtoolsIndex
 
 from dark.reads import Read, DNARead
+from dark.utils import orderedPoolMap
 
 
 class UnequalReferenceLengthError(Exception):
@@ -22,9 +29,36 @@ class InvalidSAM(Exception):
     "SAM/BAM file has unexpected/invalid content."
 
 
+class AlignedRead(Read):
+    """
+    A read that also holds the C{pysam.AlignedSegment} it came from.
+
+    @param id: A C{str} describing the read.
+    @param sequence: A C{str} of sequence information.
+    @param quality: An optional C{str} of phred quality scores.
+    @param alignment: A C{pysam.AlignedSegment} instance.
+    """
+    __slots__ = ('alignment',)
+
+    def __init__(self, id, sequence, quality=None, alignment=None):
+        if six.PY3:
+            super().__init__(id, sequence, quality)
+        else:
+            Read.__init__(self, id, sequence, quality)
+        self.alignment = alignment
+
+
 # From https://samtools.github.io/hts-specs/SAMv1.pdf
 _CONSUMES_QUERY = {CMATCH, CINS, CSOFT_CLIP, CEQUAL, CDIFF}
 _CONSUMES_REFERENCE = {CMATCH, CDEL, CREF_SKIP, CEQUAL, CDIFF}
+_MATCHES = {CMATCH, CEQUAL, CDIFF}
+
+# The minimum base quality used by default by pysam's pileup.
+MIN_BASE_QUALITY = 13
+
+# Translate the (binary) quality values given by pysam into FASTQ quality
+# characters.
+_PHRED_TO_ASCII = bytes(bytearray((value + 33) % 256 for value in range(256)))
 
 
 @contextmanager
@@ -82,6 +116,377 @@ def samReferencesToStr(filenameOrSamfile, indent=0):
         return _references(sam)
 
 
+def samIsIndexed(filename):
+    """
+    Check whether a SAM/BAM file has an index (and so can be read a region at
+    a time).
+
+    @param filename: A C{str} SAM/BAM file name.
+    @return: C{True} if the file has an index, else C{False}.
+    """
+    with samfile(filename) as sam:
+        return sam.has_index()
+
+
+def samRegions(filenameOrSamfile, regionSize):
+    """
+    Divide the references of a SAM/BAM file into regions.
+
+    @param filenameOrSamfile: Either a C{str} SAM/BAM file name or an
+        instance of C{pysam.AlignmentFile}.
+    @param regionSize: The C{int} maximum length of a region.
+    @return: A C{list} of (referenceId, start, end) C{tuple}s, with 0-based
+        half-open offsets, covering all references in the order they appear
+        in the SAM/BAM header. The end of the last region of each reference
+        is C{None}, so that region also includes any alignment columns that
+        run off the end of the reference.
+    """
+    def _regions(sam):
+        result = []
+        for referenceId, length in zip(sam.references, sam.lengths):
+            for start in range(0, length, regionSize):
+                end = start + regionSize
+                result.append((referenceId, start,
+                               None if end >= length else end))
+        return result
+
+    if isinstance(filenameOrSamfile, six.string_types):
+        with samfile(filenameOrSamfile) as sam:
+            return _regions(sam)
+    else:
+        return _regions(filenameOrSamfile)
+
+
+def regionAlignments(sam, region):
+    """
+    Get the alignments that start in a region of a SAM/BAM file, so that
+    each alignment is found in exactly one of the regions returned by
+    C{samRegions}.
+
+    @param sam: A C{pysam.AlignmentFile} instance.
+    @param region: A (referenceId, start, end) C{tuple} as returned by
+        C{samRegions}, or C{None} to get all alignments.
+    @return: A generator that yields C{pysam.AlignedSegment} instances, in the
+        order they appear in the file.
+    """
+    if region is None:
+        for alignment in sam.fetch():
+            yield alignment
+    else:
+        referenceId, start, end = region
+        for alignment in sam.fetch(referenceId, start, end):
+            if alignment.reference_start >= start:
+                yield alignment
+
+
+# The SAM/BAM file and the function that worker processes apply to its
+# regions (see _initRegionWorker).
+_regionWorkerSam = _regionWorkerFunction = None
+
+
+def _initRegionWorker(filename, function):
+    """
+    Initialize a worker process for C{mapSAMRegions}.
+
+    @param filename: The C{str} SAM/BAM file name.
+    @param function: The function to apply to regions of the file.
+    """
+    global _regionWorkerSam, _regionWorkerFunction
+    _regionWorkerSam = AlignmentFile(filename)
+    _regionWorkerFunction = function
+
+
+def _applyToRegion(region):
+    """
+    Apply the worker's function to a region of its SAM/BAM file.
+
+    @param region: A (referenceId, start, end) C{tuple}.
+    @return: The result of the worker's function.
+    """
+    return _regionWorkerFunction(_regionWorkerSam, region)
+
+
+def mapSAMRegions(filename, function, workers=None, regionSize=None):
+    """
+    Apply a function to regions of a SAM/BAM file, in parallel if possible.
+
+    If C{workers} is greater than one and the file has an index, the file
+    is divided into regions (see C{samRegions}) and C{function} is called on
+    each region in a pool of worker processes. Otherwise, C{function} is
+    called once, in this process, with a region of C{None} (meaning the
+    whole file).
+
+    Where possible, worker processes are started by forking, so C{function}
+    does not need to be picklable. Its result must be.
+
+    @param filename: The C{str} SAM/BAM file name.
+    @param function: A function that takes an open C{pysam.AlignmentFile}
+        and a region (as passed to C{regionAlignments}) and returns a result.
+    @param workers: The C{int} number of worker processes to use, or C{None}.
+    @param regionSize: The C{int} maximum length of a region. If C{None},
+        regions are made so that there are 16 for each worker.
+    @return: A generator that yields the result of calling C{function} on
+        each region, in region order.
+    """
+    if workers is None or workers < 2 or not samIsIndexed(filename):
+        with samfile(filename) as sam:
+            yield function(sam, None)
+        return
+
+    with samfile(filename) as sam:
+        if regionSize is None:
+            regionSize = max(1, -(-sum(sam.lengths) // (16 * workers)))
+        regions = samRegions(sam, regionSize)
+
+    for _, result in orderedPoolMap(
+            _applyToRegion, regions, workers,
+            initializer=_initRegionWorker, initargs=(filename, function)):
+        yield result
+
+
+def mateMayOverlap(alignment):
+    """
+    Check whether an alignment is one whose overlap with its mate is
+    detected in a pysam pileup.
+
+    @param alignment: A pysam alignment instance.
+    @return: C{True} if C{alignment} is in a proper pair and might overlap
+        its mate.
+    """
+    return (alignment.is_proper_pair and not alignment.mate_is_unmapped and
+            not (alignment.next_reference_id >= 0 and
+                 alignment.next_reference_id != alignment.reference_id) and
+            not (abs(alignment.template_length) >=
+                 2 * alignment.query_length and
+                 alignment.next_reference_start >= alignment.reference_end))
+
+
+def _khashKeepsFirst(name):
+    """
+    Find out which of two overlapping mates htslib keeps the combined base
+    quality in. It does this using the hash value its khash library gives
+    the read name.
+
+    @param name: The C{str} read name.
+    @return: C{True} if the first mate keeps the quality, else C{False}.
+    """
+    mask = 0xffffffff
+    # The khash X31 string hash.
+    key = 0
+    for index, char in enumerate(six.iterbytes(name.encode('ascii'))):
+        key = char if index == 0 else (key * 31 + char) & mask
+    # The khash (Wang) integer hash.
+    key = (key + (~(key << 15) & mask)) & mask
+    key ^= key >> 10
+    key = (key + (key << 3)) & mask
+    key ^= key >> 6
+    key = (key + (~(key << 11) & mask)) & mask
+    key ^= key >> 16
+    return bool(key & 1)
+
+
+class _CigarCursor(object):
+    """
+    Step through the matched bases of an alignment the way htslib does when
+    it adjusts the qualities of overlapping mates.
+
+    @param cigar: A C{list} of (operation, length) CIGAR C{tuple}s.
+    """
+    def __init__(self, cigar):
+        self.cigar = cigar
+        self.cigarIndex = 0
+        self.operationOffset = 0
+        self.queryOffset = 0
+        self.referenceOffset = 0
+
+    def previousOperation(self):
+        """
+        Get the CIGAR operation before the current one.
+
+        @return: The C{int} CIGAR operation, or C{None} if the cursor is on
+            the first operation.
+        """
+        if self.cigarIndex:
+            return self.cigar[self.cigarIndex - 1][0]
+
+    def seek(self, offset):
+        """
+        Move to the first matched base at or after a reference offset.
+
+        @param offset: The C{int} reference offset, relative to the start of
+            the alignment.
+        @return: C{True} if a matched base was found, else C{False}.
+        """
+        if offset < 0:
+            return False
+        self.operationOffset = self.queryOffset = self.referenceOffset = 0
+        cigar = self.cigar
+        while self.cigarIndex < len(cigar):
+            operation, length = cigar[self.cigarIndex]
+            if operation in _MATCHES:
+                offset -= length
+                if offset < 0:
+                    self.operationOffset = length + offset
+                    self.queryOffset += self.operationOffset
+                    self.referenceOffset += self.operationOffset
+                    return True
+                self.referenceOffset += length
+            elif operation in (CDEL, CREF_SKIP):
+                offset = max(0, offset - length)
+                self.referenceOffset += length
+            if operation in (CINS, CSOFT_CLIP, CMATCH, CEQUAL, CDIFF):
+                self.queryOffset += length
+            self.cigarIndex += 1
+            self.operationOffset = 0
+        return False
+
+    def advance(self):
+        """
+        Move to the next matched base.
+
+        @return: C{True} if there was another matched base, else C{False}.
+        """
+        cigar = self.cigar
+        while self.cigarIndex < len(cigar):
+            operation, length = cigar[self.cigarIndex]
+            if operation in _MATCHES:
+                if self.operationOffset < length - 1:
+                    self.queryOffset += 1
+                    self.operationOffset += 1
+                    self.referenceOffset += 1
+                    return True
+            elif operation in (CDEL, CREF_SKIP):
+                self.referenceOffset += length
+            elif operation in (CINS, CSOFT_CLIP):
+                self.queryOffset += length
+            self.cigarIndex += 1
+            self.operationOffset = -1
+        self.referenceOffset = -1
+        return False
+
+
+def overlappingMateQualities(first, second):
+    """
+    Adjust the base qualities of two overlapping mates in the way a pysam
+    pileup (i.e., htslib) does, so that only one of the mates has a base
+    quality at each offset they both match.
+
+    Where the two read bases agree, one mate (chosen by a hash of the read
+    name) gets the sum of the qualities (to a maximum of 200) and the other
+    a quality of zero. Where they disagree, the base with the lower quality
+    (or the base of the mate not chosen by the hash, if the qualities are
+    equal) gets zero and the other keeps 80% of its quality. Like htslib,
+    the bases of one mate that are aligned to a deletion in the other are
+    also given zero (or 80% of their quality, in the chosen mate).
+
+    @param first: The pysam alignment instance of the mate that was read
+        first.
+    @param second: The pysam alignment instance of the mate that was read
+        second.
+    @return: A 2-C{tuple} with the C{np.ndarray} base qualities of
+        C{first} and C{second}, or C{None} for an alignment that has no
+        qualities.
+    """
+    firstQualities = first.query_qualities
+    secondQualities = second.query_qualities
+
+    if firstQualities is None or secondQualities is None:
+        return firstQualities, secondQualities
+
+    firstQualities = np.array(firstQualities, dtype=np.int64)
+    secondQualities = np.array(secondQualities, dtype=np.int64)
+    firstSequence = first.query_sequence
+    secondSequence = second.query_sequence
+    keepFirst = _khashKeepsFirst(first.query_name)
+    firstStart = first.reference_start
+    secondStart = second.reference_start
+    firstCursor = _CigarCursor(first.cigartuples)
+    secondCursor = _CigarCursor(second.cigartuples)
+
+    def reduceQuality(qualities, offset, keep):
+        qualities[offset] = int(0.8 * qualities[offset]) if keep else 0
+
+    # This follows tweak_overlap_quality in htslib's sam.c.
+    offset = secondStart
+    if not (firstCursor.seek(offset - firstStart) and
+            secondCursor.seek(0)):
+        return firstQualities, secondQualities
+
+    while True:
+        while 0 <= firstCursor.referenceOffset < offset - firstStart:
+            if not firstCursor.advance():
+                return firstQualities, secondQualities
+        while 0 <= secondCursor.referenceOffset < offset - secondStart:
+            if not secondCursor.advance():
+                return firstQualities, secondQualities
+        firstOffset = firstCursor.referenceOffset + firstStart
+        secondOffset = secondCursor.referenceOffset + secondStart
+        offset = max(offset, firstOffset, secondOffset) + 1
+
+        if firstOffset != secondOffset:
+            if (firstOffset < secondOffset and
+                    secondCursor.previousOperation() == CDEL):
+                # The first mate has bases where the second has a deletion.
+                while True:
+                    reduceQuality(firstQualities, firstCursor.queryOffset,
+                                  keepFirst)
+                    if not firstCursor.advance():
+                        return firstQualities, secondQualities
+                    if (firstCursor.referenceOffset + firstStart >=
+                            secondOffset):
+                        break
+            elif firstCursor.previousOperation() == CDEL:
+                # The second mate has bases where the first has a deletion
+                # (htslib does not check which offset is lower here).
+                while True:
+                    reduceQuality(secondQualities,
+                                  secondCursor.queryOffset, not keepFirst)
+                    if not secondCursor.advance():
+                        return firstQualities, secondQualities
+                    if (secondCursor.referenceOffset + secondStart >=
+                            firstOffset):
+                        break
+            else:
+                continue
+
+        firstIndex = firstCursor.queryOffset
+        secondIndex = secondCursor.queryOffset
+        firstQuality = firstQualities[firstIndex]
+        secondQuality = secondQualities[secondIndex]
+        if firstSequence[firstIndex] == secondSequence[secondIndex]:
+            quality = min(firstQuality + secondQuality, 200)
+            if keepFirst:
+                firstQualities[firstIndex] = quality
+                secondQualities[secondIndex] = 0
+            else:
+                firstQualities[firstIndex] = 0
+                secondQualities[secondIndex] = quality
+        elif (firstQuality > secondQuality or
+              (firstQuality == secondQuality and keepFirst)):
+            reduceQuality(firstQualities, firstIndex, True)
+            secondQualities[secondIndex] = 0
+        else:
+            firstQualities[firstIndex] = 0
+            reduceQuality(secondQualities, secondIndex, True)
+
+
+def _isStateful(function):
+    """
+    Check whether a query filtering function may give a result that depends
+    on the queries it was given before (e.g., because it keeps only the
+    first few, or removes duplicates).
+
+    @param function: A function passed as C{filterRead} or C{filterQuery}
+        to C{SAMFilter}, or C{None}.
+    @return: A C{bool}. A function that is not a method of an object with a
+        C{stateful} attribute (such as a C{dark.reads.ReadFilter} or
+        C{dark.reads.Reads} instance) is assumed to be stateful.
+    """
+    if function is None:
+        return False
+    return getattr(getattr(function, '__self__', None), 'stateful', True)
+
+
 def _hardClip(sequence, quality, cigartuples):
     """
     Hard clip (if necessary) a sequence.
@@ -185,6 +590,11 @@ class SAMFilter(object):
         and returns either C{None} or a C{Read} instance, according to
         whether the passed read should be omitted or not. If C{None} is
         passed, no filtering on reads (i.e., queries) is done.
+    @param filterQuery: A function that takes a pysam alignment instance and
+        returns C{False} if its query should be omitted, such as the
+        C{filterAlignment} method of a C{dark.reads.Reads} instance. If
+        given, this is used instead of C{filterRead} and avoids making a
+        C{Read} for every alignment.
     @param referenceIds: Either C{None} or a set of C{str} reference ids
         that should be kept (other references will be dropped).
     @param storeQueryIds: If C{True}, query ids will be stored (in
@@ -205,14 +615,26 @@ class SAMFilter(object):
         have a score will not be output.
     @param scoreTag: The alignment tag to extract for minScore and maxScore
         comparisons.
+    @param workers: If not C{None} and greater than one, and the SAM/BAM file
+        has an index, the C{int} number of worker processes to read and
+        filter regions of the file with (see C{mapSAMRegions}). Alignments
+        are still produced in the order they appear in the file.
+    @param regionSize: The C{int} maximum length of the regions of the
+        references to give to each worker process, or C{None} to have the
+        size chosen automatically. If the query filter is stateful (e.g.,
+        it keeps only the first N queries, or removes duplicates), it is
+        applied in this process, in file order, so the result is the same
+        as filtering serially.
     """
     def __init__(self, filename, filterRead=None, referenceIds=None,
                  storeQueryIds=False, dropUnmapped=False,
                  dropSecondary=False, dropSupplementary=False,
                  dropDuplicates=False, keepQCFailures=False, minScore=None,
-                 maxScore=None, scoreTag='AS'):
+                 maxScore=None, scoreTag='AS', workers=None,
+                 regionSize=None, filterQuery=None):
         self.filename = filename
         self.filterRead = filterRead
+        self.filterQuery = filterQuery
         self.referenceIds = referenceIds
         self.dropUnmapped = dropUnmapped
         self.dropSecondary = dropSecondary
@@ -223,6 +645,10 @@ class SAMFilter(object):
         self.minScore = minScore
         self.maxScore = maxScore
         self.scoreTag = scoreTag
+        self.workers = workers
+        self.regionSize = regionSize
+        self._statefulQuery = _isStateful(
+            filterRead if filterQuery is None else filterQuery)
 
     @staticmethod
     def addFilteringOptions(parser, samfileIsPositional=False,
@@ -319,8 +745,21 @@ class SAMFilter(object):
             help=('The alignment tag to extract for --minScore and --maxScore '
                   'comparisons.'))
 
+        parser.add_argument(
+            '--workers', type=int, metavar='N',
+            help=('The number of processes to use to read regions of the '
+                  'SAM/BAM file. This is only possible if the file has an '
+                  'index.'))
+
+        parser.add_argument(
+            '--regionSize', type=int, metavar='N',
+            help=('The maximum length of the reference regions given to each '
+                  'process when --workers is used. If not given, a size is '
+                  'chosen automatically.'))
+
     @classmethod
-    def parseFilteringOptions(cls, args, filterRead=None, storeQueryIds=False):
+    def parseFilteringOptions(cls, args, filterRead=None, storeQueryIds=False,
+                              filterQuery=None):
         """
         Parse command line options (added in C{addSAMFilteringOptions}.
 
@@ -331,11 +770,15 @@ class SAMFilter(object):
             or else a C{Read} instance.
         @param storeQueryIds: If C{True}, query ids will be stored as the
             SAM/BAM file is read.
+        @param filterQuery: A one-argument function that accepts a pysam
+            alignment and returns C{False} if its query should be omitted in
+            filtering (see C{__init__}).
         @return: A C{SAMFilter} instance.
         """
         return cls(
             args.samfile,
             filterRead=filterRead,
+            filterQuery=filterQuery,
             referenceIds=set(args.referenceId) if args.referenceId else None,
             storeQueryIds=storeQueryIds,
             dropUnmapped=args.dropUnmapped,
@@ -344,7 +787,9 @@ class SAMFilter(object):
             dropDuplicates=args.dropDuplicates,
             keepQCFailures=args.keepQCFailures,
             minScore=args.minScore,
-            maxScore=args.maxScore)
+            maxScore=args.maxScore,
+            workers=args.workers,
+            regionSize=args.regionSize)
 
     def filterAlignment(self, alignment):
         """
@@ -354,6 +799,17 @@ class SAMFilter(object):
         @return: A C{bool}, C{True} if the alignment passes our filtering,
             C{False} if it should be discarded.
         """
+        return (self._passesScore(alignment) and
+                self._passesQuery(alignment) and
+                self._passesFlags(alignment))
+
+    def _passesScore(self, alignment):
+        """
+        Test an alignment against the minimum and maximum score.
+
+        @param alignment: A pysam alignment instance.
+        @return: A C{bool}, C{True} if the alignment has an acceptable score.
+        """
         if self.minScore is not None or self.maxScore is not None:
             try:
                 score = alignment.get_tag(self.scoreTag)
@@ -364,18 +820,96 @@ class SAMFilter(object):
                         (self.maxScore is not None and score > self.maxScore)):
                     return False
 
-        return ((self.filterRead is None or
-                 self.filterRead(Read(alignment.query_name,
-                                      alignment.query_sequence,
-                                      alignment.qual))) and
-                not (
-                    (self.referenceIds and
-                     alignment.reference_name not in self.referenceIds) or
-                    (alignment.is_unmapped and self.dropUnmapped) or
-                    (alignment.is_secondary and self.dropSecondary) or
-                    (alignment.is_supplementary and self.dropSupplementary) or
-                    (alignment.is_duplicate and self.dropDuplicates) or
-                    (alignment.is_qcfail and not self.keepQCFailures)))
+        return True
+
+    def _passesQuery(self, alignment):
+        """
+        Test the query of an alignment with the query filter (if any).
+
+        @param alignment: A pysam alignment instance.
+        @return: A C{bool}, C{True} if the query passes the filter.
+        """
+        if self.filterQuery is not None:
+            if not self.filterQuery(alignment):
+                return False
+        elif self.filterRead is not None:
+            if not self.filterRead(Read(alignment.query_name,
+                                        alignment.query_sequence,
+                                        alignment.qual)):
+                return False
+
+        return True
+
+    def _passesFlags(self, alignment):
+        """
+        Test an alignment against the wanted references and flags.
+
+        @param alignment: A pysam alignment instance.
+        @return: A C{bool}, C{True} if the alignment passes.
+        """
+        return not (
+            (self.referenceIds and
+             alignment.reference_name not in self.referenceIds) or
+            (alignment.is_unmapped and self.dropUnmapped) or
+            (alignment.is_secondary and self.dropSecondary) or
+            (alignment.is_supplementary and self.dropSupplementary) or
+            (alignment.is_duplicate and self.dropDuplicates) or
+            (alignment.is_qcfail and not self.keepQCFailures))
+
+    @staticmethod
+    def _hardClipAlignment(alignment, lastAlignment, count):
+        """
+        Hard clip the query of an alignment (if necessary), giving it the
+        query of the last alignment if it has none.
+
+        @param alignment: A pysam alignment instance.
+        @param lastAlignment: The last pysam alignment instance that had a
+            query sequence, or C{None} if there has not been one.
+        @param count: The C{int} (1-based) number of C{alignment} in the
+            SAM/BAM file.
+        @raise InvalidSAM: If C{alignment} has no query sequence and
+            C{lastAlignment} is C{None}.
+        @return: The pysam alignment instance that is the last to have had a
+            query sequence.
+        """
+        # Secondary and supplementary alignments may have a '*' (pysam
+        # returns this as None) SEQ field, indicating that the previous
+        # sequence should be used. This is best practice according to
+        # section 2.5.2 of https://samtools.github.io/hts-specs/SAMv1.pdf So
+        # we use the last alignment query and quality strings if we get None
+        # as a query sequence.
+        if alignment.query_sequence is None:
+            if lastAlignment is None:
+                raise InvalidSAM(
+                    'pysam produced an alignment (number %d) with no '
+                    'query sequence without previously giving an '
+                    'alignment with a sequence.' % count)
+            # Use the previous query sequence and quality. I'm not making the
+            # call to _hardClip dependent on alignment.cigartuples (as in the
+            # else clause below) because I don't think it's possible for
+            # alignment.cigartuples to be None in this case. If we have a
+            # second match on a query, then it must be aligned to something
+            # (i.e., it cannot be unmapped with no CIGAR string). The
+            # assertion will tell us if this is ever not the case.
+            assert alignment.cigartuples
+            (alignment.query_sequence,
+             alignment.query_qualities, _) = _hardClip(
+                 lastAlignment.query_sequence,
+                 lastAlignment.query_qualities,
+                 alignment.cigartuples)
+            return lastAlignment
+        else:
+            cigartuples = alignment.cigartuples
+            if cigartuples:
+                sequence, quality, clipped = _hardClip(
+                    alignment.query_sequence, alignment.query_qualities,
+                    cigartuples)
+                # Only give the alignment a new query if it was clipped,
+                # because setting the sequence and quality is slow.
+                if clipped:
+                    alignment.query_sequence = sequence
+                    alignment.query_qualities = quality
+            return alignment
 
     def alignments(self):
         """
@@ -389,6 +923,12 @@ class SAMFilter(object):
         if storeQueryIds:
             self.queryIds = queryIds = set()
 
+        if (self.workers is not None and self.workers > 1 and
+                samIsIndexed(self.filename)):
+            for alignment in self._regionAlignments():
+                yield alignment
+            return
+
         lastAlignment = None
         count = 0
         with samfile(self.filename) as samAlignment:
@@ -396,48 +936,111 @@ class SAMFilter(object):
                 if storeQueryIds:
                     queryIds.add(alignment.query_name)
 
-                # Secondary and supplementary alignments may have a '*'
-                # (pysam returns this as None) SEQ field, indicating that
-                # the previous sequence should be used. This is best
-                # practice according to section 2.5.2 of
-                # https://samtools.github.io/hts-specs/SAMv1.pdf So we use
-                # the last alignment query and quality strings if we get
-                # None as a query sequence.
-                if alignment.query_sequence is None:
-                    if lastAlignment is None:
-                        raise InvalidSAM(
-                            'pysam produced an alignment (number %d) with no '
-                            'query sequence without previously giving an '
-                            'alignment with a sequence.' % count)
-                    # Use the previous query sequence and quality. I'm not
-                    # making the call to _hardClip dependent on
-                    # alignment.cigartuples (as in the else clause below)
-                    # because I don't think it's possible for
-                    # alignment.cigartuples to be None in this case. If we
-                    # have a second match on a query, then it must be
-                    # aligned to something (i.e., it cannot be unmapped
-                    # with no CIGAR string). The assertion will tell us if
-                    # this is ever not the case.
-                    assert alignment.cigartuples
-                    (alignment.query_sequence,
-                     alignment.query_qualities, _) = _hardClip(
-                         lastAlignment.query_sequence,
-                         lastAlignment.query_qualities,
-                         alignment.cigartuples)
-                else:
-                    lastAlignment = alignment
-                    if alignment.cigartuples:
-                        (alignment.query_sequence,
-                         alignment.query_qualities, _) = _hardClip(
-                             alignment.query_sequence,
-                             alignment.query_qualities,
-                             alignment.cigartuples)
+                lastAlignment = self._hardClipAlignment(
+                    alignment, lastAlignment, count)
 
                 if self.filterAlignment(alignment):
                     yield alignment
 
         self.alignmentCount = count
 
+    def _filterRegion(self, sam, region):
+        """
+        Filter the alignments in a region of the SAM/BAM file.
+
+        This is run in worker processes, and so returns alignments as SAM
+        strings. Alignments with no query sequence that occur before any
+        alignment that has one are returned unprocessed, because they need
+        the query of an alignment in an earlier region.
+
+        If the query filter is stateful, it must see the queries in file
+        order, so it is not applied here. Instead, all the alignments with
+        an acceptable score are returned, each with a C{bool} indicating
+        whether it passes the other checks, and the query filter is applied
+        by C{_regionAlignments}.
+
+        @param sam: A C{pysam.AlignmentFile} instance.
+        @param region: A (referenceId, start, end) C{tuple}.
+        @return: A 5-C{tuple} with the C{int} number of alignments in the
+            region, a C{set} of their query ids (or C{None} if
+            C{self.storeQueryIds} is C{False}), a C{list} of the unprocessed
+            alignments, a C{list} of the alignments that pass our filtering
+            (or of 2-tuples of alignments and C{bool}s, if the query filter
+            is stateful), and the last alignment that had a query sequence
+            (or C{None}).
+        """
+        statefulQuery = self._statefulQuery
+        queryIds = set() if self.storeQueryIds else None
+        unprocessed = []
+        kept = []
+        lastAlignment = None
+        count = 0
+        for count, alignment in enumerate(
+                regionAlignments(sam, region), start=1):
+            if queryIds is not None:
+                queryIds.add(alignment.query_name)
+
+            if alignment.query_sequence is None and lastAlignment is None:
+                unprocessed.append(alignment.to_string())
+                continue
+
+            lastAlignment = self._hardClipAlignment(
+                alignment, lastAlignment, count)
+
+            if statefulQuery:
+                if self._passesScore(alignment):
+                    kept.append((alignment.to_string(),
+                                 self._passesFlags(alignment)))
+            elif self.filterAlignment(alignment):
+                kept.append(alignment.to_string())
+
+        return (count, queryIds, unprocessed, kept,
+                None if lastAlignment is None else lastAlignment.to_string())
+
+    def _regionAlignments(self):
+        """
+        Get filtered alignments from the SAM/BAM file, using worker processes
+        to read and filter regions of the file.
+
+        @return: A generator that yields pysam alignment instances that pass
+            our filtering criteria, in the order they appear in the file.
+        """
+        with samfile(self.filename) as sam:
+            header = sam.header
+
+        lastAlignment = None
+        total = 0
+        for count, queryIds, unprocessed, kept, last in mapSAMRegions(
+                self.filename, self._filterRegion, self.workers,
+                self.regionSize):
+            if queryIds is not None:
+                self.queryIds.update(queryIds)
+
+            for index, string in enumerate(unprocessed, start=1):
+                alignment = AlignedSegment.fromstring(string, header)
+                lastAlignment = self._hardClipAlignment(
+                    alignment, lastAlignment, total + index)
+                if self.filterAlignment(alignment):
+                    yield alignment
+
+            if self._statefulQuery:
+                # Apply the query filter in file order, as filterAlignment
+                # would (i.e., to every alignment with an acceptable score).
+                for string, passesFlags in kept:
+                    alignment = AlignedSegment.fromstring(string, header)
+                    if self._passesQuery(alignment) and passesFlags:
+                        yield alignment
+            else:
+                for string in kept:
+                    yield AlignedSegment.fromstring(string, header)
+
+            if last is not None:
+                lastAlignment = AlignedSegment.fromstring(last, header)
+
+            total += count
+
+        self.alignmentCount = total
+
     def referenceLengths(self):
         """
         Get the lengths of wanted references.
@@ -465,17 +1068,181 @@ class SAMFilter(object):
         return result
 
 
+class SAMWriter(object):
+    """
+    Write alignments to a SAM, BAM or CRAM file. BAM and CRAM output is
+    compressed (in BGZF blocks, for BAM) by C{threads} htslib threads, so
+    the writing process is not limited by the speed of one compressing
+    thread.
+
+    @param filename: The C{str} name of the file to write, or '-' for
+        standard output.
+    @param template: The C{str} name of a SAM/BAM/CRAM file whose header
+        should be used for the output.
+    @param header: If not C{None}, a C{dict} header to use instead of the
+        header of C{template}.
+    @param format_: One of 'sam', 'bam', or 'cram'.
+    @param threads: The C{int} number of threads to use for compression.
+    @param index: If C{True}, index the output file (BAM or CRAM only) when
+        it is closed. The alignments must have been written in coordinate
+        order (as they will be if they come from a coordinate-sorted file
+        via C{SAMFilter}), otherwise an exception will be raised by
+        C{pysam} when indexing.
+    @param referenceFilename: The C{str} name of a FASTA file with the
+        reference sequences, needed for CRAM output.
+    @raise ValueError: If C{format_} is unknown, or C{index} is C{True} and
+        the output is SAM or is written to standard output.
+    """
+    MODES = {
+        'bam': 'wb',
+        'cram': 'wc',
+        'sam': 'w',
+    }
+
+    def __init__(self, filename, template, header=None, format_='sam',
+                 threads=1, index=False, referenceFilename=None):
+        try:
+            mode = self.MODES[format_]
+        except KeyError:
+            raise ValueError('Unknown SAM output format %r. Known formats '
+                             'are: %s.' % (format_,
+                                           ', '.join(sorted(self.MODES))))
+
+        if index and (format_ == 'sam' or filename == '-'):
+            raise ValueError(
+                'Only BAM or CRAM output written to a file can be indexed.')
+
+        self.filename = filename
+        self.index = index
+        self.threads = threads
+        self.count = 0
+
+        if header is None:
+            with samfile(template) as sam:
+                self._out = AlignmentFile(
+                    filename, mode, template=sam, threads=threads,
+                    reference_filename=referenceFilename)
+        else:
+            self._out = AlignmentFile(
+                filename, mode, header=header, threads=threads,
+                reference_filename=referenceFilename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        # Don't index a file whose writing was interrupted by an exception.
+        self.close(index=excType is None)
+
+    def write(self, alignment):
+        """
+        Write an alignment.
+
+        @param alignment: A pysam alignment instance.
+        """
+        self._out.write(alignment)
+        self.count += 1
+
+    def writeAlignments(self, alignments):
+        """
+        Write alignments.
+
+        @param alignments: An iterable of pysam alignment instances.
+        @return: The C{int} number of alignments written.
+        """
+        save = self._out.write
+        count = 0
+        for count, alignment in enumerate(alignments, start=1):
+            save(alignment)
+        self.count += count
+        return count
+
+    def close(self, index=True):
+        """
+        Close the output file, and index it if requested.
+
+        @param index: If C{False}, do not index the output file, even if
+            indexing was requested when the writer was created.
+        """
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+            if index and self.index:
+                samtoolsIndex('-@', str(self.threads), self.filename)
+
+
+class _SpillingCounter(object):
+    """
+    Count C{str} keys in bounded memory. Counts are kept in a C{dict}
+    until it holds C{maxsize} keys, at which point they are all written to
+    an sqlite3 database table and the C{dict} is emptied.
+
+    @param connection: An C{sqlite3.Connection} instance.
+    @param maxsize: The C{int} maximum number of counts to keep in memory.
+    """
+    def __init__(self, connection, maxsize):
+        self._connection = connection
+        self._maxsize = maxsize
+        self._counts = {}
+        self._spilled = False
+        connection.execute('DROP TABLE IF EXISTS counts')
+        connection.execute(
+            'CREATE TABLE counts (key TEXT PRIMARY KEY, count INTEGER)')
+
+    def increment(self, key):
+        """
+        Increment the count for a key.
+
+        @param key: A C{str} key.
+        @return: The C{int} count for C{key} before it was incremented.
+        """
+        counts = self._counts
+        try:
+            count = counts[key]
+        except KeyError:
+            count = 0
+            if self._spilled:
+                row = self._connection.execute(
+                    'SELECT count FROM counts WHERE key = ?',
+                    (key,)).fetchone()
+                if row:
+                    count = row[0]
+            if len(counts) >= self._maxsize:
+                self._spill()
+        counts[key] = count + 1
+        return count
+
+    def _spill(self):
+        """
+        Write the in-memory counts to the database and empty the C{dict}.
+        """
+        self._connection.executemany(
+            'INSERT OR REPLACE INTO counts VALUES (?, ?)',
+            self._counts.items())
+        self._counts.clear()
+        self._spilled = True
+
+
 class PaddedSAM(object):
     """
     Obtain aligned (padded) queries from a SAM/BAM file.
 
     @param samFilter: A C{SAMFilter} instance.
+    @param streaming: If C{True}, use bounded memory, no matter how many
+        queries there are. Reference insertions are written to a temporary
+        sqlite3 database (on disk) instead of being kept in
+        C{self.referenceInsertions} (which is then C{None}), and only the
+        C{maxIds} most recently seen query ids are kept in memory for
+        numbering duplicate ids. Use C{insertions} and C{insertionCounts}
+        to get the reference insertions in either mode.
+    @param maxIds: The C{int} maximum number of query ids to keep in memory
+        when C{streaming} is C{True}.
     @raises UnequalReferenceLengthError: If C{referenceName} is C{None}
         and the reference sequence lengths in the SAM/BAM file are not all
         identical.
     @raises UnknownReference: If C{referenceName} does not exist.
     """
-    def __init__(self, samFilter):
+    def __init__(self, samFilter, streaming=False, maxIds=100000):
         referenceLengths = samFilter.referenceLengths()
 
         if len(set(referenceLengths.values())) != 1:
@@ -490,12 +1257,96 @@ class PaddedSAM(object):
         # Get the length of any of the sequences (they are all identical).
         self.referenceLength = referenceLengths.popitem()[1]
         self.samFilter = samFilter
-        # self.referenceInsertions will be keyed by query id (the query
-        # that would cause a reference insertion). The values will be lists
-        # of 2-tuples, with each 2-tuple containing an offset into the
-        # reference sequence and the C{str} of nucleotides that would be
-        # inserted starting at that offset.
-        self.referenceInsertions = defaultdict(list)
+        self.maxIds = maxIds
+        if streaming:
+            # An empty file name gives a private temporary on-disk database
+            # that is removed when the connection is closed.
+            self._connection = sqlite3.connect('')
+            self._connection.execute(
+                'CREATE TABLE insertions (offset INTEGER, queryId TEXT, '
+                'nucleotides TEXT)')
+            self._insertionBuffer = []
+            self.referenceInsertions = None
+        else:
+            self._connection = None
+            # self.referenceInsertions will be keyed by query id (the query
+            # that would cause a reference insertion). The values will be
+            # lists of 2-tuples, with each 2-tuple containing an offset into
+            # the reference sequence and the C{str} of nucleotides that
+            # would be inserted starting at that offset.
+            self.referenceInsertions = defaultdict(list)
+
+    def close(self):
+        """
+        Close (and so remove) the temporary database used in streaming mode.
+        """
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _addInsertion(self, queryId, offset, nucleotides):
+        """
+        Record a reference insertion.
+
+        @param queryId: The C{str} id of the query causing the insertion.
+        @param offset: The C{int} reference offset of the insertion.
+        @param nucleotides: The C{str} nucleotides that would be inserted.
+        """
+        if self._connection is None:
+            self.referenceInsertions[queryId].append((offset, nucleotides))
+        else:
+            self._insertionBuffer.append((offset, queryId, nucleotides))
+            if len(self._insertionBuffer) >= 10000:
+                self._flushInsertions()
+
+    def _flushInsertions(self):
+        """
+        Write buffered reference insertions to the database.
+        """
+        if self._insertionBuffer:
+            self._connection.executemany(
+                'INSERT INTO insertions VALUES (?, ?, ?)',
+                self._insertionBuffer)
+            del self._insertionBuffer[:]
+
+    def insertions(self):
+        """
+        Get the reference insertions found by C{queries}.
+
+        @return: A generator of (offset, queryId, nucleotides) 3-tuples,
+            sorted by C{int} offset and then by C{str} query id.
+        """
+        if self._connection is None:
+            return iter(sorted(
+                (offset, queryId, nucleotides)
+                for queryId, insertions in self.referenceInsertions.items()
+                for offset, nucleotides in insertions))
+        else:
+            self._flushInsertions()
+            return self._connection.execute(
+                'SELECT offset, queryId, nucleotides FROM insertions '
+                'ORDER BY offset, queryId, nucleotides')
+
+    def insertionCounts(self):
+        """
+        Count the nucleotides that queries would insert at each reference
+        offset.
+
+        @return: A C{defaultdict(Counter)} keyed by C{int} offset, with the
+            C{Counter}s counting the C{str} nucleotides inserted there.
+        """
+        result = defaultdict(Counter)
+        if self._connection is None:
+            for insertions in self.referenceInsertions.values():
+                for offset, nucleotides in insertions:
+                    result[offset][nucleotides] += 1
+        else:
+            self._flushInsertions()
+            for offset, nucleotides, count in self._connection.execute(
+                    'SELECT offset, nucleotides, COUNT(*) FROM insertions '
+                    'GROUP BY offset, nucleotides'):
+                result[offset][nucleotides] = count
+        return result
 
     def queries(self, rcSuffix='', rcNeeded=False, padChar='-',
                 queryInsertionChar='N', unknownQualityChar='!',
@@ -529,8 +1380,8 @@ class PaddedSAM(object):
             appended to their ids. So repeated ids may appear in the yielded
             FASTA.
         @param addAlignment: If C{True} the reads yielded by the returned
-            generator will also have an C{alignment} attribute, being the
-            C{pysam.AlignedSegment} for the query.
+            generator will be C{AlignedRead} instances, with an C{alignment}
+            attribute holding the C{pysam.AlignedSegment} for the query.
         @raises InvalidSAM: If a query has an empty SEQ field and either there
             is no previous alignment or the alignment is not marked as
             secondary or supplementary.
@@ -540,10 +1391,25 @@ class PaddedSAM(object):
             corresponding C{pysam.AlignedSegment}.
         """
         referenceLength = self.referenceLength
+        padByte = padChar.encode('latin-1')
+        queryInsertionByte = queryInsertionChar.encode('latin-1')
+        unknownQualityByte = unknownQualityChar.encode('latin-1')
+        # Reference-length templates for the padded sequence and quality.
+        sequenceTemplate = padByte * referenceLength
+        qualityTemplate = unknownQualityByte * referenceLength
 
         # Hold the count for each id so we can add /1, /2 etc to duplicate
         # ids (unless --allowDuplicateIds was given).
-        idCount = Counter()
+        if self._connection is None:
+            idCount = Counter()
+
+            def countId(id_):
+                count = idCount[id_]
+                idCount[id_] = count + 1
+                return count
+        else:
+            countId = _SpillingCounter(self._connection,
+                                       self.maxIds).increment
 
         MATCH_OPERATIONS = {CMATCH, CEQUAL, CDIFF}
 
@@ -551,7 +1417,12 @@ class PaddedSAM(object):
                 self.samFilter.alignments(), start=1):
 
             query = alignment.query_sequence
-            quality = ''.join(chr(q + 33) for q in alignment.query_qualities)
+            qualities = alignment.query_qualities
+            if qualities is None:
+                quality = unknownQualityByte * len(query)
+            else:
+                quality = bytes(bytearray(qualities)).translate(
+                    _PHRED_TO_ASCII)
 
             if alignment.is_reverse:
                 if rcNeeded:
@@ -565,8 +1436,7 @@ class PaddedSAM(object):
             if allowDuplicateIds:
                 queryId = alignment.query_name
             else:
-                count = idCount[alignment.query_name]
-                idCount[alignment.query_name] += 1
+                count = countId(alignment.query_name)
                 queryId = alignment.query_name + (
                     '' if count == 0 else '/%d' % count)
 
@@ -574,8 +1444,11 @@ class PaddedSAM(object):
             atStart = True
             queryIndex = 0
             referenceIndex = referenceStart
-            alignedSequence = ''
-            alignedQuality = ''
+            # The parts of the aligned query. Each is a 3-tuple with the
+            # start and end offsets of a part of the query to copy, or None
+            # and the number of query insertion characters to add.
+            parts = []
+            alignedLength = 0
 
             for operation, length in alignment.cigartuples:
 
@@ -585,8 +1458,8 @@ class PaddedSAM(object):
                 # occurrence.
                 if operation in MATCH_OPERATIONS:
                     atStart = False
-                    alignedSequence += query[queryIndex:queryIndex + length]
-                    alignedQuality += quality[queryIndex:queryIndex + length]
+                    parts.append((queryIndex, queryIndex + length))
+                    alignedLength += length
                 elif operation == CINS:
                     # Insertion to the reference. This consumes query bases but
                     # we don't output them because the reference cannot be
@@ -595,16 +1468,15 @@ class PaddedSAM(object):
                     # query but record what would have been inserted into the
                     # reference.
                     atStart = False
-                    self.referenceInsertions[queryId].append(
-                        (referenceIndex,
-                         query[queryIndex:queryIndex + length]))
+                    self._addInsertion(queryId, referenceIndex,
+                                       query[queryIndex:queryIndex + length])
                 elif operation == CDEL:
                     # Delete from the reference. Some bases from the reference
                     # would need to be deleted to continue the match. So we put
                     # an insertion into the query to compensate.
                     atStart = False
-                    alignedSequence += queryInsertionChar * length
-                    alignedQuality += unknownQualityChar * length
+                    parts.append((None, length))
+                    alignedLength += length
                 elif operation == CREF_SKIP:
                     # Skipped reference. Opens a gap in the query. For
                     # mRNA-to-genome alignment, an N operation represents an
@@ -612,8 +1484,8 @@ class PaddedSAM(object):
                     # interpretation of N is not defined. So this is unlikely
                     # to occur.
                     atStart = False
-                    alignedSequence += queryInsertionChar * length
-                    alignedQuality += unknownQualityChar * length
+                    parts.append((None, length))
+                    alignedLength += length
                 elif operation == CSOFT_CLIP:
                     # Bases in the query that are not part of the match. We
                     # remove these from the query if they protrude before the
@@ -626,33 +1498,29 @@ class PaddedSAM(object):
                         unwantedLeft = length - referenceStart
                         if unwantedLeft > 0:
                             # The query protrudes left. Copy its right part.
-                            alignedSequence += query[
-                                queryIndex + unwantedLeft:queryIndex + length]
-                            alignedQuality += quality[
-                                queryIndex + unwantedLeft:queryIndex + length]
+                            parts.append((queryIndex + unwantedLeft,
+                                          queryIndex + length))
+                            alignedLength += length - unwantedLeft
                             referenceStart = 0
                         else:
                             referenceStart -= length
-                            alignedSequence += query[
-                                queryIndex:queryIndex + length]
-                            alignedQuality += quality[
-                                queryIndex:queryIndex + length]
+                            parts.append((queryIndex, queryIndex + length))
+                            alignedLength += length
                     else:
                         unwantedRight = (
-                            (referenceStart + len(alignedSequence) + length) -
+                            (referenceStart + alignedLength + length) -
                             referenceLength)
 
                         if unwantedRight > 0:
                             # The query protrudes right. Copy its left part.
-                            alignedSequence += query[
-                                queryIndex:queryIndex + length - unwantedRight]
-                            alignedQuality += quality[
-                                queryIndex:queryIndex + length - unwantedRight]
+                            # (If the aligned query already extends past the
+                            # end of the reference, nothing is copied.)
+                            wanted = max(0, length - unwantedRight)
+                            parts.append((queryIndex, queryIndex + wanted))
+                            alignedLength += wanted
                         else:
-                            alignedSequence += query[
-                                queryIndex:queryIndex + length]
-                            alignedQuality += quality[
-                                queryIndex:queryIndex + length]
+                            parts.append((queryIndex, queryIndex + length))
+                            alignedLength += length
                 elif operation == CHARD_CLIP:
                     # Some bases have been completely removed from the query.
                     # This (H) can only be present as the first and/or last
@@ -685,20 +1553,686 @@ class PaddedSAM(object):
             # about the part of the reference that lies to the right of the
             # aligned query.
 
-            # Put gap characters before and after the aligned sequence so that
-            # it is offset properly and matches the length of the reference.
-            padRightLength = (referenceLength -
-                              (referenceStart + len(alignedSequence)))
-            paddedSequence = (padChar * referenceStart +
-                              alignedSequence +
-                              padChar * padRightLength)
-            paddedQuality = (unknownQualityChar * referenceStart +
-                             alignedQuality +
-                             unknownQualityChar * padRightLength)
+            # Copy the aligned parts of the query into buffers that are
+            # already padded with gap characters, so that the query is offset
+            # properly and matches the length of the reference. (A query
+            # whose alignment extends past the end of the reference is not
+            # truncated.)
+            sequenceBuffer = bytearray(sequenceTemplate)
+            qualityBuffer = bytearray(qualityTemplate)
+            excess = referenceStart + alignedLength - referenceLength
+            if excess > 0:
+                sequenceBuffer.extend(padByte * excess)
+                qualityBuffer.extend(unknownQualityByte * excess)
+            queryBytes = query.encode('latin-1')
+            offset = referenceStart
+            for start, end in parts:
+                if start is None:
+                    sequenceBuffer[offset:offset + end] = (
+                        queryInsertionByte * end)
+                    offset += end
+                else:
+                    nextOffset = offset + end - start
+                    sequenceBuffer[offset:nextOffset] = queryBytes[start:end]
+                    qualityBuffer[offset:nextOffset] = quality[start:end]
+                    offset = nextOffset
 
-            read = Read(queryId, paddedSequence, paddedQuality)
+            paddedSequence = sequenceBuffer.decode('latin-1')
+            paddedQuality = qualityBuffer.decode('latin-1')
 
             if addAlignment:
-                read.alignment = alignment
+                read = AlignedRead(queryId, paddedSequence, paddedQuality,
+                                   alignment)
+            else:
+                read = Read(queryId, paddedSequence, paddedQuality)
 
             yield read
+
+
+# The characters whose counts are kept by SAMBaseCounts, and the row that
+# each byte of a query sequence is counted in. Bytes other than A, C, G,
+# and T are counted as N.
+_BASE_COUNT_ALPHABET = 'ACGTN-'
+_BASE_COUNT_ROWS = np.full(256, _BASE_COUNT_ALPHABET.index('N'), np.intp)
+for _index, _base in enumerate('ACGT'):
+    _BASE_COUNT_ROWS[ord(_base)] = _BASE_COUNT_ROWS[ord(_base.lower())] = (
+        _index)
+_GAP_ROW = _BASE_COUNT_ALPHABET.index('-')
+
+
+def _addToCounts(counts, indices):
+    """
+    Add one to C{counts} at each of a set of (possibly repeated) indices.
+
+    @param counts: A one-dimensional C{np.ndarray} of C{int} counts.
+    @param indices: A C{np.ndarray} of C{int} indices into C{counts}.
+    """
+    if len(indices):
+        # Only count over the range of indices actually present, as this
+        # is (usually) much smaller than all of counts when alignments come
+        # from a sorted SAM/BAM file.
+        low = indices.min()
+        added = np.bincount(indices - low)
+        counts[low:low + len(added)] += added
+
+
+def _blockIndices(starts, lengths, rows, width):
+    """
+    Make indices into a flattened (site, row) count array for all sites in a
+    list of alignment blocks.
+
+    @param starts: A C{list} of C{int} block start offsets.
+    @param lengths: A C{list} of C{int} block lengths.
+    @param rows: A C{np.ndarray} giving the count array row for each site in
+        all the blocks, or an C{int} row for all sites.
+    @param width: The C{int} number of rows in the count array.
+    @return: A C{np.ndarray} of C{int} indices.
+    """
+    lengths = np.array(lengths, dtype=np.intp)
+    ends = np.cumsum(lengths)
+    # The site of each element of the blocks is its block start plus its
+    # offset within the block.
+    sites = (np.arange(ends[-1], dtype=np.intp) +
+             np.repeat(np.array(starts, dtype=np.intp) - (ends - lengths),
+                       lengths))
+    return sites * width + rows
+
+
+class SAMBaseCounts(object):
+    """
+    Count the nucleotides (and deletions) aligned to each site of the
+    references in a SAM/BAM file.
+
+    This works from the CIGAR blocks of each alignment, in a single pass
+    over the file, and is much faster than using pysam's C{pileup}. Unlike
+    C{pileup}, it does not ignore secondary or duplicate alignments, or
+    limit the depth, unless told to via C{samFilter}.
+
+    @param samFilter: A C{SAMFilter} instance, used to read and filter the
+        alignments. Only the references it is restricted to (if any) are
+        counted.
+    @param storeQueryIds: If C{True}, the ids of the queries that have at
+        least one nucleotide counted at each reference will be stored (in
+        C{self.queryIds}, a C{dict} keyed by reference id, with C{set}
+        values).
+    @param minBaseQuality: If not C{None}, the C{int} minimum quality of a
+        query nucleotide for it to be counted. Query nucleotides with no
+        quality (i.e., from a query with a '*' quality string) are always
+        counted.
+    @param ignoreOrphans: If C{True}, ignore alignments of queries that are
+        paired but not mapped in a proper pair (as C{pileup} does).
+    @param ignoreOverlaps: If C{True}, adjust the qualities of the
+        nucleotides of overlapping mates of a proper pair as C{pileup} does
+        (see C{overlappingMateQualities}), so that (with a C{minBaseQuality}
+        greater than zero) only one mate is counted where they overlap.
+    @param batchSize: The C{int} number of alignments to collect before
+        adding their nucleotides to the counts.
+    """
+    ALPHABET = _BASE_COUNT_ALPHABET
+
+    def __init__(self, samFilter, storeQueryIds=False, minBaseQuality=None,
+                 ignoreOrphans=False, ignoreOverlaps=False, batchSize=5000):
+        self.samFilter = samFilter
+        self.minBaseQuality = minBaseQuality
+        self.ignoreOrphans = ignoreOrphans
+        self.ignoreOverlaps = ignoreOverlaps
+        self.referenceLengths = samFilter.referenceLengths()
+        self.queryIds = (dict((referenceId, set())
+                              for referenceId in self.referenceLengths)
+                         if storeQueryIds else None)
+
+        # The counts for all references are kept in one array, with each
+        # reference's sites at an offset into it.
+        width = len(self.ALPHABET)
+        offsets = {}
+        total = 0
+        for referenceId, length in self.referenceLengths.items():
+            offsets[referenceId] = total
+            total += length
+        counts = np.zeros((total, width), dtype=np.int64)
+        # The change in the number of alignments spanning each site.
+        spans = np.zeros(total + 1, dtype=np.int64)
+        self._count(counts.reshape(-1), spans, offsets, batchSize)
+        spans = np.cumsum(spans[:-1])
+
+        self.counts = {}
+        self._spans = {}
+        for referenceId, offset in offsets.items():
+            end = offset + self.referenceLengths[referenceId]
+            self.counts[referenceId] = counts[offset:end]
+            self._spans[referenceId] = spans[offset:end]
+
+    def _count(self, counts, spans, offsets, batchSize):
+        """
+        Read the alignments and count their nucleotides and deletions.
+
+        @param counts: A flattened C{np.ndarray} with C{len(self.ALPHABET)}
+            counts for each site of all references.
+        @param spans: A C{np.ndarray} in which to record the change in the
+            number of alignments spanning each site of all references (plus
+            one extra element).
+        @param offsets: A C{dict} mapping C{str} reference ids to the C{int}
+            site offset of each reference in C{counts}.
+        @param batchSize: The C{int} number of alignments to collect before
+            adding to C{counts}.
+        """
+        width = len(self.ALPHABET)
+        referenceLengths = self.referenceLengths
+        queryIds = self.queryIds
+        minBaseQuality = self.minBaseQuality
+        ignoreOrphans = self.ignoreOrphans
+        ignoreOverlaps = self.ignoreOverlaps and minBaseQuality is not None
+        chunks = []
+        qualityChunks = []
+        starts = []
+        lengths = []
+        # The index (in batchQueries) of the query of each block.
+        blockQueries = []
+        batchQueries = []
+        gapStarts = []
+        gapLengths = []
+        spanStarts = []
+        spanEnds = []
+        # Alignments whose mate may still be read and overlap them, keyed
+        # by query id. These are added once their mate is seen.
+        waiting = {}
+
+        def addBatch():
+            if starts:
+                rows = _BASE_COUNT_ROWS[
+                    np.frombuffer(''.join(chunks).encode('latin-1'),
+                                  dtype=np.uint8)]
+                indices = _blockIndices(starts, lengths, rows, width)
+                blockLengths = np.array(lengths, dtype=np.intp)
+                if minBaseQuality is None:
+                    counted = np.array(blockQueries, dtype=np.intp)
+                else:
+                    qualities = np.frombuffer(b''.join(qualityChunks),
+                                              dtype=np.uint8)
+                    wanted = qualities >= minBaseQuality
+                    indices = indices[wanted]
+                    counted = np.repeat(
+                        np.array(blockQueries, dtype=np.intp),
+                        blockLengths)[wanted]
+                _addToCounts(counts, indices)
+                if queryIds is not None:
+                    for index in np.unique(counted):
+                        referenceId, queryId = batchQueries[index]
+                        queryIds[referenceId].add(queryId)
+            if gapStarts:
+                _addToCounts(counts, _blockIndices(gapStarts, gapLengths,
+                                                   _GAP_ROW, width))
+            if spanStarts:
+                np.add.at(spans, spanStarts, 1)
+                np.add.at(spans, spanEnds, -1)
+            del chunks[:], qualityChunks[:], starts[:], lengths[:]
+            del blockQueries[:], batchQueries[:], gapStarts[:], gapLengths[:]
+            del spanStarts[:], spanEnds[:]
+
+        def add(alignment, quality=None):
+            referenceId = alignment.reference_name
+            offset = offsets[referenceId]
+            referenceLength = referenceLengths[referenceId]
+            query = alignment.query_sequence
+            if minBaseQuality is not None:
+                if quality is None:
+                    quality = alignment.query_qualities
+                # A query with no quality has all nucleotides counted.
+                quality = (b'\xff' * len(query) if quality is None else
+                           np.asarray(quality, dtype=np.uint8).tobytes())
+            queryIndex = len(batchQueries)
+            batchQueries.append((referenceId, alignment.query_name))
+            queryOffset = 0
+            site = alignment.reference_start
+
+            for operation, length in alignment.cigartuples:
+                if operation in _MATCHES:
+                    # Ignore any part of the query that runs off the end of
+                    # the reference.
+                    end = min(length, referenceLength - site)
+                    if end > 0:
+                        chunks.append(query[queryOffset:queryOffset + end])
+                        if minBaseQuality is not None:
+                            qualityChunks.append(
+                                quality[queryOffset:queryOffset + end])
+                        starts.append(offset + site)
+                        lengths.append(end)
+                        blockQueries.append(queryIndex)
+                    queryOffset += length
+                    site += length
+                elif operation == CDEL:
+                    end = min(length, referenceLength - site)
+                    if end > 0:
+                        gapStarts.append(offset + site)
+                        gapLengths.append(end)
+                    site += length
+                elif operation == CREF_SKIP:
+                    site += length
+                elif operation in _CONSUMES_QUERY:
+                    queryOffset += length
+
+            end = min(site, referenceLength)
+            if end > alignment.reference_start:
+                spanStarts.append(offset + alignment.reference_start)
+                spanEnds.append(offset + end)
+
+        for count, alignment in enumerate(self.samFilter.alignments()):
+            if count % batchSize == 0:
+                addBatch()
+
+            if (alignment.is_unmapped or not alignment.cigartuples or
+                    alignment.reference_name not in offsets or
+                    (ignoreOrphans and alignment.is_paired and
+                     not alignment.is_proper_pair)):
+                continue
+
+            if ignoreOverlaps and mateMayOverlap(alignment):
+                queryId = alignment.query_name
+                mate = waiting.pop(queryId, None)
+                if mate is not None:
+                    mateQuality, quality = overlappingMateQualities(
+                        mate, alignment)
+                    add(mate, mateQuality)
+                    add(alignment, quality)
+                    continue
+                elif (alignment.next_reference_start >=
+                      alignment.reference_start or
+                      alignment.next_reference_start == -1):
+                    waiting[queryId] = alignment
+                    continue
+
+            add(alignment)
+
+        # Add the alignments whose mate was never seen.
+        for alignment in waiting.values():
+            add(alignment)
+
+        addBatch()
+
+    def depth(self, referenceId, includeDeletions=False):
+        """
+        Get the coverage depth at each site of a reference.
+
+        @param referenceId: The C{str} id of a reference.
+        @param includeDeletions: If C{True}, include alignments that have a
+            deletion at a site in its depth.
+        @return: A C{np.ndarray} of C{int} depths, one per reference site.
+        """
+        counts = self.counts[referenceId]
+        return (counts if includeDeletions else counts[:, :_GAP_ROW]).sum(
+            axis=1)
+
+    def coveredSites(self, referenceId):
+        """
+        Get the sites of a reference that are covered by at least one
+        alignment. As in a C{pileup}, a site is covered if it is anywhere
+        from the start to the end of an alignment, even if the alignment has
+        a deletion or skip there or its nucleotide there is not counted (due
+        to C{minBaseQuality}).
+
+        @param referenceId: The C{str} id of a reference.
+        @return: A C{np.ndarray} of the C{int} 0-based covered sites, in
+            increasing order.
+        """
+        return self._spans[referenceId].nonzero()[0]
+
+    def baseCounts(self, referenceId, site):
+        """
+        Get the nucleotide counts at a reference site.
+
+        @param referenceId: The C{str} id of a reference.
+        @param site: The C{int} 0-based site.
+        @return: A C{Counter} with the count of each nucleotide (but not
+            deletions) at the site, omitting nucleotides not found there.
+        """
+        return Counter(dict(
+            (base, int(count)) for base, count in zip(
+                self.ALPHABET[:_GAP_ROW],
+                self.counts[referenceId][site, :_GAP_ROW]) if count))
+
+
+class _DepthFilter(object):
+    """
+    Give C{SAMBaseCounts} the alignments seen by a C{SAMStats} instance,
+    omitting secondary and duplicate alignments (as samtools does when
+    computing depth).
+
+    @param samFilter: The C{SAMFilter} instance in use.
+    @param alignments: An iterable of pysam alignment instances.
+    """
+    def __init__(self, samFilter, alignments):
+        self._samFilter = samFilter
+        self._alignments = alignments
+
+    def referenceLengths(self):
+        """
+        Get the lengths of the references of the C{SAMFilter}.
+
+        @return: A C{dict} of C{int} lengths, keyed by C{str} reference id.
+        """
+        return self._samFilter.referenceLengths()
+
+    def alignments(self):
+        """
+        Get the alignments to count.
+
+        @return: A generator of pysam alignment instances.
+        """
+        return (alignment for alignment in self._alignments
+                if not (alignment.is_secondary or alignment.is_duplicate))
+
+
+class SAMStats(object):
+    """
+    Compute statistics for a SAM/BAM file in one pass, optionally caching
+    them in a sidecar file next to it so later uses can skip the pass.
+
+    The statistics are the number of reads (distinct query ids) in the
+    file, how many of these are mapped and unmapped, the number of reads
+    in each of the categories in C{CATEGORIES} for each reference that has
+    mapped reads, the number of reads with a nucleotide aligned to each
+    reference, and a histogram of the coverage depth of each reference.
+    The depth (computed by C{SAMBaseCounts}) ignores secondary and duplicate
+    alignments.
+
+    The sidecar file name contains a hash of a key made from the filtering
+    options of C{samFilter}, C{filterKey} and the coverage options, so
+    statistics computed with different options do not overwrite each
+    other. The cache is only used if the size and modification time of the
+    SAM/BAM file are unchanged.
+
+    @param samFilter: A C{SAMFilter} instance, used to read and filter the
+        alignments.
+    @param filterKey: A C{str} describing the filtering done by the
+        C{filterRead} or C{filterQuery} function of C{samFilter} (see
+        C{dark.filter.filteringCommandLineOptionsKey}). If C{samFilter} has
+        one of those functions and C{filterKey} is C{None}, the statistics
+        are not cached (because the cache key cannot describe them).
+    @param minBaseQuality: If not C{None}, the C{int} minimum quality of a
+        query nucleotide for it to count towards coverage depth.
+    @param ignoreOrphans: If C{True}, ignore alignments of queries that are
+        paired but not mapped in a proper pair when computing coverage.
+    @param ignoreOverlaps: If C{True}, only count one of the mates of a
+        proper pair where they overlap when computing coverage depth (see
+        C{SAMBaseCounts}).
+    @param useCache: If C{True}, read the statistics from the sidecar file
+        if it is up to date, otherwise compute them and (try to) write the
+        sidecar file.
+    """
+    CATEGORIES = ('readIds', 'primary', 'secondary', 'supplementary',
+                  'duplicate', 'nonDuplicate', 'qcFail')
+    VERSION = 2
+
+    def __init__(self, samFilter, filterKey=None, minBaseQuality=None,
+                 ignoreOrphans=False, ignoreOverlaps=False, useCache=True):
+        self.samFilter = samFilter
+        self.minBaseQuality = minBaseQuality
+        self.ignoreOrphans = ignoreOrphans
+        self.ignoreOverlaps = ignoreOverlaps
+        self.fromCache = False
+
+        cacheable = useCache and (
+            filterKey is not None or
+            (samFilter.filterRead is None and samFilter.filterQuery is None))
+
+        if cacheable:
+            key = self._key(filterKey)
+            self.cacheFilename = '%s.%s.dark-stats.npz' % (
+                samFilter.filename,
+                md5(key.encode('utf-8')).hexdigest()[:12])
+            self.fromCache = self._load(key)
+        else:
+            self.cacheFilename = None
+
+        if not self.fromCache:
+            self._compute()
+            if cacheable:
+                self._save(key)
+
+    def _key(self, filterKey):
+        """
+        Make a key describing the options the statistics are computed with.
+
+        @param filterKey: A C{str} describing query filtering, or C{None}.
+        @return: A C{str} key.
+        """
+        samFilter = self.samFilter
+        return json.dumps({
+            'filterKey': filterKey,
+            'minBaseQuality': self.minBaseQuality,
+            'ignoreOrphans': self.ignoreOrphans,
+            'ignoreOverlaps': self.ignoreOverlaps,
+            'referenceIds': (None if samFilter.referenceIds is None else
+                             sorted(samFilter.referenceIds)),
+            'dropUnmapped': samFilter.dropUnmapped,
+            'dropSecondary': samFilter.dropSecondary,
+            'dropSupplementary': samFilter.dropSupplementary,
+            'dropDuplicates': samFilter.dropDuplicates,
+            'keepQCFailures': samFilter.keepQCFailures,
+            'minScore': samFilter.minScore,
+            'maxScore': samFilter.maxScore,
+            'scoreTag': samFilter.scoreTag,
+            'version': self.VERSION,
+        }, sort_keys=True)
+
+    def _fileInfo(self):
+        """
+        Get the size and modification time of the SAM/BAM file.
+
+        @return: A C{list} with the C{int} size and C{float} modification
+            time of the file.
+        """
+        stat = os.stat(self.samFilter.filename)
+        return [stat.st_size, stat.st_mtime]
+
+    def _compute(self):
+        """
+        Read the SAM/BAM file and compute the statistics.
+        """
+        readIndex = {}
+        mapped = set()
+        unmapped = set()
+        referenceReads = {}
+        categories = self.CATEGORIES
+
+        def tally():
+            for alignment in self.samFilter.alignments():
+                id_ = alignment.query_name
+                try:
+                    index = readIndex[id_]
+                except KeyError:
+                    index = readIndex[id_] = len(readIndex)
+
+                if alignment.is_unmapped:
+                    unmapped.add(index)
+                else:
+                    mapped.add(index)
+                    referenceId = alignment.reference_name
+                    try:
+                        reads = referenceReads[referenceId]
+                    except KeyError:
+                        reads = referenceReads[referenceId] = dict(
+                            (category, set()) for category in categories)
+
+                    reads['readIds'].add(index)
+
+                    if alignment.is_secondary:
+                        reads['secondary'].add(index)
+                    elif alignment.is_supplementary:
+                        reads['supplementary'].add(index)
+                    else:
+                        reads['primary'].add(index)
+
+                    if alignment.is_duplicate:
+                        reads['duplicate'].add(index)
+                    else:
+                        reads['nonDuplicate'].add(index)
+
+                    if alignment.is_qcfail:
+                        reads['qcFail'].add(index)
+
+                yield alignment
+
+        baseCounts = SAMBaseCounts(_DepthFilter(self.samFilter, tally()),
+                                   storeQueryIds=True,
+                                   minBaseQuality=self.minBaseQuality,
+                                   ignoreOrphans=self.ignoreOrphans,
+                                   ignoreOverlaps=self.ignoreOverlaps)
+
+        self.referenceLengths = baseCounts.referenceLengths
+        self.readCount = len(readIndex)
+        self.mappedCount = len(mapped)
+        self.unmappedCount = len(unmapped)
+        self.referenceReadCounts = dict(
+            (referenceId, dict((category, len(reads[category]))
+                               for category in categories))
+            for referenceId, reads in referenceReads.items())
+        self._readIndices = dict(
+            (referenceId, np.array(sorted(reads['readIds']), dtype=np.int64))
+            for referenceId, reads in referenceReads.items())
+        self.coveringReadCounts = dict(
+            (referenceId, len(queryIds))
+            for referenceId, queryIds in baseCounts.queryIds.items())
+
+        self.depthHistograms = {}
+        for referenceId in self.referenceLengths:
+            self.depthHistograms[referenceId] = np.bincount(
+                baseCounts.depth(referenceId)[
+                    baseCounts.coveredSites(referenceId)], minlength=1)
+
+        # Query ids, ordered by index.
+        self._readIds = [None] * len(readIndex)
+        for id_, index in readIndex.items():
+            self._readIds[index] = id_
+
+    def _save(self, key):
+        """
+        Write the statistics to the cache file. Errors (e.g., due to the
+        SAM/BAM file being in a directory that cannot be written) are
+        ignored, as the cache is only an optimization.
+
+        @param key: The C{str} key of the statistics options.
+        """
+        mappedReferenceIds = sorted(self._readIndices)
+        referenceIds = sorted(self.depthHistograms)
+        metadata = {
+            'coveringReadCounts': self.coveringReadCounts,
+            'fileInfo': self._fileInfo(),
+            'key': key,
+            'mappedCount': self.mappedCount,
+            'mappedReferenceIds': mappedReferenceIds,
+            'readCount': self.readCount,
+            'referenceIds': referenceIds,
+            'referenceLengths': self.referenceLengths,
+            'referenceReadCounts': self.referenceReadCounts,
+            'unmappedCount': self.unmappedCount,
+        }
+
+        def concatenate(arrays):
+            offsets = np.cumsum([0] + [len(array) for array in arrays])
+            return (np.concatenate(arrays) if arrays else
+                    np.zeros(0, dtype=np.int64)), offsets
+
+        readIndices, readIndexOffsets = concatenate(
+            [self._readIndices[referenceId]
+             for referenceId in mappedReferenceIds])
+        histograms, histogramOffsets = concatenate(
+            [self.depthHistograms[referenceId]
+             for referenceId in referenceIds])
+
+        # Write to a temporary file first, so a partially written cache file
+        # is never read.
+        tmpFilename = '%s.%d.tmp.npz' % (self.cacheFilename, os.getpid())
+        try:
+            with open(tmpFilename, 'wb') as fp:
+                np.savez(
+                    fp,
+                    metadata=np.frombuffer(
+                        json.dumps(metadata).encode('utf-8'), dtype=np.uint8),
+                    readIds=np.frombuffer(
+                        '\n'.join(self._readIds).encode('utf-8'),
+                        dtype=np.uint8),
+                    readIndices=readIndices,
+                    readIndexOffsets=readIndexOffsets,
+                    histograms=histograms,
+                    histogramOffsets=histogramOffsets)
+            os.rename(tmpFilename, self.cacheFilename)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmpFilename)
+            except OSError:
+                pass
+
+    def _load(self, key):
+        """
+        Read the statistics from the cache file, if it is up to date.
+
+        @param key: The C{str} key of the statistics options.
+        @return: C{True} if the statistics were read, else C{False}.
+        """
+        try:
+            with np.load(self.cacheFilename, allow_pickle=False) as data:
+                metadata = json.loads(data['metadata'].tobytes().decode(
+                    'utf-8'))
+                if (metadata['key'] != key or
+                        metadata['fileInfo'] != self._fileInfo()):
+                    return False
+                readIds = data['readIds'].tobytes()
+                readIndices = data['readIndices']
+                readIndexOffsets = data['readIndexOffsets']
+                histograms = data['histograms']
+                histogramOffsets = data['histogramOffsets']
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+
+        self.referenceLengths = metadata['referenceLengths']
+        self.readCount = metadata['readCount']
+        self.mappedCount = metadata['mappedCount']
+        self.unmappedCount = metadata['unmappedCount']
+        self.referenceReadCounts = metadata['referenceReadCounts']
+        self.coveringReadCounts = metadata['coveringReadCounts']
+        self._readIndices = dict(
+            (referenceId, readIndices[start:end]) for referenceId, start, end
+            in zip(metadata['mappedReferenceIds'], readIndexOffsets,
+                   readIndexOffsets[1:]))
+        self.depthHistograms = dict(
+            (referenceId, histograms[start:end]) for referenceId, start, end
+            in zip(metadata['referenceIds'], histogramOffsets,
+                   histogramOffsets[1:]))
+        self._readIds = readIds.decode('utf-8').split('\n') if readIds else []
+        return True
+
+    def readIndices(self, referenceId):
+        """
+        Get the indices of the reads mapped to a reference.
+
+        @param referenceId: The C{str} id of a reference.
+        @return: A sorted C{np.ndarray} of the C{int} indices of the reads
+            mapped to the reference (empty if there are none). Use
+            C{readIds} to convert indices to read ids.
+        """
+        return self._readIndices.get(referenceId,
+                                     np.zeros(0, dtype=np.int64))
+
+    def readIds(self, indices):
+        """
+        Convert read indices to read ids.
+
+        @param indices: An iterable of C{int} read indices.
+        @return: A C{list} of C{str} read ids.
+        """
+        readIds = self._readIds
+        return [readIds[index] for index in indices]
+
+    def depths(self, referenceId):
+        """
+        Get the coverage depths of the sites of a reference that are
+        covered by at least one alignment (see
+        C{SAMBaseCounts.coveredSites}).
+
+        @param referenceId: The C{str} id of a reference.
+        @return: A sorted C{np.ndarray} of C{int} depths, one per site
+            covered by an alignment.
+        """
+        histogram = self.depthHistograms[referenceId]
+        return np.repeat(np.arange(len(histogram)), histogram)
@@ -9,6 +9,8 @@ class HigherIsBetterScore(object):
 
     @param score: The numeric score of this HSP.
     """
+    __slots__ = ('score',)
+
     def __init__(self, score):
         self.score = score
 
@@ -36,6 +38,8 @@ class LowerIsBetterScore(object):
 
     @param score: The numeric score of this LSP.
     """
+    __slots__ = ('score',)
+
     def __init__(self, score):
         self.score = score
 
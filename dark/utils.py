@@ -2,15 +2,45 @@ from __future__ import division
 
 import os
 import re
+import codecs
 import string
 import six
 import bz2
 import gzip
+import multiprocessing
 from os.path import basename
+from collections import deque
 from contextlib import contextmanager
+from hashlib import md5
 from re import compile
 import numpy as np
 
+try:
+    from xxhash import xxh3_128_intdigest
+except ImportError:
+    try:
+        from hashlib import blake2b
+    except ImportError:
+        # Python 2 has no BLAKE2.
+        def xxh3_128_intdigest(data):
+            return int(md5(data).hexdigest(), 16)
+    else:
+        def xxh3_128_intdigest(data):
+            """
+            Make a 128-bit hash of some data, for use when the xxhash module
+            is not installed.
+
+            @param data: The C{bytes} to hash.
+            @return: The C{int} value of the 16-byte BLAKE2b digest of
+                C{data}, so the result has the same type as the xxhash
+                function it replaces.
+            """
+            return int.from_bytes(blake2b(data, digest_size=16).digest(),
+                                  'big')
+
+# The default number of bytes to read at a time in textChunks (below).
+DEFAULT_BUFFER_SIZE = 1 << 20
+
 
 def numericallySortFilenames(names):
     """
@@ -112,12 +142,22 @@ def asHandle(fileNameOrHandle, mode='rt', encoding='UTF-8'):
     Based on L{Bio.File.as_handle}.
 
     @param fileNameOrHandle: Either a C{str} or a file handle.
-    @param mode: The C{str} mode to use for opening the file.
+    @param mode: The C{str} mode to use for opening the file. If this
+        contains 'b' the file will be opened in binary mode and
+        C{encoding} will be ignored.
     @param encoding: The C{str} encoding to use when opening the file.
     @return: A generator that can be turned into a context manager via
         L{contextlib.contextmanager}.
     """
-    if isinstance(fileNameOrHandle, six.string_types):
+    if isinstance(fileNameOrHandle, six.string_types) and 'b' in mode:
+        if fileNameOrHandle.endswith('.gz'):
+            yield gzip.open(fileNameOrHandle, mode=mode)
+        elif fileNameOrHandle.endswith('.bz2'):
+            yield bz2.open(fileNameOrHandle, mode=mode)
+        else:
+            with open(fileNameOrHandle, mode) as fp:
+                yield fp
+    elif isinstance(fileNameOrHandle, six.string_types):
         if fileNameOrHandle.endswith('.gz'):
             if six.PY3:
                 yield gzip.open(fileNameOrHandle, mode=mode, encoding=encoding)
@@ -137,6 +177,76 @@ def asHandle(fileNameOrHandle, mode='rt', encoding='UTF-8'):
         yield fileNameOrHandle
 
 
+def textChunks(fp, bufferSize=DEFAULT_BUFFER_SIZE, encoding='UTF-8'):
+    """
+    Read a file in large chunks, decoding them to C{str} if the file is
+    open in binary mode.
+
+    @param fp: An open file handle, in either text or binary mode.
+    @param bufferSize: The C{int} number of bytes (or characters) to read
+        at a time.
+    @param encoding: The C{str} encoding to use if C{fp} returns C{bytes}.
+        An incremental decoder is used, so multi-byte characters that
+        straddle a chunk boundary are handled correctly.
+    @return: A generator that yields non-empty C{str} chunks.
+    """
+    decoder = None
+    while True:
+        data = fp.read(bufferSize)
+        if not data:
+            break
+        if isinstance(data, bytes):
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder(encoding)()
+            data = decoder.decode(data)
+            if not data:
+                continue
+        yield data
+
+    if decoder is not None:
+        data = decoder.decode(b'', final=True)
+        if data:
+            yield data
+
+
+# The names of the hash functions known to stringHashFunction (below).
+HASH_FUNCTIONS = ('md5', 'fast64', 'fast128')
+
+
+def stringHashFunction(hashFunction):
+    """
+    Get a function that hashes strings, for use when storing hashes (e.g.,
+    when looking for duplicate sequences) instead of the strings themselves
+    saves memory.
+
+    @param hashFunction: Either a function that takes a C{str} and returns a
+        hashable value, or one of the C{str} names in C{HASH_FUNCTIONS}:
+
+            'md5': the 16-byte MD5 digest of the string. This is slow.
+            'fast64': Python's built-in (64-bit on 64-bit platforms) string
+                hash. This is very fast (and is cached on the string) but
+                has a small chance of collisions on very large inputs.
+                The hash values differ between Python processes.
+            'fast128': a 128-bit C{int} XXH3 hash if the xxhash module
+                is installed, else a 128-bit C{int} BLAKE2b hash (which is
+                only a little faster than MD5).
+
+    @raise ValueError: If C{hashFunction} is an unknown name.
+    @return: A function that takes a C{str} and returns its hash.
+    """
+    if callable(hashFunction):
+        return hashFunction
+    elif hashFunction == 'md5':
+        return lambda s: md5(s.encode('UTF-8')).digest()
+    elif hashFunction == 'fast64':
+        return hash
+    elif hashFunction == 'fast128':
+        return lambda s: xxh3_128_intdigest(s.encode('UTF-8'))
+    else:
+        raise ValueError('Unknown hash function %r. Known hash functions: '
+                         '%s.' % (hashFunction, ', '.join(HASH_FUNCTIONS)))
+
+
 _rangeRegex = compile(r'^\s*(\d+)(?:\s*-\s*(\d+))?\s*$')
 
 
@@ -366,3 +476,61 @@ def take(iterator, n):
             if len(items) == n:
                 yield items
                 items = []
+
+
+def orderedPoolMap(function, items, workers, initializer=None, initargs=(),
+                   inFlight=None):
+    """
+    Apply a function to items in a pool of worker processes, yielding the
+    results in the order of the items.
+
+    Items are taken from C{items} only as they are needed, and only
+    C{inFlight} of them are given to the pool at a time, so neither the
+    input nor the results pile up in memory when the workers (or the
+    caller) are slow. Where possible, worker processes are started by
+    forking, so C{function} and C{initializer} (which must be module-level
+    functions) can rely on global state set up before the call. When the
+    generator finishes, raises, or is closed, the pool is terminated and
+    its processes are waited for.
+
+    @param function: A function of one argument, to call on each item in a
+        worker process. Its result must be picklable.
+    @param items: An iterable of picklable items.
+    @param workers: The C{int} number of worker processes to use.
+    @param initializer: If not C{None}, a function to call (with
+        C{initargs}) when each worker process starts.
+    @param initargs: A C{tuple} of arguments for C{initializer}.
+    @param inFlight: The C{int} maximum number of items to have given to the
+        pool at once whose results have not been yielded. If C{None}, twice
+        the number of workers.
+    @return: A generator that yields (item, result) 2-tuples, in the order
+        of C{items}.
+    """
+    try:
+        context = multiprocessing.get_context('fork')
+    except (AttributeError, ValueError):
+        # Python 2 (which always forks, where it can), or a platform that
+        # cannot fork.
+        context = multiprocessing
+
+    if inFlight is None:
+        inFlight = 2 * workers
+
+    items = iter(items)
+    pending = deque()
+    pool = context.Pool(processes=workers, initializer=initializer,
+                        initargs=initargs)
+
+    try:
+        while True:
+            for item in items:
+                pending.append((item, pool.apply_async(function, (item,))))
+                if len(pending) >= inFlight:
+                    break
+            if not pending:
+                break
+            item, result = pending.popleft()
+            yield item, result.get()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -39,6 +39,7 @@ scripts = [
     'bin/convert-diamond-to-json.py',
     'bin/convert-diamond-to-sam.py',
     'bin/convert-sam-to-fastq.sh',
+    'bin/convert-to-alignment-store.py',
     'bin/create-newick-relabeling-output.py',
     'bin/dark-matter-version.py',
     'bin/describe-protein-database.py',
@@ -147,4 +148,8 @@ setup(name='dark-matter',
           'cachetools>=3.1.0',
           'simplejson>=3.5.3',
           'six>=1.11.0',
-      ])
+      ],
+      extras_require={
+          # A faster 'fast128' string hash (see dark.utils.HASH_FUNCTIONS).
+          'xxhash': ['xxhash>=1.0.0'],
+      })
@@ -5,6 +5,9 @@ import platform
 from six.moves import builtins
 from copy import deepcopy
 from json import dumps
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
 from unittest import TestCase, skip
 import sqlite3
 
@@ -1547,3 +1550,122 @@ class TestBlastReadsAlignmentsFiltering(TestCase):
             readsAlignments = BlastReadsAlignments(reads, 'file.json')
             result = list(readsAlignments.filter(readIdRegex='^ID0$'))
             self.assertEqual(0, len(result))
+
+
+class TestBlastReadsAlignmentsConcurrent(TestCase):
+    """
+    Test reading BLAST files concurrently.
+    """
+    def setUp(self):
+        self.tempdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def writeFile(self, name, params, records):
+        """
+        Write a JSON BLAST file.
+
+        @param name: The C{str} name of the file.
+        @param params: A C{dict} of BLAST parameters.
+        @param records: A C{list} of BLAST record C{dict}s.
+        @return: The C{str} path to the file.
+        """
+        filename = join(self.tempdir, name)
+        with open(filename, 'w') as fp:
+            for item in [params] + records:
+                fp.write(dumps(item) + '\n')
+        return filename
+
+    def makeReads(self, count):
+        """
+        Make reads whose ids match the sample data records.
+
+        @param count: The C{int} number of reads to make.
+        @return: A C{Reads} instance.
+        """
+        return Reads([Read('id%d' % i, 'A' * 70) for i in range(count)])
+
+    def testReadsPerFileRequired(self):
+        """
+        If fileWorkers is more than one and there are several files,
+        readsPerFile must be given.
+        """
+        filenames = [self.writeFile('0.json', PARAMS, [RECORD0]),
+                     self.writeFile('1.json', PARAMS, [RECORD1])]
+        error = ('^readsPerFile must be given if fileWorkers is more than '
+                 'one\\.$')
+        self.assertRaisesRegex(ValueError, error, BlastReadsAlignments,
+                               self.makeReads(2), filenames, fileWorkers=2)
+
+    def testConcurrent(self):
+        """
+        Reading files concurrently must give the same result as reading them
+        one after another.
+        """
+        filenames = [
+            self.writeFile('0.json', PARAMS, [RECORD0, RECORD1]),
+            self.writeFile('1.json', PARAMS, [RECORD2, RECORD3]),
+            self.writeFile('2.json', PARAMS, [RECORD4]),
+        ]
+
+        def summary(**kwargs):
+            readsAlignments = BlastReadsAlignments(
+                self.makeReads(5), filenames, **kwargs)
+            return [(readAlignments.read.id,
+                     [(alignment.subjectTitle,
+                       [hsp.toDict() for hsp in alignment.hsps])
+                      for alignment in readAlignments])
+                    for readAlignments in readsAlignments]
+
+        expected = summary()
+        self.assertEqual(['id0', 'id1', 'id2', 'id3', 'id4'],
+                         [readId for readId, _ in expected])
+        self.assertEqual(expected, summary(fileWorkers=2, readsPerFile=2))
+        self.assertEqual(expected,
+                         summary(fileWorkers=3, readsPerFile=[2, 2, 1]))
+
+    def testWrongNumberOfReadsPerFile(self):
+        """
+        If readsPerFile is a list whose length is not the number of files,
+        a ValueError must be raised.
+        """
+        filenames = [self.writeFile('0.json', PARAMS, [RECORD0]),
+                     self.writeFile('1.json', PARAMS, [RECORD1])]
+        readsAlignments = BlastReadsAlignments(
+            self.makeReads(2), filenames, fileWorkers=2, readsPerFile=[1])
+        error = ('^The number of reads per file was given for 1 file, but '
+                 'there are 2 files\\.$')
+        self.assertRaisesRegex(ValueError, error, list, readsAlignments)
+
+    def testTooManyReadsForFile(self):
+        """
+        If a file has fewer records than the number of reads given for it, a
+        ValueError must be raised.
+        """
+        filenames = [self.writeFile('0.json', PARAMS, [RECORD0]),
+                     self.writeFile('1.json', PARAMS, [RECORD1, RECORD2])]
+        readsAlignments = BlastReadsAlignments(
+            self.makeReads(3), filenames, fileWorkers=2, readsPerFile=2)
+        error = ("^Only 1 of the 2 reads given for file '.*0\\.json' have a "
+                 "record in it\\. First unused read id is 'id1'\\.$")
+        self.assertRaisesRegex(ValueError, error, list, readsAlignments)
+
+    def testIncompatibleParams(self):
+        """
+        If a file has BLAST parameters that are not compatible with those of
+        the first file, a ValueError must be raised before any of its
+        alignments are yielded.
+        """
+        params = deepcopy(PARAMS)
+        params['sc_match'] = 100
+        filenames = [self.writeFile('0.json', PARAMS, [RECORD0]),
+                     self.writeFile('1.json', params, [RECORD1])]
+        readsAlignments = BlastReadsAlignments(
+            self.makeReads(2), filenames, fileWorkers=2, readsPerFile=1)
+        result = []
+        error = '^Incompatible BLAST parameters found\\.'
+        with self.assertRaisesRegex(ValueError, error):
+            for readAlignments in readsAlignments:
+                result.append(readAlignments.read.id)
+        self.assertEqual(['id0'], result)
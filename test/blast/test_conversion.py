@@ -7,7 +7,11 @@ except ImportError:
     from mock import patch
 
 from json import dumps
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
 
+from dark.alignment_store import AlignmentStore
 from dark.blast.conversion import XMLRecordsReader, JSONRecordsReader
 from dark.reads import Reads, DNARead
 
@@ -163,6 +167,30 @@ class TestXMLRecordsReader(TestCase):
             self.assertEqual(0, len(record1.alignments))
             self.assertEqual(2, len(record2.alignments))
 
+    def testSaveAsAlignmentStore(self):
+        """
+        BLAST XML must be saved correctly as an alignment store.
+        """
+        tempdir = mkdtemp()
+        try:
+            xmlFilename = join(tempdir, 'file.xml')
+            storeFilename = join(tempdir, 'file.alignments.npz')
+            with open(xmlFilename, 'w') as fp:
+                fp.write(RECORD)
+            reader = XMLRecordsReader(xmlFilename)
+            self.assertEqual(2, reader.saveAsAlignmentStore(storeFilename))
+            store = AlignmentStore(storeFilename)
+            record1, record2 = list(store.records())
+            store.close()
+        finally:
+            rmtree(tempdir)
+
+        self.assertEqual('BLASTN', store.params['application'])
+        self.assertEqual([], record1['alignments'])
+        self.assertEqual(2, len(record2['alignments']))
+        hsp = record2['alignments'][0]['hsps'][0]
+        self.assertEqual(2, len(hsp['frame']))
+
 
 _JSON_RECORDS = [
     {
@@ -1,6 +1,14 @@
+from random import Random
 from unittest import TestCase
 
-from dark.blast.hsp import normalizeHSP
+from six import StringIO
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from dark.blast.hsp import normalizeHSP, normalizeHSPs
 
 
 class Frame(object):
@@ -920,3 +928,143 @@ class Old_ReadPositiveHitNegative(TestCase):
             'readStartInSubject': 1775,
             'readEndInSubject': 1925,
         }, normalized)
+
+
+class TestNormalizeHSPs(TestCase):
+    """
+    Property tests that normalizeHSPs gives the same results as
+    normalizeHSP.
+    """
+    def randomHSPs(self, count, seed, blastApplication):
+        """
+        Make random HSPs, many of which are valid and some of which will
+        fail normalizeHSP's sanity checks.
+
+        @param count: The C{int} number of HSPs to make.
+        @param seed: The C{int} random seed.
+        @param blastApplication: The C{str} BLAST program.
+        @return: A C{list} of (hsp, readLen) 2-tuples.
+        """
+        random = Random(seed)
+        result = []
+        for _ in range(count):
+            readLen = random.randint(2, 300)
+            frame = Frame(random.choice((-3, -2, -1, 1, 2, 3)),
+                          random.choice((-3, -2, -1, 1, 2, 3)))
+            readStart, readEnd = sorted(
+                random.sample(range(1, readLen + 1), 2))
+            if random.random() < 0.05:
+                readStart, readEnd = readEnd, readStart
+            elif random.random() < 0.05:
+                # Exercise the division of negative offsets for blastx.
+                readStart = 0
+            readGaps = random.choice((0, 0, 0, 1, 2))
+            hitGaps = random.choice((0, 0, 0, 1, 2))
+            if blastApplication == 'blastx':
+                matchLen = readEnd // 3 - (readStart - 1) // 3
+            else:
+                matchLen = readEnd - readStart + 1
+            subjectStart = random.randint(1, 100)
+            subjectEnd = (subjectStart + matchLen + readGaps - hitGaps - 1 +
+                          random.choice((0, 0, 0, -1, 1)))
+            if random.random() < 0.5:
+                subjectStart, subjectEnd = subjectEnd, subjectStart
+            hsp = FakeHSP(subjectStart, subjectEnd, readStart, readEnd,
+                          frame, hit='A-' * hitGaps, read='A-' * readGaps)
+            # normalizeHSP prints these when a sanity check fails.
+            hsp['bits'] = hsp['expect'] = None
+            result.append((hsp, readLen))
+        return result
+
+    def batch(self, hsps, blastApplication):
+        """
+        Normalize HSPs with normalizeHSPs.
+
+        @param hsps: A C{list} of (hsp, readLen) 2-tuples.
+        @param blastApplication: The C{str} BLAST program.
+        @return: A C{list} of C{dict}s, like those returned by normalizeHSP.
+        """
+        normalized = normalizeHSPs(
+            [hsp['query_start'] for hsp, _ in hsps],
+            [hsp['query_end'] for hsp, _ in hsps],
+            [hsp['sbjct_start'] for hsp, _ in hsps],
+            [hsp['sbjct_end'] for hsp, _ in hsps],
+            [hsp['frame'][0] for hsp, _ in hsps],
+            [hsp['frame'][1] for hsp, _ in hsps],
+            [readLen for _, readLen in hsps],
+            [hsp['query'].count('-') for hsp, _ in hsps],
+            [hsp['sbjct'].count('-') for hsp, _ in hsps],
+            blastApplication)
+        for values in normalized.values():
+            self.assertEqual('int64', values.dtype)
+        return [dict((key, int(normalized[key][index]))
+                     for key in normalized)
+                for index in range(len(hsps))]
+
+    def scalar(self, hsp, readLen, blastApplication):
+        """
+        Normalize an HSP with normalizeHSP, without its error output.
+
+        @param hsp: A C{FakeHSP} instance.
+        @param readLen: The C{int} read length.
+        @param blastApplication: The C{str} BLAST program.
+        @return: The C{dict} returned by normalizeHSP, or C{None} if it
+            raised an C{AssertionError}.
+        """
+        with patch('sys.stdout', new_callable=StringIO):
+            try:
+                return normalizeHSP(hsp, readLen, blastApplication)
+            except AssertionError:
+                return None
+
+    def testIdenticalResults(self):
+        """
+        For each HSP, normalizeHSPs must raise exactly when normalizeHSP
+        does and otherwise give identical results.
+        """
+        for blastApplication in 'blastn', 'blastx':
+            hsps = self.randomHSPs(2000, 1, blastApplication)
+            valid = 0
+            for hsp, readLen in hsps:
+                expected = self.scalar(hsp, readLen, blastApplication)
+                if expected is None:
+                    self.assertRaises(AssertionError, self.batch,
+                                      [(hsp, readLen)], blastApplication)
+                else:
+                    valid += 1
+                    self.assertEqual([expected],
+                                     self.batch([(hsp, readLen)],
+                                                blastApplication))
+            # Make sure both valid and invalid HSPs were checked.
+            self.assertTrue(0 < valid < len(hsps))
+
+    def testBatch(self):
+        """
+        A batch of valid HSPs must be normalized exactly as normalizeHSP
+        normalizes them one at a time.
+        """
+        hsps = [(hsp, readLen)
+                for hsp, readLen in self.randomHSPs(5000, 2, 'blastx')
+                if self.scalar(hsp, readLen, 'blastx')]
+        self.assertEqual(
+            [normalizeHSP(hsp, readLen, 'blastx') for hsp, readLen in hsps],
+            self.batch(hsps, 'blastx'))
+
+    def testBatchError(self):
+        """
+        If an HSP in a batch fails a sanity check, an AssertionError giving
+        the index of the HSP must be raised.
+        """
+        frame = Frame(1, 1)
+        hsps = [(FakeHSP(1, 4, 1, 4, frame), 4)] * 3
+        hsps[2] = (FakeHSP(1, 5, 1, 4, frame), 4)
+        error = ('^Including gaps, hit match length != Read match length '
+                 '\\(HSP 2\\)$')
+        self.assertRaisesRegex(AssertionError, error, self.batch, hsps,
+                               'blastn')
+
+    def testEmpty(self):
+        """
+        Normalizing no HSPs must give empty arrays.
+        """
+        self.assertEqual([], self.batch([], 'blastn'))
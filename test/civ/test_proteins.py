@@ -1,5 +1,5 @@
 from unittest import TestCase
-# from six import assertRaisesRegex
+from six import assertRaisesRegex
 
 from dark.civ.proteins import SqliteIndex, SqliteIndexWriter
 
@@ -38,3 +38,108 @@ class TestSqliteIndex(TestCase):
         self.assertEqual(1, db.proteinCount())
         writer.close()
         db.close()
+
+    def testGenomeLengthsEmpty(self):
+        """
+        An empty database must have no genome lengths.
+        """
+        writer = SqliteIndexWriter(':memory:')
+        db = SqliteIndex(writer._connection)
+        self.assertEqual([], list(db.genomeLengths()))
+        writer.close()
+        db.close()
+
+    def testGenomeLengths(self):
+        """
+        Genome lengths must be returned sorted by accession number.
+        """
+        writer = SqliteIndexWriter(':memory:')
+        for accession, length in ('NC2', 30), ('NC1', 20):
+            writer._connection.execute(
+                'INSERT INTO genomes(accession, organism, name, sequence, '
+                'length, proteinCount) VALUES (?, ?, ?, ?, ?, ?)',
+                (accession, 'organism', 'name', 'A' * length, length, 0))
+        db = SqliteIndex(writer._connection)
+        self.assertEqual([('NC1', 20), ('NC2', 30)], list(db.genomeLengths()))
+        writer.close()
+        db.close()
+
+    def testFindGenomes(self):
+        """
+        Many genomes must be found at once, without their sequences, and
+        genomes that are not in the database must not be in the result.
+        """
+        writer = SqliteIndexWriter(':memory:')
+        for accession, length in ('NC2', 30), ('NC1', 20):
+            writer._connection.execute(
+                'INSERT INTO genomes(accession, organism, name, sequence, '
+                'length, proteinCount) VALUES (?, ?, ?, ?, ?, ?)',
+                (accession, 'organism', 'name', 'A' * length, length, 0))
+        db = SqliteIndex(writer._connection)
+        genomes = db.findGenomes(['NC1', 'civ|GENBANK|P1|GENBANK|NC2|x',
+                                  'NC3'])
+        self.assertEqual({'NC1', 'NC2'}, set(genomes))
+        self.assertEqual(30, genomes['NC2']['length'])
+        self.assertNotIn('sequence', genomes['NC1'])
+        writer.close()
+        db.close()
+
+    def testFindGenomesColumns(self):
+        """
+        When columns are given to findGenomes, only those (and the accession)
+        must be returned.
+        """
+        writer = SqliteIndexWriter(':memory:')
+        writer._connection.execute(
+            'INSERT INTO genomes(accession, organism, name, sequence, '
+            'length, proteinCount) VALUES (?, ?, ?, ?, ?, ?)',
+            ('NC1', 'organism', 'name', 'AAA', 3, 0))
+        db = SqliteIndex(writer._connection)
+        self.assertEqual({'NC1': {'accession': 'NC1', 'length': 3}},
+                         db.findGenomes(['NC1'], columns=['length']))
+        writer.close()
+        db.close()
+
+    def testFindGenomesUnknownColumn(self):
+        """
+        Passing an unknown column name to findGenomes must result in a
+        ValueError.
+        """
+        writer = SqliteIndexWriter(':memory:')
+        db = SqliteIndex(writer._connection)
+        error = r'^Unknown genomes column name: xxx\.$'
+        assertRaisesRegex(self, ValueError, error, db.findGenomes, ['NC1'],
+                          columns=['xxx'])
+        writer.close()
+        db.close()
+
+    def testFindProteins(self):
+        """
+        Many proteins must be found at once, in batches, without their
+        sequences.
+        """
+        writer = SqliteIndexWriter(':memory:')
+        for index in range(5):
+            writer.addProtein('P%d' % index, 'NC1', 'AAA', 'offsets', True,
+                              False, 1)
+        db = SqliteIndex(writer._connection)
+        db.LOOKUP_BATCH_SIZE = 2
+        proteins = db.findProteins(['P%d' % index for index in range(6)])
+        self.assertEqual(set('P%d' % index for index in range(5)),
+                         set(proteins))
+        self.assertEqual(
+            {
+                'accession': 'P3',
+                'circular': False,
+                'forward': True,
+                'gene': None,
+                'genomeAccession': 'NC1',
+                'length': 3,
+                'note': None,
+                'offsets': 'offsets',
+                'product': None,
+                'rangeCount': 1,
+            },
+            proteins['P3'])
+        writer.close()
+        db.close()
@@ -5,6 +5,9 @@ import platform
 from six.moves import builtins
 from copy import deepcopy
 from json import dumps
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
 from unittest import TestCase, skip
 
 try:
@@ -2033,3 +2036,60 @@ class TestDiamondReadsAlignmentsFiltering(TestCase):
                 reads, 'file.json', databaseFilename='database.fasta')
             result = list(readsAlignments.filter(readIdRegex='^ID0$'))
             self.assertEqual(0, len(result))
+
+
+class TestDiamondReadsAlignmentsConcurrent(TestCase):
+    """
+    Test reading DIAMOND files concurrently.
+    """
+    def setUp(self):
+        self.tempdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def writeFile(self, name, records):
+        """
+        Write a JSON DIAMOND file.
+
+        @param name: The C{str} name of the file.
+        @param records: A C{list} of DIAMOND record C{dict}s.
+        @return: The C{str} path to the file.
+        """
+        filename = join(self.tempdir, name)
+        with open(filename, 'w') as fp:
+            for item in [PARAMS] + records:
+                fp.write(dumps(item) + '\n')
+        return filename
+
+    def testUnmatchedReads(self):
+        """
+        Reads with no DIAMOND record, including those at the end of a file's
+        reads and those after the reads of the last file, must be yielded
+        with no alignments, in order.
+        """
+        filenames = [self.writeFile('0.json', [RECORD0]),
+                     self.writeFile('1.json', [RECORD2])]
+        reads = Reads([Read('id%d' % i, 'A' * 70) for i in range(5)])
+        readsAlignments = DiamondReadsAlignments(
+            reads, filenames, fileWorkers=2, readsPerFile=[2, 2])
+        result = [(readAlignments.read.id, len(readAlignments))
+                  for readAlignments in readsAlignments]
+        self.assertEqual(
+            [('id0', 2), ('id1', 0), ('id2', 1), ('id3', 0), ('id4', 0)],
+            result)
+
+    def testReadMissingFromFileReads(self):
+        """
+        If a file has a record for a read that is not among the reads given
+        for the file, a ValueError must be raised.
+        """
+        filenames = [self.writeFile('0.json', [RECORD0]),
+                     self.writeFile('1.json', [RECORD1])]
+        reads = Reads([Read('id%d' % i, 'A' * 70) for i in range(3)])
+        readsAlignments = DiamondReadsAlignments(
+            reads, filenames, fileWorkers=2, readsPerFile=[2, 1])
+        error = ("^Read generator failed to yield a read with id 'id1' as "
+                 "found in record number 1 during parsing of DIAMOND output "
+                 "file '.*1\\.json'\\.$")
+        self.assertRaisesRegex(ValueError, error, list, readsAlignments)
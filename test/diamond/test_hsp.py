@@ -1,6 +1,15 @@
+from random import Random
 from unittest import TestCase
 
-from dark.diamond.hsp import normalizeHSP
+from six import StringIO
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from dark.btop import countGaps
+from dark.diamond.hsp import normalizeHSP, normalizeHSPs
 
 
 class FakeHSP(dict):
@@ -1987,3 +1996,136 @@ class TestBlastxFrameMinus1WithGaps(TestCase):
             'readStartInSubject': 0,
             'readEndInSubject': 4,
         }, normalized)
+
+
+class TestNormalizeHSPs(TestCase):
+    """
+    Property tests that normalizeHSPs gives the same results as
+    normalizeHSP.
+    """
+    def randomHSPs(self, count, seed, diamondTask):
+        """
+        Make random HSPs, many of which are valid and some of which will
+        fail normalizeHSP's sanity checks.
+
+        @param count: The C{int} number of HSPs to make.
+        @param seed: The C{int} random seed.
+        @param diamondTask: The C{str} DIAMOND task.
+        @return: A C{list} of (hsp, queryLen) 2-tuples.
+        """
+        random = Random(seed)
+        result = []
+        for _ in range(count):
+            queryLen = random.randint(3, 300)
+            frame = random.choice((-3, -2, -1, 1, 2, 3))
+            queryStart, queryEnd = sorted(
+                random.sample(range(1, queryLen + 1), 2))
+            if frame < 0:
+                queryStart, queryEnd = queryEnd, queryStart
+            queryGaps = random.choice((0, 0, 0, 1, 2))
+            subjectGaps = random.choice((0, 0, 0, 1, 2))
+            btop = '3' + '-A' * queryGaps + 'A-' * subjectGaps
+            subjectStart = random.randint(1, 100)
+            matchLen = abs(queryEnd - queryStart) + 1
+            if diamondTask == 'blastx':
+                matchLen //= 3
+            subjectEnd = (subjectStart + matchLen +
+                          queryGaps - subjectGaps - 1 +
+                          random.choice((0, 0, 0, -1, 1)))
+            result.append((FakeHSP(subjectStart, subjectEnd, queryStart,
+                                   queryEnd, frame, btop=btop), queryLen))
+        return result
+
+    def batch(self, hsps, diamondTask):
+        """
+        Normalize HSPs with normalizeHSPs.
+
+        @param hsps: A C{list} of (hsp, queryLen) 2-tuples.
+        @param diamondTask: The C{str} DIAMOND task.
+        @return: A C{list} of C{dict}s, like those returned by normalizeHSP.
+        """
+        gaps = [countGaps(hsp['btop']) for hsp, _ in hsps]
+        normalized = normalizeHSPs(
+            [hsp['query_start'] for hsp, _ in hsps],
+            [hsp['query_end'] for hsp, _ in hsps],
+            [hsp['sbjct_start'] for hsp, _ in hsps],
+            [hsp['sbjct_end'] for hsp, _ in hsps],
+            [hsp['frame'] for hsp, _ in hsps],
+            [queryLen for _, queryLen in hsps],
+            [queryGaps for queryGaps, _ in gaps],
+            [subjectGaps for _, subjectGaps in gaps],
+            diamondTask)
+        for values in normalized.values():
+            self.assertEqual('int64', values.dtype)
+        return [dict((key, int(normalized[key][index]))
+                     for key in normalized)
+                for index in range(len(hsps))]
+
+    def scalar(self, hsp, queryLen, diamondTask):
+        """
+        Normalize an HSP with normalizeHSP, without its error output.
+
+        @param hsp: A C{FakeHSP} instance.
+        @param queryLen: The C{int} query length.
+        @param diamondTask: The C{str} DIAMOND task.
+        @return: The C{dict} returned by normalizeHSP, or C{None} if it
+            raised an C{AssertionError}.
+        """
+        with patch('sys.stderr', new_callable=StringIO):
+            try:
+                return normalizeHSP(hsp, queryLen, diamondTask)
+            except AssertionError:
+                return None
+
+    def testIdenticalResults(self):
+        """
+        For each HSP, normalizeHSPs must raise exactly when normalizeHSP
+        does and otherwise give identical results.
+        """
+        for diamondTask in 'blastx', 'blastp':
+            hsps = self.randomHSPs(2000, 1, diamondTask)
+            valid = 0
+            for hsp, queryLen in hsps:
+                expected = self.scalar(hsp, queryLen, diamondTask)
+                if expected is None:
+                    self.assertRaises(AssertionError, self.batch,
+                                      [(hsp, queryLen)], diamondTask)
+                else:
+                    valid += 1
+                    self.assertEqual([expected],
+                                     self.batch([(hsp, queryLen)],
+                                                diamondTask))
+            # Make sure both valid and invalid HSPs were checked.
+            self.assertTrue(0 < valid < len(hsps))
+
+    def testBatch(self):
+        """
+        A batch of valid HSPs must be normalized exactly as normalizeHSP
+        normalizes them one at a time.
+        """
+        hsps = [(hsp, queryLen)
+                for hsp, queryLen in self.randomHSPs(5000, 2, 'blastx')
+                if self.scalar(hsp, queryLen, 'blastx')]
+        self.assertEqual(
+            [normalizeHSP(hsp, queryLen, 'blastx') for hsp, queryLen in hsps],
+            self.batch(hsps, 'blastx'))
+
+    def testBatchError(self):
+        """
+        If an HSP in a batch fails a sanity check, an AssertionError giving
+        the index of the HSP must be raised.
+        """
+        hsps = [(FakeHSP(subjectStart=1, subjectEnd=4, queryStart=1,
+                         queryEnd=12, frame=1), 12)] * 3
+        hsps[1] = (FakeHSP(subjectStart=1, subjectEnd=5, queryStart=1,
+                           queryEnd=12, frame=1), 12)
+        error = ('^Including gaps, subject match length != Query match '
+                 'length \\(HSP 1\\)$')
+        self.assertRaisesRegex(AssertionError, error, self.batch, hsps,
+                               'blastx')
+
+    def testEmpty(self):
+        """
+        Normalizing no HSPs must give empty arrays.
+        """
+        self.assertEqual([], self.batch([], 'blastx'))
@@ -1,9 +1,10 @@
 from unittest import TestCase, skipUnless, skip
-from six import StringIO
+from six import StringIO, assertRaisesRegex
 
 from dark.aa import CODONS
 from dark.civ.proteins import SqliteIndex, SqliteIndexWriter, _Genome
-from dark.diamond.sam import SimpleDiamondSAMWriter
+from dark.diamond.sam import (
+    SimpleDiamondSAMWriter, StreamingDiamondSAMWriter)
 from dark.diamond.run import DiamondExecutor, diamondInstalled
 from dark.genbank import GenomeRanges
 from dark.reads import Read, Reads
@@ -271,3 +272,159 @@ class TestAdw2Polymerase(TestCase):
                 )))
             )) + '\n',
             fp.getvalue())
+
+
+class TestStreamingDiamondSAMWriter(TestCase):
+    """
+    Test the StreamingDiamondSAMWriter class.
+    """
+    def makeDatabase(self):
+        """
+        Make a genomes/proteins database with two genomes and a protein.
+
+        @return: A C{SqliteIndexWriter} instance.
+        """
+        proteinAccession = 'YP_009259545.1'
+        proteinRange = SAMPLE_DATA['proteins'][proteinAccession]['range']
+        db = SqliteIndexWriter(':memory:')
+
+        for genomeAccession in 'NC_030446.1', 'AM282986.1':
+            genomeSequence = SAMPLE_DATA['genomes'][genomeAccession]['genome']
+            db.addGenome(
+                _Genome(
+                    {
+                        'id': genomeAccession,
+                        'name': SAMPLE_DATA['genomes'][genomeAccession]['id'],
+                        'sequence': genomeSequence,
+                        'features': [],
+                    }
+                ),
+                source={
+                    'host': 'Homo sapiens',
+                    'mol_type': 'DNA',
+                    'organism': 'Hepatitis B Virus',
+                },
+                taxonomyId=500, proteinCount=1, databaseName='test-db')
+
+        ranges = GenomeRanges(proteinRange)
+        genomeLen = len(SAMPLE_DATA['genomes']['NC_030446.1']['genome'])
+        db.addProtein(
+            proteinAccession, 'NC_030446.1',
+            SAMPLE_DATA['proteins'][proteinAccession]['protein'],
+            proteinRange, True, ranges.circular(genomeLen),
+            ranges.distinctRangeCount(genomeLen))
+
+        return db
+
+    def testHeaderHasAllGenomes(self):
+        """
+        The SAM header must be written immediately and have an @SQ line for
+        every genome in the database, sorted by accession.
+        """
+        fp = StringIO()
+        StreamingDiamondSAMWriter(SqliteIndex(self.makeDatabase()._connection),
+                                  fp, headerLines=['@HD\tVN:1.6'])
+        self.assertEqual(
+            '@HD\tVN:1.6\n'
+            '@SQ\tSN:AM282986.1\tLN:%d\n'
+            '@SQ\tSN:NC_030446.1\tLN:%d\n' % (
+                len(SAMPLE_DATA['genomes']['AM282986.1']['genome']),
+                len(SAMPLE_DATA['genomes']['NC_030446.1']['genome'])),
+            fp.getvalue())
+
+    def testMatch(self):
+        """
+        A match must be written as a SAM line.
+        """
+        stitle = 'civ|GENBANK|YP_009259545.1|GENBANK|NC_030446.1|protein'
+        diamondStr = '\t'.join(map(str, (
+            82.4, '4', 1, 12, 'EEEEEEEEEEEE', 12, 'ATGAAAAAACCC', 'query', 1,
+            100, 11, stitle)))
+        fp = StringIO()
+        writer = StreamingDiamondSAMWriter(
+            SqliteIndex(self.makeDatabase()._connection), fp, batchSize=2)
+        writer.addMatch(diamondStr)
+        writer.save()
+        self.assertEqual(
+            '\t'.join(map(str, (
+                'query', 0, 'NC_030446.1', 31, 255, '12M', '*', 0, 0,
+                'ATGAAAAAACCC', 'EEEEEEEEEEEE', 'AS:i:82'))) + '\n',
+            fp.getvalue().split('\n', 2)[2])
+
+    def testAddMatches(self):
+        """
+        Adding several matches at once must give the same SAM as adding
+        them one at a time.
+        """
+        stitle = 'civ|GENBANK|YP_009259545.1|GENBANK|NC_030446.1|protein'
+        diamondStrs = [
+            '\t'.join(map(str, (
+                82.4, '4', 1, 12, 'EEEEEEEEEEEE', 12, 'ATGAAAAAACCC',
+                'query%d' % index, 1, 100, 11 + index, stitle)))
+            for index in range(3)]
+        db = SqliteIndex(self.makeDatabase()._connection)
+
+        fp1 = StringIO()
+        writer = StreamingDiamondSAMWriter(db, fp1)
+        writer.addMatches(diamondStrs)
+        writer.save()
+
+        fp2 = StringIO()
+        writer = StreamingDiamondSAMWriter(db, fp2)
+        for diamondStr in diamondStrs:
+            writer.addMatch(diamondStr)
+        writer.save()
+
+        self.assertEqual(fp1.getvalue(), fp2.getvalue())
+        self.assertEqual(5, len(fp1.getvalue().splitlines()))
+
+    def testLookupCacheSize(self):
+        """
+        No more than LOOKUP_CACHE_SIZE genomes must be kept after they are
+        looked up, and matches against more genomes than that must still be
+        converted correctly.
+        """
+        class SmallCacheWriter(StreamingDiamondSAMWriter):
+            LOOKUP_CACHE_SIZE = 1
+
+        diamondStrs = [
+            '\t'.join(map(str, (
+                82.4, '4', 1, 12, 'EEEEEEEEEEEE', 12, 'ATGAAAAAACCC',
+                'query%d' % index, 1, 100, 11,
+                'civ|GENBANK|YP_009259545.1|GENBANK|%s|protein' %
+                genomeAccession)))
+            for index, genomeAccession in enumerate(
+                ('NC_030446.1', 'AM282986.1', 'NC_030446.1'))]
+        db = SqliteIndex(self.makeDatabase()._connection)
+
+        fp1 = StringIO()
+        writer = StreamingDiamondSAMWriter(db, fp1)
+        writer.addMatches(diamondStrs)
+        writer.save()
+
+        fp2 = StringIO()
+        writer = SmallCacheWriter(db, fp2)
+        writer.addMatches(diamondStrs)
+        writer.addMatches(diamondStrs[:2])
+        writer.save()
+
+        self.assertEqual(1, len(writer._genomes))
+        self.assertEqual(1, len(writer._proteins))
+        self.assertEqual(fp1.getvalue().splitlines(),
+                         fp2.getvalue().splitlines()[:5])
+
+    def testUnknownProtein(self):
+        """
+        A match against a protein that is not in the database must result
+        in a ValueError.
+        """
+        stitle = 'civ|GENBANK|XXX|GENBANK|NC_030446.1|protein'
+        diamondStr = '\t'.join(map(str, (
+            82.4, '4', 1, 12, 'EEEEEEEEEEEE', 12, 'ATGAAAAAACCC', 'query', 1,
+            100, 11, stitle)))
+        writer = StreamingDiamondSAMWriter(
+            SqliteIndex(self.makeDatabase()._connection), StringIO())
+        error = (r"^Could not find accession 'XXX' in proteins database "
+                 r"table\.$")
+        assertRaisesRegex(self, ValueError, error, writer.addMatches,
+                          [diamondStr])
@@ -0,0 +1,142 @@
+from unittest import TestCase
+from random import Random
+from six import assertRaisesRegex
+
+from dark.alignment_matrix import AlignmentMatrix
+from dark.dna import FloatBaseCounts
+from dark.errors import ReadLengthsNotIdenticalError
+from dark.reads import Read
+
+
+class TestAlignmentMatrix(TestCase):
+    """
+    Test the AlignmentMatrix class.
+    """
+    def testEmpty(self):
+        """
+        A matrix made from no reads must have no sites.
+        """
+        am = AlignmentMatrix([])
+        self.assertEqual(0, am.n)
+        self.assertEqual(0, am.length)
+        self.assertEqual({}, am.variableSites())
+        self.assertEqual('', am.combine())
+
+    def testMatrix(self):
+        """
+        The matrix must hold the bytes of the sequences, one read per row,
+        with short reads padded with zeroes.
+        """
+        am = AlignmentMatrix([Read('id1', 'ACG'), Read('id2', 'T')])
+        self.assertEqual([[65, 67, 71], [84, 0, 0]], am.matrix.tolist())
+        self.assertFalse(am.equalLengths)
+
+    def testUnequalLengths(self):
+        """
+        The methods that need equal length reads must raise a
+        ReadLengthsNotIdenticalError if the reads have different lengths.
+        """
+        am = AlignmentMatrix([Read('id1', 'ACG'), Read('id2', 'T')])
+        self.assertRaises(ReadLengthsNotIdenticalError, am.variableSites)
+        self.assertRaises(ReadLengthsNotIdenticalError, am.combine)
+
+    def testHistogram(self):
+        """
+        The histogram must count each byte value at each site.
+        """
+        am = AlignmentMatrix([Read('id1', 'AC'), Read('id2', 'AG'),
+                              Read('id3', 'A')])
+        histogram = am.histogram()
+        self.assertEqual(3, histogram[0, ord('A')])
+        self.assertEqual(1, histogram[1, ord('C')])
+        self.assertEqual(1, histogram[1, ord('G')])
+        self.assertEqual(1, histogram[1, 0])
+        self.assertEqual(6, histogram.sum())
+
+    def testBaseCounts(self):
+        """
+        Base counts must share ambiguous codes between their bases, count
+        lower case as upper case, and put unknown characters under '-'.
+        """
+        am = AlignmentMatrix([Read('id1', 'Aa'), Read('id2', 'R?'),
+                              Read('id3', 'N-')])
+        self.assertEqual(
+            [[1.75, 0.25, 0.75, 0.25, 0.0],
+             [1.0, 0.0, 0.0, 0.0, 2.0]],
+            am.baseCounts().tolist())
+
+    def testBaseCountsUnknownAreAmbiguous(self):
+        """
+        If unknownAreAmbiguous is True, unknown characters must be counted
+        as being any of ACGT.
+        """
+        am = AlignmentMatrix([Read('id1', '?'), Read('id2', 'A')])
+        self.assertEqual([[1.25, 0.25, 0.25, 0.25, 0.0]],
+                         am.baseCounts(unknownAreAmbiguous=True).tolist())
+
+    def testSummarizePosition(self):
+        """
+        summarizePosition must give the same result as
+        Reads.summarizePosition.
+        """
+        am = AlignmentMatrix([Read('id1', 'aaaaaa'), Read('id2', 'aata'),
+                              Read('id3', 'aataaaaaa')])
+        self.assertEqual({'excludedCount': 0,
+                          'countAtPosition': {'a': 1, 't': 2}},
+                         am.summarizePosition(2))
+        self.assertEqual({'excludedCount': 2,
+                          'countAtPosition': {'a': 1}},
+                         am.summarizePosition(7))
+        self.assertEqual({'excludedCount': 0,
+                          'countAtPosition': {'a': 3}},
+                         am.summarizePosition(-1))
+
+    def testCombineUnknownBases(self):
+        """
+        combine must raise a ValueError if a site has more than one code and
+        none are nucleotides.
+        """
+        am = AlignmentMatrix([Read('id1', 'A-'), Read('id2', 'A?')])
+        error = r'^Unknown DNA base\(s\) at site 1: -, \?$'
+        assertRaisesRegex(self, ValueError, error, am.combine)
+
+    def testCombine(self):
+        """
+        combine must keep unanimous bases, prefer a base over N, and use
+        ambiguous codes elsewhere.
+        """
+        am = AlignmentMatrix([Read('id1', 'ACNAR-'), Read('id2', 'ANCGY-')])
+        self.assertEqual('ACCRN-', am.combine())
+
+    def testAgreesWithFloatBaseCounts(self):
+        """
+        The variable sites found must be the same as those found using
+        FloatBaseCounts on each site, on random alignments.
+        """
+        rng = Random(7)
+        for _ in range(200):
+            alphabet = rng.choice(['ACGT', 'AAAAC', 'ACGTN-', 'ARN',
+                                   'acgtRYN-?', 'A-?'])
+            length = rng.randint(1, 8)
+            reads = [
+                Read('id%d' % i,
+                     ''.join(rng.choice(alphabet) for _ in range(length)))
+                for i in range(rng.randint(1, 6))]
+            am = AlignmentMatrix(reads)
+            for confirm in False, True:
+                for unknownAreAmbiguous in False, True:
+                    for level in 1.0, 0.6:
+                        expected = {}
+                        for site in range(length):
+                            counts = FloatBaseCounts(
+                                [read.sequence[site] for read in reads],
+                                unknownAreAmbiguous=unknownAreAmbiguous)
+                            if (counts.variable(confirm) and
+                                    not counts.homogeneous(level)):
+                                expected[site] = counts.counts
+                        variableSites = am.variableSites(
+                            confirm, level, unknownAreAmbiguous)
+                        self.assertEqual(
+                            expected,
+                            dict((site, counts.counts) for site, counts in
+                                 variableSites.items()))
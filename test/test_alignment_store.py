@@ -0,0 +1,315 @@
+from __future__ import print_function
+
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+from json import dumps
+
+import numpy as np
+
+from dark.alignment_store import (
+    AlignmentStore, AlignmentStoreWriter, saveAlignmentStore)
+from dark.blast.alignments import BlastReadsAlignments
+from dark.diamond.alignments import DiamondReadsAlignments
+from dark.hsp import SlottedHSP
+from dark.reads import Read, Reads
+
+from .blast import sample_data as blastData
+from .diamond import sample_data as diamondData
+
+BLAST_RECORDS = [blastData.RECORD0, blastData.RECORD1, blastData.RECORD2,
+                 blastData.RECORD3, blastData.RECORD4]
+
+DIAMOND_RECORDS = [diamondData.RECORD0, diamondData.RECORD1,
+                   diamondData.RECORD2, diamondData.RECORD3,
+                   diamondData.RECORD4]
+
+
+class _TempDirMixin(object):
+    """
+    Make a temporary directory for each test.
+    """
+    def setUp(self):
+        self.tempdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+
+class TestAlignmentStore(_TempDirMixin, TestCase):
+    """
+    Tests for the dark.alignment_store writer and reader.
+    """
+    def roundTrip(self, params, records, chunkSize=10000):
+        """
+        Save records to a store and read them back.
+
+        @param params: A C{dict} of parameters.
+        @param records: A C{list} of record C{dict}s.
+        @param chunkSize: The C{int} number of records to decode at once.
+        @return: A 2-tuple with the store params and a C{list} of records.
+        """
+        filename = join(self.tempdir, 'store.alignments.npz')
+        self.assertEqual(len(records),
+                         saveAlignmentStore(filename, params, records))
+        store = AlignmentStore(filename)
+        try:
+            return store.params, list(store.records(chunkSize=chunkSize))
+        finally:
+            store.close()
+
+    def testNoRecords(self):
+        """
+        A store with no records must have the right parameters and no
+        records.
+        """
+        params, records = self.roundTrip(diamondData.PARAMS, [])
+        self.assertEqual(diamondData.PARAMS, params)
+        self.assertEqual([], records)
+
+    def testLength(self):
+        """
+        The length of a store must be its number of records.
+        """
+        filename = join(self.tempdir, 'store.alignments.npz')
+        saveAlignmentStore(filename, diamondData.PARAMS, DIAMOND_RECORDS)
+        store = AlignmentStore(filename)
+        self.assertEqual(5, len(store))
+        store.close()
+
+    def testBLASTRecords(self):
+        """
+        BLAST records (whose HSPs have a pair of frames) must be read back
+        as they were saved.
+        """
+        params, records = self.roundTrip(blastData.PARAMS, BLAST_RECORDS)
+        self.assertEqual(blastData.PARAMS, params)
+        self.assertEqual(BLAST_RECORDS, records)
+
+    def testDIAMONDRecords(self):
+        """
+        DIAMOND records must be read back as they were saved.
+        """
+        params, records = self.roundTrip(diamondData.PARAMS, DIAMOND_RECORDS)
+        self.assertEqual(diamondData.PARAMS, params)
+        self.assertEqual(DIAMOND_RECORDS, records)
+
+    def testSmallChunkSize(self):
+        """
+        Records must be read back correctly when they are decoded a few
+        at a time.
+        """
+        params, records = self.roundTrip(diamondData.PARAMS, DIAMOND_RECORDS,
+                                         chunkSize=2)
+        self.assertEqual(DIAMOND_RECORDS, records)
+
+    def testNoneValuesAndMissingKeys(self):
+        """
+        HSP values that are None, or HSP keys that are missing from some
+        HSPs, must be read back as None. Non-ASCII titles must be preserved.
+        """
+        hsp1 = {
+            'bits': 10.5,
+            'btop': None,
+            'expect': 0.0,
+            'frame': -2,
+            'identicalCount': None,
+            'query': 'ACGT',
+            'query_end': 4,
+            'query_start': 1,
+            'sbjct': 'AC-T',
+            'sbjct_end': 3,
+            'sbjct_start': 1,
+        }
+        hsp2 = dict(hsp1, btop='2-A1', identicalCount=3, percentIdentical=75.0)
+        records = [
+            {
+                'query': 'read1',
+                'alignments': [
+                    {
+                        'hsps': [hsp1, hsp2],
+                        'length': 100,
+                        'title': 'Protein é',
+                    },
+                ],
+            },
+            {
+                'query': 'read2',
+                'alignments': [],
+            },
+        ]
+        _, result = self.roundTrip(diamondData.PARAMS, records)
+        expectedHsp1 = dict(hsp1, percentIdentical=None)
+        self.assertEqual(
+            [expectedHsp1, hsp2], result[0]['alignments'][0]['hsps'])
+        self.assertEqual('Protein é', result[0]['alignments'][0]['title'])
+        self.assertEqual({'query': 'read2', 'alignments': []}, result[1])
+
+    def testSharedTitles(self):
+        """
+        Subject titles that occur in many alignments must be stored once.
+        """
+        filename = join(self.tempdir, 'store.alignments.npz')
+        records = [diamondData.RECORD0, diamondData.RECORD0]
+        saveAlignmentStore(filename, diamondData.PARAMS, records)
+        with np.load(filename) as data:
+            self.assertEqual(3, len(data['title.offsets']))
+            self.assertEqual([0, 1, 0, 1], list(data['alignmentTitle']))
+
+    def testUnknownHSPKey(self):
+        """
+        An HSP with an unknown key must cause a ValueError.
+        """
+        writer = AlignmentStoreWriter()
+        record = {
+            'query': 'read1',
+            'alignments': [
+                {
+                    'hsps': [{'frame': 1, 'weird': 3}],
+                    'length': 100,
+                    'title': 'title',
+                },
+            ],
+        }
+        error = "^Unknown HSP key 'weird'\\.$"
+        self.assertRaisesRegex(ValueError, error, writer.addRecord, record)
+
+    def testInconsistentFrames(self):
+        """
+        If some HSPs have a pair of frames and others a single frame, a
+        ValueError must be raised.
+        """
+        writer = AlignmentStoreWriter()
+        writer.addRecord(blastData.RECORD0)
+        error = '^Inconsistent HSP frame 1\\.$'
+        self.assertRaisesRegex(ValueError, error, writer.addRecord,
+                               diamondData.RECORD0)
+
+    def testMatchedSequences(self):
+        """
+        The matchedSequences method must return the query and subject
+        sequences of an HSP, given its index in the store, also after the
+        store has been closed.
+        """
+        filename = join(self.tempdir, 'store.alignments.npz')
+        saveAlignmentStore(filename, diamondData.PARAMS, DIAMOND_RECORDS)
+        hsps = [hsp for record in DIAMOND_RECORDS
+                for alignment in record['alignments']
+                for hsp in alignment['hsps']]
+        store = AlignmentStore(filename)
+        list(store.records())
+        store.close()
+        # The sequence data must be read from the file when needed.
+        self.assertIsInstance(store._sequenceArrays['hsp.query.data'],
+                              np.memmap)
+        self.assertEqual([(hsp['query'], hsp['sbjct']) for hsp in hsps],
+                         [store.matchedSequences(index)
+                          for index in range(len(hsps))])
+
+    def testNotAStore(self):
+        """
+        Opening an npz file that is not an alignment store must raise a
+        ValueError.
+        """
+        filename = join(self.tempdir, 'other.npz')
+        np.savez(filename, x=np.arange(3))
+        error = "^'.*other\\.npz' is not an alignment store\\.$"
+        self.assertRaisesRegex(ValueError, error, AlignmentStore, filename)
+
+
+class TestReadsAlignmentsFromStore(_TempDirMixin, TestCase):
+    """
+    Reading BLAST and DIAMOND alignments from a store must give the same
+    results as reading them from JSON.
+    """
+    def writeFiles(self, params, records):
+        """
+        Write records to a JSON file and to an alignment store.
+
+        @param params: A C{dict} of parameters.
+        @param records: A C{list} of record C{dict}s.
+        @return: A 2-tuple of the C{str} JSON and store file names.
+        """
+        jsonFilename = join(self.tempdir, 'file.json')
+        storeFilename = join(self.tempdir, 'file.alignments.npz')
+        with open(jsonFilename, 'w') as fp:
+            for item in [params] + records:
+                print(dumps(item), file=fp)
+        saveAlignmentStore(storeFilename, params, records)
+        return jsonFilename, storeFilename
+
+    def assertSameAlignments(self, cls, reads, filenames, **kwargs):
+        """
+        Check that alignments read from JSON and from a store are equal.
+
+        @param cls: A C{ReadsAlignments} subclass.
+        @param reads: A C{Reads} instance.
+        @param filenames: A 2-tuple of C{str} JSON and store file names.
+        @param kwargs: Keyword arguments for C{cls}.
+        """
+        results = []
+        for filename in filenames:
+            readsAlignments = cls(reads, filename, **kwargs)
+            results.append([
+                (readAlignments.read.id, [
+                    (alignment.subjectTitle, alignment.subjectLength,
+                     [hsp.toDict() for hsp in alignment.hsps])
+                    for alignment in readAlignments])
+                for readAlignments in readsAlignments])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(len(list(reads)), len(results[0]))
+
+    def testBLAST(self):
+        """
+        BlastReadsAlignments must read a store just as it reads JSON.
+        """
+        filenames = self.writeFiles(blastData.PARAMS, BLAST_RECORDS)
+        reads = Reads([Read('id%d' % i, 'A' * 70) for i in range(5)])
+        self.assertSameAlignments(BlastReadsAlignments, reads, filenames,
+                                  databaseFilename='database.fasta')
+
+    def testPlainNpzSuffix(self):
+        """
+        A file whose name ends in .npz but not in SUFFIX must not be read as
+        an alignment store.
+        """
+        filename = join(self.tempdir, 'file.npz')
+        saveAlignmentStore(filename, blastData.PARAMS, BLAST_RECORDS)
+        error = r"^Unknown BLAST record file suffix for file '.*file\.npz'\.$"
+        self.assertRaisesRegex(ValueError, error, BlastReadsAlignments,
+                               Reads(), filename,
+                               databaseFilename='database.fasta')
+
+    def testDIAMOND(self):
+        """
+        DiamondReadsAlignments must read a store just as it reads JSON,
+        including yielding reads that have no record.
+        """
+        filenames = self.writeFiles(diamondData.PARAMS, DIAMOND_RECORDS)
+        reads = Reads([Read('id%d' % i, 'A' * 70) for i in range(6)])
+        self.assertSameAlignments(DiamondReadsAlignments, reads, filenames,
+                                  databaseFilename='database.fasta')
+
+    def testLazyHSPs(self):
+        """
+        Alignments read from a store must have SlottedHSPs whose matched
+        sequences are loaded from the store, also when they are accessed
+        after the store has been read.
+        """
+        _, storeFilename = self.writeFiles(diamondData.PARAMS,
+                                           DIAMOND_RECORDS)
+        reads = Reads([Read('id%d' % i, 'A' * 70) for i in range(5)])
+        readsAlignments = list(DiamondReadsAlignments(
+            reads, storeFilename, databaseFilename='database.fasta'))
+        hsps = [hsp for readAlignments in readsAlignments
+                for alignment in readAlignments for hsp in alignment.hsps]
+        self.assertTrue(all(isinstance(hsp, SlottedHSP) for hsp in hsps))
+        self.assertIsNotNone(hsps[0]._sequenceSource)
+        expected = [hsp for record in DIAMOND_RECORDS
+                    for alignment in record['alignments']
+                    for hsp in alignment['hsps']]
+        self.assertEqual(
+            [(hsp['query'], hsp['sbjct']) for hsp in expected],
+            [(hsp.readMatchedSequence, hsp.subjectMatchedSequence)
+             for hsp in hsps])
@@ -0,0 +1,129 @@
+from unittest import TestCase
+from six import assertRaisesRegex
+
+from dark.bloom import BloomFilter
+from dark.utils import xxh3_128_intdigest
+
+
+class TestBloomFilter(TestCase):
+    """
+    Test the BloomFilter class.
+    """
+    def testNoSize(self):
+        """
+        If neither capacity nor maxBytes is given, a ValueError must be
+        raised.
+        """
+        error = '^At least one of capacity or maxBytes must be given\\.$'
+        assertRaisesRegex(self, ValueError, error, BloomFilter)
+
+    def testBadErrorRate(self):
+        """
+        An error rate that is not between zero and one must cause a
+        ValueError.
+        """
+        error = (r'^The error rate \(1\.0\) must be greater than zero and '
+                 r'less than one\.$')
+        assertRaisesRegex(self, ValueError, error, BloomFilter,
+                          capacity=10, errorRate=1.0)
+
+    def testBadCapacity(self):
+        """
+        A capacity less than one must cause a ValueError.
+        """
+        error = r'^The capacity \(0\) must be at least one\.$'
+        assertRaisesRegex(self, ValueError, error, BloomFilter, capacity=0)
+
+    def testBadMaxBytes(self):
+        """
+        A maxBytes less than one must cause a ValueError.
+        """
+        error = (r'^The maximum number of bytes \(0\) must be at least '
+                 r'one\.$')
+        assertRaisesRegex(self, ValueError, error, BloomFilter, maxBytes=0)
+
+    def testSizeFromCapacity(self):
+        """
+        The number of bits and hashes must be calculated correctly from the
+        capacity and error rate.
+        """
+        bf = BloomFilter(capacity=1000, errorRate=0.01)
+        # 1000 * -ln(0.01) / ln(2)^2 = 9585.06, rounded up to a whole
+        # number of bytes.
+        self.assertEqual(9592, bf.bitCount)
+        self.assertEqual(7, bf.hashCount)
+
+    def testMaxBytesLimitsSize(self):
+        """
+        If the capacity would need more memory than maxBytes, the filter
+        must be limited to maxBytes.
+        """
+        bf = BloomFilter(capacity=1000, errorRate=0.01, maxBytes=100)
+        self.assertEqual(800, bf.bitCount)
+        self.assertEqual(1000, bf.capacity)
+        self.assertEqual(1, bf.hashCount)
+
+    def testCapacityFromMaxBytes(self):
+        """
+        If only maxBytes is given, the capacity must be calculated from it.
+        """
+        bf = BloomFilter(errorRate=0.01, maxBytes=1000)
+        self.assertEqual(8000, bf.bitCount)
+        self.assertEqual(834, bf.capacity)
+
+    def testEmpty(self):
+        """
+        An empty filter must not contain anything.
+        """
+        bf = BloomFilter(capacity=10)
+        self.assertNotIn('ACGT', bf)
+        self.assertEqual(0, len(bf))
+        self.assertEqual(0.0, bf.falsePositiveRate())
+
+    def testAdd(self):
+        """
+        Adding a string must return False the first time and True after
+        that, and the string must then be in the filter.
+        """
+        bf = BloomFilter(capacity=10)
+        self.assertFalse(bf.add('ACGT'))
+        self.assertIn('ACGT', bf)
+        self.assertTrue(bf.add('ACGT'))
+        self.assertEqual(1, len(bf))
+
+    def testOffsetsUseSharedHash(self):
+        """
+        The bit offsets for a string must come from the 128-bit hash in
+        dark.utils, with the low 64 bits giving the first offset and the
+        high 64 bits (made odd) the step between offsets.
+        """
+        bf = BloomFilter(capacity=10)
+        digest = xxh3_128_intdigest(b'ACGT')
+        first = (digest & ((1 << 64) - 1)) % bf.bitCount
+        step = ((digest >> 64) | 1) % bf.bitCount
+        self.assertEqual(
+            [(first + i * step) % bf.bitCount for i in range(bf.hashCount)],
+            bf._offsets('ACGT'))
+
+    def testNoFalseNegatives(self):
+        """
+        All added strings must be found, even when the filter is over
+        capacity.
+        """
+        bf = BloomFilter(capacity=100, errorRate=0.01)
+        strings = ['seq%d' % i for i in range(1000)]
+        for s in strings:
+            bf.add(s)
+        self.assertTrue(all(s in bf for s in strings))
+
+    def testFalsePositiveRate(self):
+        """
+        When the filter is filled to capacity, the false positive rate must
+        be close to the error rate.
+        """
+        bf = BloomFilter(capacity=10000, errorRate=0.01)
+        for i in range(10000):
+            bf.add('in-%d' % i)
+        falsePositives = sum(('out-%d' % i) in bf for i in range(10000))
+        self.assertTrue(falsePositives < 200)
+        self.assertAlmostEqual(0.01, bf.falsePositiveRate(), places=2)
@@ -3,7 +3,8 @@ from unittest import TestCase
 
 from dark.dna import (
     AMBIGUOUS, BASES_TO_AMBIGUOUS, compareDNAReads, matchToString,
-    findKozakConsensus, FloatBaseCounts, sequenceToRegex)
+    findKozakConsensus, FloatBaseCounts, sequenceToRegex, compareDNAReadSets,
+    MATCH_COUNT_NAMES)
 from dark.reads import Read, DNARead, DNAKozakRead
 
 # The following are the letters that used to be on
@@ -721,6 +722,99 @@ class TestCompareDNAReads(TestCase):
             compareDNAReads(Read('id1', 'ACGTT'),
                             Read('id2', 'ACGCC')))
 
+    def testIdenticalUnknownCharacters(self):
+        """
+        Two identical characters that are not nucleotide codes must be
+        counted as a non-gap mismatch.
+        """
+        match = compareDNAReads(Read('id1', 'AC?'), Read('id2', 'AC?'))
+        self.assertEqual(2, match['match']['identicalMatchCount'])
+        self.assertEqual(1, match['match']['nonGapMismatchCount'])
+
+
+class TestCompareDNAReadSets(TestCase):
+    """
+    Test the compareDNAReadSets function.
+    """
+    READS = [
+        Read('id1', 'ACGTACGT'),
+        Read('id2', 'ACGTAC'),
+        Read('id3', 'ACGTNCG-'),
+        Read('id4', 'AC-TRCGTTT'),
+        Read('id5', 'ACGT--GT'),
+        Read('id6', 'MCGTAC?T'),
+    ]
+
+    def check(self, reads1, reads2, matchAmbiguous=True, **kwargs):
+        """
+        Check that compareDNAReadSets gives the same counts as
+        compareDNAReads for all pairs of reads.
+        """
+        result = compareDNAReadSets(reads1, reads2,
+                                    matchAmbiguous=matchAmbiguous, **kwargs)
+        if reads2 is None:
+            reads2 = reads1
+        for name in MATCH_COUNT_NAMES:
+            self.assertEqual((len(reads1), len(reads2)), result[name].shape)
+        for i, read1 in enumerate(reads1):
+            for j, read2 in enumerate(reads2):
+                expected = compareDNAReads(
+                    read1, read2, matchAmbiguous=matchAmbiguous)['match']
+                for name in MATCH_COUNT_NAMES:
+                    self.assertEqual(expected[name], result[name][i, j],
+                                     '%s for %s and %s' % (
+                                         name, read1.id, read2.id))
+
+    def testEmpty(self):
+        """
+        Comparing an empty set of reads must give empty count arrays.
+        """
+        result = compareDNAReadSets([], [Read('id1', 'ACGT')])
+        self.assertEqual(set(MATCH_COUNT_NAMES), set(result))
+        for name in MATCH_COUNT_NAMES:
+            self.assertEqual((0, 1), result[name].shape)
+
+    def testOneRead(self):
+        """
+        Comparing a read with itself must give the expected counts.
+        """
+        result = compareDNAReadSets([Read('id1', 'ACGTN-')])
+        self.assertEqual(4, result['identicalMatchCount'][0, 0])
+        self.assertEqual(1, result['ambiguousMatchCount'][0, 0])
+        self.assertEqual(1, result['gapGapMismatchCount'][0, 0])
+        self.assertEqual(0, result['gapMismatchCount'][0, 0])
+        self.assertEqual(0, result['nonGapMismatchCount'][0, 0])
+
+    def testSquare(self):
+        """
+        If reads2 is not given, the reads must be compared with each other.
+        """
+        self.check(self.READS, None)
+
+    def testTwoSets(self):
+        """
+        Two different sets of reads must be compared correctly.
+        """
+        self.check(self.READS[:2], self.READS[2:])
+
+    def testStrict(self):
+        """
+        If matchAmbiguous is False, ambiguous matches must not be counted.
+        """
+        self.check(self.READS, None, matchAmbiguous=False)
+
+    def testLowerCase(self):
+        """
+        Lower case sequences must be compared correctly.
+        """
+        self.check([Read('id1', 'acgtn'), Read('id2', 'ACGTA')], None)
+
+    def testWorkers(self):
+        """
+        Using worker processes must give the same result.
+        """
+        self.check(self.READS, None, workers=2)
+
 
 class TestMatchToString(TestCase):
     """
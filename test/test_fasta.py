@@ -13,7 +13,7 @@ except ImportError:
 
 from dark.reads import Read, AARead, DNARead, RNARead, Reads
 from dark.fasta import (dedupFasta, dePrefixAndSuffixFasta, fastaSubtract,
-                        FastaReads, combineReads, SqliteIndex)
+                        FastaReads, combineReads, SqliteIndex, fastaRecords)
 from dark.utils import StringIO
 
 
@@ -55,6 +55,18 @@ class FastaDeDup(TestCase):
         reads.add(Read('id2', 'GGG'))
         self.assertEqual(list(dedupFasta(reads)), [Read('id1', 'GGG')])
 
+    def testHashFunctions(self):
+        """
+        Duplicates must be removed no matter what hash function is used,
+        including when no hash function is used.
+        """
+        reads = [Read('id1', 'GGG'), Read('id2', 'GGA'), Read('id3', 'GGG')]
+        for hashFunction in 'md5', 'fast64', 'fast128', None, len:
+            self.assertEqual([Read('id1', 'GGG'), Read('id2', 'GGA')]
+                             if hashFunction is not len else
+                             [Read('id1', 'GGG')],
+                             list(dedupFasta(reads, hashFunction)))
+
 
 class Unused(TestCase):
 
@@ -433,6 +445,148 @@ class TestFastaReads(TestCase):
                 list(reads))
 
 
+class TestFastaRecords(TestCase):
+    """
+    Tests for the L{dark.fasta.fastaRecords} function.
+    """
+
+    def testEmpty(self):
+        """
+        An empty file must result in no records.
+        """
+        self.assertEqual([], list(fastaRecords(StringIO(''))))
+
+    def testOneRecord(self):
+        """
+        A file with one record must be parsed correctly.
+        """
+        self.assertEqual([('id1', 'ACGT')],
+                         list(fastaRecords(StringIO('>id1\nACGT\n'))))
+
+    def testNoTrailingNewline(self):
+        """
+        A file with no trailing newline must be parsed correctly.
+        """
+        self.assertEqual([('id1', 'ACGT'), ('id2', 'TT')],
+                         list(fastaRecords(StringIO('>id1\nACGT\n>id2\nTT'))))
+
+    def testTitleOnly(self):
+        """
+        A record with a title but no sequence must have an empty sequence.
+        """
+        self.assertEqual([('id1', ''), ('id2', 'A')],
+                         list(fastaRecords(StringIO('>id1\n>id2\nA\n'))))
+
+    def testWhitespace(self):
+        """
+        Whitespace must be removed from sequences and trailing whitespace
+        must be removed from titles.
+        """
+        data = '>id1 desc  \r\nAC GT\r\nTT\n\n>id2\nA\n'
+        self.assertEqual([('id1 desc', 'ACGTTT'), ('id2', 'A')],
+                         list(fastaRecords(StringIO(data))))
+
+    def testLeadingBlankLines(self):
+        """
+        Blank lines before the first record must be ignored.
+        """
+        self.assertEqual([('id1', 'ACGT')],
+                         list(fastaRecords(StringIO('\n\n>id1\nACGT\n'))))
+
+    def testLeadingText(self):
+        """
+        Non-blank text before the first record must result in a ValueError.
+        """
+        error = '^FASTA input contains text before the first record\\.$'
+        assertRaisesRegex(self, ValueError, error, list,
+                          fastaRecords(StringIO('junk\n>id1\nACGT\n')))
+
+    def testBytes(self):
+        """
+        A file opened in binary mode must be parsed correctly.
+        """
+        self.assertEqual([('id1', 'ACGT'), ('id2', 'TT')],
+                         list(fastaRecords(BytesIO(b'>id1\nACGT\n>id2\nTT'))))
+
+    def testSmallBuffers(self):
+        """
+        The records found must not depend on the buffer size (in particular,
+        on where record boundaries fall relative to chunk boundaries).
+        """
+        data = ('>id1 description\nACGT\nAAA\n>id2\n\n>id3\nGG\nTTTT\n'
+                '>id4\nCCC\n')
+        expected = list(SeqIO.parse(StringIO(data), 'fasta'))
+        expected = [(seq.description, str(seq.seq)) for seq in expected]
+        for bufferSize in range(1, len(data) + 2):
+            self.assertEqual(
+                expected,
+                list(fastaRecords(StringIO(data), bufferSize=bufferSize)))
+
+
+class TestFastaReadsNativeParser(TestCase):
+    """
+    Tests for the L{dark.fasta.FastaReads} class when using the native
+    parser.
+    """
+
+    def testUnknownParser(self):
+        """
+        An unknown parser name must result in a ValueError.
+        """
+        error = ("^Unknown FASTA parser 'xxx'. Known parsers: biopython, "
+                 "native\\.$")
+        assertRaisesRegex(self, ValueError, error, FastaReads,
+                          'filename.fasta', parser='xxx')
+
+    def testEmpty(self):
+        """
+        An empty FASTA file results in an empty iterator.
+        """
+        with patch.object(builtins, 'open', mock_open()):
+            reads = FastaReads('filename.fasta', parser='native')
+            self.assertEqual([], list(reads))
+
+    def testTwoReads(self):
+        """
+        A FASTA file with two reads must be read properly and its
+        sequences must be returned in the correct order.
+        """
+        data = '\n'.join(['>id1', 'ACGT', '>id2', 'TGCA'])
+        with patch.object(builtins, 'open', mock_open(read_data=data)):
+            reads = list(FastaReads('filename.fasta', parser='native'))
+            self.assertEqual([Read('id1', 'ACGT'), Read('id2', 'TGCA')], reads)
+
+    def testTypeAA(self):
+        """
+        A FASTA file whose read class is AARead must result in reads that
+        are instances of AARead.
+        """
+        data = '\n'.join(['>id1', 'ACGST'])
+        with patch.object(builtins, 'open', mock_open(read_data=data)):
+            reads = list(FastaReads('filename.fasta', AARead,
+                                    parser='native'))
+            self.assertTrue(isinstance(reads[0], AARead))
+
+    def testConvertLowerToUpperCase(self):
+        """
+        A read needs to be converted from lower to upper case if specified.
+        """
+        data = '\n'.join(['>id1', 'actg'])
+        with patch.object(builtins, 'open', mock_open(read_data=data)):
+            reads = list(FastaReads('filename.fasta', upperCase=True,
+                                    parser='native'))
+            self.assertEqual([DNARead('id1', 'ACTG')], reads)
+
+    def testOpenFileHandle(self):
+        """
+        An already-open file handle must be read properly.
+        """
+        reads = FastaReads(StringIO('>id1\nACTG\n>id2\nCAGT\n'),
+                           parser='native')
+        self.assertEqual([DNARead('id1', 'ACTG'), DNARead('id2', 'CAGT')],
+                         list(reads))
+
+
 class TestCombineReads(TestCase):
     """
     Tests for the L{dark.fasta.combineReads} function.
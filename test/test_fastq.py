@@ -1,9 +1,11 @@
 from six.moves import builtins
 
 from dark.reads import AARead, DNARead, RNARead
-from dark.fastq import FastqReads
+from dark.fastq import FastqReads, fastqRecords
 from dark.utils import StringIO
 
+from io import BytesIO
+from six import assertRaisesRegex
 from unittest import TestCase, skip
 
 try:
@@ -119,3 +121,114 @@ class TestFastqReads(TestCase):
                     DNARead('id2', 'CAGT', '!!!!'),
                 ],
                 list(reads))
+
+
+class TestFastqRecords(TestCase):
+    """
+    Tests for the L{dark.fastq.fastqRecords} function.
+    """
+
+    def testEmpty(self):
+        """
+        An empty file must result in no records.
+        """
+        self.assertEqual([], list(fastqRecords(StringIO(''))))
+
+    def testTwoRecords(self):
+        """
+        A file with two records must be parsed correctly.
+        """
+        data = '@id1\nACGT\n+\n!!!!\n@id2 desc\nTG\n+id2 desc\n@@\n'
+        self.assertEqual([('id1', 'ACGT', '!!!!'), ('id2 desc', 'TG', '@@')],
+                         list(fastqRecords(StringIO(data))))
+
+    def testBytes(self):
+        """
+        A file opened in binary mode must be parsed correctly.
+        """
+        data = b'@id1\nACGT\n+\n!!!!'
+        self.assertEqual([('id1', 'ACGT', '!!!!')],
+                         list(fastqRecords(BytesIO(data))))
+
+    def testWrapped(self):
+        """
+        Multi-line sequences and quality strings must be joined.
+        """
+        data = '@id1\nAC\nGT\n+\n@!\n!@\n'
+        self.assertEqual([('id1', 'ACGT', '@!!@')],
+                         list(fastqRecords(StringIO(data))))
+
+    def testSmallBuffers(self):
+        """
+        The records found must not depend on the buffer size.
+        """
+        data = '@id1\nACGT\n+\n!!!!\n\n@id2\nTG\n+\n@@\n'
+        for bufferSize in range(1, len(data) + 2):
+            self.assertEqual(
+                [('id1', 'ACGT', '!!!!'), ('id2', 'TG', '@@')],
+                list(fastqRecords(StringIO(data), bufferSize=bufferSize)))
+
+    def testBadTitle(self):
+        """
+        A record that does not start with @ must result in a ValueError.
+        """
+        error = "^FASTQ record title line does not start with @: 'id1'$"
+        assertRaisesRegex(self, ValueError, error, list,
+                          fastqRecords(StringIO('id1\nACGT\n+\n!!!!\n')))
+
+    def testTruncated(self):
+        """
+        A record with no + line must result in a ValueError.
+        """
+        error = "^Truncated FASTQ record for 'id1'\\.$"
+        assertRaisesRegex(self, ValueError, error, list,
+                          fastqRecords(StringIO('@id1\nACGT\n')))
+
+    def testQualityLengthMismatch(self):
+        """
+        A record whose quality string is shorter than its sequence must
+        result in a ValueError.
+        """
+        error = (r'^Lengths of sequence and quality values differs for id1 '
+                 r'\(4 and 3\)\.$')
+        assertRaisesRegex(self, ValueError, error, list,
+                          fastqRecords(StringIO('@id1\nACGT\n+\n!!!\n')))
+
+
+class TestFastqReadsNativeParser(TestCase):
+    """
+    Tests for the L{dark.fastq.FastqReads} class when using the native
+    parser.
+    """
+
+    def testUnknownParser(self):
+        """
+        An unknown parser name must result in a ValueError.
+        """
+        error = ("^Unknown FASTQ parser 'xxx'. Known parsers: biopython, "
+                 "native\\.$")
+        assertRaisesRegex(self, ValueError, error, FastqReads,
+                          'filename.fastq', parser='xxx')
+
+    def testTwoReads(self):
+        """
+        A FASTQ file with two reads must be read properly and its
+        sequences must be returned in the correct order.
+        """
+        data = '\n'.join(['@id1', 'ACGT', '+', '!!!!',
+                          '@id2', 'TGCA', '+', '????'])
+        with patch.object(builtins, 'open', mock_open(read_data=data)):
+            reads = list(FastqReads('filename.fastq', parser='native'))
+            self.assertEqual([DNARead('id1', 'ACGT', '!!!!'),
+                              DNARead('id2', 'TGCA', '????')], reads)
+
+    def testTypeAA(self):
+        """
+        A FASTQ file whose read class is AARead must result in reads that
+        are instances of AARead.
+        """
+        data = '\n'.join(['@id1', 'ACGT', '+', '!!!!'])
+        with patch.object(builtins, 'open', mock_open(read_data=data)):
+            reads = list(FastqReads('filename.fastq', AARead,
+                                    parser='native'))
+            self.assertTrue(isinstance(reads[0], AARead))
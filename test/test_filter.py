@@ -1,3 +1,4 @@
+import argparse
 from six.moves import builtins
 from unittest import TestCase
 
@@ -6,7 +7,9 @@ try:
 except ImportError:
     from mock import patch
 
-from dark.filter import ReadSetFilter, TitleFilter
+from dark.filter import (
+    ReadSetFilter, TitleFilter, addFASTAFilteringCommandLineOptions,
+    filteringCommandLineOptionsKey)
 from dark.reads import Read
 from dark.titles import TitleAlignment, TitleAlignments
 
@@ -343,3 +346,41 @@ class FakeDbConnection(object):
 
     def close(self):
         self.open = False
+
+
+class FilteringCommandLineOptionsKeyTest(TestCase):
+    """
+    Tests for the dark.filter.filteringCommandLineOptionsKey function.
+    """
+    def parse(self, args):
+        parser = argparse.ArgumentParser()
+        addFASTAFilteringCommandLineOptions(parser)
+        parser.add_argument('--other')
+        return parser.parse_args(args)
+
+    def testSameOptions(self):
+        """
+        The same filtering options must give the same key, and other options
+        must not change it.
+        """
+        self.assertEqual(
+            filteringCommandLineOptionsKey(self.parse(['--minLength', '5'])),
+            filteringCommandLineOptionsKey(
+                self.parse(['--minLength', '5', '--other', 'x'])))
+
+    def testDifferentOptions(self):
+        """
+        Different filtering options must give different keys.
+        """
+        self.assertNotEqual(
+            filteringCommandLineOptionsKey(self.parse(['--minLength', '5'])),
+            filteringCommandLineOptionsKey(self.parse(['--minLength', '6'])))
+
+    def testRandom(self):
+        """
+        Options that select reads at random must result in a C{None} key.
+        """
+        self.assertIsNone(filteringCommandLineOptionsKey(
+            self.parse(['--sampleFraction', '0.5'])))
+        self.assertIsNone(filteringCommandLineOptionsKey(
+            self.parse(['--randomSubset', '3'])))
@@ -1,8 +1,10 @@
 from unittest import TestCase
+from os import close, unlink, write
 from os.path import dirname, join
+from tempfile import mkstemp
 
 import dark
-from dark.genomes import GenomeProteinInfo
+from dark.genomes import GenomeProteinInfo, addSAMToGenomes
 from dark.civ.proteins import SqliteIndex
 
 TOP = dirname(dirname(dark.__file__))
@@ -204,3 +206,199 @@ class TestGenomeProteinInfo(TestCase):
         # matching nucleotides.
         info = gpi.proteinCoverageInfo('AJF20804.1', 199)
         self.assertEqual({'query1'}, info['readIds'])
+
+    def _addSAM(self, data, **kwargs):
+        """
+        Make a GenomeProteinInfo instance and add SAM data to it.
+
+        @param data: A C{list} of C{str} SAM lines, with fields separated by
+            spaces.
+        @param kwargs: Keyword arguments to pass to C{addSAM}.
+        @return: A C{GenomeProteinInfo} instance.
+        """
+        fd, filename = mkstemp()
+        write(fd, '\n'.join(data).replace(' ', '\t').encode('utf-8'))
+        close(fd)
+
+        try:
+            gpi = GenomeProteinInfo('KJ586809.1', DB, True)
+            gpi.addSAM(filename, **kwargs)
+        finally:
+            unlink(filename)
+
+        return gpi
+
+    def testAddSAMToGenomes(self):
+        """
+        Adding SAM files with addSAMToGenomes must give the expected result.
+        """
+        gpi = GenomeProteinInfo('KJ586809.1', DB, True)
+        for filename in BAM1, BAM2, BAM3:
+            addSAMToGenomes([gpi], filename)
+
+        self.assertEqual([BAM1, BAM2, BAM3], gpi.samFiles)
+        # There are 50 offsets that are covered twice.
+        self.assertEqual(set(range(200)) | set(range(1000, 1500)),
+                         set(gpi.coveredOffsetCount))
+        self.assertEqual([1] * 650 + [2] * 50,
+                         sorted(gpi.coveredOffsetCount.values()))
+        self.assertEqual({'query1', 'query2', 'query3'},
+                         gpi.readIdsMatchingGenome)
+        self.assertEqual({'query2', 'query3'}, gpi.offsets[1400]['readIds'])
+
+        info = gpi.proteinCoverageInfo('AJF20804.1')
+        self.assertEqual(700, info['coveredOffsets'])
+        self.assertEqual(750, info['totalBases'])
+        self.assertEqual({'query1', 'query2', 'query3'}, info['readIds'])
+
+    def testOrphansIgnored(self):
+        """
+        Alignments of paired reads that are not in a proper pair must be
+        ignored, unless ignoreOrphans is C{False}.
+        """
+        data = [
+            '@SQ SN:KJ586809.1 LN:3221',
+            'query1 65 KJ586809.1 1 60 10M = 101 0 %s %s' % ('A' * 10,
+                                                             'I' * 10),
+            'query2 0 KJ586809.1 6 60 10M * 0 0 %s %s' % ('A' * 10, 'I' * 10),
+        ]
+
+        gpi = self._addSAM(data)
+        self.assertEqual({'query2'}, gpi.readIdsMatchingGenome)
+        self.assertEqual(list(range(5, 15)), list(gpi.coveredOffsetCount))
+
+        gpi = self._addSAM(data, ignoreOrphans=False)
+        self.assertEqual({'query1', 'query2'}, gpi.readIdsMatchingGenome)
+        self.assertEqual([1] * 5 + [2] * 5 + [1] * 5,
+                         list(gpi.coveredOffsetCount.values()))
+
+    def testLowQualityBasesIgnored(self):
+        """
+        Read bases with a quality below 13 must not count as covering the
+        genome, and deleted offsets must use the quality of the next read
+        base. A read with no bases of sufficient quality must not be
+        counted as matching the genome.
+        """
+        data = [
+            '@SQ SN:KJ586809.1 LN:3221',
+            # Quality '-' is 12 and '.' is 13.
+            'query1 0 KJ586809.1 1 60 4M2D2M2D4M * 0 0 %s %s' % (
+                'A' * 10, 'II-.-I.III'),
+            'query2 0 KJ586809.1 1 60 5M * 0 0 %s %s' % ('A' * 5, '-----'),
+        ]
+
+        gpi = self._addSAM(data)
+        self.assertEqual({'query1'}, gpi.readIdsMatchingGenome)
+        self.assertEqual([0, 1, 3, 7, 8, 9, 10, 11, 12, 13],
+                         list(gpi.coveredOffsetCount))
+        info = gpi.proteinCoverageInfo('AJF20804.1', 10)
+        self.assertEqual({'query1'}, info['readIds'])
+        info = gpi.proteinCoverageInfo('AJF20804.1', 11)
+        self.assertEqual(set(), info['readIds'])
+
+        gpi = self._addSAM(data, minBaseQuality=0)
+        self.assertEqual({'query1', 'query2'}, gpi.readIdsMatchingGenome)
+        self.assertEqual([2] * 5 + [1] * 9,
+                         list(gpi.coveredOffsetCount.values()))
+
+    def testOverlappingMates(self):
+        """
+        Where the mates of a proper pair overlap, only one of them must be
+        counted, unless ignoreOverlaps is C{False}. Where the bases of the
+        mates disagree, the base with the higher quality is counted.
+        """
+        data = [
+            '@SQ SN:KJ586809.1 LN:3221',
+            'query1 99 KJ586809.1 1 60 10M = 6 15 %s %s' % ('A' * 10,
+                                                            '5' * 10),
+            'query1 147 KJ586809.1 6 60 10M = 1 -15 %s %s' % (
+                'AACCA' + 'A' * 5, '55++5' + '5' * 5),
+        ]
+
+        gpi = self._addSAM(data)
+        self.assertEqual([1] * 15, list(gpi.coveredOffsetCount.values()))
+        self.assertEqual(list(range(15)), list(gpi.coveredOffsetCount))
+
+        # At offsets 7 and 8 the bases disagree, so the base of the first
+        # mate (quality 20) is counted but its quality is reduced to 16.
+        gpi = self._addSAM(data, minBaseQuality=17)
+        self.assertEqual([0, 1, 2, 3, 4, 5, 6, 9, 10, 11, 12, 13, 14],
+                         list(gpi.coveredOffsetCount))
+
+        gpi = self._addSAM(data, ignoreOverlaps=False)
+        self.assertEqual([1] * 5 + [2, 2, 1, 1, 2] + [1] * 5,
+                         list(gpi.coveredOffsetCount.values()))
+
+    def testOverlappingMatesWithDeletion(self):
+        """
+        Where one of two overlapping mates has a deletion, the coverage must
+        be the same as in a pysam pileup. The bases of the other mate that
+        are aligned to the deletion are not counted, and the deleted offsets
+        are covered according to the (adjusted) quality of the next base,
+        except for the offsets a pileup reports before it reads the second
+        mate, which use the original quality.
+        """
+        first = 'query3 99 KJ586809.1 1 60 2M6D5M = 7 14 AAAAAAA 55+5555'
+        second = ('query3 147 KJ586809.1 7 60 8M = 1 -14 AAAAAAAA '
+                  '++++++++')
+        other = 'query4 0 KJ586809.1 5 60 1M * 0 0 A 5'
+
+        # The quality of the base after the deletion (10) is added to that
+        # of the matching base of the second mate (10), so all the deleted
+        # offsets are covered.
+        gpi = self._addSAM(['@SQ SN:KJ586809.1 LN:3221', first, second])
+        self.assertEqual(list(range(13)), list(gpi.coveredOffsetCount))
+
+        # Offsets 2 and 3 are reported (with the original quality of the
+        # base after the deletion) before the second mate is read.
+        gpi = self._addSAM(['@SQ SN:KJ586809.1 LN:3221', first, other,
+                            second])
+        self.assertEqual([0, 1] + list(range(4, 13)),
+                         list(gpi.coveredOffsetCount))
+        self.assertEqual(2, gpi.coveredOffsetCount[4])
+
+    def testReadWithTwoAlignments(self):
+        """
+        If a read has two overlapping alignments, both must be counted in
+        the genome coverage but the read must only be counted once at each
+        protein offset. Secondary alignments and alignments to other
+        references must be ignored.
+        """
+        data = '\n'.join([
+            '@SQ SN:KJ586809.1 LN:3221',
+            '@SQ SN:other LN:1000',
+            'query1 0 KJ586809.1 1 60 10M * 0 0 %s %s' % ('A' * 10, 'I' * 10),
+            'query1 2048 KJ586809.1 6 60 10M * 0 0 %s %s' % ('A' * 10,
+                                                             'I' * 10),
+            'query1 256 KJ586809.1 101 60 10M * 0 0 * *',
+            'query2 0 other 1 60 10M * 0 0 %s %s' % ('A' * 10, 'I' * 10),
+        ]).replace(' ', '\t')
+
+        fd, filename = mkstemp()
+        write(fd, data.encode('utf-8'))
+        close(fd)
+
+        try:
+            gpi = GenomeProteinInfo('KJ586809.1', DB, True)
+            gpi.addSAM(filename)
+        finally:
+            unlink(filename)
+
+        self.assertEqual([1] * 5 + [2] * 5 + [1] * 5,
+                         list(gpi.coveredOffsetCount.values()))
+        self.assertEqual(list(range(15)), list(gpi.coveredOffsetCount))
+        self.assertEqual({'query1'}, gpi.readIdsMatchingGenome)
+        self.assertEqual({'query1'}, gpi.offsets[7]['readIds'])
+
+        # AJF20804.1 coverage (its ranges are 2306-3221 and 0-1623)
+        info = gpi.proteinCoverageInfo('AJF20804.1')
+        self.assertEqual(15, info['coveredOffsets'])
+        self.assertEqual(15, info['totalBases'])
+        self.assertEqual({'query1'}, info['readIds'])
+
+        info = gpi.proteinCoverageInfo('AJF20804.1', 15)
+        self.assertEqual({'query1'}, info['readIds'])
+
+        info = gpi.proteinCoverageInfo('AJF20804.1', 16)
+        self.assertEqual(set(), info['readIds'])
+        self.assertEqual(0, info['totalBases'])
@@ -1,6 +1,7 @@
+from pickle import dumps, loads
 from unittest import TestCase
 
-from dark.hsp import HSP, LSP
+from dark.hsp import HSP, LSP, SlottedHSP, SlottedLSP
 
 
 class TestHSP(TestCase):
@@ -170,3 +171,96 @@ class TestLSP(TestCase):
                 'subjectMatchedSequence': 'ccc',
             },
             lsp.toDict())
+
+
+class _Source(object):
+    """
+    A source of matched sequences, for testing lazy loading.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def matchedSequences(self, index):
+        self.calls.append(index)
+        return 'read%d' % index, 'subject%d' % index
+
+
+class TestSlottedHSP(TestCase):
+    """
+    Tests of the L{dark.hsp.SlottedHSP} class.
+    """
+    def testToDictAsHSP(self):
+        """
+        The toDict method must return the same dictionary as that of an HSP
+        made with the same arguments.
+        """
+        kwargs = dict(readStart=1, readEnd=2, readStartInSubject=3,
+                      readEndInSubject=4, subjectStart=5, subjectEnd=6,
+                      readMatchedSequence='aaa', subjectMatchedSequence='ccc',
+                      readFrame=7, subjectFrame=8, identicalCount=9,
+                      percentIdentical=99.3, positiveCount=10,
+                      percentPositive=3.0)
+        self.assertEqual(HSP(4, **kwargs).toDict(),
+                         SlottedHSP(4, **kwargs).toDict())
+
+    def testNoDict(self):
+        """
+        A SlottedHSP must not have an instance __dict__.
+        """
+        self.assertFalse(hasattr(SlottedHSP(7), '__dict__'))
+        self.assertRaises(AttributeError, setattr, SlottedHSP(7), 'x', 1)
+
+    def testCompare(self):
+        """
+        SlottedHSPs must compare as HSPs do.
+        """
+        self.assertEqual(SlottedHSP(7), SlottedHSP(7))
+        self.assertTrue(SlottedHSP(7) < SlottedHSP(8))
+        self.assertTrue(SlottedHSP(7).betterThan(5))
+
+    def testLazySequences(self):
+        """
+        If a sequence source is given, the matched sequences must be loaded
+        from it only when they are accessed.
+        """
+        source = _Source()
+        hsp = SlottedHSP(7, readStart=1, sequenceSource=source,
+                         sequenceIndex=3)
+        self.assertEqual([], source.calls)
+        self.assertEqual('read3', hsp.readMatchedSequence)
+        self.assertEqual('subject3', hsp.subjectMatchedSequence)
+        self.assertEqual([3, 3], source.calls)
+
+    def testPickle(self):
+        """
+        A pickled SlottedHSP with a sequence source must be unpickled with
+        its matched sequences, and without the source.
+        """
+        hsp = SlottedHSP(7, readStart=1, readFrame=2,
+                         sequenceSource=_Source(), sequenceIndex=3)
+        unpickled = loads(dumps(hsp, 2))
+        self.assertEqual(hsp.toDict(), unpickled.toDict())
+        self.assertIsNone(unpickled._sequenceSource)
+
+
+class TestSlottedLSP(TestCase):
+    """
+    Tests of the L{dark.hsp.SlottedLSP} class.
+    """
+    def testCompare(self):
+        """
+        SlottedLSPs must compare as LSPs do.
+        """
+        self.assertEqual(SlottedLSP(7), SlottedLSP(7))
+        self.assertTrue(SlottedLSP(8) < SlottedLSP(7))
+        self.assertTrue(SlottedLSP(5).betterThan(7))
+
+    def testToDictAsLSP(self):
+        """
+        The toDict method must return the same dictionary as that of an LSP
+        made with the same arguments.
+        """
+        kwargs = dict(readStart=1, readEnd=2, readMatchedSequence='aaa',
+                      subjectMatchedSequence='ccc')
+        self.assertEqual(LSP(4, **kwargs).toDict(),
+                         SlottedLSP(4, **kwargs).toDict())
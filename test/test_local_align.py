@@ -2,7 +2,7 @@ import six
 from unittest import TestCase
 
 from dark.reads import Read
-from dark.local_align import LocalAlignment
+from dark.local_align import LocalAlignment, alignToReference
 
 
 class TestLocalAlign(TestCase):
@@ -298,3 +298,266 @@ class TestLocalAlign(TestCase):
             },
             result
         )
+
+    def testNegativeBand(self):
+        """
+        If the band passed is negative, an exception must be raised.
+        """
+        seq1 = Read('seq1', 'a')
+        seq2 = Read('seq2', 'a')
+        six.assertRaisesRegex(self, ValueError, 'Band must not be negative',
+                              LocalAlignment, seq1, seq2, band=-1)
+
+    def testBandWithGapExtendDecay(self):
+        """
+        If a band and a gap extend decay are both passed, an exception must
+        be raised.
+        """
+        seq1 = Read('seq1', 'a')
+        seq2 = Read('seq2', 'a')
+        six.assertRaisesRegex(
+            self, ValueError,
+            'A band cannot be used with a gap extend decay',
+            LocalAlignment, seq1, seq2, band=3, gapExtendDecay=0.5)
+
+    def testWikiAnswerWithBand(self):
+        """
+        Test the example given in Wikipedia using a band that is wide enough
+        to contain the best alignment.
+        """
+        seq1 = Read('seq1', 'ACACACTA')
+        seq2 = Read('seq2', 'AGCACACA')
+        align = LocalAlignment(seq1, seq2, match=2, band=1)
+        result = align.createAlignment()
+        self.assertEqual('1=1I5=1D1=', result['cigar'])
+        self.assertEqual(1, result['sequence1Start'])
+        self.assertEqual(8, result['sequence2End'])
+
+    def testZeroBand(self):
+        """
+        With a band of zero, the alignment cannot contain gaps.
+        """
+        seq1 = Read('seq1', 'AACCGGTT')
+        seq2 = Read('seq2', 'AACGGTT')
+        self.assertEqual(
+            '2=1D5=', LocalAlignment(seq1, seq2).createAlignment()['cigar'])
+        align = LocalAlignment(seq1, seq2, band=0)
+        self.assertEqual('3=1X1=1X1=', align.createAlignment()['cigar'])
+
+    def testAffineGap(self):
+        """
+        When opening a gap costs more than extending one, a single long gap
+        must be preferred.
+        """
+        seq1 = Read('seq1', 'CCCCAAAAGGGG')
+        seq2 = Read('seq2', 'CCCCGGGG')
+        align = LocalAlignment(seq1, seq2, match=2, gap=-2, gapExtend=0)
+        result = align.createAlignment()
+        self.assertEqual('4=4D4=', result['cigar'])
+        self.assertEqual(
+            [
+                'seq1 1 CCCCAAAAGGGG 12',
+                '       ||||    ||||',
+                'seq2 1 CCCC----GGGG 8',
+            ],
+            result['text'])
+
+    def testUnequalGapPenalties(self):
+        """
+        When the gap open and extend penalties differ, the alignment made
+        with NumPy arrays must be the same as the one made with a table of
+        C{dict}s. In that table, a gap is only extended if the cell above
+        was reached by a gap of the same kind.
+        """
+        pairs = [
+            ({'gap': -3, 'gapExtend': -1}, 'AGCGACGGAATTA', 'AGCGACGATTA'),
+            ({'gap': -3, 'gapExtend': -1}, 'CACCCTTGGTGTAT',
+             'CACCCTTGGTTCGTAT'),
+            ({'gap': -3, 'gapExtend': -1}, 'CCCTAACAGAGTTT',
+             'CCCTAACACGAGAGTTT'),
+            ({'gap': -1, 'gapExtend': -3}, 'TTGAGGATTGA', 'TGATTATA'),
+            ({'gap': -1, 'gapExtend': -3}, 'TTTGCTCT', 'GCTACCT'),
+            ({'gap': -1, 'gapExtend': -3}, 'CCAGATGG', 'CTTCCACTGACT'),
+        ]
+        for kwargs, sequence1, sequence2 in pairs:
+            align = LocalAlignment(Read('seq1', sequence1),
+                                   Read('seq2', sequence2), **kwargs)
+            table = align._initialise()
+            expected = align._fillAndTraceback(table)
+            _, maxRow, maxCol, (flags, rowStarts) = align._fillArrays()
+            self.assertEqual(expected, align._tracebackArrays(
+                maxRow, maxCol, flags, rowStarts))
+            self.assertEqual(
+                {
+                    'score': max(cell['score'] for row in table
+                                 for cell in row),
+                    'sequence1End': expected[1]['max_col'],
+                    'sequence2End': expected[1]['max_row'],
+                },
+                align.score())
+
+    def testUnequalGapPenaltiesResult(self):
+        """
+        With a gap open penalty of 3 and an extend penalty of 1, a two
+        nucleotide deletion must not be part of the best alignment of two
+        sequences that differ only by it (because the gap is opened twice).
+        """
+        seq1 = Read('seq1', 'AGCGACGGAATTA')
+        seq2 = Read('seq2', 'AGCGACGATTA')
+        align = LocalAlignment(seq1, seq2, gap=-3, gapExtend=-1)
+        self.assertEqual('7=', align.createAlignment()['cigar'])
+
+    def testScore(self):
+        """
+        The score method must return the best score and where the best
+        alignment ends.
+        """
+        seq1 = Read('seq1', 'ACACACTA')
+        seq2 = Read('seq2', 'AGCACACA')
+        align = LocalAlignment(seq1, seq2, match=2)
+        self.assertEqual(
+            {
+                'score': 12,
+                'sequence1End': 8,
+                'sequence2End': 8,
+            },
+            align.score())
+
+    def testScoreWithBand(self):
+        """
+        The score method must return the best score in the band.
+        """
+        seq1 = Read('seq1', 'CCCCAAAAGGGG')
+        seq2 = Read('seq2', 'CCCCGGGG')
+        align = LocalAlignment(seq1, seq2, gap=-2, gapExtend=0, band=2)
+        self.assertEqual(4, align.score()['score'])
+
+    def testScoreNoAlignment(self):
+        """
+        The score method must return C{None} when two completely different
+        sequences are given.
+        """
+        seq1 = Read('seq1', 'aaaaaa')
+        seq2 = Read('seq2', 'gggggg')
+        align = LocalAlignment(seq1, seq2)
+        self.assertIsNone(align.score())
+
+    def testScoreWithGapExtendDecay(self):
+        """
+        The score method must raise an exception if a gap extend decay is
+        used.
+        """
+        seq1 = Read('seq1', 'acgt')
+        seq2 = Read('seq2', 'acgt')
+        align = LocalAlignment(seq1, seq2, gapExtendDecay=0.5)
+        six.assertRaisesRegex(
+            self, ValueError,
+            'Scores cannot be computed separately when using a gap extend '
+            'decay', align.score)
+
+    def testGapExtendDecay(self):
+        """
+        An alignment with a gap extend decay must still be made.
+        """
+        seq1 = Read('seq1', 'cgaatcg')
+        seq2 = Read('seq2', 'cgaatcg')
+        align = LocalAlignment(seq1, seq2, gapExtendDecay=0.5)
+        self.assertEqual('7=', align.createAlignment()['cigar'])
+
+
+class TestAlignToReference(TestCase):
+    """
+    Test the alignToReference function.
+    """
+    REFERENCE = Read('ref', 'ACACACTA')
+    QUERIES = [
+        Read('query1', 'AGCACACA'),
+        Read('query2', 'gggggg'),
+        Read('query3', 'CACTT'),
+    ]
+
+    def testNoQueries(self):
+        """
+        If no queries are given, no results must be returned.
+        """
+        self.assertEqual([], list(alignToReference(self.REFERENCE, [])))
+
+    def testDict(self):
+        """
+        The results must be the same as those from LocalAlignment, in the
+        order of the queries.
+        """
+        self.assertEqual(
+            [LocalAlignment(self.REFERENCE, query, match=2).createAlignment()
+             for query in self.QUERIES],
+            list(alignToReference(self.REFERENCE, iter(self.QUERIES),
+                                  match=2)))
+
+    def testStr(self):
+        """
+        Results must be returned as strings when requested.
+        """
+        self.assertEqual(
+            [LocalAlignment(self.REFERENCE, query, band=2).createAlignment(
+                resultFormat=str) for query in self.QUERIES],
+            list(alignToReference(self.REFERENCE, self.QUERIES, band=2,
+                                  resultFormat=str)))
+
+    def testWorkers(self):
+        """
+        Using worker processes must give the same results.
+        """
+        self.assertEqual(
+            list(alignToReference(self.REFERENCE, self.QUERIES, gap=-2,
+                                  gapExtend=0)),
+            list(alignToReference(self.REFERENCE, self.QUERIES, gap=-2,
+                                  gapExtend=0, workers=2, chunkSize=1)))
+
+    def testEmptyQuery(self):
+        """
+        If a query is empty, an exception must be raised.
+        """
+        six.assertRaisesRegex(self, ValueError, 'Empty sequence: query',
+                              list, alignToReference(self.REFERENCE,
+                                                     [Read('query', '')]))
+
+    def testWorkersChunks(self):
+        """
+        Using worker processes with chunks of several queries (the last one
+        not full) must give the same results, in order.
+        """
+        queries = self.QUERIES * 5
+        self.assertEqual(
+            list(alignToReference(self.REFERENCE, queries)),
+            list(alignToReference(self.REFERENCE, iter(queries), workers=2,
+                                  chunkSize=4)))
+
+    def testWorkersReadQueriesAsNeeded(self):
+        """
+        When worker processes are used, queries must only be read as they are
+        needed: at most twice the number of workers chunks of queries ahead
+        of the results that have been returned.
+        """
+        taken = []
+
+        def queries():
+            for index in range(100):
+                taken.append(index)
+                yield Read('query%d' % index, 'CACTT')
+
+        results = alignToReference(self.REFERENCE, queries(), workers=2,
+                                   chunkSize=3)
+        next(results)
+        self.assertEqual(12, len(taken))
+        self.assertEqual(99, len(list(results)))
+        self.assertEqual(100, len(taken))
+
+    def testEmptyQueryInWorker(self):
+        """
+        If a query aligned in a worker process is empty, an exception must be
+        raised.
+        """
+        six.assertRaisesRegex(self, ValueError, 'Empty sequence: query',
+                              list, alignToReference(self.REFERENCE,
+                                                     [Read('query', '')],
+                                                     workers=2))
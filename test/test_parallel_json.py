@@ -0,0 +1,216 @@
+import bz2
+import gzip
+from json import dumps
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from dark.parallel_json import (
+    compression, parallelJSONLines, segmentBoundaries)
+from dark.diamond.alignments import DiamondReadsAlignments
+from dark.reads import Read, Reads
+
+from .diamond.sample_data import PARAMS, RECORD0, RECORD1, RECORD2
+
+# Enough lines that small segments cut lines in two.
+VALUES = [{'line': i, 'text': 'x' * (i % 17)} for i in range(500)]
+
+
+def _compress(data, compressor, memberSize):
+    """
+    Compress data as many independent streams or members.
+
+    @param data: The C{bytes} to compress.
+    @param compressor: A function to compress C{bytes}.
+    @param memberSize: The C{int} number of uncompressed bytes to put into
+        each stream or member.
+    @return: The compressed C{bytes}.
+    """
+    return b''.join(compressor(data[start:start + memberSize])
+                    for start in range(0, len(data), memberSize))
+
+
+class _Mixin(object):
+    """
+    Write test files into a temporary directory.
+    """
+    def setUp(self):
+        self.tempdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def writeFile(self, name, values, memberSize=100, text=None):
+        """
+        Write JSON lines to a file, compressed according to its name.
+
+        @param name: The C{str} name of the file.
+        @param values: A C{list} of values to write, one per line.
+        @param memberSize: The C{int} number of uncompressed bytes to put
+            into each stream or member.
+        @param text: If not C{None}, a C{str} to write instead of C{values}.
+        @return: The C{str} path to the file.
+        """
+        if text is None:
+            text = ''.join(dumps(value) + '\n' for value in values)
+        data = text.encode('UTF-8')
+        fileCompression = compression(name)
+        if fileCompression == 'bz2':
+            data = _compress(data, bz2.compress, memberSize)
+        elif fileCompression == 'gzip':
+            data = _compress(data, gzip.compress, memberSize)
+        filename = join(self.tempdir, name)
+        with open(filename, 'wb') as fp:
+            fp.write(data)
+        return filename
+
+
+class TestSegmentBoundaries(_Mixin, TestCase):
+    """
+    Test the segmentBoundaries function.
+    """
+    def testEmpty(self):
+        """
+        An empty file must have one (empty) segment.
+        """
+        filename = self.writeFile('file.bz2', [], text='')
+        self.assertEqual([0, 0], segmentBoundaries(filename, 'bz2'))
+
+    def testSingleStream(self):
+        """
+        A file with a single bzip2 stream must have one segment.
+        """
+        filename = self.writeFile('file.bz2', VALUES, memberSize=10 ** 6)
+        boundaries = segmentBoundaries(filename, 'bz2', segmentSize=10)
+        self.assertEqual(2, len(boundaries))
+
+    def testManyMembers(self):
+        """
+        Files with many bzip2 streams or gzip members must be cut into many
+        segments, at member boundaries.
+        """
+        for name in 'file.bz2', 'file.gz':
+            filename = self.writeFile(name, VALUES)
+            boundaries = segmentBoundaries(filename, compression(name),
+                                           segmentSize=500)
+            self.assertTrue(len(boundaries) > 5)
+            with open(filename, 'rb') as fp:
+                data = fp.read()
+            magic = b'BZh' if name.endswith('.bz2') else b'\x1f\x8b\x08'
+            for offset in boundaries[:-1]:
+                self.assertEqual(magic, data[offset:offset + len(magic)])
+            self.assertEqual(len(data), boundaries[-1])
+
+
+class TestParallelJSONLines(_Mixin, TestCase):
+    """
+    Test the parallelJSONLines function.
+    """
+    def testUncompressed(self):
+        """
+        An uncompressed file must be read correctly.
+        """
+        filename = self.writeFile('file.json', VALUES)
+        self.assertEqual(VALUES, list(parallelJSONLines(filename, 2)))
+
+    def testNoWorkers(self):
+        """
+        A compressed file must be read correctly when no workers are given.
+        """
+        filename = self.writeFile('file.json.bz2', VALUES)
+        self.assertEqual(VALUES, list(parallelJSONLines(filename)))
+
+    def testParallel(self):
+        """
+        Compressed files with many streams or members must be read correctly
+        by several workers, including lines that cross segment boundaries.
+        """
+        for name in 'file.json.bz2', 'file.json.gz':
+            filename = self.writeFile(name, VALUES)
+            self.assertEqual(
+                VALUES,
+                list(parallelJSONLines(filename, 3, segmentSize=300)))
+
+    def testFalseBoundary(self):
+        """
+        If a segment boundary is not really the start of a member, the
+        file must still be read correctly.
+        """
+        filename = self.writeFile('file.json.gz', VALUES)
+        boundaries = segmentBoundaries(filename, 'gzip', segmentSize=300)
+        # Add a boundary that is not at the start of a member.
+        boundaries.insert(3, boundaries[2] + 5)
+        with patch('dark.parallel_json.segmentBoundaries',
+                   return_value=boundaries):
+            self.assertEqual(
+                VALUES,
+                list(parallelJSONLines(filename, 2, segmentSize=300)))
+
+    def testNoFinalNewline(self):
+        """
+        A final line without a newline must be read.
+        """
+        text = '{"a": 1}\n{"b": 2}'
+        filename = self.writeFile('file.json.gz', None, memberSize=4,
+                                  text=text)
+        self.assertEqual([{'a': 1}, {'b': 2}],
+                         list(parallelJSONLines(filename, 2, segmentSize=20)))
+
+    def testBadLine(self):
+        """
+        A line that is not JSON must result in a ValueError that gives the
+        line number, after the earlier lines have been returned.
+        """
+        text = ''.join(dumps(value) + '\n' for value in VALUES[:100])
+        text += 'not JSON\n'
+        filename = self.writeFile('file.json.bz2', None, text=text)
+        values = []
+        error = "^Could not convert line 101 of '.*' to JSON "
+        with self.assertRaisesRegex(ValueError, error):
+            for value in parallelJSONLines(filename, 2, segmentSize=300):
+                values.append(value)
+        self.assertEqual(VALUES[:100], values)
+
+    def testTruncated(self):
+        """
+        A truncated compressed file must result in a ValueError.
+        """
+        filename = self.writeFile('file.json.bz2', VALUES, memberSize=10 ** 6)
+        with open(filename, 'rb') as fp:
+            data = fp.read()
+        with open(filename, 'wb') as fp:
+            fp.write(data[:-20])
+        error = '^Compressed file .* ended before the end of its last stream'
+        self.assertRaisesRegex(ValueError, error, list,
+                               parallelJSONLines(filename, 2))
+
+
+class TestDiamondReadsAlignmentsParallel(_Mixin, TestCase):
+    """
+    DiamondReadsAlignments must read compressed JSON with decompression
+    workers.
+    """
+    def testRecords(self):
+        """
+        The records in a compressed JSON file with many members must be
+        read correctly.
+        """
+        filename = self.writeFile(
+            'file.json.gz', [PARAMS, RECORD0, RECORD1, RECORD2])
+        reads = Reads([Read('id0', 'A' * 70), Read('id1', 'A' * 70),
+                       Read('id2', 'A' * 70)])
+        readsAlignments = DiamondReadsAlignments(
+            reads, filename, decompressionWorkers=2)
+        result = list(readsAlignments)
+        self.assertEqual(['id0', 'id1', 'id2'],
+                         [readAlignments.read.id for readAlignments in result])
+        self.assertEqual(
+            [len(RECORD0['alignments']), len(RECORD1['alignments']),
+             len(RECORD2['alignments'])],
+            [len(readAlignments) for readAlignments in result])
@@ -16,8 +16,8 @@ from dark.errors import ReadLengthsNotIdenticalError
 from dark.fasta import FastaReads
 from dark.hsp import HSP
 from dark.reads import (
-    Read, TranslatedRead, Reads, ReadsInRAM, DNARead, RNARead, DNAKozakRead,
-    AARead, AAReadORF, AAReadWithX, SSAARead, SSAAReadWithX,
+    Read, ReadFilter, TranslatedRead, Reads, ReadsInRAM, DNARead, RNARead,
+    DNAKozakRead, AARead, AAReadORF, AAReadWithX, SSAARead, SSAAReadWithX,
     readClassNameToClass)
 from dark.utils import StringIO
 
@@ -637,6 +637,29 @@ class TestRead(TestCase):
                          Read('id1', 'TAGCTA', '654321').reverse())
 
 
+class TestReadSlots(TestCase):
+    """
+    Test that the standard read classes are slotted.
+    """
+    def testNoDict(self):
+        """
+        Instances of the standard read classes must not have a __dict__.
+        """
+        for read in (Read('id', 'A'), DNARead('id', 'A'), RNARead('id', 'A'),
+                     AARead('id', 'A'), AAReadWithX('id', 'A'),
+                     SSAARead('id', 'A', 'H'),
+                     TranslatedRead(Read('id', 'ATG'), 'M', 0)):
+            self.assertFalse(hasattr(read, '__dict__'))
+
+    def testSubclassKeepsAttributes(self):
+        """
+        Subclasses that add attributes must still store them.
+        """
+        read = TranslatedRead(DNARead('id', 'ATG'), 'M', 1, True)
+        self.assertEqual(1, read.frame)
+        self.assertTrue(read.reverseComplemented)
+
+
 class TestDNARead(TestCase):
     """
     Tests for the DNARead class.
@@ -3193,6 +3216,105 @@ class TestReadsFiltering(TestCase):
                               removeDuplicatesUseMD5=True)
         self.assertEqual([read1], list(result))
 
+    def testFilterDuplicatesUseHash(self):
+        """
+        Filtering on sequence and id duplicates must work correctly when a
+        named hash function is used instead of the sequence or id.
+        """
+        read1 = Read('id1', 'ATCG')
+        read2 = Read('id2', 'ATCG')
+        read3 = Read('id1', 'ATTT')
+        for hash_ in 'fast64', 'fast128', 'md5':
+            result = Reads([read1, read2, read3]).filter(
+                removeDuplicates=True, removeDuplicatesHash=hash_)
+            self.assertEqual([read1, read3], list(result))
+            result = Reads([read1, read2, read3]).filter(
+                removeDuplicatesById=True, removeDuplicatesHash=hash_)
+            self.assertEqual([read1, read2], list(result))
+
+    def testFilterDuplicatesUseHashFunction(self):
+        """
+        It must be possible to pass a function to be used as the hash
+        when removing duplicates.
+        """
+        reads = Reads([Read('id1', 'ATCG'), Read('id2', 'ATCG'),
+                       Read('id3', 'ATT')])
+        result = reads.filter(removeDuplicates=True, removeDuplicatesHash=len)
+        self.assertEqual(['id1', 'id3'], [read.id for read in result])
+
+    def testFilterDuplicatesHashWithoutRemoveDuplicates(self):
+        """
+        Passing removeDuplicatesHash without removeDuplicates or
+        removeDuplicatesById must result in a ValueError.
+        """
+        error = ('^If you specify removeDuplicatesHash, you need to also '
+                 'use one of removeDuplicates or removeDuplicatesById\\.$')
+        six.assertRaisesRegex(self, ValueError, error, Reads().filter,
+                              removeDuplicatesHash='fast64')
+
+    def testFilterDuplicatesBloom(self):
+        """
+        Filtering on sequence and id duplicates must work correctly when a
+        Bloom filter is used.
+        """
+        read1 = Read('id1', 'ATCG')
+        read2 = Read('id2', 'ATCG')
+        read3 = Read('id1', 'ATTT')
+        result = Reads([read1, read2, read3]).filter(
+            removeDuplicates=True, removeDuplicatesBloomCapacity=100)
+        self.assertEqual([read1, read3], list(result))
+        result = Reads([read1, read2, read3]).filter(
+            removeDuplicatesById=True, removeDuplicatesBloomMaxBytes=100,
+            removeDuplicatesBloomErrorRate=0.01)
+        self.assertEqual([read1, read2], list(result))
+
+    def testFilterDuplicatesBloomWithoutRemoveDuplicates(self):
+        """
+        Passing a Bloom filter capacity without removeDuplicates or
+        removeDuplicatesById must result in a ValueError.
+        """
+        error = ('^If you specify a Bloom filter capacity or maximum size, '
+                 'you need to also use one of removeDuplicates or '
+                 'removeDuplicatesById\\.$')
+        six.assertRaisesRegex(self, ValueError, error, Reads().filter,
+                              removeDuplicatesBloomCapacity=10)
+
+    def testFilterDuplicatesBloomErrorRateOnly(self):
+        """
+        Passing a Bloom filter error rate without a capacity or maximum
+        size must result in a ValueError.
+        """
+        error = ('^If you specify removeDuplicatesBloomErrorRate, you need '
+                 'to also use removeDuplicatesBloomCapacity or '
+                 'removeDuplicatesBloomMaxBytes\\.$')
+        six.assertRaisesRegex(self, ValueError, error, Reads().filter,
+                              removeDuplicates=True,
+                              removeDuplicatesBloomErrorRate=0.1)
+
+    def testFilterDuplicatesBloomAndHash(self):
+        """
+        Passing a Bloom filter capacity and a hash function must result in
+        a ValueError.
+        """
+        error = ('^A Bloom filter cannot be used with removeDuplicatesHash '
+                 'or removeDuplicatesUseMD5\\.$')
+        six.assertRaisesRegex(self, ValueError, error, Reads().filter,
+                              removeDuplicates=True,
+                              removeDuplicatesUseMD5=True,
+                              removeDuplicatesBloomCapacity=10)
+
+    def testFilterDuplicatesHashAndMD5(self):
+        """
+        Passing both removeDuplicatesUseMD5 and a removeDuplicatesHash that
+        is not md5 must result in a ValueError.
+        """
+        error = ('^removeDuplicatesUseMD5 and removeDuplicatesHash cannot be '
+                 'used simultaneously\\.$')
+        six.assertRaisesRegex(self, ValueError, error, Reads().filter,
+                              removeDuplicates=True,
+                              removeDuplicatesUseMD5=True,
+                              removeDuplicatesHash='fast64')
+
     def testFilterRemoveDescriptions(self):
         """
         Removing read id descriptions must work correctly.
@@ -3746,6 +3868,130 @@ class TestReadsFiltering(TestCase):
                               reads.filter(reverseComplement=True))
 
 
+class TestReadFilterStateful(TestCase):
+    """
+    Test the ReadFilter and Reads stateful properties.
+    """
+    def testStateless(self):
+        """
+        A filter whose result for a read does not depend on earlier reads
+        must not be stateful.
+        """
+        self.assertFalse(ReadFilter().stateful)
+        self.assertFalse(ReadFilter(minLength=3, titleRegex='x').stateful)
+        self.assertFalse(Reads().filter(maxLength=3).stateful)
+
+    def testStateful(self):
+        """
+        Filters that use sequence numbers, sampling, head, or duplicate
+        removal must be stateful.
+        """
+        for kwargs in ({'head': 3}, {'keepSequences': {1}},
+                       {'removeSequences': {1}}, {'sampleFraction': 0.5},
+                       {'randomSubset': 2, 'trueLength': 4},
+                       {'removeDuplicates': True},
+                       {'removeDuplicatesById': True}):
+            self.assertTrue(ReadFilter(**kwargs).stateful)
+            self.assertTrue(
+                Reads().filter(minLength=1).filter(**kwargs).stateful)
+
+
+class TestReadsFilteringWithWorkers(TestCase):
+    """
+    Test that filtering reads using worker processes gives the same results
+    as filtering serially.
+    """
+    def _reads(self):
+        """
+        Make a set of reads with some duplicates and some gaps.
+
+        @return: A C{list} of C{DNARead} instances.
+        """
+        result = []
+        for i in range(50):
+            result.append(DNARead('id%d desc' % (i % 40),
+                                  'ACG-TN'[:i % 6 + 1] + 'ACGT' * (i % 7)))
+        return result
+
+    def _check(self, **kwargs):
+        """
+        Check that serial and parallel filtering agree.
+
+        @param kwargs: Keyword arguments for C{Reads.filter}.
+        """
+        expected = list(Reads(self._reads()).filter(**kwargs))
+        reads = Reads(self._reads()).filter(workers=2, chunkSize=7, **kwargs)
+        self.assertEqual(expected, list(reads))
+        self.assertEqual(50, reads.unfilteredLength())
+
+    def testNoOptions(self):
+        """
+        Filtering with no options must give the same result.
+        """
+        self._check()
+
+    def testLengthAndNFraction(self):
+        """
+        Filtering on length and N fraction must give the same result.
+        """
+        self._check(minLength=5, maxLength=20, maxNFraction=0.1)
+
+    def testRemoveDuplicates(self):
+        """
+        Removing duplicates (after removing gaps) must give the same result.
+        """
+        self._check(removeGaps=True, removeDuplicates=True)
+
+    def testRemoveDuplicatesByIdWithIdLambda(self):
+        """
+        Removing duplicates by id must use the id before any id lambda is
+        applied.
+        """
+        self._check(removeDuplicatesById=True,
+                    idLambda='lambda id: id.upper()')
+
+    def testTruncateTitlesAndHead(self):
+        """
+        Title truncation and head must give the same result.
+        """
+        self._check(truncateTitlesAfter='1', head=30)
+
+    def testSequenceNumbersAndSites(self):
+        """
+        Keeping sequences and sites must give the same result.
+        """
+        self._check(keepSequences={1, 5, 9, 20, 33}, keepSites={0, 2, 3},
+                    reverseComplement=True, removeDescriptions=True)
+
+    def testModifier(self):
+        """
+        A modifier function must be applied before the transformations done
+        in the workers.
+        """
+        self._check(modifier=lambda read: (
+            None if read.sequence.startswith('AC') else read),
+            readLambda='lambda r: r[1:]')
+
+    def testRandomSubset(self):
+        """
+        A random subset must be taken (serially) when workers are requested.
+        """
+        reads = Reads(self._reads()).filter(workers=2, randomSubset=10,
+                                            trueLength=50)
+        self.assertEqual(10, len(list(reads)))
+
+    def testTwoFilters(self):
+        """
+        Two filters that use workers must give the same result as when they
+        are applied serially.
+        """
+        expected = list(Reads(self._reads()).filter(minLength=3).filter(
+            removeDuplicates=True, reverse=True))
+        reads = Reads(self._reads()).filter(minLength=3, workers=2).filter(
+            removeDuplicates=True, reverse=True, workers=3, chunkSize=5)
+        self.assertEqual(expected, list(reads))
+
+
 class TestReadsInRAM(TestCase):
     """
     Test the ReadsInRAM class.
@@ -3872,6 +4118,103 @@ class TestReadsInRAM(TestCase):
         self.assertEqual(read2, reads[0])
 
 
+class TestCompactReadsInRAM(TestCase):
+    """
+    Test the ReadsInRAM class when reads are stored compactly.
+    """
+
+    def testNoReads(self):
+        """
+        A compact ReadsInRAM instance with no reads must return an empty
+        iterator and have length zero.
+        """
+        reads = ReadsInRAM(compact=True)
+        self.assertEqual([], list(reads))
+        self.assertEqual(0, len(reads))
+
+    def testAdd(self):
+        """
+        It must be possible to add reads to a compact ReadsInRAM instance.
+        """
+        reads = ReadsInRAM(compact=True)
+        read = Read('id', 'ACGT')
+        reads.add(read)
+        self.assertEqual([read], list(reads))
+
+    def testIterateTwice(self):
+        """
+        A compact ReadsInRAM instance must give the same reads, with and
+        without qualities, each time it is iterated.
+        """
+        expected = [DNARead('id1', 'ACGT', '!!!!'), DNARead('id2', 'AA'),
+                    DNARead('id3 \u00e9', '', '')]
+        reads = ReadsInRAM(expected, compact=True)
+        self.assertEqual(expected, list(reads))
+        self.assertEqual(expected, list(reads))
+
+    def testReadClassesArePreserved(self):
+        """
+        The classes of reads in a compact ReadsInRAM instance must be
+        preserved.
+        """
+        reads = ReadsInRAM([DNARead('id1', 'ACGT'), AARead('id2', 'MMM'),
+                            RNARead('id3', 'ACGU')], compact=True)
+        self.assertEqual([DNARead, AARead, RNARead],
+                         [read.__class__ for read in reads])
+
+    def testIndex(self):
+        """
+        A compact ReadsInRAM instance must be able to be indexed, including
+        with negative indices and slices.
+        """
+        read1 = Read('id1', 'ATCG')
+        read2 = Read('id2', 'AT')
+        reads = ReadsInRAM([read1, read2], compact=True)
+        self.assertEqual(read1, reads[0])
+        self.assertEqual(read2, reads[-1])
+        self.assertEqual([read2], reads[1:])
+
+    def testIndexOutOfRange(self):
+        """
+        Indexing past the end of a compact ReadsInRAM instance must raise an
+        IndexError.
+        """
+        reads = ReadsInRAM([Read('id1', 'ATCG')], compact=True)
+        six.assertRaisesRegex(self, IndexError, '^list index out of range$',
+                              reads.__getitem__, 1)
+
+    def testSetItem(self):
+        """
+        It must be possible to set a value for a compact ReadsInRAM index.
+        """
+        reads = ReadsInRAM([Read('id1', 'ATCG'), Read('id2', 'A')],
+                           compact=True)
+        read3 = TranslatedRead(Read('id3', 'ATG'), 'M', 0)
+        reads[0] = read3
+        self.assertEqual([read3, Read('id2', 'A')], list(reads))
+
+    def testUnsupportedReadClass(self):
+        """
+        Adding a read whose class has extra attributes must raise a
+        ValueError.
+        """
+        error = ('^Reads of class TranslatedRead cannot be stored '
+                 'compactly\\.$')
+        six.assertRaisesRegex(
+            self, ValueError, error, ReadsInRAM,
+            [TranslatedRead(Read('id', 'ATG'), 'M', 0)], compact=True)
+
+    def testFilter(self):
+        """
+        Reads in a compact ReadsInRAM instance must be able to be filtered
+        after being turned back into a Reads instance.
+        """
+        reads = ReadsInRAM([Read('id1', 'ATCG'), Read('id2', 'A')],
+                           compact=True)
+        self.assertEqual([Read('id1', 'ATCG')],
+                         list(Reads(reads).filter(minLength=2)))
+
+
 class TestSummarizePosition(TestCase):
     """
     Tests for the reads.summarizePosition function.
@@ -1,15 +1,20 @@
 from six import assertRaisesRegex
 from unittest import TestCase
-from tempfile import mkstemp
-from os import close, unlink, write
+from tempfile import mkstemp, mkdtemp
+from os import close, unlink, write, utime
+from os.path import join, exists, dirname
+from shutil import rmtree
 from contextlib import contextmanager
 
+import pysam
 from pysam import CHARD_CLIP, CMATCH
 
-from dark.reads import Read, ReadFilter
+from dark.reads import Read, ReadFilter, Reads
 from dark.sam import (
-    PaddedSAM, SAMFilter, UnequalReferenceLengthError, UnknownReference,
-    InvalidSAM, samReferencesToStr, _hardClip)
+    PaddedSAM, SAMFilter, SAMBaseCounts, SAMStats, SAMWriter,
+    UnequalReferenceLengthError,
+    UnknownReference, InvalidSAM, samReferencesToStr, samIsIndexed,
+    samRegions, regionAlignments, mapSAMRegions, _hardClip)
 
 
 # These tests actually use the filesystem to read files. That's due to the API
@@ -28,6 +33,163 @@ def dataFile(data):
     unlink(filename)
 
 
+@contextmanager
+def indexedBAMFile(data):
+    """
+    Create a context manager to store SAM data in a temporary sorted and
+    indexed BAM file and later remove it.
+    """
+    dirname = mkdtemp()
+    try:
+        samFilename = join(dirname, 'data.sam')
+        bamFilename = join(dirname, 'data.bam')
+        with open(samFilename, 'w') as fp:
+            fp.write(data + '\n')
+        pysam.sort('-o', bamFilename, samFilename)
+        pysam.index(bamFilename)
+        yield bamFilename
+    finally:
+        rmtree(dirname)
+
+
+# SAM data with two references, used to test the reading of regions of an
+# indexed BAM file.
+REGION_DATA = '\n'.join([
+    '@SQ SN:ref1 LN:20',
+    '@SQ SN:ref2 LN:10',
+    'query1 0 ref1 1 60 6M * 0 0 TCTAGG ZZZZZZ',
+    'query2 0 ref1 3 60 4M * 0 0 TAGG ZZZZ',
+    'query3 0 ref1 7 60 10M * 0 0 AAAAACCCCC ZZZZZZZZZZ',
+    'query3 256 ref1 12 60 2H3M * 0 0 * *',
+    'query4 0 ref1 18 60 5M * 0 0 GGGGG ZZZZZ',
+    'query5 0 ref2 2 60 3M * 0 0 TTT ZZZ',
+    'query6 4 ref2 2 0 * * 0 0 ACGT ZZZZ',
+]).replace(' ', '\t')
+
+
+class TestSAMRegions(TestCase):
+    """
+    Test the samIsIndexed, samRegions, regionAlignments, and mapSAMRegions
+    functions.
+    """
+    def testSAMIsNotIndexed(self):
+        """
+        A SAM file must not be considered to have an index.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref LN:10',
+            'query1 0 ref 1 60 6M * 0 0 TCTAGG ZZZZZZ',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            self.assertFalse(samIsIndexed(filename))
+
+    def testBAMIsIndexed(self):
+        """
+        An indexed BAM file must be considered to have an index.
+        """
+        with indexedBAMFile(REGION_DATA) as filename:
+            self.assertTrue(samIsIndexed(filename))
+
+    def testRegions(self):
+        """
+        The references must be divided into regions of the right size, with
+        the last region of each reference having a C{None} end.
+        """
+        with indexedBAMFile(REGION_DATA) as filename:
+            self.assertEqual(
+                [('ref1', 0, 8), ('ref1', 8, 16), ('ref1', 16, None),
+                 ('ref2', 0, 8), ('ref2', 8, None)],
+                samRegions(filename, 8))
+
+    def testRegionsLargeSize(self):
+        """
+        If the region size is bigger than the references, there must be one
+        region per reference.
+        """
+        with indexedBAMFile(REGION_DATA) as filename:
+            self.assertEqual(
+                [('ref1', 0, None), ('ref2', 0, None)],
+                samRegions(filename, 100))
+
+    def testRegionAlignments(self):
+        """
+        Each alignment must be returned in exactly one region, which is the
+        region in which it starts.
+        """
+        with indexedBAMFile(REGION_DATA) as filename:
+            with pysam.AlignmentFile(filename) as sam:
+                self.assertEqual(
+                    [
+                        ['query1', 'query2', 'query3'],
+                        ['query3'],
+                        ['query4'],
+                        ['query5', 'query6'],
+                        [],
+                    ],
+                    [[alignment.query_name
+                      for alignment in regionAlignments(sam, region)]
+                     for region in samRegions(sam, 8)])
+
+    def testRegionAlignmentsNoRegion(self):
+        """
+        If no region is given, all alignments must be returned.
+        """
+        with indexedBAMFile(REGION_DATA) as filename:
+            with pysam.AlignmentFile(filename) as sam:
+                self.assertEqual(
+                    ['query1', 'query2', 'query3', 'query3', 'query4',
+                     'query5', 'query6'],
+                    [alignment.query_name
+                     for alignment in regionAlignments(sam, None)])
+
+    def testMapSerial(self):
+        """
+        If no workers are given, the function must be called once, with a
+        C{None} region.
+        """
+        def function(sam, region):
+            return region, len(list(regionAlignments(sam, region)))
+
+        with indexedBAMFile(REGION_DATA) as filename:
+            self.assertEqual(
+                [(None, 7)], list(mapSAMRegions(filename, function)))
+
+    def testMapUnindexed(self):
+        """
+        If workers are given but the file has no index, the function must be
+        called once, with a C{None} region.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref LN:10',
+            'query1 0 ref 1 60 6M * 0 0 TCTAGG ZZZZZZ',
+        ]).replace(' ', '\t')
+
+        def function(sam, region):
+            return region, len(list(regionAlignments(sam, region)))
+
+        with dataFile(data) as filename:
+            self.assertEqual(
+                [(None, 1)],
+                list(mapSAMRegions(filename, function, workers=2)))
+
+    def testMapWorkers(self):
+        """
+        If workers are given and the file is indexed, the function must be
+        called on each region, with the results returned in region order.
+        """
+        def function(sam, region):
+            return region, len(list(regionAlignments(sam, region)))
+
+        with indexedBAMFile(REGION_DATA) as filename:
+            self.assertEqual(
+                [(('ref1', 0, 8), 3), (('ref1', 8, 16), 1),
+                 (('ref1', 16, None), 1), (('ref2', 0, 8), 2),
+                 (('ref2', 8, None), 0)],
+                list(mapSAMRegions(filename, function, workers=2,
+                                   regionSize=8)))
+
+
 class TestSAMFilter(TestCase):
     """
     Test the SAMFilter class.
@@ -282,6 +444,697 @@ class TestSAMFilter(TestCase):
             self.assertEqual('TCTAGG', alignment.query_sequence)
             self.assertIsNone(alignment.query_qualities)
 
+    def testFilterQuery(self):
+        """
+        Filtering with a C{filterQuery} function must give the same result
+        as using a C{filterRead} function, whether or not the read filter
+        changes reads.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref LN:20',
+            'query1 0 ref 1 60 6M * 0 0 TCTAGG ZZZZZZ',
+            'query2 0 ref 1 60 4M * 0 0 TAGG ZZZZ',
+            'query3 0 ref 2 60 6M * 0 0 TCTAGG ZZZZZZ',
+            'query1 256 ref 5 60 2H4M * 0 0 * *',
+            'other4 0 ref 3 60 8M * 0 0 NNNNAGGC ZZZZZZZZ',
+            'query5 4 * 0 0 * * 0 0 ACGTACGT ZZZZZZZZ',
+        ]).replace(' ', '\t')
+
+        filters = (
+            {},
+            {'minLength': 5},
+            {'maxLength': 4},
+            {'minLength': 5, 'maxLength': 6},
+            {'maxNFraction': 0.4},
+            {'titleRegex': '^query'},
+            {'negativeTitleRegex': '2'},
+            {'truncateTitlesAfter': 'ry'},
+            {'removeDuplicates': True},
+            {'removeDuplicatesById': True},
+            {'removeDuplicatesById': True, 'removeDuplicatesUseMD5': True},
+            {'head': 3},
+            {'removeSequences': {1, 4}},
+            {'removeDescriptions': True, 'removeDuplicates': True},
+            {'idLambda': 'lambda id: None if id == "query3" else id'},
+            {'removeGaps': True, 'minLength': 5},
+        )
+
+        with dataFile(data) as filename:
+            for kwargs in filters:
+                reads = Reads().filter(**kwargs)
+                expected = [
+                    alignment.to_string() for alignment in
+                    SAMFilter(filename,
+                              filterRead=reads.filterRead).alignments()]
+                reads = Reads().filter(**kwargs)
+                sf = SAMFilter(filename, filterQuery=reads.filterAlignment)
+                self.assertEqual(
+                    expected,
+                    [alignment.to_string() for alignment in sf.alignments()])
+
+    def testFilterQueryTwoFilters(self):
+        """
+        If a read filter that changes reads is followed by another, the
+        second filter must see the changed reads.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref LN:20',
+            'query1 0 ref 1 60 6M * 0 0 TCTAGG ZZZZZZ',
+            'query2 0 ref 1 60 4M * 0 0 TAGG ZZZZ',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            reads = Reads().filter(
+                idLambda='lambda id: id.replace("1", "X")').filter(
+                    titleRegex='X')
+            (alignment,) = list(
+                SAMFilter(filename,
+                          filterQuery=reads.filterAlignment).alignments())
+            self.assertEqual('query1', alignment.query_name)
+
+    def testWorkers(self):
+        """
+        Using worker processes to filter regions of an indexed BAM file must
+        give the same result as filtering it in one process, including when
+        an alignment with no query sequence is the first in its region.
+        """
+        with indexedBAMFile(REGION_DATA) as filename:
+            sf = SAMFilter(filename, storeQueryIds=True, dropUnmapped=True)
+            expected = [alignment.to_string()
+                        for alignment in sf.alignments()]
+
+            for regionSize in 4, 8, 11, None:
+                sf2 = SAMFilter(filename, storeQueryIds=True,
+                                dropUnmapped=True, workers=2,
+                                regionSize=regionSize)
+                self.assertEqual(
+                    expected,
+                    [alignment.to_string() for alignment in sf2.alignments()])
+                self.assertEqual(sf.alignmentCount, sf2.alignmentCount)
+                self.assertEqual(sf.queryIds, sf2.queryIds)
+
+    def testWorkersStatefulQueryFilter(self):
+        """
+        Using worker processes with a stateful query filter (such as --head
+        or --removeDuplicatesById) must give the same result as filtering in
+        one process.
+        """
+        lines = ['@SQ SN:ref1 LN:100', '@SQ SN:ref2 LN:100']
+        for index in range(60):
+            flag = 256 if index % 7 == 3 else 0
+            lines.append('query%d %d ref%d %d 60 4M * 0 0 ACGT ZZZZ' % (
+                index % 13, flag, index % 2 + 1, index + 1))
+        data = '\n'.join(lines).replace(' ', '\t')
+
+        with indexedBAMFile(data) as filename:
+            for kwargs in ({'head': 10}, {'removeDuplicatesById': True},
+                           {'head': 25, 'removeDuplicatesById': True}):
+                results = []
+                for workers in None, 2, 4:
+                    reads = Reads().filter(**kwargs)
+                    self.assertTrue(reads.stateful)
+                    sf = SAMFilter(filename, filterQuery=reads.filterAlignment,
+                                   dropSecondary=True, workers=workers,
+                                   regionSize=7)
+                    results.append([alignment.to_string()
+                                    for alignment in sf.alignments()])
+                self.assertEqual(results[0], results[1])
+                self.assertEqual(results[0], results[2])
+
+    def testWorkersStatelessQueryFilter(self):
+        """
+        Using worker processes with a stateless query filter must give the
+        same result as filtering in one process.
+        """
+        with indexedBAMFile(REGION_DATA) as filename:
+            reads = Reads().filter(minLength=5)
+            self.assertFalse(reads.stateful)
+            expected = [alignment.to_string() for alignment in SAMFilter(
+                filename, filterQuery=reads.filterAlignment).alignments()]
+            sf = SAMFilter(filename, filterQuery=reads.filterAlignment,
+                           workers=2, regionSize=4)
+            self.assertEqual(expected, [alignment.to_string()
+                                        for alignment in sf.alignments()])
+
+    def testWorkersSecondaryWithNoPreviousSequence(self):
+        """
+        When using worker processes, if the first alignment of a file has no
+        query sequence an InvalidSAM must be raised.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref LN:10',
+            'query1 256 ref 1 60 2M * 0 0 * *',
+            'query1 0 ref 3 60 6M * 0 0 TCTAGG ZZZZZZ',
+        ]).replace(' ', '\t')
+
+        with indexedBAMFile(data) as filename:
+            sf = SAMFilter(filename, workers=2, regionSize=2)
+            error = ('^pysam produced an alignment \\(number 1\\) with no '
+                     'query sequence without previously giving an alignment '
+                     'with a sequence\\.$')
+            assertRaisesRegex(self, InvalidSAM, error, list, sf.alignments())
+
+
+class TestSAMBaseCounts(TestCase):
+    """
+    Test the SAMBaseCounts class.
+    """
+    def testNoAlignments(self):
+        """
+        If there are no alignments, all counts must be zero.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref LN:10',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            bc = SAMBaseCounts(SAMFilter(filename))
+            self.assertEqual({'ref': 10}, bc.referenceLengths)
+            self.assertEqual((10, 6), bc.counts['ref'].shape)
+            self.assertEqual(0, bc.counts['ref'].sum())
+
+    def testMatches(self):
+        """
+        Nucleotides of matching queries must be counted at the right sites.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref LN:10',
+            'query1 0 ref 2 60 4M * 0 0 TCTA ZZZZ',
+            'query2 0 ref 3 60 2=1X * 0 0 CTN ZZZ',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            bc = SAMBaseCounts(SAMFilter(filename))
+            self.assertEqual([0, 1, 2, 2, 2, 0, 0, 0, 0, 0],
+                             list(bc.depth('ref')))
+            self.assertEqual({'C': 2}, bc.baseCounts('ref', 2))
+            self.assertEqual({'A': 1, 'N': 1}, bc.baseCounts('ref', 4))
+            self.assertEqual({}, bc.baseCounts('ref', 0))
+
+    def testCigarOperations(self):
+        """
+        Soft clips and insertions must not be counted, deletions must be
+        counted as gaps, and reference skips must not be counted.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref LN:12',
+            'query1 0 ref 2 60 2S2M1I1M2D1M2N1M * 0 0 GGACTTGA ZZZZZZZZ',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            bc = SAMBaseCounts(SAMFilter(filename))
+            self.assertEqual([0, 1, 1, 1, 0, 0, 1, 0, 0, 1, 0, 0],
+                             list(bc.depth('ref')))
+            self.assertEqual([0, 1, 1, 1, 1, 1, 1, 0, 0, 1, 0, 0],
+                             list(bc.depth('ref', includeDeletions=True)))
+            self.assertEqual({'A': 1}, bc.baseCounts('ref', 1))
+            self.assertEqual({'C': 1}, bc.baseCounts('ref', 2))
+            self.assertEqual({'T': 1}, bc.baseCounts('ref', 3))
+            self.assertEqual({'G': 1}, bc.baseCounts('ref', 6))
+            self.assertEqual({'A': 1}, bc.baseCounts('ref', 9))
+
+    def testPastReferenceEnd(self):
+        """
+        Nucleotides aligned beyond the end of the reference must be ignored.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref LN:4',
+            'query1 0 ref 3 60 4M * 0 0 TCTA ZZZZ',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            bc = SAMBaseCounts(SAMFilter(filename))
+            self.assertEqual([0, 0, 1, 1], list(bc.depth('ref')))
+
+    def testMultipleReferences(self):
+        """
+        Counts for multiple references must be kept separately.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref1 LN:4',
+            '@SQ SN:ref2 LN:3',
+            'query1 0 ref1 1 60 4M * 0 0 TCTA ZZZZ',
+            'query2 0 ref2 1 60 3M * 0 0 GGG ZZZ',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            bc = SAMBaseCounts(SAMFilter(filename), storeQueryIds=True)
+            self.assertEqual([1, 1, 1, 1], list(bc.depth('ref1')))
+            self.assertEqual([1, 1, 1], list(bc.depth('ref2')))
+            self.assertEqual({'G': 1}, bc.baseCounts('ref2', 0))
+            self.assertEqual({'ref1': {'query1'}, 'ref2': {'query2'}},
+                             bc.queryIds)
+
+    def testReferenceIds(self):
+        """
+        If the SAM filter is restricted to a reference, only that reference
+        must be counted.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref1 LN:4',
+            '@SQ SN:ref2 LN:3',
+            'query1 0 ref1 1 60 4M * 0 0 TCTA ZZZZ',
+            'query2 0 ref2 1 60 3M * 0 0 GGG ZZZ',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            bc = SAMBaseCounts(SAMFilter(filename, referenceIds={'ref2'}))
+            self.assertEqual(['ref2'], list(bc.counts))
+            self.assertEqual([1, 1, 1], list(bc.depth('ref2')))
+
+    def testFiltering(self):
+        """
+        Alignments that do not pass the SAM filter must not be counted, and
+        unmapped queries must never be counted.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref LN:10',
+            'query1 0 ref 1 60 4M * 0 0 TCTA ZZZZ',
+            'query1 256 ref 5 60 2M2H * 0 0 * *',
+            'query2 4 * 0 0 * * 0 0 GGG ZZZ',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            bc = SAMBaseCounts(SAMFilter(filename))
+            self.assertEqual([1, 1, 1, 1, 1, 1, 0, 0, 0, 0],
+                             list(bc.depth('ref')))
+            self.assertEqual({'T': 1}, bc.baseCounts('ref', 4))
+
+            bc = SAMBaseCounts(SAMFilter(filename, dropSecondary=True))
+            self.assertEqual([1, 1, 1, 1, 0, 0, 0, 0, 0, 0],
+                             list(bc.depth('ref')))
+
+    def testMinBaseQuality(self):
+        """
+        Nucleotides with a quality less than the minimum must not be
+        counted, unless the query has no quality.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref LN:4',
+            'query1 0 ref 1 60 4M * 0 0 TCTA !!ZZ',
+            'query2 0 ref 1 60 4M * 0 0 TCTA *',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            bc = SAMBaseCounts(SAMFilter(filename), minBaseQuality=13)
+            self.assertEqual([1, 1, 2, 2], list(bc.depth('ref')))
+
+    def testBatches(self):
+        """
+        Counting in small batches must give the same result as counting in
+        one batch.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref LN:10',
+            'query1 0 ref 1 60 4M * 0 0 TCTA ZZZZ',
+            'query2 0 ref 3 60 2M1D2M * 0 0 CTGG ZZZZ',
+            'query3 4 * 0 0 * * 0 0 GGG ZZZ',
+            'query4 0 ref 2 60 5M * 0 0 ACGTA ZZZZZ',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            expected = SAMBaseCounts(SAMFilter(filename)).counts['ref']
+            for batchSize in 1, 2, 3:
+                bc = SAMBaseCounts(SAMFilter(filename), batchSize=batchSize)
+                self.assertEqual(expected.tolist(), bc.counts['ref'].tolist())
+
+    def testIgnoreOrphans(self):
+        """
+        Paired reads that are not in a proper pair must only be counted if
+        orphans are not ignored.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref LN:6',
+            'query1 0 ref 1 60 4M * 0 0 TCTA ZZZZ',
+            'query2 1 ref 3 60 4M * 0 0 TAGG ZZZZ',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            bc = SAMBaseCounts(SAMFilter(filename), storeQueryIds=True)
+            self.assertEqual([1, 1, 2, 2, 1, 1], list(bc.depth('ref')))
+            self.assertEqual({'ref': {'query1', 'query2'}}, bc.queryIds)
+
+            bc = SAMBaseCounts(SAMFilter(filename), storeQueryIds=True,
+                               ignoreOrphans=True)
+            self.assertEqual([1, 1, 1, 1, 0, 0], list(bc.depth('ref')))
+            self.assertEqual([0, 1, 2, 3], list(bc.coveredSites('ref')))
+            self.assertEqual({'ref': {'query1'}}, bc.queryIds)
+
+    def testCoveredSitesWithLowQualityBases(self):
+        """
+        Sites covered only by bases below the minimum quality must have a
+        zero depth but still be covered, and queries with no counted bases
+        must not be stored.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref LN:8',
+            'query1 0 ref 1 60 4M * 0 0 TCTA ZZ!!',
+            'query2 0 ref 6 60 2M * 0 0 TA !!',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            bc = SAMBaseCounts(SAMFilter(filename), storeQueryIds=True,
+                               minBaseQuality=13)
+            self.assertEqual([1, 1, 0, 0, 0, 0, 0, 0], list(bc.depth('ref')))
+            self.assertEqual([0, 1, 2, 3, 5, 6],
+                             list(bc.coveredSites('ref')))
+            self.assertEqual({'ref': {'query1'}}, bc.queryIds)
+
+    def testIgnoreOverlaps(self):
+        """
+        If overlaps are ignored, the bases of overlapping mates must only be
+        counted once when a minimum base quality is given.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref LN:6',
+            'query1 99 ref 1 60 4M = 3 6 TCTA 5555',
+            'query1 147 ref 3 60 4M = 1 -6 TAGG 5555',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            bc = SAMBaseCounts(SAMFilter(filename), minBaseQuality=13)
+            self.assertEqual([1, 1, 2, 2, 1, 1], list(bc.depth('ref')))
+
+            bc = SAMBaseCounts(SAMFilter(filename), minBaseQuality=13,
+                               ignoreOverlaps=True)
+            self.assertEqual([1, 1, 1, 1, 1, 1], list(bc.depth('ref')))
+            self.assertEqual({'T': 1}, bc.baseCounts('ref', 2))
+
+    def testIgnoreOverlapsWithIndelsMatchesPileup(self):
+        """
+        If overlaps are ignored, the nucleotides counted for overlapping
+        mates with deletions, reference skips, and insertions must be those
+        counted by a pysam pileup, including the bases of one mate that are
+        aligned to a deletion in the other.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref LN:40',
+            # The first query1 mate keeps the combined quality where the
+            # mates agree. The second mate has a deletion.
+            'query1 99 ref 1 60 12M = 5 16 ACGTACGTACGT 555555511555',
+            'query1 147 ref 5 60 3M2D7M = 1 -16 ACGCGTACGT +++++++++5',
+            # The second query2 mate keeps the combined quality. The first
+            # mate has a deletion and the second a skip and an insertion.
+            'query2 99 ref 11 60 4M3D8M = 13 18 TACGACGTACGT 555+55555555',
+            'query2 147 ref 13 60 3M2N3M1I4M = 11 -18 CGTCGTAACGT '
+            '++1+5+5++++',
+        ]).replace(' ', '\t')
+
+        with indexedBAMFile(data) as filename:
+            bc = SAMBaseCounts(SAMFilter(filename), minBaseQuality=13,
+                               ignoreOverlaps=True)
+            with pysam.AlignmentFile(filename) as sam:
+                columnCount = 0
+                for column in sam.pileup():
+                    columnCount += 1
+                    expected = {}
+                    for read in column.pileups:
+                        if not (read.is_del or read.is_refskip):
+                            alignment = read.alignment
+                            offset = read.query_position
+                            if alignment.query_qualities[offset] >= 13:
+                                base = alignment.query_sequence[offset]
+                                expected[base] = expected.get(base, 0) + 1
+                    counts = bc.baseCounts('ref', column.reference_pos)
+                    self.assertEqual(expected, counts)
+                self.assertEqual(25, columnCount)
+
+            # The bases aligned to a deletion in the other mate are not
+            # counted (their quality of 16 is reduced to 12).
+            self.assertEqual({}, bc.baseCounts('ref', 7))
+            self.assertEqual({}, bc.baseCounts('ref', 8))
+            self.assertEqual({}, bc.baseCounts('ref', 14))
+
+
+class TestSAMStats(TestCase):
+    """
+    Test the SAMStats class.
+    """
+    DATA = '\n'.join([
+        '@SQ SN:ref1 LN:10',
+        '@SQ SN:ref2 LN:10',
+        '@SQ SN:ref3 LN:10',
+        'query1 0 ref1 1 60 4M * 0 0 TCTA ZZZZ',
+        'query1 256 ref2 3 60 4M * 0 0 TCTA ZZZZ',
+        'query2 1024 ref1 3 60 2M1D2M * 0 0 TAGG ZZZZ',
+        'query3 4 * 0 0 * * 0 0 TAGG ZZZZ',
+    ]).replace(' ', '\t')
+
+    def testCounts(self):
+        """
+        The read counts must be as expected.
+        """
+        with dataFile(self.DATA) as filename:
+            stats = SAMStats(SAMFilter(filename), useCache=False)
+            self.assertIsNone(stats.cacheFilename)
+            self.assertEqual({'ref1': 10, 'ref2': 10, 'ref3': 10},
+                             stats.referenceLengths)
+            self.assertEqual(3, stats.readCount)
+            self.assertEqual(2, stats.mappedCount)
+            self.assertEqual(1, stats.unmappedCount)
+            self.assertEqual(
+                {
+                    'ref1': {
+                        'readIds': 2,
+                        'primary': 2,
+                        'secondary': 0,
+                        'supplementary': 0,
+                        'duplicate': 1,
+                        'nonDuplicate': 1,
+                        'qcFail': 0,
+                    },
+                    'ref2': {
+                        'readIds': 1,
+                        'primary': 0,
+                        'secondary': 1,
+                        'supplementary': 0,
+                        'duplicate': 0,
+                        'nonDuplicate': 1,
+                        'qcFail': 0,
+                    },
+                },
+                stats.referenceReadCounts)
+            self.assertEqual(['query1', 'query2'],
+                             stats.readIds(stats.readIndices('ref1')))
+            self.assertEqual([], stats.readIds(stats.readIndices('ref3')))
+
+    def testDepth(self):
+        """
+        Secondary and duplicate alignments must not count towards the
+        depth, and the depths of sites only covered by a deletion must be
+        zero.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref1 LN:10',
+            'query1 0 ref1 1 60 4M * 0 0 TCTA ZZZZ',
+            'query2 0 ref1 3 60 2M1D2M * 0 0 TAGG ZZZZ',
+            'query3 256 ref1 1 60 4M * 0 0 TCTA ZZZZ',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            stats = SAMStats(SAMFilter(filename), useCache=False)
+            self.assertEqual([0, 1, 1, 1, 1, 2, 2],
+                             list(stats.depths('ref1')))
+            self.assertEqual({'ref1': 2}, stats.coveringReadCounts)
+
+    def testDepthLowQualitySites(self):
+        """
+        Sites covered only by bases below the minimum base quality must be
+        given a zero depth, and orphan reads must be ignored if requested.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref1 LN:10',
+            'query1 0 ref1 1 60 4M * 0 0 TCTA ZZ!!',
+            'query2 1 ref1 7 60 2M * 0 0 TA ZZ',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            stats = SAMStats(SAMFilter(filename), minBaseQuality=13,
+                             ignoreOrphans=True, useCache=False)
+            self.assertEqual([0, 0, 1, 1], list(stats.depths('ref1')))
+            self.assertEqual({'ref1': 1}, stats.coveringReadCounts)
+
+    def testCache(self):
+        """
+        Statistics must be written to a cache file and read from it when
+        they are next wanted.
+        """
+        with indexedBAMFile(self.DATA) as filename:
+            stats = SAMStats(SAMFilter(filename))
+            self.assertFalse(stats.fromCache)
+            self.assertTrue(exists(stats.cacheFilename))
+
+            cached = SAMStats(SAMFilter(filename))
+            self.assertTrue(cached.fromCache)
+            self.assertEqual(stats.cacheFilename, cached.cacheFilename)
+            self.assertEqual(stats.referenceLengths, cached.referenceLengths)
+            self.assertEqual(stats.readCount, cached.readCount)
+            self.assertEqual(stats.mappedCount, cached.mappedCount)
+            self.assertEqual(stats.unmappedCount, cached.unmappedCount)
+            self.assertEqual(stats.referenceReadCounts,
+                             cached.referenceReadCounts)
+            self.assertEqual(stats.coveringReadCounts,
+                             cached.coveringReadCounts)
+            self.assertEqual(['query1', 'query2'],
+                             cached.readIds(cached.readIndices('ref1')))
+            for referenceId in 'ref1', 'ref2', 'ref3':
+                self.assertEqual(list(stats.depths(referenceId)),
+                                 list(cached.depths(referenceId)))
+
+    def testCacheFilterOptions(self):
+        """
+        Statistics computed with different filtering options must be
+        cached separately.
+        """
+        with indexedBAMFile(self.DATA) as filename:
+            stats = SAMStats(SAMFilter(filename))
+            dropped = SAMStats(SAMFilter(filename, dropDuplicates=True))
+            self.assertFalse(dropped.fromCache)
+            self.assertNotEqual(stats.cacheFilename, dropped.cacheFilename)
+            self.assertEqual(1, dropped.referenceReadCounts['ref1']['readIds'])
+            self.assertTrue(SAMStats(SAMFilter(filename)).fromCache)
+
+    def testWorkers(self):
+        """
+        Statistics computed with worker processes must be the same as those
+        computed without, and so share their cache.
+        """
+        with indexedBAMFile(self.DATA) as filename:
+            stats = SAMStats(SAMFilter(filename))
+            for regionSize in 3, 5:
+                workers = SAMStats(
+                    SAMFilter(filename, workers=2, regionSize=regionSize),
+                    useCache=False)
+                self.assertEqual(stats.referenceReadCounts,
+                                 workers.referenceReadCounts)
+                self.assertEqual(stats.coveringReadCounts,
+                                 workers.coveringReadCounts)
+                for referenceId in 'ref1', 'ref2', 'ref3':
+                    self.assertEqual(list(stats.depths(referenceId)),
+                                     list(workers.depths(referenceId)))
+            cached = SAMStats(SAMFilter(filename, workers=2, regionSize=5))
+            self.assertTrue(cached.fromCache)
+            self.assertEqual(stats.cacheFilename, cached.cacheFilename)
+
+    def testCacheModifiedFile(self):
+        """
+        The cache must not be used if the SAM/BAM file has been modified.
+        """
+        with indexedBAMFile(self.DATA) as filename:
+            SAMStats(SAMFilter(filename))
+            utime(filename, (0, 0))
+            self.assertFalse(SAMStats(SAMFilter(filename)).fromCache)
+            self.assertTrue(SAMStats(SAMFilter(filename)).fromCache)
+
+    def testFilterQueryWithoutKeyIsNotCached(self):
+        """
+        If a query filter is used but no key describing it is given, the
+        statistics must not be cached.
+        """
+        reads = Reads().filter(minLength=5)
+        with indexedBAMFile(self.DATA) as filename:
+            samFilter = SAMFilter(filename, filterQuery=reads.filterAlignment)
+            stats = SAMStats(samFilter)
+            self.assertIsNone(stats.cacheFilename)
+            self.assertEqual(0, stats.mappedCount)
+
+            stats = SAMStats(samFilter, filterKey='minLength=5')
+            self.assertTrue(exists(stats.cacheFilename))
+
+
+class TestSAMWriter(TestCase):
+    """
+    Test the SAMWriter class.
+    """
+    def testUnknownFormat(self):
+        """
+        An unknown output format must result in a ValueError.
+        """
+        error = r"^Unknown SAM output format 'xxx'\. Known formats are: "
+        assertRaisesRegex(self, ValueError, error, SAMWriter, 'out', 'in',
+                          format_='xxx')
+
+    def testIndexSAM(self):
+        """
+        Asking for SAM output to be indexed must result in a ValueError.
+        """
+        error = r'^Only BAM or CRAM output written to a file can be indexed\.$'
+        assertRaisesRegex(self, ValueError, error, SAMWriter, 'out', 'in',
+                          index=True)
+
+    def testIndexStandardOutput(self):
+        """
+        Asking for BAM written to standard output to be indexed must result
+        in a ValueError.
+        """
+        error = r'^Only BAM or CRAM output written to a file can be indexed\.$'
+        assertRaisesRegex(self, ValueError, error, SAMWriter, '-', 'in',
+                          format_='bam', index=True)
+
+    def testWriteBAM(self):
+        """
+        Filtered alignments must be written to a BAM file, which must be
+        indexed if requested.
+        """
+        with indexedBAMFile(REGION_DATA) as filename:
+            outFilename = join(dirname(filename), 'out.bam')
+            samFilter = SAMFilter(filename, referenceIds={'ref1'},
+                                  dropSecondary=True)
+            with SAMWriter(outFilename, filename, format_='bam', threads=2,
+                           index=True) as writer:
+                self.assertEqual(
+                    4, writer.writeAlignments(samFilter.alignments()))
+            self.assertTrue(exists(outFilename + '.bai'))
+            self.assertTrue(samIsIndexed(outFilename))
+            self.assertEqual(
+                ['query1', 'query2', 'query3', 'query4'],
+                [alignment.query_name for alignment in
+                 SAMFilter(outFilename).alignments()])
+
+    def testNoIndexAfterException(self):
+        """
+        If an exception is raised while writing, the output file must not
+        be indexed and the exception must not be suppressed.
+        """
+        with indexedBAMFile(REGION_DATA) as filename:
+            outFilename = join(dirname(filename), 'out.bam')
+            samFilter = SAMFilter(filename, referenceIds={'ref1'},
+                                  dropSecondary=True)
+            with self.assertRaises(ZeroDivisionError):
+                with SAMWriter(outFilename, filename, format_='bam',
+                               index=True) as writer:
+                    writer.writeAlignments(samFilter.alignments())
+                    1 / 0
+            self.assertTrue(exists(outFilename))
+            self.assertFalse(exists(outFilename + '.bai'))
+
+    def testWriteCRAM(self):
+        """
+        Alignments must be written to a CRAM file.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref1 LN:10',
+            'query1 0 ref1 2 60 4M * 0 0 TCTA ZZZZ',
+            'query2 0 ref1 3 60 4M * 0 0 CTAG ZZZZ',
+        ]).replace(' ', '\t')
+
+        with indexedBAMFile(data) as filename:
+            directory = dirname(filename)
+            fastaFilename = join(directory, 'ref.fasta')
+            with open(fastaFilename, 'w') as fp:
+                fp.write('>ref1\nATCTAGGGGG\n')
+            outFilename = join(directory, 'out.cram')
+            with SAMWriter(outFilename, filename, format_='cram',
+                           referenceFilename=fastaFilename) as writer:
+                for alignment in SAMFilter(filename).alignments():
+                    writer.write(alignment)
+                self.assertEqual(2, writer.count)
+            with pysam.AlignmentFile(
+                    outFilename, reference_filename=fastaFilename) as sam:
+                self.assertEqual(
+                    ['TCTA', 'CTAG'],
+                    [alignment.query_sequence for alignment in sam])
+
 
 class TestPaddedSAM(TestCase):
     """
@@ -395,6 +1248,37 @@ class TestPaddedSAM(TestCase):
             (read,) = list(ps.queries())
             self.assertEqual(Read('query1', '-TCTAGG---', '!ZZZZZZ!!!'), read)
 
+    def testUnknownQuality(self):
+        """
+        A query with no quality string must be given a quality string made
+        of the unknown quality character.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref1 LN:10',
+            'query1 0 ref1 2 60 6M * 0 0 TCTAGG *',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            ps = PaddedSAM(SAMFilter(filename))
+            (read,) = list(ps.queries(unknownQualityChar='?'))
+            self.assertEqual(Read('query1', '-TCTAGG---', '??????????'), read)
+
+    def testSoftClipRightAfterMatchPastReferenceEnd(self):
+        """
+        If a match already extends beyond the end of the reference, a
+        following right soft clip must not add anything to the query.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref1 LN:10',
+            'query1 0 ref1 10 60 2M3D2M8S * 0 0 TCTAGGCCAATT 123456789012',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            ps = PaddedSAM(SAMFilter(filename))
+            (read,) = list(ps.queries())
+            self.assertEqual(Read('query1', '---------TCNNNTA',
+                                  '!!!!!!!!!12!!!34'), read)
+
     def testRcNeeded(self):
         """
         A reverse-complemented match (flag = 16) when rcNeeded=True is passed
@@ -611,6 +1495,76 @@ class TestPaddedSAM(TestCase):
                 },
                 ps.referenceInsertions)
 
+    def testReferenceInsertionsStreaming(self):
+        """
+        In streaming mode, reference insertions must be available from the
+        insertions and insertionCounts methods, and referenceInsertions must
+        be C{None}.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref1 LN:10',
+            'query1 0 ref1 2 60 2M2I2M * 0 0 TCTAGG ZZZZZZ',
+            'query1 256 ref1 4 60 2M3I1M * 0 0 * *',
+            'query2 0 ref1 2 60 2M2I2M * 0 0 TCTAGG ZZZZZZ',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            ps = PaddedSAM(SAMFilter(filename), streaming=True)
+            (read1, read2, read3) = list(ps.queries())
+            self.assertEqual(Read('query1/1', '---TCG----', '!!!ZZZ!!!!'),
+                             read2)
+            self.assertIsNone(ps.referenceInsertions)
+            self.assertEqual(
+                [
+                    (3, 'query1', 'TA'),
+                    (3, 'query2', 'TA'),
+                    (5, 'query1/1', 'TAG'),
+                ],
+                list(ps.insertions()))
+            self.assertEqual({3: {'TA': 2}, 5: {'TAG': 1}},
+                             ps.insertionCounts())
+            ps.close()
+
+    def testInsertionCounts(self):
+        """
+        The insertionCounts method must count the nucleotides inserted at
+        each offset when not in streaming mode.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref1 LN:10',
+            'query1 0 ref1 2 60 2M2I2M * 0 0 TCTAGG ZZZZZZ',
+            'query2 0 ref1 2 60 2M2I2M * 0 0 TCGAGG ZZZZZZ',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            ps = PaddedSAM(SAMFilter(filename))
+            list(ps.queries())
+            self.assertEqual({3: {'TA': 1, 'GA': 1}}, ps.insertionCounts())
+
+    def testStreamingDuplicateIds(self):
+        """
+        In streaming mode, duplicate query ids must be numbered correctly
+        even when more ids are seen than are kept in memory.
+        """
+        data = '\n'.join([
+            '@SQ SN:ref1 LN:10',
+            'query1 0 ref1 2 60 2M * 0 0 TC ZZ',
+            'query2 0 ref1 2 60 2M * 0 0 TC ZZ',
+            'query3 0 ref1 2 60 2M * 0 0 TC ZZ',
+            'query1 256 ref1 2 60 2M * 0 0 TC ZZ',
+            'query4 0 ref1 2 60 2M * 0 0 TC ZZ',
+            'query1 256 ref1 2 60 2M * 0 0 TC ZZ',
+            'query2 256 ref1 2 60 2M * 0 0 TC ZZ',
+        ]).replace(' ', '\t')
+
+        with dataFile(data) as filename:
+            ps = PaddedSAM(SAMFilter(filename), streaming=True, maxIds=2)
+            self.assertEqual(
+                ['query1', 'query2', 'query3', 'query1/1', 'query4',
+                 'query1/2', 'query2/1'],
+                [read.id for read in ps.queries()])
+            ps.close()
+
     def testReferenceDeletion(self):
         """
         An deletion of reference bases must result in the expected padded
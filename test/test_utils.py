@@ -3,8 +3,9 @@ import gzip
 from six.moves import builtins
 from unittest import TestCase
 from unittest.mock import mock_open
-from six import assertRaisesRegex
+from six import assertRaisesRegex, integer_types
 from collections import Counter
+from hashlib import md5
 
 try:
     from unittest.mock import patch
@@ -16,7 +17,35 @@ from io import BytesIO
 from dark.utils import (
     numericallySortFilenames, median, asHandle, parseRangeString,
     parseRangeExpression, pct, StringIO, baseCountsToStr, nucleotidesToStr,
-    countPrint, take)
+    countPrint, take, textChunks, stringHashFunction, orderedPoolMap)
+
+
+# The offset added to items by _addOffset in a worker process. Set by
+# _initOffsetWorker.
+_workerOffset = 0
+
+
+def _initOffsetWorker(offset):
+    """
+    Initialize a worker process for the orderedPoolMap tests.
+
+    @param offset: The C{int} offset for _addOffset to add.
+    """
+    global _workerOffset
+    _workerOffset = offset
+
+
+def _addOffset(n):
+    """
+    Add the worker offset to a number.
+
+    @param n: An C{int}.
+    @raise ValueError: If C{n} is negative.
+    @return: The C{int} sum of C{n} and the worker offset.
+    """
+    if n < 0:
+        raise ValueError('Negative: %d' % n)
+    return n + _workerOffset
 
 
 class TestNumericallySortFilenames(TestCase):
@@ -169,6 +198,86 @@ class TestAsHandle(TestCase):
                 self.assertEqual('xxx', fp.read())
 
 
+class TestTextChunks(TestCase):
+    """
+    Test the textChunks function.
+    """
+
+    def testEmpty(self):
+        """
+        An empty file must result in no chunks.
+        """
+        self.assertEqual([], list(textChunks(StringIO(''))))
+
+    def testText(self):
+        """
+        A file opened in text mode must be returned in chunks of the
+        requested size.
+        """
+        self.assertEqual(['abc', 'def', 'g'],
+                         list(textChunks(StringIO('abcdefg'), 3)))
+
+    def testBytes(self):
+        """
+        A file opened in binary mode must be returned as C{str} chunks.
+        """
+        self.assertEqual(['abc', 'def', 'g'],
+                         list(textChunks(BytesIO(b'abcdefg'), 3)))
+
+    def testMultiByteCharacterOnChunkBoundary(self):
+        """
+        A multi-byte UTF-8 character that is split across two reads must be
+        decoded correctly.
+        """
+        data = 'a\u00e9b'.encode('UTF-8')
+        self.assertEqual('a\u00e9b', ''.join(textChunks(BytesIO(data), 2)))
+
+
+class TestStringHashFunction(TestCase):
+    """
+    Test the stringHashFunction function.
+    """
+    def testUnknown(self):
+        """
+        An unknown hash function name must result in a ValueError.
+        """
+        error = ("^Unknown hash function 'xxx'. Known hash functions: md5, "
+                 "fast64, fast128\\.$")
+        assertRaisesRegex(self, ValueError, error, stringHashFunction, 'xxx')
+
+    def testCallable(self):
+        """
+        A function must be returned unchanged.
+        """
+        self.assertIs(len, stringHashFunction(len))
+
+    def testMD5(self):
+        """
+        The md5 hash function must return the MD5 digest of the string.
+        """
+        self.assertEqual(md5(b'ACGT').digest(),
+                         stringHashFunction('md5')('ACGT'))
+
+    def testEqualAndUnequal(self):
+        """
+        All hash functions must give equal values for equal strings and
+        (almost always) different values for different strings.
+        """
+        for name in 'md5', 'fast64', 'fast128':
+            hash_ = stringHashFunction(name)
+            self.assertEqual(hash_('ACGT'), hash_('ACG' + 'T'))
+            self.assertNotEqual(hash_('ACGT'), hash_('ACGA'))
+
+    def testFast128IsInt(self):
+        """
+        The fast128 hash function must return a 128-bit C{int}, whether or
+        not the xxhash module is installed.
+        """
+        value = stringHashFunction('fast128')('ACGT')
+        self.assertIsInstance(value, integer_types)
+        self.assertTrue(0 <= value < 1 << 128)
+
+
 class TestParseRangeString(TestCase):
     """
     Check that the parseRangeString function works as expected.
@@ -541,3 +650,79 @@ class TestTake(TestCase):
         """
         self.assertEqual([[0, 1, 2], [3, 4, 5], [6, 7, 8], [9, 10]],
                          list(take(range(11), 3)))
+
+
+class TestOrderedPoolMap(TestCase):
+    """
+    Test the orderedPoolMap function.
+    """
+    def testEmpty(self):
+        """
+        If no items are given, nothing must be yielded.
+        """
+        self.assertEqual([], list(orderedPoolMap(_addOffset, [], 2)))
+
+    def testOrder(self):
+        """
+        The items and their results must be yielded in the order of the
+        items.
+        """
+        self.assertEqual(
+            [(n, n) for n in range(50)],
+            list(orderedPoolMap(_addOffset, range(50), 3)))
+
+    def testInitializer(self):
+        """
+        The initializer must be called with the initargs in each worker
+        process.
+        """
+        self.assertEqual(
+            [(n, n + 10) for n in range(20)],
+            list(orderedPoolMap(_addOffset, range(20), 2,
+                                initializer=_initOffsetWorker,
+                                initargs=(10,))))
+
+    def testItemsTakenAsNeeded(self):
+        """
+        No more than C{inFlight} items may be taken from the input beyond
+        those whose results have been yielded.
+        """
+        taken = []
+
+        def items():
+            for n in range(100):
+                taken.append(n)
+                yield n
+
+        for count, (n, result) in enumerate(
+                orderedPoolMap(_addOffset, items(), 2, inFlight=3)):
+            self.assertTrue(len(taken) <= count + 3)
+        self.assertEqual(100, len(taken))
+
+    def testDefaultInFlight(self):
+        """
+        If C{inFlight} is not given, no more than twice the number of workers
+        items may be in flight.
+        """
+        taken = []
+
+        def items():
+            for n in range(100):
+                taken.append(n)
+                yield n
+
+        results = orderedPoolMap(_addOffset, items(), 3)
+        next(results)
+        self.assertEqual(6, len(taken))
+        results.close()
+
+    def testException(self):
+        """
+        An exception raised by the function in a worker process must be
+        raised when the result for its item is reached.
+        """
+        results = orderedPoolMap(_addOffset, [0, 1, -1, 3], 2)
+        self.assertEqual((0, 0), next(results))
+        self.assertEqual((1, 1), next(results))
+        error = 'Negative: -1'
+        assertRaisesRegex(self, ValueError, error, next, results)